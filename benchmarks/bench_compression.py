@@ -0,0 +1,83 @@
+"""
+Effective throughput of each compression codec and level over a link of a
+given speed (100 Mbit by default, like our branch offices).
+
+Blocks are compressed exactly as a transfer does (codecs.encode_block), and
+compression, the wire and decompression are assumed to overlap, so the
+effective rate is the file size over the slowest of the three stages. As in
+a real transfer, a codec whose sample of the data does not compress is
+skipped and the data goes out raw.
+
+    python -m benchmarks.bench_compression [size_mb] [link_mbit]
+"""
+
+import os
+import random
+import sys
+import time
+
+from benchmarks.common import MB, report
+from src.logic.codecs import BLOCK, BLOCK_SIZE, SAMPLE_SIZE, available_codecs, \
+    decode_block, encode_block, get_codec, worth_compressing
+
+LEVELS = {"zlib": (1, 6, 9), "lzma": (0, 1, 6)}
+
+
+def sample_data(kind, size):
+    rng = random.Random(1)
+    if kind == "random":
+        return os.urandom(size)
+    lines = []
+    total = 0
+    while total < size:
+        if kind == "log":
+            line = (f"2024-05-{rng.randint(1, 28):02d}T{rng.randint(0, 23):02d}:"
+                    f"{rng.randint(0, 59):02d}:{rng.randint(0, 59):02d} "
+                    f"{rng.choice(['INFO', 'WARN', 'ERROR'])} worker-{rng.randint(1, 16)} "
+                    f"request {rng.getrandbits(32):08x} took {rng.randint(1, 900)} ms\n")
+        else:
+            line = (f"{rng.randint(1, 10**6)},{rng.choice(['north', 'south', 'east'])},"
+                    f"{rng.random() * 1000:.2f},{rng.randint(0, 99)}\n")
+        lines.append(line)
+        total += len(line)
+    return "".join(lines).encode()[:size]
+
+
+def measure(codec, level, data):
+    """Return (wire bytes, compress seconds, decompress seconds)"""
+    blocks = []
+    start = time.perf_counter()
+    for i in range(0, len(data), BLOCK_SIZE):
+        blocks.append(encode_block(codec, level, data[i:i + BLOCK_SIZE]))
+    compress = time.perf_counter() - start
+    start = time.perf_counter()
+    for block in blocks:
+        kind, _ = BLOCK.unpack_from(block)
+        decode_block(codec, kind, block[BLOCK.size:])
+    decompress = time.perf_counter() - start
+    return sum(len(b) for b in blocks), compress, decompress
+
+
+def run(size_mb=32, link_mbit=100):
+    link = link_mbit * 1e6 / 8  # bytes per second
+    rows = []
+    for kind in ("log", "csv", "random"):
+        data = sample_data(kind, size_mb * MB)
+        rows.append([kind, "none", "-", "1.00", "-", f"{link / MB:.1f} MB/s"])
+        for name in available_codecs():
+            codec = get_codec(name)
+            for level in LEVELS.get(name, (codec.default_level,)):
+                if not worth_compressing(codec, level, data[:SAMPLE_SIZE]):
+                    rows.append([kind, name, level, "skipped", "-", f"{link / MB:.1f} MB/s"])
+                    continue
+                wire, comp, decomp = measure(codec, level, data)
+                slowest = max(comp, decomp, wire / link)
+                rows.append([kind, name, level, f"{len(data) / wire:.2f}",
+                             f"{len(data) / comp / MB:.0f} MB/s",
+                             f"{len(data) / slowest / MB:.1f} MB/s"])
+    report(f"{size_mb} MB per data set over a {link_mbit} Mbit link", rows,
+           ["data", "codec", "level", "ratio", "compress", "effective"])
+
+
+if __name__ == "__main__":
+    run(*(int(a) for a in sys.argv[1:3]))
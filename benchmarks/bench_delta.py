@@ -0,0 +1,71 @@
+"""
+Delta transfers over synthetic mutations of a file the receiver already
+holds: bytes that had to cross the wire and time taken, against a full send.
+
+    python -m benchmarks.bench_delta [size_mb]
+"""
+
+import os
+import random
+import shutil
+import sys
+import tempfile
+
+from benchmarks.common import MB, free_port, receiver_process, report, timed
+from src.logic.network import NetworkManager
+
+
+def mutations(basis):
+    rng = random.Random(1)
+    size = len(basis)
+    scattered = bytearray(basis)
+    for _ in range(100):
+        k = rng.randrange(size)
+        scattered[k] ^= 0xFF
+    overwritten = bytearray(basis)
+    for _ in range(10):
+        k = rng.randrange(size - 65536)
+        overwritten[k:k + 65536] = os.urandom(65536)
+    return [
+        ("unchanged", basis),
+        ("append 1 MB", basis + os.urandom(MB)),
+        ("insert 100 B in middle", basis[:size // 2] + os.urandom(100) + basis[size // 2:]),
+        ("delete first 1 MB", basis[MB:]),
+        ("overwrite 10 x 64 KB", bytes(overwritten)),
+        ("flip 100 scattered bytes", bytes(scattered)),
+    ]
+
+
+def run(size_mb=32):
+    basis = os.urandom(size_mb * MB)
+    rows = []
+    src_dir = tempfile.mkdtemp()
+    dst_dir = tempfile.mkdtemp()
+    try:
+        port = free_port()
+        with receiver_process(port, dst_dir) as receiver:
+            sender = NetworkManager(port=port)
+            for label, data in mutations(basis):
+                source = os.path.join(src_dir, "image.bin")
+                with open(source, "wb") as f:
+                    f.write(data)
+                with open(os.path.join(dst_dir, "image.bin"), "wb") as f:
+                    f.write(basis)
+                sender._upload_bytes = 0
+
+                def send():
+                    sender.send_file_delta("127.0.0.1", source)
+                    receiver.wait_for("[OK] Received")
+                _, wall, _ = timed(send)
+                sent = sender._upload_bytes
+                rows.append([label, f"{len(data) / MB:.1f} MB", f"{sent / 1024:.0f} KB",
+                             f"{100 * sent / len(data):.2f}%", f"{wall:.2f} s"])
+    finally:
+        shutil.rmtree(src_dir)
+        shutil.rmtree(dst_dir)
+    report(f"Delta transfers against a {size_mb} MB basis", rows,
+           ["mutation", "new size", "literal data", "of full", "time"])
+
+
+if __name__ == "__main__":
+    run(*(int(a) for a in sys.argv[1:2]))
@@ -0,0 +1,60 @@
+"""
+Time to push one file to many peers: a send_file() to each in turn vs.
+relay_file(), which sends it down a tree of peers that pass it on as it
+arrives. The peers are NetworkManagers on 127.0.0.2 and up, each with its
+uplink capped so the numbers reflect a LAN rather than memory copies.
+
+    python -m benchmarks.bench_fanout [file_mb] [uplink_mb_s] [fanout]
+"""
+
+import os
+import shutil
+import sys
+import tempfile
+import threading
+import time
+
+from benchmarks.common import MB, free_port, make_file, report, timed
+from src.logic.network import NetworkManager
+
+PEER_COUNTS = (1, 3, 7, 15, 31)
+
+
+def run(file_mb=4, uplink_mb_s=20, fanout=2):
+    work = tempfile.mkdtemp()
+    managers = []
+    rows = []
+    try:
+        path = make_file(file_mb * MB, work)
+        port = free_port()
+        sender = NetworkManager(port=port)
+        managers.append(sender)
+        peers = [f"127.0.0.{i}" for i in range(2, 2 + max(PEER_COUNTS))]
+        for ip in peers:
+            peer = NetworkManager(port=port, host=ip, download_dir=os.path.join(work, ip))
+            os.mkdir(peer.download_dir)
+            peer.running = True
+            threading.Thread(target=peer._start_server, daemon=True).start()
+            managers.append(peer)
+        for manager in managers:
+            manager.set_rate_limits(upload=uplink_mb_s * MB)
+        time.sleep(0.2)
+
+        for count in PEER_COUNTS:
+            targets = peers[:count]
+            _, one_by_one, _ = timed(lambda: [sender.send_file(ip, path) for ip in targets])
+            results, relayed, _ = timed(sender.relay_file, targets, path, fanout=fanout)
+            if not all(results.values()):
+                raise RuntimeError(f"relay to {count} peers failed")
+            rows.append([count, f"{one_by_one:.2f}", f"{relayed:.2f}",
+                         f"{one_by_one / relayed:.1f}x"])
+    finally:
+        for manager in managers:
+            manager.stop()
+        shutil.rmtree(work)
+    report(f"{file_mb} MB file, {uplink_mb_s} MB/s uplink per peer, fan-out {fanout}",
+           rows, ["peers", "one by one (s)", "relay tree (s)", "speedup"])
+
+
+if __name__ == "__main__":
+    run(*(int(a) for a in sys.argv[1:4]))
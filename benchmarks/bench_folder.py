@@ -0,0 +1,54 @@
+"""
+Files per second when sending a tree of small files: one streamed folder
+archive over a single connection vs. one send_file() connection per file.
+
+The per-file baseline is timed on at most 5000 files; its rate is what the
+whole tree would take at that pace.
+
+    python -m benchmarks.bench_folder [files] [file_kb]
+"""
+
+import os
+import shutil
+import sys
+import tempfile
+
+from benchmarks.common import free_port, make_tree, receiver_process, report, timed
+from src.logic.network import NetworkManager
+
+PER_FILE_LIMIT = 5000
+
+
+def run(files=100000, file_kb=4):
+    source = tempfile.mkdtemp()
+    rows = []
+    try:
+        tree = os.path.join(source, "tree")
+        paths = make_tree(tree, files, file_kb * 1024)
+        with tempfile.TemporaryDirectory() as download_dir:
+            port = free_port()
+            with receiver_process(port, download_dir) as receiver:
+                sender = NetworkManager(port=port)
+
+                def send_folder():
+                    sender.send_folder("127.0.0.1", tree)
+                    receiver.wait_for("[OK] Received folder")
+                _, wall, _ = timed(send_folder)
+                rows.append(["streamed folder", files, f"{files / wall:.0f}"])
+
+                sample = paths[:PER_FILE_LIMIT]
+
+                def send_each():
+                    for path in sample:
+                        sender.send_file("127.0.0.1", path)
+                        receiver.wait_for("[OK] Received")
+                _, wall, _ = timed(send_each)
+                rows.append(["file per connection", len(sample), f"{len(sample) / wall:.0f}"])
+    finally:
+        shutil.rmtree(source)
+    report(f"{files} files of {file_kb} KiB over loopback", rows,
+           ["method", "files timed", "files/s"])
+
+
+if __name__ == "__main__":
+    run(*(int(a) for a in sys.argv[1:3]))
@@ -0,0 +1,109 @@
+"""
+Compare the receive path in NetworkManager._handle_client before and after
+pooled recv_into() buffers: N parallel uploads land on one receiver and we
+report throughput and the receiver's peak RSS.
+
+Each receiver runs in its own process so peak RSS is measured in isolation.
+
+    python -m benchmarks.bench_receive [parallel] [size_mb]
+"""
+
+import json
+import os
+import resource
+import socket
+import struct
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+from benchmarks.common import MB, free_port, make_file, report
+from src.logic.network import NetworkManager
+
+
+class AllocatingNetworkManager(NetworkManager):
+    """The original receive loop: one fresh bytes object per recv()"""
+
+    def _recv_body(self, conn, f, count):
+        received = 0
+        while received < count:
+            chunk = conn.recv(min(65536, count - received))
+            if not chunk:
+                break
+            f.write(chunk)
+            received += len(chunk)
+            self._download_bytes += len(chunk)
+        return received
+
+
+def upload(port, path):
+    """Send one file with the plain upload header, the path both receive
+    loops handle; send_file() negotiates a framed session instead"""
+    name = os.path.basename(path).encode()
+    with socket.create_connection(("127.0.0.1", port)) as sock, open(path, "rb") as f:
+        sock.sendall(struct.pack("!II", len(name), os.path.getsize(path)) + name)
+        sock.sendfile(f)
+
+
+def serve(mode, port, download_dir, expected, size):
+    cls = AllocatingNetworkManager if mode == "recv" else NetworkManager
+    nm = cls(port=port, download_dir=download_dir)
+    nm.running = True
+    threading.Thread(target=nm._start_server, daemon=True).start()
+    print("READY", flush=True)
+    while True:
+        done = [n for n in os.listdir(download_dir)
+                if os.path.getsize(os.path.join(download_dir, n)) == size]
+        if len(done) >= expected:
+            break
+        time.sleep(0.01)
+    rss_kb = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    print(json.dumps({"maxrss_mb": rss_kb / 1024}), flush=True)
+
+
+def run(parallel=10, size_mb=128):
+    size = size_mb * MB
+    sources = [make_file(size) for _ in range(parallel)]
+    rows = []
+    try:
+        for mode in ("recv", "recv_into"):
+            port = free_port()
+            with tempfile.TemporaryDirectory() as download_dir:
+                child = subprocess.Popen(
+                    [sys.executable, "-m", "benchmarks.bench_receive", "--serve",
+                     mode, str(port), download_dir, str(parallel), str(size)],
+                    stdout=subprocess.PIPE, text=True)
+                child.stdout.readline()
+                time.sleep(0.2)
+                start = time.perf_counter()
+                threads = [threading.Thread(target=upload, args=(port, p))
+                           for p in sources]
+                for t in threads:
+                    t.start()
+                for t in threads:
+                    t.join()
+                result = json.loads(child.stdout.readline())
+                elapsed = time.perf_counter() - start
+                child.kill()
+                child.wait()
+            rows.append([
+                mode,
+                f"{parallel} x {size_mb} MB",
+                f"{parallel * size_mb / elapsed:.0f} MB/s",
+                f"{result['maxrss_mb']:.1f} MB",
+            ])
+    finally:
+        for p in sources:
+            os.unlink(p)
+    report("Parallel uploads into one receiver", rows,
+           ["receive loop", "load", "throughput", "peak RSS"])
+
+
+if __name__ == "__main__":
+    if len(sys.argv) > 1 and sys.argv[1] == "--serve":
+        mode, port, download_dir, expected, size = sys.argv[2:7]
+        serve(mode, int(port), download_dir, int(expected), int(size))
+    else:
+        run(*(int(a) for a in sys.argv[1:3]))
@@ -0,0 +1,42 @@
+"""
+Compare the zero-copy sendfile() path against the chunked read/sendall loop
+in NetworkManager.send_file over loopback.
+
+    python -m benchmarks.bench_send_file [size_mb] [rounds]
+"""
+
+import os
+import sys
+
+from benchmarks.common import MB, free_port, make_file, report, sink_server, timed
+from src.logic.network import NetworkManager
+
+
+def run(size_mb=512, rounds=3):
+    path = make_file(size_mb * MB)
+    port = free_port()
+    rows = []
+    try:
+        with sink_server(port):
+            for zero_copy in (False, True):
+                nm = NetworkManager(port=port, zero_copy=zero_copy)
+                best = None
+                for _ in range(rounds):
+                    _, wall, cpu = timed(nm.send_file, "127.0.0.1", path)
+                    if best is None or wall < best[0]:
+                        best = (wall, cpu)
+                wall, cpu = best
+                rows.append([
+                    "sendfile" if nm.zero_copy else "chunked",
+                    f"{size_mb} MB",
+                    f"{size_mb / wall:.0f} MB/s",
+                    f"{cpu:.2f} s",
+                ])
+    finally:
+        os.unlink(path)
+    report("send_file over loopback (best of %d)" % rounds, rows,
+           ["path", "size", "throughput", "cpu"])
+
+
+if __name__ == "__main__":
+    run(*(int(a) for a in sys.argv[1:3]))
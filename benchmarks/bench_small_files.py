@@ -0,0 +1,45 @@
+"""
+Files per second for a batch of small files: send_files() over one
+pipelined connection vs. one send_file() connection per file.
+
+    python -m benchmarks.bench_small_files [files] [file_kb]
+"""
+
+import shutil
+import sys
+import tempfile
+
+from benchmarks.common import free_port, make_tree, receiver_process, report, timed
+from src.logic.network import NetworkManager
+
+
+def run(files=10000, file_kb=4):
+    source = tempfile.mkdtemp()
+    rows = []
+    try:
+        paths = make_tree(source, files, file_kb * 1024)
+        with tempfile.TemporaryDirectory() as download_dir:
+            port = free_port()
+            with receiver_process(port, download_dir) as receiver:
+                sender = NetworkManager(port=port)
+
+                def send_batch():
+                    sender.send_files("127.0.0.1", paths)
+                    receiver.wait_for("[OK] Received")
+                _, wall, _ = timed(send_batch)
+                rows.append(["one connection", f"{files / wall:.0f}"])
+
+                def send_each():
+                    for path in paths:
+                        sender.send_file("127.0.0.1", path)
+                        receiver.wait_for("[OK] Received")
+                _, wall, _ = timed(send_each)
+                rows.append(["connection per file", f"{files / wall:.0f}"])
+    finally:
+        shutil.rmtree(source)
+    report(f"{files} files of {file_kb} KiB over loopback", rows,
+           ["method", "files/s"])
+
+
+if __name__ == "__main__":
+    run(*(int(a) for a in sys.argv[1:3]))
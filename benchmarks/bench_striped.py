@@ -0,0 +1,47 @@
+"""
+Throughput of a single large file sent over N parallel striped connections.
+
+On loopback every stream shares one host, so scaling comes from spreading
+per-connection work across cores; on a long fat link it also comes from
+filling more of the bandwidth-delay product.
+
+    python -m benchmarks.bench_striped [size_mb] [max_streams]
+"""
+
+import os
+import sys
+import tempfile
+
+from benchmarks.common import MB, free_port, make_file, receiver_process, report, timed
+from src.logic.network import NetworkManager
+
+
+def run(size_mb=512, max_streams=8):
+    path = make_file(size_mb * MB)
+    rows = []
+    try:
+        with tempfile.TemporaryDirectory() as download_dir:
+            port = free_port()
+            with receiver_process(port, download_dir) as receiver:
+                sender = NetworkManager(port=port)
+                streams = 1
+                base = None
+                while streams <= max_streams:
+                    sender.streams = streams
+
+                    def send():
+                        sender.send_file("127.0.0.1", path)
+                        receiver.wait_for("[OK] Received")
+                    _, wall, _ = timed(send)
+                    rate = size_mb / wall
+                    base = base or rate
+                    rows.append([streams, f"{rate:.0f} MB/s", f"{rate / base:.2f}x"])
+                    streams *= 2
+    finally:
+        os.unlink(path)
+    report(f"Striped transfer of {size_mb} MB over loopback", rows,
+           ["streams", "throughput", "vs 1 stream"])
+
+
+if __name__ == "__main__":
+    run(*(int(a) for a in sys.argv[1:3]))
@@ -0,0 +1,50 @@
+"""
+Throughput of a single large file with and without end-to-end stripe
+verification, for each stream count.
+
+The sender hashes each stripe on its hash executor while the stripe is on
+the wire and the receiver checks it after writing, so verification should
+cost far less than a second pass over the data.
+
+    python -m benchmarks.bench_verify [size_mb] [max_streams]
+"""
+
+import os
+import sys
+import tempfile
+
+from benchmarks.common import MB, free_port, make_file, receiver_process, report, timed
+from src.logic.network import NetworkManager
+
+
+def run(size_mb=512, max_streams=4):
+    path = make_file(size_mb * MB)
+    rows = []
+    try:
+        with tempfile.TemporaryDirectory() as download_dir:
+            port = free_port()
+            with receiver_process(port, download_dir) as receiver:
+                sender = NetworkManager(port=port)
+                streams = 1
+                while streams <= max_streams:
+                    sender.streams = streams
+                    rates = []
+                    for verify in (False, True):
+                        sender.verify = verify
+
+                        def send():
+                            sender.send_file("127.0.0.1", path)
+                            receiver.wait_for("[OK] Received")
+                        _, wall, _ = timed(send)
+                        rates.append(size_mb / wall)
+                    rows.append([streams, f"{rates[0]:.0f} MB/s", f"{rates[1]:.0f} MB/s",
+                                 f"{rates[1] / rates[0]:.2f}x"])
+                    streams *= 2
+    finally:
+        os.unlink(path)
+    report(f"{size_mb} MB over loopback with {sender.hash_name} stripe verification", rows,
+           ["streams", "unverified", "verified", "ratio"])
+
+
+if __name__ == "__main__":
+    run(*(int(a) for a in sys.argv[1:3]))
@@ -0,0 +1,139 @@
+"""
+Shared helpers for the loopback benchmarks.
+Run a benchmark from the repository root, e.g.:
+
+    python -m benchmarks.bench_send_file
+"""
+
+import os
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from contextlib import contextmanager
+
+MB = 1024 * 1024
+
+
+def free_port():
+    """Return a TCP port that is currently free on the loopback interface"""
+    with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def make_file(size, directory=None, pattern=None):
+    """Create a temp file of `size` bytes and return its path"""
+    fd, path = tempfile.mkstemp(dir=directory, suffix=".bin")
+    block = pattern or os.urandom(MB)
+    with os.fdopen(fd, "wb") as f:
+        remaining = size
+        while remaining > 0:
+            piece = block[:min(len(block), remaining)]
+            f.write(piece)
+            remaining -= len(piece)
+    return path
+
+
+def make_tree(root, files, file_size):
+    """Create `files` files of `file_size` bytes spread over 100 directories
+    below root and return their paths"""
+    block = os.urandom(file_size)
+    paths = []
+    for i in range(files):
+        directory = os.path.join(root, f"d{i % 100:02d}")
+        os.makedirs(directory, exist_ok=True)
+        path = os.path.join(directory, f"f{i:06d}.bin")
+        with open(path, "wb") as f:
+            f.write(block)
+        paths.append(path)
+    if hasattr(os, "sync"):
+        os.sync()  # keep writeback of the new tree out of the timings
+    return paths
+
+
+@contextmanager
+def sink_server(port):
+    """Accept connections on `port` and discard everything they send"""
+    server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    server.bind(("127.0.0.1", port))
+    server.listen(64)
+    stop = threading.Event()
+
+    def drain(conn):
+        buf = bytearray(1024 * 1024)
+        with conn:
+            while conn.recv_into(buf):
+                pass
+
+    def serve():
+        while not stop.is_set():
+            try:
+                conn, _ = server.accept()
+            except OSError:
+                break
+            threading.Thread(target=drain, args=(conn,), daemon=True).start()
+
+    threading.Thread(target=serve, daemon=True).start()
+    try:
+        yield server
+    finally:
+        stop.set()
+        try:
+            server.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+        server.close()
+
+
+class ReceiverProcess:
+    """A NetworkManager receiver running in a child process"""
+
+    def __init__(self, port, download_dir):
+        self.proc = subprocess.Popen(
+            [sys.executable, "-u", "-m", "benchmarks.receiver", str(port), download_dir],
+            stdout=subprocess.PIPE, text=True)
+        self.wait_for("READY")
+        time.sleep(0.2)
+
+    def wait_for(self, prefix):
+        """Block until the receiver prints a line starting with `prefix`"""
+        for line in self.proc.stdout:
+            if line.startswith(prefix):
+                return line
+        raise RuntimeError("receiver exited before printing %r" % prefix)
+
+    def close(self):
+        self.proc.kill()
+        self.proc.wait()
+
+
+@contextmanager
+def receiver_process(port, download_dir):
+    receiver = ReceiverProcess(port, download_dir)
+    try:
+        yield receiver
+    finally:
+        receiver.close()
+
+
+def timed(fn, *args, **kwargs):
+    """Call fn and return (result, wall seconds, cpu seconds)"""
+    wall = time.perf_counter()
+    cpu = time.process_time()
+    result = fn(*args, **kwargs)
+    return result, time.perf_counter() - wall, time.process_time() - cpu
+
+
+def report(title, rows, headers):
+    """Print a fixed-width result table"""
+    widths = [max(len(str(h)), *(len(str(r[i])) for r in rows))
+              for i, h in enumerate(headers)]
+    print(f"\n{title}")
+    print("-" * (sum(widths) + 3 * (len(widths) - 1)))
+    print(" | ".join(str(h).ljust(w) for h, w in zip(headers, widths)))
+    for row in rows:
+        print(" | ".join(str(c).ljust(w) for c, w in zip(row, widths)))
@@ -0,0 +1,25 @@
+"""
+Standalone receiving NetworkManager used by the benchmarks, so the receiver
+runs in its own process (and its own GIL) instead of beside the sender.
+
+    python -m benchmarks.receiver <port> <download_dir>
+"""
+
+import sys
+import threading
+import time
+
+from src.logic.network import NetworkManager
+
+
+def serve(port, download_dir):
+    nm = NetworkManager(port=port, download_dir=download_dir)
+    nm.running = True
+    threading.Thread(target=nm._start_server, daemon=True).start()
+    print("READY", flush=True)
+    while True:
+        time.sleep(3600)
+
+
+if __name__ == "__main__":
+    serve(int(sys.argv[1]), sys.argv[2])
@@ -3,9 +3,15 @@ import logging
 
 # from src.network.chat import ChatManager  # Moved to __init__ to avoid circular import
 from src.logic import FileManager
+from src.logic.archive import tree_size
+from src.logic.codecs import negotiate
+from src.logic.remote_catalog import RemoteCatalog
+from src.logic.scheduler import PRIORITY_NORMAL, TransferScheduler
+from src.logic.shared_library import CATALOG_FILE, SharedLibrary
 from src.controller import peer_signal
 from src.controller import transfer_request_signal
 
+os.makedirs("src/logs", exist_ok=True)
 logging.basicConfig(
     level=logging.WARNING,
     format='%(asctime)s [%(levelname)s] %(message)s',
@@ -13,9 +19,11 @@ logging.basicConfig(
 )
 logger = logging.getLogger("ShareSync")
 
+MB = 1024 * 1024
+
 
 class AppLogic:
-    def __init__(self, chat_display=None, username=None):
+    def __init__(self, chat_display=None, username=None, catalog_path=None):
         # Lazy import to avoid circular dependency
         from src.logic import NetworkManager
         from src.logic import ChatManager
@@ -24,11 +32,34 @@ class AppLogic:
 
         self.network_manager = NetworkManager()
         self.chat_manager = ChatManager(
-            chat_display, username=username or self.network_manager._get_local_ip())
+            chat_display, username=username or self.network_manager._get_local_ip(),
+            network_manager=self.network_manager)
+        self.network_manager.control_handler = self.chat_manager._dispatch
+        # Our beacons carry the chat name; the peer list in the GUI follows
+        # peers appearing, leaving and changing what they advertise
+        self.network_manager.name = self.chat_manager.username
+        self.network_manager.peers.on_change = self.peers_changed
         self.file_manager = FileManager()
+        # Files peers send us show up in the transfers table too
+        self.network_manager.incoming_handler = self.track_incoming
+        # Transfers run on the scheduler's worker threads, never on the
+        # caller's (usually the GUI) thread
+        self.scheduler = TransferScheduler(self.file_manager)
+        # ... and a transfer a receiver held starts again once it is released
+        self.network_manager.release_handler = self.scheduler.dispatch
+        # Files we share, stat'ed and indexed off the GUI thread
+        self.shared_library = SharedLibrary(catalog_path or CATALOG_FILE)
+        # Peers browse them with OP_BROWSE; we browse theirs through a cache
+        self.network_manager.browse_handler = self.shared_library.browse
+        # ... and fetch them by content hash in swarm downloads
+        self.network_manager.content_handler = self.shared_library.path_for_hash
+        self.remote_catalog = RemoteCatalog(self.network_manager)
         self.network_manager.start()
         self.chat_manager.start()
         self.pending_transfers = {}
+        self.incoming_requests = {}
+        transfer_request_signal.transfer_request_received.connect(
+            self.handle_transfer_request)
         transfer_request_signal.transfer_response_received.connect(
             self.handle_transfer_response)
         logger.info("Network and Chat managers started")
@@ -38,13 +69,20 @@ class AppLogic:
         logger.info(f"Fetched peers: {peers}")
         return peers
 
-    def send_file(self, peer_ip, file_path):
+    def send_file(self, peer_ip, file_path, priority=PRIORITY_NORMAL):
+        """Queue a file or folder for sending; returns once it is queued"""
         try:
             if os.path.exists(file_path):
-                size = os.path.getsize(file_path)
-                self.file_manager.add_transfer(file_path, peer_ip, size)
-                logger.info(f"Sending file '{file_path}' to {peer_ip}")
-                self.network_manager.send_file(peer_ip, file_path)
+                if os.path.isdir(file_path):
+                    size = tree_size(file_path)
+                else:
+                    size = os.path.getsize(file_path)
+                transfer = self.file_manager.add_transfer(file_path, peer_ip, size)
+                logger.info(f"Queueing file '{file_path}' for {peer_ip}")
+                self.scheduler.submit(
+                    transfer, lambda: self.network_manager.send_file(
+                        peer_ip, file_path, control=transfer.control),
+                    priority)
                 return True
             else:
                 logger.error(f"File {file_path} does not exist.")
@@ -53,6 +91,47 @@ class AppLogic:
             logger.error(f"Sending file {file_path} to {peer_ip}: {e}")
             return False
 
+    def send_files(self, peer_ip, paths, priority=PRIORITY_NORMAL):
+        """Queue many files and folders for sending to a peer as one batch
+        over one connection; returns once it is queued"""
+        paths = list(paths)
+        if len(paths) == 1:
+            return self.send_file(peer_ip, paths[0], priority)
+        try:
+            size = sum(tree_size(path) if os.path.isdir(path) else os.path.getsize(path)
+                       for path in paths)
+        except OSError as e:
+            logger.error(f"Sending {len(paths)} files to {peer_ip}: {e}")
+            return False
+        transfer = self.file_manager.add_transfer(f"{len(paths)} files", peer_ip, size)
+        logger.info(f"Queueing {len(paths)} files for {peer_ip}")
+        self.scheduler.submit(
+            transfer, lambda: self.network_manager.send_files(
+                peer_ip, paths, control=transfer.control),
+            priority)
+        return True
+
+    def send_file_to_peers(self, peer_ips, file_path, priority=PRIORITY_NORMAL):
+        """Queue a file for sending to many peers at once, relayed from
+        peer to peer rather than sent to each of them by us"""
+        peer_ips = list(peer_ips)
+        if len(peer_ips) == 1 or os.path.isdir(file_path):
+            return all([self.send_file(peer_ip, file_path, priority) for peer_ip in peer_ips])
+        try:
+            size = os.path.getsize(file_path)
+        except OSError as e:
+            logger.error(f"Sending file {file_path} to {len(peer_ips)} peers: {e}")
+            return False
+        transfer = self.file_manager.add_transfer(file_path, f"{len(peer_ips)} peers", size)
+        logger.info(f"Queueing file '{file_path}' for {len(peer_ips)} peers")
+
+        def job():
+            results = self.network_manager.relay_file(peer_ips, file_path,
+                                                      control=transfer.control)
+            return all(results.values())
+        self.scheduler.submit(transfer, job, priority)
+        return True
+
     def receive_file(self):
         # Receiving is handled automatically by NetworkManager
         logger.info("Receive file called (handled automatically)")
@@ -61,6 +140,7 @@ class AppLogic:
     def stop(self):
         logger.info("Stopping network manager")
         self.network_manager.stop()
+        self.shared_library.stop()
 
     def send_chat_message(self, msg):
         logger.info(f"Sending chat message: {msg}")
@@ -76,12 +156,25 @@ class AppLogic:
         logger.info(f"LAN status: {status}")
         return status
 
+    # Bandwidth caps, in MB/s like the status bar readout; 0 is unlimited
+    def get_rate_limits(self):
+        """(download, upload, per peer) caps"""
+        download, upload, _, peer_upload = self.network_manager.get_rate_limits()
+        return download / MB, upload / MB, peer_upload / MB
+
+    def set_rate_limits(self, download=None, upload=None, per_peer=None):
+        logger.info(f"Rate limits: down={download} up={upload} per peer={per_peer} MB/s")
+
+        def to_bytes(mb):
+            return None if mb is None else int(mb * MB)
+        self.network_manager.set_rate_limits(
+            download=to_bytes(download), upload=to_bytes(upload),
+            peer_download=to_bytes(per_peer), peer_upload=to_bytes(per_peer))
+
     # File transfer management
     def get_active_transfers(self):
-        transfers = self.file_manager.get_active_transfers()
-        logger.info(
-            f"Active transfers: {[(t.filename, t.peer_ip, t.status) for t in transfers]}")
-        return transfers
+        # Polled by the transfers view every frame, so nothing is logged here
+        return self.file_manager.get_active_transfers()
 
     def pause_transfer(self, filename, peer_ip):
         logger.info(f"Pausing transfer: {filename} to {peer_ip}")
@@ -90,10 +183,40 @@ class AppLogic:
     def resume_transfer(self, filename, peer_ip):
         logger.info(f"Resuming transfer: {filename} to {peer_ip}")
         self.file_manager.resume_transfer(filename, peer_ip)
+        self.scheduler.dispatch()
 
     def cancel_transfer(self, filename, peer_ip):
         logger.info(f"Cancelling transfer: {filename} to {peer_ip}")
         self.file_manager.cancel_transfer(filename, peer_ip)
+        self.scheduler.dispatch()
+
+    def track_incoming(self, meta, peer_ip):
+        """Add a file a peer started sending us to the transfers table;
+        returns the control its byte pumps report to"""
+        return self.file_manager.add_incoming(meta["name"], peer_ip, meta["size"]).control
+
+    def browse_peer(self, peer_ip, query="", page=0, substring=False):
+        """A page of the files a peer shares that match `query`: (total
+        matches, entries), or None if the peer could not be asked"""
+        try:
+            return self.remote_catalog.page(peer_ip, query, page, substring)
+        except Exception as e:
+            logger.error(f"Browsing {peer_ip} failed: {e}")
+            return None
+
+    def swarm_download(self, content_hash, name, size, peers=None, priority=PRIORITY_NORMAL):
+        """Queue a download of a file, by the content hash browse_peer()
+        lists, from every peer holding some of it at once"""
+        logger.info(f"Queueing swarm download of {name} ({content_hash})")
+        # Pulled by a scheduler job, so a pause gives up its slot like a send
+        transfer = self.file_manager.add_transfer(name, "swarm", size, incoming=True,
+                                                  park=False)
+
+        def job():
+            return self.network_manager.swarm_download(
+                content_hash, name, size, peers, control=transfer.control)
+        self.scheduler.submit(transfer, job, priority)
+        return transfer
 
     def update_transfer_progress(self, filename, peer_ip, progress):
         logger.info(
@@ -108,11 +231,12 @@ class AppLogic:
     def send_transfer_request(self, peer_ip, file_path):
         try:
             if os.path.exists(file_path):
-                file_size = os.path.getsize(file_path)
                 is_folder = os.path.isdir(file_path)
-                filename = os.path.basename(file_path)
+                file_size = tree_size(file_path) if is_folder else os.path.getsize(file_path)
+                filename = os.path.basename(os.path.normpath(file_path))
                 request_id = self.chat_manager.send_transfer_request(
-                    peer_ip, filename, str(file_size), is_folder)
+                    peer_ip, filename, str(file_size), is_folder,
+                    codecs=self.network_manager.offered_codecs(), features=("delta",))
                 if request_id:
                     self.pending_transfers[request_id] = (peer_ip, file_path)
                 logger.info(
@@ -126,8 +250,23 @@ class AppLogic:
                 f"Sending transfer request for {file_path} to {peer_ip}: {e}")
             return None
 
+    def handle_transfer_request(self, peer_ip, filename, file_size, request_id):
+        # Remember what was offered so the response can ask for a delta
+        self.incoming_requests[request_id] = (peer_ip, filename)
+
     def respond_to_transfer_request(self, peer_ip, request_id, response):
         try:
+            request = self.incoming_requests.pop(request_id, None)
+            codec = negotiate(self.chat_manager.offered_codecs.pop(request_id, ()))
+            features = self.chat_manager.offered_features.pop(request_id, ())
+            if response == "accept" and request and "delta" in features and \
+                    self.network_manager.has_local_copy(request[1]):
+                # We already hold an older copy: only the changes need to move.
+                # Peers that did not offer deltas would read this as a decline
+                response = "accept_delta"
+            elif response == "accept" and codec:
+                # Responses are "accept|<codec>" when the sender offered one we know
+                response = f"accept|{codec}"
             self.chat_manager.send_transfer_response(
                 peer_ip, request_id, response)
             logger.info(
@@ -138,10 +277,13 @@ class AppLogic:
     def handle_transfer_response(self, request_id, response):
         if request_id in self.pending_transfers:
             peer_ip, file_path = self.pending_transfers[request_id]
-            if response == "accept":
+            response, _, codec = response.partition("|")
+            if response in ("accept", "accept_delta"):
                 logger.info(
                     f"Transfer accepted by {peer_ip}, starting transfer of {file_path}")
-                self.start_file_transfer(peer_ip, file_path)
+                self.start_file_transfer(
+                    peer_ip, file_path, delta=response == "accept_delta",
+                    codec=codec or None)
             else:
                 logger.info(f"Transfer declined by {peer_ip}")
             del self.pending_transfers[request_id]
@@ -149,15 +291,30 @@ class AppLogic:
             logger.warning(
                 f"Received response for unknown request ID: {request_id}")
 
-    def start_file_transfer(self, peer_ip, file_path):
-        """Start sending a file to a peer"""
+    def start_file_transfer(self, peer_ip, file_path, delta=False, codec=None,
+                            priority=PRIORITY_NORMAL):
+        """Queue a file or folder for sending to a peer, as a delta against
+        the peer's existing copy when `delta` is set, compressed with `codec`
+        when one was negotiated"""
         try:
             if os.path.exists(file_path):
-                size = os.path.getsize(file_path)
-                self.file_manager.add_transfer(file_path, peer_ip, size)
+                if os.path.isdir(file_path):
+                    delta = False
+                    size = tree_size(file_path)
+                else:
+                    size = os.path.getsize(file_path)
+                transfer = self.file_manager.add_transfer(file_path, peer_ip, size)
                 logger.info(
-                    f"Starting file transfer: {file_path} to {peer_ip}")
-                self.network_manager.send_file(peer_ip, file_path)
+                    f"Queueing file transfer: {file_path} to {peer_ip}")
+                if delta:
+                    def job():
+                        return self.network_manager.send_file_delta(
+                            peer_ip, file_path, control=transfer.control)
+                else:
+                    def job():
+                        return self.network_manager.send_file(
+                            peer_ip, file_path, codec=codec, control=transfer.control)
+                self.scheduler.submit(transfer, job, priority)
                 return True
             else:
                 logger.error(f"File {file_path} does not exist.")
@@ -167,13 +324,20 @@ class AppLogic:
                 f"Starting file transfer {file_path} to {peer_ip}: {e}")
             return False
 
+    def get_peer_info(self, peer_ip):
+        """{port, name, caps} advertised by a peer, or None"""
+        return self.network_manager.get_peer_info(peer_ip)
+
+    def peers_changed(self, added, removed, changed):
+        logger.info(f"Peers joined {added}, left {removed}, changed {changed}")
+        peer_signal.peers_changed.emit()
+
+    # The peer table reports these changes through peers_changed()
     def add_peer(self, peer):
         self.network_manager.add_peer(peer)
-        peer_signal.peers_changed.emit()
 
     def remove_peer(self, peer):
         self.network_manager.remove_peer(peer)
-        peer_signal.peers_changed.emit()
 
     def update_network(self):
         # Call this when network state changes
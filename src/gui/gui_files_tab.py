@@ -1,6 +1,3 @@
-import os
-import json
-
 from PyQt5.QtWidgets import (
     QWidget,
     QVBoxLayout,
@@ -8,7 +5,8 @@ from PyQt5.QtWidgets import (
     QPushButton,
     QLineEdit,
     QGroupBox,
-    QListWidget,
+    QAbstractItemView,
+    QListView,
     QFileDialog,
     QMessageBox,
     QMenu,
@@ -21,7 +19,7 @@ from src.controller import AppLogic
 from src.controller import transfer_request_signal
 from src.controller import peer_signal
 
-SHARED_FILES_FILE = "src/shared_files.json"
+from .gui_models import Coalescer, SharedFilesModel
 
 
 def create_files_tab(app_logic: AppLogic):
@@ -30,30 +28,8 @@ def create_files_tab(app_logic: AppLogic):
     layout.setSpacing(20)
     layout.setContentsMargins(20, 20, 20, 20)
 
-    # Shared files storage
-    shared_files = []
-
-    def save_shared_files():
-        try:
-            os.makedirs(os.path.dirname(SHARED_FILES_FILE), exist_ok=True)
-            with open(SHARED_FILES_FILE, 'w') as f:
-                json.dump(shared_files, f, indent=2)
-        except Exception as e:
-            print(f"Error saving shared files: {e}")
-
-    def load_shared_files():
-        try:
-            if os.path.exists(SHARED_FILES_FILE):
-                with open(SHARED_FILES_FILE, 'r') as f:
-                    loaded_files = json.load(f)
-                    # Filter out files that no longer exist
-                    return [f for f in loaded_files if os.path.exists(f)]
-        except Exception as e:
-            print(f"Error loading shared files: {e}")
-        return []
-
-    # Load shared files on startup
-    shared_files = load_shared_files()
+    # Shared files: the library stats and indexes them in the background
+    library = app_logic.shared_library
 
     # Peer selection and send controls
     send_controls = QHBoxLayout()
@@ -99,48 +75,23 @@ def create_files_tab(app_logic: AppLogic):
     files_layout = QVBoxLayout(files_group)
     files_layout.setSpacing(10)
 
-    files_list = QListWidget()
-    files_list.setSelectionMode(QListWidget.MultiSelection)
+    files_model = SharedFilesModel(library, widget)
+    files_list = QListView()
+    files_list.setModel(files_model)
+    files_list.setUniformItemSizes(True)  # lets the view skip rows it does not show
+    files_list.setSelectionMode(QAbstractItemView.MultiSelection)
     files_list.setContextMenuPolicy(Qt.ContextMenuPolicy.CustomContextMenu)
 
-    def update_files_display():
-        files_list.clear()
-        for file_path in shared_files:
-            if os.path.exists(file_path):
-                file_size = os.path.getsize(file_path)
-                size_str = f"{file_size / (1024*1024):.1f} MB" if file_size > 1024 * \
-                    1024 else f"{file_size / 1024:.1f} KB"
-                display_name = os.path.basename(file_path)
-                files_list.addItem(f"📄 {display_name} • {size_str}")
-            else:
-                # Remove if file no longer exists
-                shared_files.remove(file_path)
-        save_shared_files()  # Save after cleanup
-
     def search_files():
-        query = search_input.text().lower()
-        for i in range(files_list.count()):
-            item = files_list.item(i)
-            if item:
-                item.setHidden(query not in item.text().lower())
+        files_model.set_filter(search_input.text())
 
     def show_context_menu(position):
         menu = QMenu()
         remove_action = menu.addAction("Remove from Sharing")
         action = menu.exec_(files_list.mapToGlobal(position))
         if action == remove_action:
-            selected_items = files_list.selectedItems()
-            for item in selected_items:
-                # Find the corresponding file path
-                display_text = item.text()
-                file_name = display_text.split(" • ")[0].replace("📄 ", "")
-                # Copy to avoid modification during iteration
-                for file_path in shared_files[:]:
-                    if os.path.basename(file_path) == file_name:
-                        shared_files.remove(file_path)
-                        break
-            update_files_display()
-            save_shared_files()
+            library.remove([files_model.id_at(index.row())
+                            for index in files_list.selectionModel().selectedRows()])
 
     def send_file_to_peer():
         selected_peer = peer_combo.currentText()
@@ -203,7 +154,7 @@ def create_files_tab(app_logic: AppLogic):
 
     def handle_transfer_response(request_id, response):
         app_logic.handle_transfer_response(request_id, response)
-        if response == "accept":
+        if response.startswith("accept"):
             QMessageBox.information(
                 widget, "Transfer Accepted", "The recipient accepted your transfer request!")
         else:
@@ -223,7 +174,14 @@ def create_files_tab(app_logic: AppLogic):
     files_layout.addWidget(files_list)
     layout.addWidget(files_group)
 
-    # Initial display
-    update_files_display()
+    # Sizes and removals arrive from the stat pool; repaint at frame rate
+    sizes_coalescer = Coalescer(files_model.sizes_changed, parent=widget)
+    files_coalescer = Coalescer(files_model.reload, parent=widget)
+    library.metadata_changed.connect(sizes_coalescer.poke)
+    library.files_changed.connect(files_coalescer.poke)
+
+    # Initial display; the library may still be loading, and says so
+    # with files_changed when it is done
+    files_model.reload()
 
     return widget
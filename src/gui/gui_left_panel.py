@@ -52,7 +52,9 @@ def create_left_panel(app_logic: AppLogic):
         peers = app_logic.get_peers()
         if peers:
             for peer in peers:
-                peers_list.addItem(f"🟢 {peer}")
+                info = app_logic.get_peer_info(peer)
+                name = info["name"] if info else None
+                peers_list.addItem(f"🟢 {name} ({peer})" if name else f"🟢 {peer}")
         else:
             peers_list.addItem("No peers found. Waiting for connections...")
 
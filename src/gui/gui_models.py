@@ -0,0 +1,246 @@
+import os
+
+from PyQt5.QtCore import (
+    QAbstractListModel, QAbstractTableModel, QModelIndex, QObject, QRectF, Qt, QTimer, pyqtSlot
+)
+from PyQt5.QtGui import QBrush, QColor, QLinearGradient, QPainter
+from PyQt5.QtWidgets import QStyledItemDelegate
+
+# Most repaints per second driven by the transfer signals, which worker
+# threads may fire thousands of times a second
+FRAME_RATE = 30
+
+
+class Coalescer(QObject):
+    """Calls `callback` at most FRAME_RATE times a second, however often
+    poke() is called. Connect signals from worker threads to poke(); being
+    a slot of a GUI-thread object, it always runs on the GUI thread."""
+
+    def __init__(self, callback, fps=FRAME_RATE, parent=None):
+        super().__init__(parent)
+        self._timer = QTimer(self)
+        self._timer.setSingleShot(True)
+        self._timer.setInterval(int(1000 / fps))
+        self._timer.timeout.connect(callback)
+
+    @pyqtSlot()
+    def poke(self):
+        if not self._timer.isActive():
+            self._timer.start()
+
+
+class Relay(QObject):
+    """Forwards `signal` to `callback` for as long as `parent` lives. Qt
+    drops the connection, and any emissions still queued for it, when the
+    widget goes away, so app-wide signals cannot reach deleted labels."""
+
+    def __init__(self, signal, callback, parent):
+        super().__init__(parent)
+        self._callback = callback
+        signal.connect(self._relay)
+
+    def _relay(self, *args):
+        self._callback(*args)
+
+
+class TransfersModel(QAbstractTableModel):
+    """Table of the transfers `source()` returns, refreshed in place.
+
+    refresh() keeps existing rows where they are, removes finished ones,
+    appends new ones and emits dataChanged only for rows whose status,
+    progress or speed changed since they were last shown, so the view
+    repaints a handful of rows instead of rebuilding the table.
+    """
+
+    COLUMNS = ("File", "Peer", "Status", "Progress", "Speed")
+    PROGRESS_COLUMN = 3
+
+    def __init__(self, source, parent=None):
+        super().__init__(parent)
+        self._source = source
+        self._rows = []
+        self._shown = {}  # transfer -> (status, progress, speed) last shown
+
+    @staticmethod
+    def _snapshot(t):
+        return t.status, int(t.progress), t.speed
+
+    def rowCount(self, parent=QModelIndex()):
+        return 0 if parent.isValid() else len(self._rows)
+
+    def columnCount(self, parent=QModelIndex()):
+        return 0 if parent.isValid() else len(self.COLUMNS)
+
+    def headerData(self, section, orientation, role=Qt.DisplayRole):
+        if role == Qt.DisplayRole and orientation == Qt.Horizontal:
+            return self.COLUMNS[section]
+        return None
+
+    def data(self, index, role=Qt.DisplayRole):
+        if not index.isValid():
+            return None
+        t = self._rows[index.row()]
+        column = index.column()
+        if role == Qt.DisplayRole:
+            if column == 0:
+                return f"📥 {t.filename}" if t.incoming else f"📤 {t.filename}"
+            if column == 1:
+                return t.peer_ip
+            if column == 2:
+                return t.status
+            if column == 3:
+                return t.progress
+            return t.speed
+        if role == Qt.ToolTipRole and column == 0:
+            return f"{t.filename} ({t.size} bytes)"
+        return None
+
+    def transfer(self, row):
+        return self._rows[row]
+
+    def refresh(self):
+        current = self._source()
+        keep = set(current)
+
+        # Remove rows that are gone, bottom-up in contiguous runs
+        row = len(self._rows) - 1
+        while row >= 0:
+            if self._rows[row] in keep:
+                row -= 1
+                continue
+            last = row
+            while row >= 0 and self._rows[row] not in keep:
+                row -= 1
+            self.beginRemoveRows(QModelIndex(), row + 1, last)
+            for gone in self._rows[row + 1:last + 1]:
+                del self._shown[gone]
+            del self._rows[row + 1:last + 1]
+            self.endRemoveRows()
+
+        # Repaint changed rows, again in contiguous runs
+        first = None
+        for row, t in enumerate(self._rows):
+            snapshot = self._snapshot(t)
+            if snapshot != self._shown[t]:
+                self._shown[t] = snapshot
+                if first is None:
+                    first = row
+            elif first is not None:
+                self._changed(first, row - 1)
+                first = None
+        if first is not None:
+            self._changed(first, len(self._rows) - 1)
+
+        added = [t for t in current if t not in self._shown]
+        if added:
+            start = len(self._rows)
+            self.beginInsertRows(QModelIndex(), start, start + len(added) - 1)
+            for t in added:
+                self._rows.append(t)
+                self._shown[t] = self._snapshot(t)
+            self.endInsertRows()
+
+    def _changed(self, first, last):
+        self.dataChanged.emit(self.index(first, 0),
+                              self.index(last, len(self.COLUMNS) - 1), [Qt.DisplayRole])
+
+
+def format_size(size):
+    if size > 1024 * 1024:
+        return f"{size / (1024 * 1024):.1f} MB"
+    return f"{size / 1024:.1f} KB"
+
+
+class SharedFilesModel(QAbstractListModel):
+    """The shared files in `library` matching the current search.
+
+    A row holds only the file's id; names and sizes are looked up when the
+    view paints the row, and a QListView with uniform item sizes only
+    paints visible rows, so 200k shared files cost one list of ints.
+    Sizes show as "…" until the library's background stat has run.
+    """
+
+    def __init__(self, library, parent=None):
+        super().__init__(parent)
+        self._library = library
+        self._query = ""
+        self._ids = []
+        self._row_of = None  # id -> row, built when sizes change
+
+    def rowCount(self, parent=QModelIndex()):
+        return 0 if parent.isValid() else len(self._ids)
+
+    def data(self, index, role=Qt.DisplayRole):
+        if not index.isValid():
+            return None
+        item_id = self._ids[index.row()]
+        path = self._library.path(item_id)
+        if path is None:  # removed; a reload is on its way
+            return None
+        if role == Qt.DisplayRole:
+            size = self._library.size(item_id)
+            return f"📄 {os.path.basename(path)} • {format_size(size) if size is not None else '…'}"
+        if role == Qt.ToolTipRole:
+            return path
+        return None
+
+    def id_at(self, row):
+        return self._ids[row]
+
+    def set_filter(self, query):
+        self._query = query
+        self.reload()
+
+    def reload(self):
+        """Re-run the search, e.g. after files were added or removed"""
+        self.beginResetModel()
+        self._ids = self._library.search(self._query)
+        self._row_of = None
+        self.endResetModel()
+
+    def sizes_changed(self):
+        """Repaint the rows whose sizes the library has looked up since
+        the last call"""
+        changed = self._library.take_changed()
+        if not changed or not self._ids:
+            return
+        if self._row_of is None:
+            self._row_of = {item_id: row for row, item_id in enumerate(self._ids)}
+        rows = sorted(self._row_of[i] for i in changed if i in self._row_of)
+        start = prev = None
+        for row in rows:
+            if start is None:
+                start = prev = row
+            elif row == prev + 1:
+                prev = row
+            else:
+                self.dataChanged.emit(self.index(start), self.index(prev), [Qt.DisplayRole])
+                start = prev = row
+        if start is not None:
+            self.dataChanged.emit(self.index(start), self.index(prev), [Qt.DisplayRole])
+
+
+class ProgressDelegate(QStyledItemDelegate):
+    """Paints a progress value (0-100) as a bar in the app's colours,
+    without a QProgressBar widget per row"""
+
+    def paint(self, painter, option, index):
+        progress = index.data() or 0
+        rect = QRectF(option.rect.adjusted(4, 6, -4, -6))
+        painter.save()
+        painter.setRenderHint(QPainter.Antialiasing)
+        painter.setPen(Qt.NoPen)
+        painter.setBrush(QColor("#313244"))
+        painter.drawRoundedRect(rect, 6, 6)
+        if progress > 0:
+            chunk = QRectF(rect)
+            chunk.setWidth(rect.width() * min(progress, 100) / 100)
+            gradient = QLinearGradient(chunk.topLeft(), chunk.topRight())
+            gradient.setColorAt(0, QColor("#a6e3a1"))
+            gradient.setColorAt(1, QColor("#94e2d5"))
+            painter.setBrush(QBrush(gradient))
+            painter.drawRoundedRect(chunk, 6, 6)
+        painter.setPen(QColor("#cdd6f4"))
+        painter.drawText(rect, Qt.AlignCenter,
+                         f"{int(progress)}%" if progress < 100 else "Complete")
+        painter.restore()
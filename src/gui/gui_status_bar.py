@@ -1,9 +1,11 @@
-from PyQt5.QtWidgets import QFrame, QHBoxLayout, QLabel
+from PyQt5.QtWidgets import QDoubleSpinBox, QFrame, QHBoxLayout, QLabel
 from src.controller import AppLogic
 
 from src.controller import peer_signal
 from src.controller import bandwidth_signal
 
+from .gui_models import Coalescer, Relay
+
 
 def create_status_bar(app_logic: AppLogic):
     status_bar = QFrame()
@@ -31,16 +33,42 @@ def create_status_bar(app_logic: AppLogic):
     layout.addStretch()
     layout.addWidget(bandwidth_status)
 
+    # Bandwidth caps in MB/s, applied to the network manager as they change
+    download_cap, upload_cap, peer_cap = app_logic.get_rate_limits()
+
+    def add_limit(label, tooltip, value, apply):
+        caption = QLabel(label)
+        caption.setStyleSheet(
+            "QLabel { border: none; font-size: 12px; color: #f9e2af; }")
+        spin = QDoubleSpinBox()
+        spin.setRange(0, 10000)
+        spin.setDecimals(1)
+        spin.setSingleStep(0.5)
+        spin.setSpecialValueText("∞")
+        spin.setSuffix(" MB/s")
+        spin.setToolTip(tooltip)
+        spin.setValue(value)
+        spin.valueChanged.connect(apply)
+        layout.addWidget(caption)
+        layout.addWidget(spin)
+
+    add_limit("↓ cap", "Download cap for all peers together (0 = unlimited)",
+              download_cap, lambda v: app_logic.set_rate_limits(download=v))
+    add_limit("↑ cap", "Upload cap for all peers together (0 = unlimited)",
+              upload_cap, lambda v: app_logic.set_rate_limits(upload=v))
+    add_limit("per peer", "Cap for each peer, both directions (0 = unlimited)",
+              peer_cap, lambda v: app_logic.set_rate_limits(per_peer=v))
+
     def update_network_status():
         peers = app_logic.get_peers()
         network_status.setText(f"🌐 Network: {len(peers)} peers connected")
 
     def update_transfer_status():
         transfers = app_logic.get_active_transfers()
-        active = sum(1 for t in transfers if t.status == "active")
-        completed = sum(1 for t in transfers if t.status == "completed")
+        running = sum(1 for t in transfers if t.status == "Running")
+        queued = sum(1 for t in transfers if t.status == "Queued")
         transfer_status.setText(
-            f"📊 Transfers: {active} active, {completed} completed")
+            f"📊 Transfers: {running} running, {queued} queued")
 
     def update_bandwidth_status(download=1.2, upload=0.8):
         bandwidth_status.setText(
@@ -51,10 +79,10 @@ def create_status_bar(app_logic: AppLogic):
         update_transfer_status()
         update_bandwidth_status()
 
-    peer_signal.peers_changed.connect(update_network_status)
+    Relay(peer_signal.peers_changed, update_network_status, status_bar)
     if hasattr(app_logic.file_manager, "transfers_changed"):
-        app_logic.file_manager.transfers_changed.connect(
-            update_transfer_status)
-    bandwidth_signal.bandwidth_changed.connect(update_bandwidth_status)
+        transfer_status_coalescer = Coalescer(update_transfer_status, parent=status_bar)
+        app_logic.file_manager.transfers_changed.connect(transfer_status_coalescer.poke)
+    Relay(bandwidth_signal.bandwidth_changed, update_bandwidth_status, status_bar)
     update_all()
     return status_bar
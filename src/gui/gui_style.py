@@ -40,7 +40,7 @@ def get_modern_style():
         background: #45475a;
         color: #6c7086;
     }
-    QListWidget {
+    QListWidget, QListView {
         background: rgba(49, 50, 68, 0.8);
         color: #cdd6f4;
         border: 1px solid #45475a;
@@ -50,19 +50,36 @@ def get_modern_style():
         selection-background-color: rgba(137, 180, 250, 0.3);
         outline: none;
     }
-    QListWidget::item {
+    QListWidget::item, QListView::item {
         padding: 12px;
         border-radius: 6px;
         margin: 2px 0px;
         border: none;
     }
-    QListWidget::item:selected {
+    QListWidget::item:selected, QListView::item:selected {
         background: rgba(137, 180, 250, 0.2);
         color: #89b4fa;
     }
-    QListWidget::item:hover {
+    QListWidget::item:hover, QListView::item:hover {
         background: rgba(137, 180, 250, 0.1);
     }
+    QTableView {
+        background: rgba(49, 50, 68, 0.8);
+        color: #cdd6f4;
+        border: 1px solid #45475a;
+        border-radius: 12px;
+        font-size: 12px;
+        selection-background-color: rgba(137, 180, 250, 0.2);
+        selection-color: #89b4fa;
+        outline: none;
+    }
+    QHeaderView::section {
+        background: #313244;
+        color: #a6adc8;
+        border: none;
+        padding: 6px;
+        font-weight: 600;
+    }
     QProgressBar {
         border: none;
         background: #313244;
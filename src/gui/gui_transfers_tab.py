@@ -1,4 +1,9 @@
-from PyQt5.QtWidgets import QWidget, QVBoxLayout, QHBoxLayout, QPushButton, QGroupBox, QVBoxLayout, QFrame, QLabel, QProgressBar
+from PyQt5.QtWidgets import (
+    QAbstractItemView, QWidget, QVBoxLayout, QHBoxLayout, QPushButton, QGroupBox, QHeaderView,
+    QLabel, QTableView
+)
+
+from .gui_models import Coalescer, ProgressDelegate, TransfersModel
 
 
 def create_transfers_tab(app_logic):
@@ -25,57 +30,33 @@ def create_transfers_tab(app_logic):
     transfers_layout.setSpacing(15)
     layout.addWidget(transfers_group)
 
+    # Rows are updated in place by the model; signals from the transfer
+    # threads only schedule a refresh, at most FRAME_RATE times a second
+    model = TransfersModel(app_logic.get_active_transfers, widget)
+    view = QTableView()
+    view.setModel(model)
+    view.setItemDelegateForColumn(TransfersModel.PROGRESS_COLUMN, ProgressDelegate(view))
+    view.setSelectionBehavior(QAbstractItemView.SelectRows)
+    view.setShowGrid(False)
+    view.setWordWrap(False)
+    view.verticalHeader().hide()
+    view.verticalHeader().setSectionResizeMode(QHeaderView.Fixed)
+    view.verticalHeader().setDefaultSectionSize(32)
+    header = view.horizontalHeader()
+    header.setSectionResizeMode(QHeaderView.Interactive)
+    header.setSectionResizeMode(0, QHeaderView.Stretch)
+    header.resizeSection(TransfersModel.PROGRESS_COLUMN, 160)
+    transfers_layout.addWidget(view)
+
+    empty_label = QLabel("No active transfers.")
+    empty_label.setStyleSheet("color: #6c7086; font-size: 13px;")
+    transfers_layout.addWidget(empty_label)
+
     def update_transfers():
-        # Clear previous widgets
-        while transfers_layout.count():
-            item = transfers_layout.takeAt(0)
-            if item is not None:
-                w = item.widget()
-                if w:
-                    w.deleteLater()
-        # Get active transfers from logic
-        transfers = app_logic.get_active_transfers()
-        if not transfers:
-            empty_label = QLabel("No active transfers.")
-            empty_label.setStyleSheet("color: #6c7086; font-size: 13px;")
-            transfers_layout.addWidget(empty_label)
-            return
-        for t in transfers:
-            transfer_item = QFrame()
-            transfer_item.setStyleSheet("""
-                QFrame {
-                    background: rgba(49, 50, 68, 0.3);
-                    border: 1px solid rgba(69, 71, 90, 0.5);
-                    border-radius: 8px;
-                    padding: 10px;
-                }
-            """)
-            transfer_layout = QVBoxLayout(transfer_item)
-            transfer_layout.setSpacing(8)
-            info_layout = QHBoxLayout()
-            filename_label = QLabel(f"📁 {t.filename}")
-            filename_label.setStyleSheet(
-                "QLabel { font-weight: 600; border: none; padding: 0; }")
-            status_label = QLabel(f"{t.status} {t.speed}")
-            status_label.setStyleSheet(
-                "QLabel { color: #6c7086; border: none; padding: 0; font-size: 11px; }")
-            info_layout.addWidget(filename_label)
-            info_layout.addStretch()
-            info_layout.addWidget(status_label)
-            transfer_layout.addLayout(info_layout)
-            progress_bar = QProgressBar()
-            progress_bar.setValue(int(t.progress))
-            progress_bar.setFormat(
-                f"{int(t.progress)}%" if t.progress < 100 else "Complete")
-            if t.progress >= 100:
-                progress_bar.setStyleSheet("""
-                    QProgressBar::chunk {
-                        background: qlineargradient(x1: 0, y1: 0, x2: 1, y2: 0,
-                                                  stop: 0 #a6e3a1, stop: 1 #94e2d5);
-                    }
-                """)
-            transfer_layout.addWidget(progress_bar)
-            transfers_layout.addWidget(transfer_item)
+        model.refresh()
+        empty = model.rowCount() == 0
+        empty_label.setVisible(empty)
+        view.setVisible(not empty)
 
     # Wire up control buttons
     def pause_all():
@@ -97,6 +78,7 @@ def create_transfers_tab(app_logic):
     cancel_btn.clicked.connect(cancel_all)
 
     # Connect FileManager signal for real-time updates
-    app_logic.file_manager.transfers_changed.connect(update_transfers)
+    coalescer = Coalescer(update_transfers, parent=widget)
+    app_logic.file_manager.transfers_changed.connect(coalescer.poke)
     update_transfers()
     return widget
@@ -0,0 +1,187 @@
+import os
+import stat
+
+from .protocol import OP_ENTRY, OP_FOLDER_END, ProtocolError, encode_frame, read_frame
+
+# A folder travels as a stream of OP_ENTRY frames over one connection: every
+# directory and regular file below the root, parents before children, each
+# file's bytes straight after its frame. Nothing is staged on either side;
+# the receiver creates each entry as soon as its bytes arrive. Frames and
+# small files are coalesced into one send of up to BATCH_SIZE bytes, so a
+# tree of many tiny files costs a few syscalls per file, not a connection.
+# The same stream carries a batch of unrelated files (OP_FILES), so sending
+# many small files never waits on a connect or a reply per file.
+BATCH_SIZE = 1024 * 1024
+SMALL_FILE = 64 * 1024  # bodies up to this size are copied into the batch
+
+
+def walk(root):
+    """Yield (relative path, os.DirEntry) for the directories and regular
+    files below root; paths use "/" and symlinks are skipped"""
+    stack = [""]
+    while stack:
+        rel_dir = stack.pop()
+        with os.scandir(os.path.join(root, rel_dir)) as it:
+            entries = sorted(it, key=lambda e: e.name)
+        for entry in entries:
+            rel = f"{rel_dir}/{entry.name}" if rel_dir else entry.name
+            if entry.is_dir(follow_symlinks=False):
+                yield rel, entry
+                stack.append(rel)
+            elif entry.is_file(follow_symlinks=False):
+                yield rel, entry
+
+
+def tree_size(root):
+    """Total size in bytes of the regular files below root"""
+    return sum(entry.stat(follow_symlinks=False).st_size
+               for _, entry in walk(root) if not entry.is_dir(follow_symlinks=False))
+
+
+def safe_join(root, rel):
+    """Join an archive path onto root, refusing anything that could escape it"""
+    parts = rel.split("/")
+    for part in parts:
+        if part in ("", ".", "..") or os.sep in part or (os.altsep and os.altsep in part):
+            raise ProtocolError(f"unsafe path in folder archive: {rel!r}")
+    return os.path.join(root, *parts)
+
+
+def batch_entries(paths):
+    """Archive entries for a list of files and folders: each lands in the
+    receiver's download directory under its own base name"""
+    for path in paths:
+        name = os.path.basename(os.path.normpath(path))
+        yield name, path
+        if os.path.isdir(path):
+            for rel, entry in walk(path):
+                yield f"{name}/{rel}", entry.path
+
+
+def send_archive(sock, root, send_body, on_bytes=None):
+    """Stream the tree below root; see send_entries"""
+    return send_entries(sock, ((rel, entry.path) for rel, entry in walk(root)), send_body,
+                        on_bytes)
+
+
+def send_entries(sock, entries, send_body, on_bytes=None):
+    """Stream (archive path, local path) entries, then OP_FOLDER_END.
+    `send_body(sock, f, count)` sends files too large to batch; `on_bytes`
+    is called with the file bytes in each batch once it is sent. Returns
+    (files, bytes)"""
+    files = total = 0
+    batch = bytearray()
+    batched = 0  # file bytes in batch
+
+    def flush():
+        nonlocal batched
+        sock.sendall(batch)
+        batch.clear()
+        if on_bytes and batched:
+            on_bytes(batched)
+        batched = 0
+
+    for rel, path in entries:
+        st = os.stat(path, follow_symlinks=False)
+        meta = {"path": rel, "mode": stat.S_IMODE(st.st_mode), "mtime": st.st_mtime_ns}
+        if stat.S_ISDIR(st.st_mode):
+            meta["dir"] = True
+            batch += encode_frame(OP_ENTRY, meta)
+        else:
+            size = meta["size"] = st.st_size
+            with open(path, "rb") as f:
+                batch += encode_frame(OP_ENTRY, meta)
+                if size <= SMALL_FILE:
+                    data = f.read(size)
+                    if len(data) < size:
+                        raise ProtocolError(f"{rel} shrank while being sent")
+                    batch += data
+                    batched += size
+                else:
+                    flush()
+                    if send_body(sock, f, size) < size:
+                        raise ProtocolError(f"{rel} shrank while being sent")
+            files += 1
+            total += size
+        if len(batch) >= BATCH_SIZE:
+            flush()
+    batch += encode_frame(OP_FOLDER_END, {"files": files, "bytes": total})
+    flush()
+    return files, total
+
+
+def _apply_metadata(path, meta):
+    try:
+        os.chmod(path, meta["mode"])
+        os.utime(path, ns=(meta["mtime"], meta["mtime"]))
+    except (OSError, KeyError):
+        pass
+
+
+def extract_archive(stream, root, buf, on_bytes=None, made=None):
+    """Create the entries read from `stream` (a buffered reader) under root
+    until OP_FOLDER_END, copying file bodies through `buf`. `made`, if
+    given, collects the directories created and files written, for
+    remove_extracted(). Returns (files, bytes)"""
+    buf = memoryview(buf)
+
+    def makedirs(path):
+        if made is not None and not os.path.isdir(path):
+            made.append(path)
+        os.makedirs(path, exist_ok=True)
+
+    makedirs(root)
+    created = {root}
+    dirs = []
+    files = total = 0
+    while True:
+        op, meta = read_frame(stream)
+        if op is None:
+            raise ProtocolError("connection closed inside a folder")
+        if op == OP_FOLDER_END:
+            break
+        if op != OP_ENTRY:
+            raise ProtocolError(f"unexpected opcode {op} inside a folder")
+        path = safe_join(root, meta["path"])
+        if meta.get("dir"):
+            makedirs(path)
+            created.add(path)
+            dirs.append((path, meta))
+            continue
+        parent = os.path.dirname(path)
+        if parent not in created:
+            makedirs(parent)
+            created.add(parent)
+        if made is not None:
+            made.append(path)
+        remaining = meta["size"]
+        with open(path, "wb") as f:
+            while remaining:
+                n = stream.readinto(buf[:min(len(buf), remaining)])
+                if not n:
+                    raise ProtocolError(f"connection closed inside {meta['path']}")
+                f.write(buf[:n])
+                remaining -= n
+                if on_bytes:
+                    on_bytes(n)
+        _apply_metadata(path, meta)
+        files += 1
+        total += meta["size"]
+    # Directories last and deepest first: writing their files would bump
+    # their mtimes, and a read-only mode would block those writes
+    for path, meta in reversed(dirs):
+        _apply_metadata(path, meta)
+    return files, total
+
+
+def remove_extracted(made):
+    """Delete what an interrupted extract_archive() wrote, as listed in its
+    `made`; directories that hold anything else are kept"""
+    for path in reversed(made):
+        try:
+            if os.path.isdir(path) and not os.path.islink(path):
+                os.rmdir(path)
+            else:
+                os.unlink(path)
+        except OSError:
+            pass
@@ -0,0 +1,466 @@
+import asyncio
+import collections
+import json
+import os
+import socket
+import struct
+import threading
+import time
+
+from .protocol import (
+    FRAME, MAGIC, OP_CONTROL, OP_DIGEST, OP_MISSING, OP_OFFER, OP_STRIPE, OP_VERIFY,
+    ProtocolError, encode_frame
+)
+from .transfer_control import TransferInterrupted
+
+# Optional asyncio transport. One event loop, running in a daemon thread,
+# multiplexes the TCP server, plain file sends and the discovery and chat
+# UDP sockets, so hundreds of concurrent transfers cost a coroutine each
+# rather than an OS thread each. The Qt signals in src/controller/signals.py
+# are emitted from the loop thread exactly as the threaded engine emits them
+# from its worker threads; Qt queues them onto the GUI thread.
+
+# How often a paused receive checks whether it was resumed.
+PAUSE_POLL = 0.05
+# Pause after a failed accept(), so running out of descriptors does not spin.
+ACCEPT_RETRY = 0.05
+
+
+class EventLoopThread:
+    """An asyncio event loop running forever in a daemon thread"""
+
+    def __init__(self):
+        self.loop = asyncio.new_event_loop()
+        self.thread = threading.Thread(target=self.loop.run_forever, daemon=True)
+        self.thread.start()
+
+    def submit(self, coro):
+        """Schedule a coroutine from any thread; returns a concurrent Future"""
+        return asyncio.run_coroutine_threadsafe(coro, self.loop)
+
+    def run(self, coro, timeout=None):
+        """Run a coroutine on the loop and block until it finishes"""
+        return self.submit(coro).result(timeout)
+
+
+_shared = None
+_shared_lock = threading.Lock()
+
+
+def shared_loop():
+    """The process-wide EventLoopThread, started on first use"""
+    global _shared
+    with _shared_lock:
+        if _shared is None:
+            _shared = EventLoopThread()
+        return _shared
+
+
+async def recv_exact(loop, sock, n):
+    """Async counterpart of protocol.recv_exact for non-blocking sockets"""
+    buf = bytearray(n)
+    view = memoryview(buf)
+    got = 0
+    while got < n:
+        k = await loop.sock_recv_into(sock, view[got:])
+        if not k:
+            return b""
+        got += k
+    return bytes(buf)
+
+
+async def recv_frame(loop, sock):
+    header = await recv_exact(loop, sock, FRAME.size)
+    if not header:
+        return None, None
+    op, length = FRAME.unpack(header)
+    payload = await recv_exact(loop, sock, length) if length else b"{}"
+    if length and not payload:
+        raise ProtocolError("connection closed inside a frame")
+    return op, json.loads(payload)
+
+
+def udp_socket(port, broadcast=False, reuse=False):
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    if broadcast:
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_BROADCAST, 1)
+    if reuse:
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    sock.bind(("", port))
+    sock.setblocking(False)
+    return sock
+
+
+class DatagramHandler(asyncio.DatagramProtocol):
+    """Forward every datagram to a callback(data, addr)"""
+
+    def __init__(self, callback):
+        self.callback = callback
+
+    def datagram_received(self, data, addr):
+        try:
+            self.callback(data, addr)
+        except Exception as e:
+            print(f"[ERROR] Handling datagram from {addr}: {e}")
+
+
+class AsyncTransport:
+    """Runs a NetworkManager's server, discovery and sends on the shared loop.
+
+    Plain transfers (legacy uploads, OP_OFFER, uncompressed OP_STRIPE and
+    OP_VERIFY) and control messages are handled entirely on the loop. Any
+    other frame (deduplicated, delta or compressed data, which is CPU-bound)
+    hands the rest of the connection to the manager's thread executor, with that
+    frame already read.
+    """
+
+    def __init__(self, network_manager):
+        self.nm = network_manager
+        self.runner = shared_loop()
+        self.loop = self.runner.loop
+        self._server = None
+        self._discovery = None
+        self._tasks = set()
+
+    def start(self):
+        self.runner.run(self._start())
+
+    def stop(self):
+        self.runner.run(self._stop())
+
+    def run(self, coro):
+        return self.runner.run(coro)
+
+    def _spawn(self, coro):
+        task = self.loop.create_task(coro)
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+        return task
+
+    async def _start(self):
+        server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        server.bind((self.nm.host, self.nm.port))
+        server.listen(512)
+        server.setblocking(False)
+        self._server = server
+        self._spawn(self._accept_loop())
+
+        sock = udp_socket(self.nm.broadcast_port, broadcast=True)
+        self._discovery, _ = await self.loop.create_datagram_endpoint(
+            lambda: DatagramHandler(self.nm._on_discovery_datagram), sock=sock)
+        self._spawn(self._beacon_loop())
+
+    async def _stop(self):
+        for task in list(self._tasks):
+            task.cancel()
+        if self._server:
+            self._server.close()
+            self._server = None
+        if self._discovery:
+            self._discovery.close()
+            self._discovery = None
+
+    async def _beacon_loop(self):
+        wakeup = asyncio.Event()
+        self.nm._wake_beacons = lambda: self.loop.call_soon_threadsafe(wakeup.set)
+        self.nm.beacons.reset()
+        while self.nm.running:
+            for addr, kind in self.nm.beacons.due():
+                try:
+                    self._discovery.sendto(self.nm._beacon(kind),
+                                           addr or ("<broadcast>", self.nm.broadcast_port))
+                except Exception:
+                    pass
+            try:
+                await asyncio.wait_for(wakeup.wait(), max(
+                    0.0, self.nm.beacons.next_time() - time.monotonic()))
+            except asyncio.TimeoutError:
+                pass
+            wakeup.clear()
+
+    # -------------------- Server --------------------
+    async def _accept_loop(self):
+        while self.nm.running:
+            try:
+                conn, addr = await self.loop.sock_accept(self._server)
+            except OSError:
+                # e.g. EMFILE or ECONNABORTED: one failed accept must not
+                # take the listener down
+                await asyncio.sleep(ACCEPT_RETRY)
+                continue
+            conn.setblocking(False)
+            self._spawn(self._handle_client(conn, addr))
+
+    async def _handle_client(self, conn, addr):
+        handed_off = False
+        try:
+            prefix = await recv_exact(self.loop, conn, 4)
+            if not prefix:
+                return
+            if prefix == MAGIC:
+                handed_off = await self._handle_session(conn, addr)
+                return
+            header = prefix + await recv_exact(self.loop, conn, 4)
+            name_len, file_size = struct.unpack("!II", header)
+            filename = (await recv_exact(self.loop, conn, name_len)).decode()
+            path = self.nm._download_path(filename)
+            with open(path, "wb") as f:
+                received = await self._recv_into(conn, file_size, f.write)
+            if received < file_size:
+                os.unlink(path)
+                print(f"[ERROR] Short read from {addr}: "
+                      f"{received}/{file_size} bytes of {filename}; discarded")
+        except asyncio.CancelledError:
+            raise
+        except TransferInterrupted:
+            pass  # already reported by whoever paused or cancelled it
+        except Exception as e:
+            print(f"[ERROR] Failed receiving from {addr}: {e}")
+        finally:
+            if not handed_off:
+                conn.close()
+
+    async def _handle_session(self, conn, addr):
+        """Serve plain-transfer frames; returns True if the connection was
+        handed to a worker thread"""
+        from .network import SESSION_IDLE_TIMEOUT, Session
+        session = Session(conn, addr)
+        try:
+            while True:
+                try:
+                    op, meta = await asyncio.wait_for(
+                        recv_frame(self.loop, conn), SESSION_IDLE_TIMEOUT)
+                except asyncio.TimeoutError:
+                    return False  # an idle pooled connection the sender forgot
+                if op is None:
+                    return False
+                if op == OP_OFFER:
+                    part = await self._acquire_incoming(session, meta)
+                    self.nm.incoming_control(meta, addr[0]).seek(part.received)
+                    await self.loop.sock_sendall(conn, encode_frame(
+                        OP_MISSING, {"id": meta["id"], "ranges": part.missing(), "verify": True}))
+                elif op == OP_STRIPE and not meta.get("codec"):
+                    await self._recv_stripe(session, meta)
+                elif op == OP_CONTROL:
+                    self.nm._recv_control(session, meta)
+                elif op == OP_VERIFY:
+                    await self._recv_verify(session, meta)
+                else:
+                    conn.setblocking(True)
+                    # The worker takes over the session's open files too
+                    self.loop.run_in_executor(
+                        self.nm.executor, self.nm._serve_session, conn, addr, op, meta, session)
+                    session = None
+                    return True
+        finally:
+            if session is not None:
+                for transfer_id, part in session.incoming.items():
+                    await self._release_incoming(transfer_id, part, addr[0])
+
+    async def _acquire_incoming(self, session, meta):
+        """NetworkManager._acquire_incoming on the executor: opening a new
+        PartialFile preallocates it, which must not hold up the loop"""
+        return await self.loop.run_in_executor(
+            self.nm.executor, self.nm._acquire_incoming, session, meta)
+
+    async def _release_incoming(self, transfer_id, part, peer_ip):
+        """NetworkManager._release_incoming on the executor while running:
+        holding a paused transfer waits for the sender's answer"""
+        if self.nm.running:
+            try:
+                return await self.loop.run_in_executor(
+                    self.nm.executor, self.nm._release_incoming, transfer_id, part, peer_ip)
+            except RuntimeError:  # shutting down
+                pass
+        self.nm._release_incoming(transfer_id, part, peer_ip)
+
+    async def _recv_stripe(self, session, meta):
+        part = await self._acquire_incoming(session, meta)
+        offset, length = meta["offset"], meta["length"]
+        position = [offset]
+
+        def write(data):
+            part.write_at(position[0], data)
+            position[0] += len(data)
+
+        control = self.nm.incoming_control(meta, session.addr[0])
+        try:
+            with self.nm._controlled(session.conn, control):
+                received = await self._recv_into(session.conn, length, write)
+        except Exception:
+            if control.cancelled:
+                self.nm._discard_incoming(meta["id"], part)
+            raise
+        if control.cancelled:
+            self.nm._discard_incoming(meta["id"], part)
+            raise TransferInterrupted("cancelled")
+        if received < length:
+            if not meta.get("hash"):
+                part.commit(offset, received)
+            raise ProtocolError(f"short stripe: {received}/{length} bytes at {offset}")
+        digest = None
+        if meta.get("hash"):
+            op, trailer = await recv_frame(self.loop, session.conn)
+            if op != OP_DIGEST:
+                raise ProtocolError(f"expected OP_DIGEST, got {op}")
+            digest = trailer["digest"]
+        self.nm._settle_stripe(meta, part, digest, session.addr[0])
+
+    async def _recv_verify(self, session, meta):
+        from .network import VERIFY_TIMEOUT
+        part = session.incoming.get(meta["id"])
+        if part is None:
+            raise ProtocolError(f"OP_VERIFY for unknown transfer {meta['id']}")
+        await self.loop.run_in_executor(
+            self.nm.executor, part.wait_settled, meta["sent"], VERIFY_TIMEOUT)
+        await self.loop.sock_sendall(session.conn, encode_frame(
+            OP_MISSING, {"id": meta["id"], "ranges": part.missing()}))
+
+    async def _recv_into(self, conn, count, write):
+        """Receive `count` bytes through a pooled buffer, passing each piece
+        to `write`; returns the number of bytes received"""
+        received = 0
+        with self.nm.buffer_pool.buffer() as buf:
+            while received < count:
+                n = await self.loop.sock_recv_into(conn, buf[:min(len(buf), count - received)])
+                if not n:
+                    break
+                write(buf[:n])
+                received += n
+                self.nm._download_bytes += n
+                await self._throttle(self.nm.download_limit, conn, n)
+        return received
+
+    # -------------------- Sending --------------------
+    async def _connect(self, peer_ip):
+        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        sock.setblocking(False)
+        try:
+            port = self.nm.peers.port_of(peer_ip, self.nm.port)
+            await self.loop.sock_connect(sock, (peer_ip, port))
+        except Exception:
+            sock.close()
+            raise
+        return sock
+
+    async def send_file(self, peer_ip, filename, meta, control=None):
+        """Offer the file, then send the ranges the receiver is missing over
+        `streams` connections, re-sending any that fail verification.
+        `control` may pause or cancel it between chunks."""
+        from .network import VERIFY_RETRIES
+        try:
+            sock = await self._connect(peer_ip)
+            try:
+                with self.nm._controlled(sock, control):
+                    await self.loop.sock_sendall(sock, MAGIC + encode_frame(OP_OFFER, meta))
+                    reply = await self._recv_missing(sock)
+                    missing = reply["ranges"]
+                    if control is not None:
+                        control.seek(meta["size"] - sum(e - s for s, e in missing))
+                    verify = self.nm.verify and reply.get("verify", False)
+                    for _ in range(VERIFY_RETRIES + 1):
+                        await self._send_ranges(sock, peer_ip, filename, meta, missing, verify,
+                                                control)
+                        if not verify or not missing:
+                            break
+                        await self.loop.sock_sendall(sock, encode_frame(
+                            OP_VERIFY, {"id": meta["id"], "sent": missing}))
+                        missing = (await self._recv_missing(sock))["ranges"]
+                        if control is not None:
+                            control.seek(meta["size"] - sum(e - s for s, e in missing))
+                        if not missing:
+                            break
+                        print(f"[WARN] Re-sending {sum(e - s for s, e in missing)} corrupted "
+                              f"bytes of {filename} → {peer_ip}")
+                    else:
+                        raise ProtocolError(f"{filename} still corrupted after "
+                                            f"{VERIFY_RETRIES} retries")
+            finally:
+                sock.close()
+            print(f"[OK] Sent {filename} → {peer_ip}")
+            return True
+        except Exception as e:
+            if control is None or not control.stopped:
+                print(f"[ERROR] Sending to {peer_ip}: {e}")
+            return False
+
+    async def _recv_missing(self, sock):
+        op, reply = await recv_frame(self.loop, sock)
+        if op != OP_MISSING:
+            raise ProtocolError(f"expected OP_MISSING, got {op}")
+        return reply
+
+    async def _send_ranges(self, sock, peer_ip, filename, meta, ranges, verify, control=None):
+        """Send ranges as stripes over `sock` plus up to `streams` - 1 extra
+        connections, which are closed afterwards"""
+        from .network import STRIPE_SIZE
+        pieces = collections.deque()
+        for start, end in ranges:
+            for offset in range(start, end, STRIPE_SIZE):
+                pieces.append((offset, min(STRIPE_SIZE, end - offset)))
+        socks = [sock]
+        try:
+            for _ in range(min(self.nm.streams, len(pieces)) - 1):
+                extra = await self._connect(peer_ip)
+                socks.append(extra)
+                await self.loop.sock_sendall(extra, MAGIC)
+            await asyncio.gather(*(self._send_pieces(s, filename, meta, pieces, verify, control)
+                                   for s in socks))
+        finally:
+            for extra in socks[1:]:
+                extra.close()
+
+    async def _send_pieces(self, sock, filename, meta, pieces, verify, control):
+        with self.nm._controlled(sock, control), open(filename, "rb") as f:
+            while pieces:
+                offset, length = pieces.popleft()
+                stripe = dict(meta, offset=offset, length=length)
+                if verify:
+                    # Hashed on the hash executor while the stripe is sent
+                    digest = self.loop.run_in_executor(
+                        self.nm.hash_executor, self.nm._hash_range, filename, offset, length)
+                    stripe["hash"] = self.nm.hash_name
+                await self.loop.sock_sendall(sock, encode_frame(OP_STRIPE, stripe))
+                await self._send_body(sock, f, length, offset)
+                if verify:
+                    await self.loop.sock_sendall(
+                        sock, encode_frame(OP_DIGEST, {"digest": await digest}))
+
+    async def _send_body(self, sock, f, count, offset):
+        from .network import CHUNK_SIZE, SENDFILE_CHUNK
+        step = CHUNK_SIZE if self.nm.upload_limit.enabled else SENDFILE_CHUNK
+        sent = 0
+        while sent < count:
+            if self.nm.zero_copy:
+                # sock_sendfile falls back to read/send where sendfile() is
+                # unavailable; slicing keeps the upload counter moving
+                n = await self.loop.sock_sendfile(
+                    sock, f, offset + sent, min(step, count - sent))
+            else:
+                f.seek(offset + sent)
+                data = f.read(min(CHUNK_SIZE, count - sent))
+                if data:
+                    await self.loop.sock_sendall(sock, data)
+                n = len(data)
+            if not n:
+                break
+            sent += n
+            self.nm._upload_bytes += n
+            await self._throttle(self.nm.upload_limit, sock, n)
+        return sent
+
+    async def _throttle(self, limiter, sock, n):
+        """Charge `n` bytes to a rate limiter and honour a pause or cancel,
+        without blocking the loop"""
+        if limiter.enabled:
+            from .network import peer_ip_of
+            delay = limiter.reserve(peer_ip_of(sock), n)
+            if delay > 0:
+                await asyncio.sleep(delay)
+        control = self.nm._sock_controls.get(sock)
+        if control is not None:
+            control.moved(n)
+            parked = time.monotonic()
+            while control.poll(time.monotonic() - parked):
+                await asyncio.sleep(PAUSE_POLL)
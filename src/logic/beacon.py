@@ -0,0 +1,110 @@
+import math
+import random
+import threading
+import time
+
+from decouple import config
+
+# Seconds between discovery broadcasts right after startup, and the most
+# they back off to once the peer set is stable
+beacon_min = config("P2P_BEACON_MIN", default=1, cast=float)
+beacon_max = config("P2P_BEACON_MAX", default=30, cast=float)
+# Every wait is stretched or shrunk by up to this fraction, so peers started
+# together drift apart instead of beaconing in lock-step
+BEACON_JITTER = 0.2
+# Answers to a newcomer are spread over this many seconds
+REPLY_SPREAD = 0.5
+# Beacons in a row a peer can miss before it drops us
+MISSED_BEACONS = 3
+
+
+class BeaconScheduler:
+    """When to send discovery beacons, and to whom.
+
+    Broadcasts start every `min_interval` seconds and the gap doubles after
+    each one, up to `max_interval`, except while new peers are still
+    turning up. Since the gap keeps growing, every beacon says how long its
+    receivers should keep us listed (`ttl()`, enough for MISSED_BEACONS
+    lost in a row).
+
+    Known peers are refreshed by unicast instead of waiting on broadcasts:
+    a peer whose beacon adds it to our table is answered directly, so a
+    newcomer learns the whole network within REPLY_SPREAD seconds (or from
+    our next broadcast, if that is two fast rounds away at most), and every
+    third of the table's ttl the peers gone quiet for most of theirs (or
+    added by hand, and perhaps out of broadcast reach) are probed, which
+    they answer the same way. Answers are never answered.
+
+    due() returns what to send now as (addr, kind) pairs, addr None for a
+    broadcast and kind one of "beacon", "reply" or "probe"; next_time() is
+    when to call it again.
+    """
+
+    def __init__(self, peers, port, min_interval=beacon_min, max_interval=beacon_max,
+                 jitter=BEACON_JITTER, rng=None):
+        self.peers = peers
+        self.port = port  # where peers listen for unicast beacons
+        self.min_interval = min_interval
+        self.max_interval = max(min_interval, max_interval)
+        self.jitter = jitter
+        self.rng = rng or random.Random()
+        self.interval = min_interval
+        self._next_broadcast = 0.0
+        self._pending = {}  # addr -> when to send it a reply
+        self._settled = False
+        # No peer of ours asks for less than the table's ttl, so this
+        # probes a quiet one at least once before it expires
+        self.probe_interval = peers.ttl / MISSED_BEACONS
+        self._next_probe = 0.0
+        self._lock = threading.Lock()  # heard() runs on the receiving thread
+
+    def reset(self, now=None):
+        """Beacon fast again, e.g. at startup or on a new network"""
+        now = time.monotonic() if now is None else now
+        self.interval = self.min_interval
+        self._next_broadcast = now
+        self._next_probe = now + self.probe_interval
+        self._settled = False
+
+    def ttl(self):
+        """Seconds receivers of our next beacon should keep us for: long
+        enough for MISSED_BEACONS lost even if the gap doubles again, and
+        never less than the table's default"""
+        gap = min(2 * self.interval, self.max_interval) * (1 + self.jitter)
+        return max(math.ceil(MISSED_BEACONS * gap), self.peers.ttl)
+
+    def heard(self, addr, meta, added, now=None):
+        """Note a beacon from `addr`; `added` is whether it put the peer in
+        our table. Returns whether an answer was queued."""
+        if added:
+            self._settled = False
+        if meta.get("reply") or not (added or meta.get("probe")):
+            return False
+        now = time.monotonic() if now is None else now
+        if added and self._next_broadcast <= now + 2 * self.min_interval:
+            return False  # our broadcast will reach it about as soon
+        with self._lock:
+            self._pending.setdefault(addr, now + self.rng.uniform(0, REPLY_SPREAD))
+        return True
+
+    def next_time(self):
+        with self._lock:
+            return min(self._next_broadcast, self._next_probe, *self._pending.values())
+
+    def due(self, now=None):
+        now = time.monotonic() if now is None else now
+        with self._lock:
+            sends = [(addr, "reply") for addr, when in self._pending.items() if when <= now]
+            for addr, _ in sends:
+                del self._pending[addr]
+        if now >= self._next_broadcast:
+            if self._settled:
+                self.interval = min(self.interval * 2, self.max_interval)
+            self._settled = True
+            self._next_broadcast = now + self.interval * self.rng.uniform(
+                1 - self.jitter, 1 + self.jitter)
+            sends.append((None, "beacon"))
+        if now >= self._next_probe:
+            self._next_probe = now + self.probe_interval
+            sends.extend(((ip, self.port), "probe") for ip in self.peers.stale(now))
+        return sends
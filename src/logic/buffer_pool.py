@@ -0,0 +1,44 @@
+import queue
+import threading
+from contextlib import contextmanager
+
+
+class BufferPool:
+    """Fixed set of preallocated receive buffers shared by worker threads.
+
+    Buffers are handed out as memoryviews so callers can slice them without
+    copying. When every buffer is in use a temporary one is allocated rather
+    than blocking the caller; it is dropped on release so the pool never grows.
+    """
+
+    def __init__(self, count, size):
+        self.size = size
+        self._free = queue.LifoQueue()
+        self._lock = threading.Lock()
+        self.misses = 0
+        for _ in range(count):
+            self._free.put(memoryview(bytearray(size)))
+        self.capacity = count
+
+    def acquire(self):
+        try:
+            return self._free.get_nowait()
+        except queue.Empty:
+            with self._lock:
+                self.misses += 1
+            return memoryview(bytearray(self.size))
+
+    def release(self, buf):
+        if self._free.qsize() < self.capacity:
+            self._free.put(buf)
+
+    @contextmanager
+    def buffer(self):
+        buf = self.acquire()
+        try:
+            yield buf
+        finally:
+            self.release(buf)
+
+    def available(self):
+        return self._free.qsize()
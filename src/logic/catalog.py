@@ -0,0 +1,152 @@
+import hashlib
+import os
+import sqlite3
+import threading
+
+# Content hashes of shared files, as hex digests of this hashlib algorithm
+HASH_NAME = "sha256"
+HASH_READ_SIZE = 1024 * 1024
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS files (
+    id INTEGER PRIMARY KEY,
+    path TEXT NOT NULL UNIQUE,
+    size INTEGER,
+    mtime_ns INTEGER,
+    hash TEXT,
+    tags TEXT NOT NULL DEFAULT ''
+)
+"""
+_HASH_INDEX = "CREATE INDEX IF NOT EXISTS files_hash ON files (hash)"
+
+
+def file_hash(path, stop=None):
+    """Hex digest of the contents of `path`, or None if the `stop` event
+    was set while reading"""
+    h = hashlib.new(HASH_NAME)
+    with open(path, "rb") as f:
+        while True:
+            if stop is not None and stop.is_set():
+                return None
+            data = f.read(HASH_READ_SIZE)
+            if not data:
+                break
+            h.update(data)
+    return h.hexdigest()
+
+
+class Catalog:
+    """SQLite table of shared files: path, size, mtime, content hash and
+    tags, keyed by a stable integer id.
+
+    Every change is a small transaction touching only the rows concerned,
+    so sharing one more file does not rewrite the whole list. The database
+    runs in WAL mode: a commit appends to the log instead of rewriting
+    pages in place, and a crash leaves the last committed state. Size,
+    mtime and hash are NULL until the file has been looked at.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self.created = not os.path.exists(path)
+        self._db = sqlite3.connect(path, check_same_thread=False)
+        self._lock = threading.Lock()
+        with self._lock:
+            self._db.execute("PRAGMA journal_mode=WAL")
+            self._db.execute("PRAGMA synchronous=NORMAL")  # safe with WAL
+            self._db.execute(_SCHEMA)
+            self._db.execute(_HASH_INDEX)
+            self._db.commit()
+
+    def _write(self, sql, rows):
+        with self._lock, self._db:
+            return self._db.executemany(sql, rows).rowcount
+
+    def paths(self):
+        """{id: path} of every file, in id order"""
+        with self._lock:
+            return dict(self._db.execute("SELECT id, path FROM files ORDER BY id"))
+
+    def sizes(self):
+        """{id: size} of every file whose size is known"""
+        with self._lock:
+            return dict(self._db.execute("SELECT id, size FROM files WHERE size IS NOT NULL"))
+
+    def tagged(self):
+        """{id: comma-separated tags} of every file that has tags"""
+        with self._lock:
+            return dict(self._db.execute("SELECT id, tags FROM files WHERE tags != ''"))
+
+    def containing(self, words):
+        """{id: (path, tags)} of files whose path or tags contain every one
+        of `words`, ignoring ASCII case (SQLite's LIKE)"""
+        where = " AND ".join("(path LIKE ? OR tags LIKE ?)" for _ in words) or "1"
+        args = [f"%{word}%" for word in words for _ in range(2)]
+        with self._lock:
+            rows = self._db.execute(f"SELECT id, path, tags FROM files WHERE {where}", args)
+            return {row[0]: row[1:] for row in rows}
+
+    def add(self, paths):
+        """Insert new paths; returns [(id, path)] of those not already there"""
+        added = []
+        with self._lock, self._db:
+            for path in paths:
+                cursor = self._db.execute("INSERT OR IGNORE INTO files (path) VALUES (?)", (path,))
+                if cursor.rowcount:
+                    added.append((cursor.lastrowid, path))
+        return added
+
+    def remove(self, ids):
+        return self._write("DELETE FROM files WHERE id = ?", ((i,) for i in ids))
+
+    def stats(self, ids):
+        """{id: (size, mtime_ns, hash)} for those of `ids` still present"""
+        ids = list(ids)
+        if not ids:
+            return {}
+        with self._lock:
+            rows = self._db.execute(
+                f"SELECT id, size, mtime_ns, hash FROM files WHERE id IN ({','.join('?' * len(ids))})",
+                ids).fetchall()
+        return {row[0]: row[1:] for row in rows}
+
+    def update_stats(self, rows):
+        """Record new (id, size, mtime_ns); the old hash no longer applies"""
+        self._write("UPDATE files SET size = ?, mtime_ns = ?, hash = NULL WHERE id = ?",
+                    ((size, mtime_ns, item_id) for item_id, size, mtime_ns in rows))
+
+    def set_hashes(self, rows):
+        """Record (id, size, mtime_ns, hash) digests. A row is only updated
+        while its size and mtime still match, so a hash of contents that
+        changed while they were read never lands."""
+        self._write("UPDATE files SET hash = ? WHERE id = ? AND size = ? AND mtime_ns = ?",
+                    ((digest, item_id, size, mtime_ns) for item_id, size, mtime_ns, digest in rows))
+
+    def set_tags(self, item_id, tags):
+        self._write("UPDATE files SET tags = ? WHERE id = ?", [(",".join(tags), item_id)])
+
+    def path_for_hash(self, digest):
+        """Path of a file with that content hash, or None"""
+        with self._lock:
+            row = self._db.execute("SELECT path FROM files WHERE hash = ? LIMIT 1",
+                                   (digest,)).fetchone()
+        return row[0] if row else None
+
+    def entries(self, ids):
+        """{id: (path, size, hash, tags)} for those of `ids` still present"""
+        ids = list(ids)
+        if not ids:
+            return {}
+        with self._lock:
+            rows = self._db.execute(
+                f"SELECT id, path, size, hash, tags FROM files WHERE id IN ({','.join('?' * len(ids))})",
+                ids).fetchall()
+        return {row[0]: (row[1], row[2], row[3], row[4].split(",") if row[4] else [])
+                for row in rows}
+
+    def close(self):
+        with self._lock:
+            self._db.close()
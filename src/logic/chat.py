@@ -4,23 +4,61 @@ import socket
 import threading
 from decouple import config
 
+from .interfaces import shared_registry
+
 
 port = config("CHAT_PORT", default=5002, cast=int)
+use_asyncio = config("P2P_ASYNCIO", default=False, cast=bool)
 
 
 class ChatManager:
-    def __init__(self, chat_display, username=None, port=port):
+    def __init__(self, chat_display, username=None, port=port, use_asyncio=use_asyncio,
+                 network_manager=None):
         self.chat_display = chat_display
+        # When set, messages for a single peer go over its pooled TCP
+        # connection; broadcast chat stays on UDP
+        self.network_manager = network_manager
         self.username = username or self._get_local_ip()
         self.port = port
+        self.use_asyncio = use_asyncio
+        # Codec names offered with each incoming transfer request, by request id
+        self.offered_codecs = {}
+        # Optional features (e.g. "delta") the requester supports, by request id
+        self.offered_features = {}
+        self._transport = None
         self.running = False
 
     def start(self):
         self.running = True
+        if self._shares_discovery_port():
+            # Discovery already listens here; it passes chat datagrams on
+            self.network_manager.datagram_handler = self._dispatch
+            return
+        if self.use_asyncio:
+            # Listen on the shared event loop instead of a dedicated thread
+            from .async_engine import DatagramHandler, shared_loop, udp_socket
+            runner = shared_loop()
+            sock = udp_socket(self.port, reuse=True)
+            self._transport, _ = runner.run(runner.loop.create_datagram_endpoint(
+                lambda: DatagramHandler(self._dispatch), sock=sock))
+            return
         threading.Thread(target=self._listen, daemon=True).start()
 
     def stop(self):
         self.running = False
+        if self._shares_discovery_port() and \
+                self.network_manager.datagram_handler == self._dispatch:
+            self.network_manager.datagram_handler = None
+        if self._transport:
+            from .async_engine import shared_loop
+            shared_loop().loop.call_soon_threadsafe(self._transport.close)
+            self._transport = None
+
+    def _shares_discovery_port(self):
+        """Whether chat and discovery use the same port (both default to
+        5002), which only one socket can be bound to"""
+        return self.network_manager is not None and \
+            self.network_manager.broadcast_port == self.port
 
     def send_message(self, msg):
         message = f"CHAT:{self.username}:{msg}"
@@ -29,52 +67,70 @@ class ChatManager:
         sock.sendto(message.encode(), ("<broadcast>", self.port))
         sock.close()
 
-    def send_transfer_request(self, target_ip, filename, file_size, is_folder=False):
+    def send_transfer_request(self, target_ip, filename, file_size, is_folder=False, codecs=(),
+                              features=()):
         request_id = str(uuid.uuid4())
         message = f"TRANSFER_REQUEST:{self.username}:{request_id}:{filename}:{file_size}:{is_folder}"
-        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-        sock.sendto(message.encode(), (target_ip, self.port))
-        sock.close()
+        if codecs or features:
+            # Older peers split off five fields and ignore these
+            message += ":" + ",".join(codecs)
+        if features:
+            message += ":" + ",".join(features)
+        self._send_to(target_ip, message)
         return request_id
 
     def send_transfer_response(self, target_ip, request_id, response):
         message = f"TRANSFER_RESPONSE:{self.username}:{request_id}:{response}"
+        self._send_to(target_ip, message)
+
+    def _send_to(self, target_ip, message):
+        if self.network_manager:
+            try:
+                if self.network_manager.send_control(target_ip, message):
+                    return
+            except OSError:
+                pass  # no TCP route to the peer; fall back to a datagram
         sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
         sock.sendto(message.encode(), (target_ip, self.port))
         sock.close()
 
     def _listen(self):
-        # Import moved here to avoid circular import
-        from src.controller import chat_signal
-        from src.controller import transfer_request_signal
         sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
         sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
         sock.bind(("", self.port))
         while self.running:
             try:
                 data, addr = sock.recvfrom(4096)
-                decoded = data.decode(errors="ignore")
-                if decoded.startswith("CHAT:"):
-                    _, sender, message = decoded.split(":", 2)
-                    chat_signal.message_received.emit(sender, message)
-                elif decoded.startswith("TRANSFER_REQUEST:"):
-                    _, sender, request_id, filename, file_size, is_folder = decoded.split(
-                        ":", 5)
-                    transfer_request_signal.transfer_request_received.emit(
-                        addr[0], filename, file_size, request_id)
-                elif decoded.startswith("TRANSFER_RESPONSE:"):
-                    _, sender, request_id, response = decoded.split(":", 3)
-                    transfer_request_signal.transfer_response_received.emit(
-                        request_id, response)
+                self._dispatch(data, addr)
             except Exception:
                 pass
 
+    def _dispatch(self, data, addr):
+        """Turn one chat datagram into the matching Qt signal"""
+        # Import moved here to avoid circular import
+        from src.controller import chat_signal
+        from src.controller import transfer_request_signal
+        decoded = data.decode(errors="ignore")
+        if decoded.startswith("CHAT:"):
+            _, sender, message = decoded.split(":", 2)
+            chat_signal.message_received.emit(sender, message)
+        elif decoded.startswith("TRANSFER_REQUEST:"):
+            _, sender, request_id, filename, file_size, is_folder = decoded.split(
+                ":", 5)
+            is_folder, _, codecs = is_folder.partition(":")
+            codecs, _, features = codecs.partition(":")
+            if codecs:
+                self.offered_codecs[request_id] = codecs.split(",")
+            if features:
+                self.offered_features[request_id] = features.split(",")
+            transfer_request_signal.transfer_request_received.emit(
+                addr[0], filename, file_size, request_id)
+        elif decoded.startswith("TRANSFER_RESPONSE:"):
+            _, sender, request_id, response = decoded.split(":", 3)
+            transfer_request_signal.transfer_response_received.emit(
+                request_id, response)
+
     def _get_local_ip(self):
-        s = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-        try:
-            s.connect(("8.8.8.8", 80))
-            return s.getsockname()[0]
-        except:
-            return "127.0.0.1"
-        finally:
-            s.close()
+        if self.network_manager:
+            return self.network_manager._get_local_ip()
+        return shared_registry().primary
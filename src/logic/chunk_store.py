@@ -0,0 +1,155 @@
+import hashlib
+import os
+import re
+import threading
+import zlib
+from collections import Counter, OrderedDict
+
+# Content-defined chunking parameters. A chunk boundary may fall after an
+# anchor byte once MIN_CHUNK bytes have passed, and is taken when the
+# checksum of the WINDOW bytes ending there has its low bits clear. Because
+# the decision depends only on nearby content, an insertion early in a file
+# shifts later boundaries along with the data instead of changing every
+# chunk after it. Anchors keep the per-byte scan inside the C regex engine.
+MIN_CHUNK = 16 * 1024
+MAX_CHUNK = 256 * 1024
+WINDOW = 48
+BOUNDARY_MASK = 0xFF  # ~1 in 256 anchors cuts: about 64 KiB chunks on binary data
+_ANCHOR = re.compile(rb"[\n\x9e]")
+
+READ_SIZE = 4 * 1024 * 1024
+
+
+def chunk_digest(data):
+    return hashlib.blake2b(data, digest_size=16).hexdigest()
+
+
+def find_boundary(data, start):
+    """Return the end offset of the chunk of `data` starting at `start`"""
+    end = min(start + MAX_CHUNK, len(data))
+    pos = start + MIN_CHUNK
+    while pos < end:
+        m = _ANCHOR.search(data, pos, end)
+        if m is None:
+            break
+        i = m.end()
+        if not zlib.crc32(data[i - WINDOW:i]) & BOUNDARY_MASK:
+            return i
+        pos = i
+    return end
+
+
+def chunk_file(f):
+    """Yield (offset, length, digest) for the content-defined chunks of `f`"""
+    buf = b""
+    pos = 0  # start of the next chunk within buf
+    base = 0  # file offset of buf[0]
+    eof = False
+    while True:
+        if not eof and len(buf) - pos < MAX_CHUNK:
+            data = f.read(READ_SIZE)
+            if data:
+                buf = buf[pos:] + data
+                base += pos
+                pos = 0
+            else:
+                eof = True
+            continue
+        if pos >= len(buf):
+            return
+        end = find_boundary(buf, pos)
+        yield base + pos, end - pos, chunk_digest(buf[pos:end])
+        pos = end
+
+
+class ChunkStore:
+    """Chunks on disk keyed by their BLAKE2b digest, with an LRU size cap.
+
+    Chunks pinned by an in-flight transfer are never evicted, so a receiver
+    that promised to have a chunk still has it when it reassembles the file.
+    """
+
+    def __init__(self, root, max_bytes):
+        self.root = root
+        self.max_bytes = max_bytes
+        self.total = 0
+        self.lock = threading.Lock()
+        self._index = OrderedDict()  # digest -> size, least recently used first
+        self._pinned = Counter()
+        os.makedirs(root, exist_ok=True)
+        self._load_index()
+
+    def _path(self, digest):
+        return os.path.join(self.root, digest[:2], digest)
+
+    def _load_index(self):
+        entries = []
+        for sub in os.scandir(self.root):
+            if not sub.is_dir():
+                continue
+            for entry in os.scandir(sub.path):
+                if entry.name.endswith(".tmp"):
+                    continue
+                st = entry.stat()
+                entries.append((st.st_mtime, entry.name, st.st_size))
+        for _, digest, size in sorted(entries):
+            self._index[digest] = size
+            self.total += size
+
+    def has(self, digest):
+        with self.lock:
+            return digest in self._index
+
+    def get(self, digest):
+        with self.lock:
+            if digest not in self._index:
+                raise KeyError(digest)
+            self._index.move_to_end(digest)
+        path = self._path(digest)
+        with open(path, "rb") as f:
+            data = f.read()
+        os.utime(path)  # so LRU order survives a restart
+        return data
+
+    def put(self, digest, data):
+        with self.lock:
+            if digest in self._index:
+                self._index.move_to_end(digest)
+                return
+        path = self._path(digest)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp = path + ".tmp"
+        with open(tmp, "wb") as f:
+            f.write(data)
+        os.replace(tmp, path)
+        with self.lock:
+            if digest not in self._index:
+                self._index[digest] = len(data)
+                self.total += len(data)
+            self._evict()
+
+    def pin(self, digests):
+        with self.lock:
+            self._pinned.update(digests)
+
+    def unpin(self, digests):
+        with self.lock:
+            self._pinned.subtract(digests)
+            self._pinned += Counter()  # drop non-positive counts
+            self._evict()
+
+    def _evict(self):
+        """Drop least recently used, unpinned chunks until under the cap"""
+        if self.total <= self.max_bytes:
+            return
+        for digest in list(self._index):
+            if self.total <= self.max_bytes:
+                break
+            if self._pinned[digest] > 0:
+                continue
+            size = self._index.pop(digest)
+            self.total -= size
+            try:
+                os.unlink(self._path(digest))
+            except OSError:
+                pass
@@ -0,0 +1,104 @@
+import lzma
+import struct
+import zlib
+
+from .protocol import ProtocolError
+
+# Optional compression of file data on the wire. The sender offers codec
+# names in the transfer request, the receiver answers with the one it picked,
+# and stripes of the file then travel as a sequence of independently
+# compressed blocks, each prefixed by BLOCK (kind, length). A block that does
+# not shrink goes out RAW, so one incompressible region costs nothing more
+# than its header.
+BLOCK = struct.Struct("!BI")
+RAW = 0
+PACKED = 1
+BLOCK_SIZE = 1024 * 1024  # raw bytes per compressed block
+# Before compressing a file the sender compresses its first SAMPLE_SIZE bytes;
+# unless that saves at least MIN_SAVING the file is sent uncompressed.
+SAMPLE_SIZE = 64 * 1024
+MIN_SAVING = 0.1
+
+
+class Codec:
+    def __init__(self, name, compress, decompress, default_level, levels):
+        self.name = name
+        self.compress = compress  # (data, level) -> bytes
+        # (data, limit) -> bytes, raising ProtocolError rather than
+        # producing more than `limit` bytes
+        self.decompress = decompress
+        self.default_level = default_level
+        self.levels = levels
+
+
+_codecs = {}
+
+
+def register_codec(name, compress, decompress, default_level, levels):
+    """Make a codec available for negotiation; earlier ones are preferred"""
+    _codecs[name] = Codec(name, compress, decompress, default_level, levels)
+
+
+def get_codec(name):
+    return _codecs[name]
+
+
+def available_codecs():
+    return list(_codecs)
+
+
+def parse_spec(spec):
+    """"zlib:6" -> (zlib codec, 6); a bare name uses the default level"""
+    name, _, level = spec.partition(":")
+    codec = get_codec(name.strip())
+    return codec, int(level) if level else codec.default_level
+
+
+def negotiate(offered):
+    """The first offered codec name we also support, or None"""
+    for name in offered:
+        if name in _codecs:
+            return name
+    return None
+
+
+def worth_compressing(codec, level, sample):
+    if not sample:
+        return False
+    return len(codec.compress(sample, level)) <= len(sample) * (1 - MIN_SAVING)
+
+
+def encode_block(codec, level, data):
+    packed = codec.compress(data, level)
+    if len(packed) < len(data):
+        return BLOCK.pack(PACKED, len(packed)) + packed
+    return BLOCK.pack(RAW, len(data)) + bytes(data)
+
+
+def decode_block(codec, kind, payload, limit=BLOCK_SIZE):
+    """The raw bytes of a block; one that would decode to more than `limit`
+    bytes raises ProtocolError"""
+    if kind == PACKED:
+        return codec.decompress(payload, limit)
+    if len(payload) > limit:
+        raise ProtocolError(f"raw block of {len(payload)} bytes, over its {limit}")
+    return payload
+
+
+def _bounded(decompressor, data, limit):
+    """Decompress one whole stream of at most `limit` bytes. Asking for a
+    byte more tells a stream that is too long from one that just fits."""
+    out = decompressor.decompress(data, limit + 1)
+    if len(out) > limit:
+        raise ProtocolError(f"compressed block expands past {limit} bytes")
+    if not decompressor.eof or decompressor.unused_data:
+        raise ProtocolError("compressed block is truncated or has trailing data")
+    return out
+
+
+register_codec("zlib", lambda data, level: zlib.compress(data, level),
+               lambda data, limit: _bounded(zlib.decompressobj(), data, limit),
+               6, range(1, 10))
+register_codec("lzma", lambda data, level: lzma.compress(data, preset=level),
+               lambda data, limit: _bounded(lzma.LZMADecompressor(), data, limit),
+               1, range(0, 10))
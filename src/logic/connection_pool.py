@@ -0,0 +1,150 @@
+import select
+import socket
+import threading
+import time
+from collections import Counter
+from contextlib import contextmanager
+
+from .protocol import MAGIC
+
+# TCP keep-alive probes for pooled connections: start after KEEPALIVE_IDLE
+# quiet seconds, then every KEEPALIVE_INTERVAL, giving up after
+# KEEPALIVE_COUNT unanswered probes. This notices peers that vanished from
+# the network without closing their connections.
+KEEPALIVE_IDLE = 30
+KEEPALIVE_INTERVAL = 10
+KEEPALIVE_COUNT = 3
+
+
+def enable_keepalive(sock):
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
+    for name, value in (("TCP_KEEPIDLE", KEEPALIVE_IDLE),
+                        ("TCP_KEEPINTVL", KEEPALIVE_INTERVAL),
+                        ("TCP_KEEPCNT", KEEPALIVE_COUNT)):
+        if hasattr(socket, name):
+            try:
+                sock.setsockopt(socket.IPPROTO_TCP, getattr(socket, name), value)
+            except OSError:
+                pass
+
+
+class ConnectionPool:
+    """Warm framed connections to peers, shared by transfers and control
+    messages.
+
+    Every pooled connection has already sent MAGIC, so callers write frames
+    straight away and hand the connection back once the exchange is over.
+    At most `max_per_peer` connections to a peer are open at a time, idle or
+    in use; prune() closes those idle for longer than `idle_timeout`.
+    """
+
+    def __init__(self, port, max_per_peer=4, idle_timeout=30.0, port_of=None):
+        self.port = port
+        # Called with (peer ip, default port) for the port a peer listens
+        # on, when peers may advertise one of their own
+        self.port_of = port_of
+        self.max_per_peer = max(1, max_per_peer)
+        self.idle_timeout = idle_timeout
+        self.created = 0
+        self.reused = 0
+        self.closed = False
+        self._idle = {}  # peer ip -> [(socket, idle since), ...], most recent last
+        self._open = Counter()
+        self._cond = threading.Condition()
+
+    def acquire(self, peer_ip, block=True, connect_timeout=None):
+        """Return a connection to peer_ip; with block=False, None if the
+        peer's limit is reached and nothing is idle. A new connection gives
+        up after `connect_timeout` seconds, if set."""
+        with self._cond:
+            while True:
+                idle = self._idle.get(peer_ip)
+                while idle:
+                    sock, _ = idle.pop()
+                    if self._alive(sock):
+                        self.reused += 1
+                        return sock
+                    self._discard(peer_ip, sock)
+                if self._open[peer_ip] < self.max_per_peer:
+                    self._open[peer_ip] += 1
+                    break
+                if not block:
+                    return None
+                self._cond.wait()
+        try:
+            port = self.port_of(peer_ip, self.port) if self.port_of else self.port
+            sock = socket.create_connection((peer_ip, port), connect_timeout)
+            sock.settimeout(None)
+            enable_keepalive(sock)
+            sock.sendall(MAGIC)
+        except Exception:
+            with self._cond:
+                self._open[peer_ip] -= 1
+                self._cond.notify_all()
+            raise
+        self.created += 1
+        return sock
+
+    def release(self, peer_ip, sock, reuse=True):
+        """Hand a connection back; it is closed unless `reuse` is set and
+        the last exchange on it completed"""
+        with self._cond:
+            if reuse and not self.closed:
+                self._idle.setdefault(peer_ip, []).append((sock, time.monotonic()))
+            else:
+                self._discard(peer_ip, sock)
+            self._cond.notify_all()
+
+    @contextmanager
+    def connection(self, peer_ip, reuse=True):
+        """A pooled connection that goes back to the pool only if the block
+        finishes without an exception"""
+        sock = self.acquire(peer_ip)
+        ok = False
+        try:
+            yield sock
+            ok = True
+        finally:
+            self.release(peer_ip, sock, reuse and ok)
+
+    def idle_count(self, peer_ip):
+        with self._cond:
+            return len(self._idle.get(peer_ip, ()))
+
+    def prune(self):
+        """Close connections that have been idle for too long"""
+        cutoff = time.monotonic() - self.idle_timeout
+        with self._cond:
+            for peer_ip, idle in list(self._idle.items()):
+                for sock, since in [e for e in idle if e[1] < cutoff]:
+                    idle.remove((sock, since))
+                    self._discard(peer_ip, sock)
+                if not idle:
+                    del self._idle[peer_ip]
+            self._cond.notify_all()
+
+    def close(self):
+        with self._cond:
+            self.closed = True
+            for peer_ip, idle in self._idle.items():
+                for sock, _ in idle:
+                    self._discard(peer_ip, sock)
+            self._idle.clear()
+            self._cond.notify_all()
+
+    def _discard(self, peer_ip, sock):
+        self._open[peer_ip] -= 1
+        try:
+            sock.close()
+        except OSError:
+            pass
+
+    @staticmethod
+    def _alive(sock):
+        """An idle connection has nothing to read; if it is readable the peer
+        closed it (or broke the protocol) and it cannot be reused"""
+        try:
+            readable, _, _ = select.select([sock], [], [], 0)
+        except (OSError, ValueError):
+            return False
+        return not readable
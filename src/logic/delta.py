@@ -0,0 +1,137 @@
+import hashlib
+import math
+import zlib
+
+# rsync-style delta encoding. The receiver describes its copy of a file as
+# one signature per fixed-size block: a weak Adler-32 checksum that can be
+# rolled one byte at a time, plus a short BLAKE2b hash to confirm matches.
+# The sender slides a block-sized window over its version and, wherever the
+# window matches a block, emits a reference to it instead of the bytes.
+
+MIN_BLOCK = 1024
+MAX_BLOCK = 64 * 1024
+READ_SIZE = 4 * 1024 * 1024
+_MOD = 65521  # Adler-32 modulus
+
+
+def block_size_for(size):
+    """About sqrt(size) bytes per block, rounded to 1 KiB and clamped"""
+    block = int(math.sqrt(size)) // 1024 * 1024
+    return max(MIN_BLOCK, min(MAX_BLOCK, block))
+
+
+def strong_hash(data):
+    return hashlib.blake2b(data, digest_size=8).hexdigest()
+
+
+def signatures(f, block_size):
+    """Return [[weak, strong], ...] for every block of `f`; the last block
+    may be shorter than block_size"""
+    sigs = []
+    while True:
+        block = f.read(block_size)
+        if not block:
+            return sigs
+        sigs.append([zlib.adler32(block), strong_hash(block)])
+
+
+def delta_ops(f, size, block_size, sigs):
+    """Yield the ops that rebuild `f` from the receiver's blocks.
+
+    ("copy", first_block, count) reuses receiver blocks;
+    ("data", offset, length) sends bytes of `f` at that offset.
+    """
+    if not sigs:
+        if size:
+            yield ("data", 0, size)
+        return
+    table = {}
+    for index, (weak, strong) in enumerate(sigs):
+        table.setdefault(weak, {}).setdefault(strong, index)
+
+    literal_start = 0
+    run = None  # pending [first_block, count]
+    buf = b""
+    base = 0  # file offset of buf[0]
+    pos = 0  # window start within buf
+    eof = False
+    a = b = None  # rolling Adler-32 halves for buf[pos:pos + block_size]
+
+    def flush_run():
+        nonlocal run
+        if run:
+            yield ("copy", run[0], run[1])
+            run = None
+
+    while True:
+        if not eof and len(buf) - pos <= block_size:
+            data = f.read(READ_SIZE)
+            if data:
+                buf = buf[pos:] + data
+                base += pos
+                pos = 0
+                continue
+            eof = True
+        if len(buf) - pos < block_size:
+            break
+        if a is None:
+            checksum = zlib.adler32(buf[pos:pos + block_size])
+            a, b = checksum & 0xFFFF, checksum >> 16
+        # Roll byte by byte until the weak checksum hits the table. This is
+        # the only per-byte Python loop, so it keeps everything in locals.
+        end = len(buf) - block_size
+        while (b << 16) | a not in table and pos < end:
+            out, new = buf[pos], buf[pos + block_size]
+            a = (a - out + new) % _MOD
+            b = (b - block_size * out + a - 1) % _MOD
+            pos += 1
+        matches = table.get((b << 16) | a)
+        if matches:
+            index = matches.get(strong_hash(buf[pos:pos + block_size]))
+            if index is not None:
+                offset = base + pos
+                if offset > literal_start:
+                    yield from flush_run()
+                    yield ("data", literal_start, offset - literal_start)
+                if run and run[0] + run[1] == index:
+                    run[1] += 1
+                else:
+                    yield from flush_run()
+                    run = [index, 1]
+                pos += block_size
+                literal_start = base + pos
+                a = None
+                continue
+        if base + pos - literal_start >= READ_SIZE:
+            # Changed data goes out as the window passes it rather than at
+            # the next match, so the receiver keeps hearing from us while
+            # the scan crawls through a file unlike its copy
+            yield from flush_run()
+            yield ("data", literal_start, base + pos - literal_start)
+            literal_start = base + pos
+        if pos >= end:
+            if eof:
+                break
+            continue  # refill, then keep rolling
+        out, new = buf[pos], buf[pos + block_size]
+        a = (a - out + new) % _MOD
+        b = (b - block_size * out + a - 1) % _MOD
+        pos += 1
+
+    # A tail shorter than a block can still equal the receiver's last block,
+    # which is short whenever its file size is not a multiple of block_size.
+    tail_start = base + pos
+    tail = buf[pos:]
+    last = len(sigs) - 1
+    if 0 < len(tail) < block_size and strong_hash(tail) == sigs[last][1]:
+        if tail_start > literal_start:
+            yield from flush_run()
+            yield ("data", literal_start, tail_start - literal_start)
+        if not (run and run[0] + run[1] == last):
+            yield from flush_run()
+            run = [last, 0]
+        run[1] += 1
+        literal_start = size
+    yield from flush_run()
+    if size > literal_start:
+        yield ("data", literal_start, size - literal_start)
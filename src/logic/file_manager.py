@@ -1,37 +1,87 @@
 from PyQt5.QtCore import QObject, pyqtSignal
+from decouple import config
+import math
 import threading
 import time
 
+from .transfer_control import TransferControl
+
+# Most progress updates published per second for one transfer; the byte
+# pumps report every chunk, which would otherwise flood the GUI
+progress_rate = config("P2P_PROGRESS_RATE", default=10, cast=float)
+
+# Time constant, in seconds, of the moving average that smooths the speed
+SPEED_WINDOW = 2.0
+
+
+def format_speed(rate):
+    if rate >= 1024 * 1024:
+        return f"{rate / (1024 * 1024):.2f} MB/s"
+    return f"{rate / 1024:.2f} KB/s"
+
 
 class FileTransfer:
-    def __init__(self, filename, peer_ip, size):
+    def __init__(self, filename, peer_ip, size, incoming=False, park=None):
         self.filename = filename
         self.peer_ip = peer_ip
         self.size = size
+        self.incoming = incoming
         self.progress = 0
+        self.transferred = 0
         self.status = "Queued"
         self.speed = ""
+        self.rate = None  # smoothed bytes per second
         self.paused = False
         self.cancelled = False
+        self.started = False
+        # Lets pause/cancel reach the byte pumps moving this transfer; a
+        # receiving pump parks rather than giving up its connection, unless
+        # `park` says otherwise
+        self.control = TransferControl(park=incoming if park is None else park)
         self.lock = threading.Lock()
-        self.last_update = time.time()
-        self.last_progress = 0
+        self.last_update = time.monotonic()
+        self.last_transferred = 0
 
-    def update_progress(self, progress):
+    def record(self, transferred, force=False):
+        """Take a new byte count, updating progress and speed at most
+        `progress_rate` times a second; returns whether it did"""
+        with self.lock:
+            now = time.monotonic()
+            self.transferred = transferred = min(transferred, self.size)
+            elapsed = now - self.last_update
+            if elapsed >= 1 / progress_rate:
+                # Shorter intervals (forced updates) make for noisy samples
+                moved = transferred - self.last_transferred
+                if moved >= 0:
+                    sample = moved / elapsed
+                    if self.rate is None:
+                        self.rate = sample
+                    else:
+                        self.rate += (1 - math.exp(-elapsed / SPEED_WINDOW)) * (sample - self.rate)
+                    self.speed = format_speed(self.rate)
+                self.last_update = now
+                self.last_transferred = transferred
+            elif not force:
+                return False
+            self.progress = 100 * transferred / self.size if self.size else 100
+            return True
+
+    def restart_clock(self):
+        """Start measuring speed afresh, e.g. once a queued transfer runs"""
         with self.lock:
-            now = time.time()
-            delta_bytes = (progress - self.last_progress) / 100 * self.size
-            delta_time = now - self.last_update
-            if delta_time > 0:
-                self.speed = f"{(delta_bytes / delta_time) / 1024:.2f} KB/s"
-            self.last_update = now
-            self.last_progress = progress
+            self.last_update = time.monotonic()
+            self.last_transferred = self.transferred
+            self.rate = None
+            self.speed = ""
 
+    def update_progress(self, progress):
+        self.record(progress / 100 * self.size, force=True)
+        with self.lock:
             self.progress = progress
             if progress >= 100:
                 self.status = "Completed"
             elif not self.paused and not self.cancelled:
-                self.status = "Downloading"
+                self.status = "Running"
 
 
 class FileManager(QObject):
@@ -42,18 +92,53 @@ class FileManager(QObject):
         self.transfers = {}
         self.lock = threading.Lock()
 
-    def add_transfer(self, filename, peer_ip, size):
+    def add_transfer(self, filename, peer_ip, size, incoming=False, park=None):
         with self.lock:
             key = (filename, peer_ip)
-            transfer = FileTransfer(filename, peer_ip, size)
+            transfer = FileTransfer(filename, peer_ip, size, incoming, park)
+            transfer.control.on_progress = lambda n: self._progress(transfer, n)
             self.transfers[key] = transfer
             self.transfers_changed.emit()
             return transfer
 
+    def add_incoming(self, filename, peer_ip, size):
+        """Track a file a peer is sending us; it runs until its pumps call
+        the control's finish()"""
+        transfer = self.add_transfer(filename, peer_ip, size, incoming=True)
+        transfer.control.on_finish = lambda ok: self._finished(transfer, ok)
+        self.set_status(transfer, "Running")
+        return transfer
+
+    def _progress(self, transfer, transferred):
+        if transfer.record(transferred):
+            self.transfers_changed.emit()
+
+    def _finished(self, transfer, ok):
+        if ok:
+            self.set_status(transfer, "Completed")
+        elif not transfer.cancelled:
+            self.set_status(transfer, "Cancelled" if transfer.control.cancelled else "Failed")
+
     def get_active_transfers(self):
         with self.lock:
             return [t for t in self.transfers.values()
-                    if t.status in ("Queued", "Downloading", "Paused") and not t.cancelled]
+                    if t.status in ("Queued", "Running", "Paused") and not t.cancelled]
+
+    def set_status(self, transfer, status):
+        """Move a transfer to a new state (Queued, Running, Paused, Completed,
+        Failed)"""
+        if status == "Running":
+            transfer.restart_clock()
+        with transfer.lock:
+            transfer.started = status == "Running"
+            if transfer.paused and status == "Running":
+                status = "Paused"
+            if status == "Completed":
+                transfer.transferred, transfer.progress = transfer.size, 100
+            if status != "Running":
+                transfer.speed = ""
+            transfer.status = status
+        self.transfers_changed.emit()
 
     def pause_transfer(self, filename, peer_ip):
         key = (filename, peer_ip)
@@ -61,6 +146,8 @@ class FileManager(QObject):
             t = self.transfers[key]
             t.paused = True
             t.status = "Paused"
+            t.speed = ""
+            t.control.pause()
             self.transfers_changed.emit()
 
     def resume_transfer(self, filename, peer_ip):
@@ -68,7 +155,9 @@ class FileManager(QObject):
         if key in self.transfers:
             t = self.transfers[key]
             t.paused = False
-            t.status = "Downloading"
+            t.status = "Running" if t.started else "Queued"
+            t.restart_clock()
+            t.control.resume()
             self.transfers_changed.emit()
 
     def cancel_transfer(self, filename, peer_ip):
@@ -77,6 +166,7 @@ class FileManager(QObject):
             t = self.transfers[key]
             t.cancelled = True
             t.status = "Cancelled"
+            t.control.cancel()
             self.transfers_changed.emit()
 
     def update_progress(self, filename, peer_ip, progress):
@@ -0,0 +1,161 @@
+import select
+import socket
+import struct
+import threading
+import time
+
+from decouple import config
+
+try:
+    import fcntl
+except ImportError:  # Windows: interfaces are found through the host name only
+    fcntl = None
+
+# Seconds between re-reads of the local addresses when the OS gives no
+# change notifications
+interface_refresh = config("P2P_INTERFACE_REFRESH", default=30, cast=float)
+
+SIOCGIFADDR = 0x8915
+# rtnetlink multicast groups: links going up or down, IPv4 addresses
+# added or removed
+RTMGRP_LINK = 0x1
+RTMGRP_IPV4_IFADDR = 0x10
+
+
+def route_address():
+    """The address outgoing traffic leaves from, or None without a default
+    route. connect() on a UDP socket only looks up the route; nothing is
+    sent."""
+    s = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    try:
+        s.connect(("8.8.8.8", 80))
+        return s.getsockname()[0]
+    except Exception:
+        return None
+    finally:
+        s.close()
+
+
+def local_addresses():
+    """Every IPv4 address of this host: the one on each interface where the
+    OS will say (Linux), plus what the host name resolves to"""
+    addresses = set()
+    if fcntl is not None and hasattr(socket, "if_nameindex"):
+        s = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        try:
+            for _, name in socket.if_nameindex():
+                try:
+                    request = struct.pack("256s", name.encode()[:15])
+                    addresses.add(socket.inet_ntoa(
+                        fcntl.ioctl(s.fileno(), SIOCGIFADDR, request)[20:24]))
+                except OSError:
+                    pass  # no IPv4 address on this interface
+        except OSError:
+            pass
+        finally:
+            s.close()
+    try:
+        for *_, sockaddr in socket.getaddrinfo(socket.gethostname(), None, socket.AF_INET):
+            addresses.add(sockaddr[0])
+    except OSError:
+        pass
+    return addresses
+
+
+def _change_monitor():
+    """A non-blocking rtnetlink socket that turns readable when an address
+    or link changes, or None where there is no netlink"""
+    if not hasattr(socket, "AF_NETLINK"):
+        return None
+    try:
+        sock = socket.socket(socket.AF_NETLINK, socket.SOCK_RAW, socket.NETLINK_ROUTE)
+    except OSError:
+        return None
+    try:
+        sock.bind((0, RTMGRP_LINK | RTMGRP_IPV4_IFADDR))
+        sock.setblocking(False)
+    except OSError:
+        sock.close()
+        return None
+    return sock
+
+
+class InterfaceRegistry:
+    """The addresses of this host, enumerated once and cached.
+
+    is_local() is a set lookup, cheap enough for every discovery datagram,
+    and primary is the address we show and chat under. poll() re-reads
+    the interfaces when netlink reports a change (Linux) or, failing that,
+    every `refresh` seconds.
+
+    Loopback addresses are left out of the set, so peers run side by side
+    on one host still see each other's beacons.
+    """
+
+    def __init__(self, refresh=interface_refresh, list_addresses=local_addresses,
+                 route=route_address, watch=True):
+        self.refresh_interval = refresh
+        self._list_addresses = list_addresses
+        self._route = route
+        self._monitor = _change_monitor() if watch else None
+        self._lock = threading.Lock()
+        self.addresses = frozenset()
+        self.primary = "127.0.0.1"
+        self._checked = 0
+        self.refresh()
+
+    def is_local(self, ip):
+        return ip in self.addresses
+
+    def refresh(self, now=None):
+        """Enumerate the addresses again; returns whether they changed"""
+        addresses = {ip for ip in self._list_addresses() if not ip.startswith("127.")}
+        primary = self._route()
+        if primary is not None and not primary.startswith("127."):
+            addresses.add(primary)
+        elif addresses:
+            # No default route: any LAN address is better than loopback
+            primary = min(addresses)
+        else:
+            primary = "127.0.0.1"
+        with self._lock:
+            self._checked = time.monotonic() if now is None else now
+            changed = addresses != self.addresses or primary != self.primary
+            self.addresses = frozenset(addresses)
+            self.primary = primary
+        return changed
+
+    def poll(self, now=None):
+        """Refresh if the interfaces changed or the cache is due; returns
+        whether the addresses changed"""
+        now = time.monotonic() if now is None else now
+        notified = False
+        if self._monitor is not None:
+            try:
+                while select.select([self._monitor], [], [], 0)[0]:
+                    notified = True
+                    self._monitor.recv(65536)  # only the wake-up matters
+            except OSError:
+                pass
+        if notified or (self.refresh_interval > 0
+                        and now - self._checked >= self.refresh_interval):
+            return self.refresh(now)
+        return False
+
+    def close(self):
+        if self._monitor is not None:
+            self._monitor.close()
+            self._monitor = None
+
+
+_shared = None
+_shared_lock = threading.Lock()
+
+
+def shared_registry():
+    """The process-wide InterfaceRegistry, enumerated on first use"""
+    global _shared
+    with _shared_lock:
+        if _shared is None:
+            _shared = InterfaceRegistry()
+        return _shared
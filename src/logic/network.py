@@ -1,51 +1,279 @@
 import socket
 import threading
 import os
+import errno
 import time
+import queue
 import struct
+import hashlib
+import json
+from contextlib import contextmanager
 from decouple import config
 from concurrent.futures import ThreadPoolExecutor
 
+from .archive import (
+    batch_entries, extract_archive, remove_extracted, safe_join, send_archive, send_entries,
+    tree_size
+)
+from .beacon import BeaconScheduler
+from .buffer_pool import BufferPool
+from .chunk_store import MAX_CHUNK, ChunkStore, chunk_digest, chunk_file
+from .codecs import (
+    BLOCK, BLOCK_SIZE, SAMPLE_SIZE, decode_block, encode_block, get_codec, parse_spec,
+    worth_compressing
+)
+from .connection_pool import ConnectionPool
+from .delta import block_size_for, delta_ops, signatures
+from .interfaces import shared_registry
+from .partial_file import PartialFile, covers, discard_partial
+from .peer_table import PeerTable
+from .rate_limit import RateLimiter
+from .relay import RelayStream, build_tree, fan_out, relay_fanout, tree_peers
+from .swarm import PIECE_SIZE, SwarmDownload
+from .transfer_control import TransferControl, TransferInterrupted
+from .protocol import (
+    MAGIC, OP_BROWSE, OP_CHUNK_NEED, OP_CHUNK_OFFER, OP_DELTA_COPY, OP_DELTA_DATA,
+    OP_DELTA_END, OP_CANCEL, OP_CONTROL, OP_DELTA_OFFER, OP_DIGEST, OP_FILES, OP_FOLDER,
+    OP_FOLDER_END, OP_GET, OP_HAVE, OP_HOLD, OP_MISSING, OP_OFFER, OP_PIECE, OP_RELAY,
+    OP_RELAY_DONE, OP_RESULTS, OP_RESUME, OP_SIGNATURES, OP_STRIPE, OP_VERIFY, OP_WANT,
+    ProtocolError, recv_exact, recv_frame, send_frame
+)
+
 
 port = config("P2P_PORT", default=5001, cast=int)
 broadcast_port = config("P2P_BROADCAST_PORT", default=5002, cast=int)
+zero_copy = config("P2P_ZERO_COPY", default=True, cast=bool)
+streams = config("P2P_STREAMS", default=1, cast=int)
+dedup = config("P2P_DEDUP", default=False, cast=bool)
+chunk_store_mb = config("P2P_CHUNK_STORE_MB", default=12288, cast=int)
+use_asyncio = config("P2P_ASYNCIO", default=False, cast=bool)
+pool_size = config("P2P_POOL_SIZE", default=4, cast=int)
+pool_idle = config("P2P_POOL_IDLE", default=30, cast=float)
+# Codecs offered to receivers in preference order, e.g. "zlib:1" or
+# "lzma:1,zlib:6"; empty sends everything uncompressed
+compression = config("P2P_COMPRESSION", default="")
+# Checksum every stripe (with this hashlib algorithm) and re-send any that
+# arrive corrupted
+verify = config("P2P_VERIFY", default=True, cast=bool)
+hash_name = config("P2P_HASH", default="sha256")
+# Bandwidth caps in KB/s, overall and for each peer; 0 is unlimited
+upload_limit = config("P2P_UPLOAD_LIMIT", default=0, cast=int)
+download_limit = config("P2P_DOWNLOAD_LIMIT", default=0, cast=int)
+peer_upload_limit = config("P2P_PEER_UPLOAD_LIMIT", default=0, cast=int)
+peer_download_limit = config("P2P_PEER_DOWNLOAD_LIMIT", default=0, cast=int)
+
+CHUNK_SIZE = 65536
+# Size of each pooled receive buffer used with recv_into().
+RECV_BUFFER_SIZE = 256 * 1024
+# Bytes handed to one os.sendfile() call. Kept small enough that the upload
+# counter read by _bandwidth_monitor advances several times per interval.
+SENDFILE_CHUNK = 1024 * 1024
+# Files are sent as ranges of this size; with `streams` > 1 the ranges are
+# spread over that many parallel connections.
+STRIPE_SIZE = 4 * 1024 * 1024
+# Rounds of re-sending corrupted stripes before a transfer is given up.
+VERIFY_RETRIES = 3
+# How long OP_VERIFY waits for stripes still being received or checked.
+VERIFY_TIMEOUT = 60
+# Most entries sent in one OP_RESULTS page.
+MAX_BROWSE_PAGE = 1000
+# A framed session with no traffic for this long is closed by the receiver.
+# Longer than the sender's pool idle timeout, so the sender normally closes
+# a warm connection before the receiver gives up on it.
+SESSION_IDLE_TIMEOUT = 120
+# How long a receiver waits for the sender to answer OP_HOLD or OP_RESUME.
+HOLD_TIMEOUT = 10
+# How long a control message waits to connect before falling back to UDP;
+# it is sent from the GUI thread.
+CONTROL_CONNECT_TIMEOUT = 3
+# Discovery beacons start with DISCOVERY_MAGIC, followed by a space and
+# JSON {port, name, caps} advertising our transfer port, display name and
+# the CAPABILITIES we serve; a bare DISCOVERY_MAGIC (older versions)
+# advertises nothing.
+DISCOVERY_MAGIC = b"PEER_DISCOVERY"
+CAPABILITIES = ["browse", "swarm", "relay"]
+# errno values meaning "sendfile() can't be used for this fd pair", after
+# which we fall back to the read/sendall loop.
+_SENDFILE_UNSUPPORTED = {errno.EINVAL, errno.ENOSYS, errno.ENOTSOCK,
+                         errno.EOPNOTSUPP, errno.EBADF}
+
+
+def peer_ip_of(sock):
+    try:
+        return sock.getpeername()[0]
+    except OSError:
+        return ""
+
+
+class Session:
+    """Per-connection state for a framed connection"""
+
+    def __init__(self, conn, addr):
+        self.conn = conn
+        self.addr = addr
+        self.incoming = {}  # transfer id -> PartialFile this connection holds open
 
 
 class NetworkManager:
-    def __init__(self, port=port, broadcast_port=broadcast_port, max_workers=10):
+    def __init__(self, port=port, broadcast_port=broadcast_port, max_workers=10,
+                 zero_copy=zero_copy, download_dir=".", streams=streams, dedup=dedup,
+                 use_asyncio=use_asyncio, pool_size=pool_size, pool_idle=pool_idle,
+                 compression=compression, verify=verify, hash_name=hash_name, host=""):
         self.port = port
+        self.host = host  # address the transfer server listens on; "" for all
         self.broadcast_port = broadcast_port
-        self.peers = set()
+        self.zero_copy = zero_copy and hasattr(os, "sendfile")
+        self.download_dir = download_dir
+        self.streams = max(1, streams)
+        self.dedup = dedup
+        self.compression = [parse_spec(spec) for spec in compression.split(",") if spec.strip()]
+        self.verify = verify
+        self.hash_name = hash_name
+        # Stripe checksums are computed here, alongside the sends and
+        # receives they check rather than in line with them
+        self.hash_executor = ThreadPoolExecutor(max_workers=min(4, os.cpu_count() or 1))
+        # Token buckets throttling each direction, adjustable at runtime
+        # with set_rate_limits()
+        self.upload_limit = RateLimiter(upload_limit * 1024, peer_upload_limit * 1024)
+        self.download_limit = RateLimiter(download_limit * 1024, peer_download_limit * 1024)
+        # With use_asyncio the server, discovery and plain sends run on one
+        # event loop (see async_engine.py) instead of a thread per connection
+        self.use_asyncio = use_asyncio
+        self._engine = None
+        # Peers found by discovery, each dropped a while after its last
+        # beacon; AppLogic sets its on_change to update the GUI
+        self.peers = PeerTable()
+        self.name = socket.gethostname()  # advertised in our beacons
+        # Our own addresses, to ignore our own beacons by
+        self.interfaces = shared_registry()
+        self.beacons = BeaconScheduler(self.peers, broadcast_port)
+        # Called when a beacon is queued, to wake whichever loop sends them
+        self._wake_beacons = lambda: None
+        # Warm connections to each peer, reused by transfers and control messages
+        self.pool = ConnectionPool(port, pool_size, pool_idle, port_of=self.peers.port_of)
+        # Called with (data, addr) for chat-protocol messages that arrive
+        # over TCP; AppLogic points it at ChatManager._dispatch
+        self.control_handler = None
+        # Called with (data, addr) for datagrams on the discovery port that
+        # are not beacons; a ChatManager sharing that port sets it rather
+        # than binding the port a second time
+        self.datagram_handler = None
+        # Called with (meta, peer ip) when a file starts arriving; returns the
+        # TransferControl its pumps report to (AppLogic adds it to the
+        # transfers table), or None for one of our own
+        self.incoming_handler = None
+        # Called with (query, offset, limit, substring) when a peer browses
+        # our shared files; returns (total, entries) for OP_RESULTS.
+        # AppLogic points it at SharedLibrary.browse
+        self.browse_handler = None
+        # Called once a receiver releases a transfer it held, to start it
+        # again; AppLogic points it at TransferScheduler.dispatch
+        self.release_handler = None
+        # Called with a content hash when a peer wants pieces of a file;
+        # returns the path of a shared file with that content, or None.
+        # AppLogic points it at SharedLibrary.path_for_hash
+        self.content_handler = None
+        # Swarm downloads in progress, by content hash, whose pieces we pass
+        # on to the rest of the swarm; and files downloaded that way, which
+        # we keep serving for as long as we run
+        self._swarms = {}
+        self.seeds = {}
+        self._chunk_store = None  # created on first deduplicated transfer
+        self._chunk_store_lock = threading.Lock()
         self.running = False
         self.executor = ThreadPoolExecutor(max_workers=max_workers)
+        # One receive buffer per executor worker, reused across connections
+        self.buffer_pool = BufferPool(max_workers, RECV_BUFFER_SIZE)
+        # Files being written by one or more framed connections, by transfer id
+        self._incoming = {}
+        self._incoming_lock = threading.Lock()
+        # Pause/cancel switches: for incoming files by transfer id, and for
+        # whichever transfer is using a socket at the moment
+        self._incoming_controls = {}
+        self._sock_controls = {}
+        # Sending side of OP_HOLD: controls of files being sent, and of those
+        # their receivers hold, by (peer ip, transfer id). Receiving side:
+        # the sender of each incoming transfer we keep paused, by transfer id
+        self._outgoing = {}
+        self._held = {}
+        self._holding = {}
+        # Connections a worker is serving frames on; stop() shuts them so an
+        # idle pooled one does not hold its worker (and exit) for
+        # SESSION_IDLE_TIMEOUT
+        self._sessions = set()
+        self._sessions_lock = threading.Lock()
+        self._frame_handlers = {
+            OP_STRIPE: self._recv_stripe,
+            OP_OFFER: self._recv_offer,
+            OP_CHUNK_OFFER: self._recv_chunk_offer,
+            OP_DELTA_OFFER: self._recv_delta_offer,
+            OP_FOLDER: self._recv_folder,
+            OP_FILES: self._recv_files,
+            OP_CONTROL: self._recv_control,
+            OP_VERIFY: self._recv_verify,
+            OP_CANCEL: self._recv_cancel,
+            OP_BROWSE: self._recv_browse,
+            OP_WANT: self._recv_want,
+            OP_GET: self._recv_get,
+            OP_RELAY: self._recv_relay,
+            OP_HOLD: self._recv_hold,
+            OP_RESUME: self._recv_resume,
+        }
         self._udp_sock = None  # Store UDP socket for cleanup
         self._server_sock = None  # Store TCP server socket for cleanup
         self._download_bytes = 0
         self._upload_bytes = 0
         self._last_bandwidth_emit = time.time()
         self._bandwidth_interval = 1.0  # seconds
-        threading.Thread(target=self._bandwidth_monitor, daemon=True).start()
+        self._closed = threading.Event()
+        self._threads = [threading.Thread(target=self._bandwidth_monitor, daemon=True)]
+        self._threads[0].start()
 
     def start(self):
         self.running = True
-        threading.Thread(target=self._discover_peers, daemon=True).start()
-        threading.Thread(target=self._start_server, daemon=True).start()
+        if self.use_asyncio:
+            from .async_engine import AsyncTransport
+            self._engine = AsyncTransport(self)
+            self._engine.start()
+            return
+        for target in (self._discover_peers, self._start_server):
+            thread = threading.Thread(target=target, daemon=True)
+            thread.start()
+            self._threads.append(thread)
 
     def stop(self):
         self.running = False
-        self.executor.shutdown(wait=False)
-        if self._udp_sock:
-            try:
-                self._udp_sock.close()
-            except Exception:
-                pass
-            self._udp_sock = None
-        if self._server_sock:
+        self._closed.set()
+        self._wake_beacons()
+        if self._engine:
+            self._engine.stop()
+            self._engine = None
+        self.pool.close()
+        with self._sessions_lock:
+            sessions, self._sessions = self._sessions, set()
+        for conn in sessions:
+            # Only shut down: the worker blocked reading it wakes and closes
+            # it, where closing it here could free the fd for reuse under it
             try:
-                self._server_sock.close()
-            except Exception:
+                conn.shutdown(socket.SHUT_RDWR)
+            except OSError:
                 pass
-            self._server_sock = None
+        self.executor.shutdown(wait=False)
+        self.hash_executor.shutdown(wait=False)
+        for name in ("_udp_sock", "_server_sock"):
+            sock = getattr(self, name)
+            if sock:
+                # close() alone leaves a thread blocked in recvfrom() or
+                # accept() holding the port; shutdown() wakes it
+                try:
+                    sock.shutdown(socket.SHUT_RDWR)
+                except OSError:
+                    pass
+                try:
+                    sock.close()
+                except Exception:
+                    pass
+                setattr(self, name, None)
 
     # -------------------- Peer Discovery --------------------
     def _discover_peers(self):
@@ -53,23 +281,22 @@ class NetworkManager:
         sock.setsockopt(socket.SOL_SOCKET, socket.SO_BROADCAST, 1)
         sock.bind(("", self.broadcast_port))
         self._udp_sock = sock
-
-        def broadcast():
-            while self.running:
-                try:
-                    sock.sendto(b"PEER_DISCOVERY",
-                                ("<broadcast>", self.broadcast_port))
-                    time.sleep(3)
-                except Exception:
-                    pass
-
-        threading.Thread(target=broadcast, daemon=True).start()
+        wakeup = threading.Event()
+        self._wake_beacons = wakeup.set
+        self.beacons.reset()
+        thread = threading.Thread(target=self._send_beacons, args=(sock, wakeup), daemon=True)
+        thread.start()
+        self._threads.append(thread)
 
         while self.running:
             try:
-                data, addr = sock.recvfrom(1024)
-                if data == b"PEER_DISCOVERY" and addr[0] != self._get_local_ip():
-                    self.peers.add(addr[0])
+                data, addr = sock.recvfrom(4096)
+            except OSError:
+                if not self.running or sock.fileno() == -1:
+                    break
+                continue  # e.g. an ICMP error for an earlier send
+            try:
+                self._on_discovery_datagram(data, addr)
             except Exception:
                 pass
         try:
@@ -78,11 +305,49 @@ class NetworkManager:
             pass
         self._udp_sock = None
 
+    def _send_beacons(self, sock, wakeup):
+        while self.running:
+            for addr, kind in self.beacons.due():
+                try:
+                    sock.sendto(self._beacon(kind), addr or ("<broadcast>", self.broadcast_port))
+                except OSError:
+                    if not self.running:
+                        return
+            wakeup.wait(max(0.0, self.beacons.next_time() - time.monotonic()))
+            wakeup.clear()
+
+    def _beacon(self, kind="beacon"):
+        meta = {"port": self.port, "name": self.name, "caps": CAPABILITIES,
+                "ttl": self.beacons.ttl()}
+        if kind != "beacon":
+            meta[kind] = True  # "reply" or "probe"
+        return DISCOVERY_MAGIC + b" " + json.dumps(meta, separators=(",", ":")).encode()
+
+    def _on_discovery_datagram(self, data, addr):
+        if not data.startswith(DISCOVERY_MAGIC):
+            if self.datagram_handler:
+                self.datagram_handler(data, addr)
+            return
+        if self.interfaces.is_local(addr[0]):
+            return
+        meta = {}
+        payload = data[len(DISCOVERY_MAGIC):].strip()
+        if payload:
+            try:
+                meta = json.loads(payload)
+            except ValueError:
+                return
+            if not isinstance(meta, dict):
+                return
+        added = self.peers.seen(addr[0], meta)
+        if self.beacons.heard(addr, meta, added):
+            self._wake_beacons()
+
     # -------------------- Server --------------------
     def _start_server(self):
         server_sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
         server_sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
-        server_sock.bind(("", self.port))
+        server_sock.bind((self.host, self.port))
         server_sock.listen(20)
         self._server_sock = server_sock
 
@@ -95,55 +360,1308 @@ class NetworkManager:
 
     def _handle_client(self, conn, addr):
         try:
-            header = conn.recv(8)
-            if not header:
+            prefix = recv_exact(conn, 4)
+            if not prefix:
+                return
+            if prefix == MAGIC:
+                self._handle_session(conn, addr)
                 return
+            header = prefix + recv_exact(conn, 4)
             name_len, file_size = struct.unpack("!II", header)
 
-            filename = conn.recv(name_len).decode()
-            with open(filename, "wb") as f:
-                remaining = file_size
-                while remaining > 0:
-                    chunk = conn.recv(min(65536, remaining))
-                    if not chunk:
-                        break
-                    f.write(chunk)
-                    remaining -= len(chunk)
-                    self._download_bytes += len(chunk)
+            filename = recv_exact(conn, name_len).decode()
+            path = self._download_path(filename)
+            with open(path, "wb") as f:
+                received = self._recv_body(conn, f, file_size)
+            if received < file_size:
+                os.unlink(path)
+                print(f"[ERROR] Short read from {addr}: "
+                      f"{received}/{file_size} bytes of {filename}; discarded")
+        except TransferInterrupted:
+            pass  # already reported by whoever paused or cancelled it
         except Exception as e:
-            print(f"[ERROR] Failed receiving from {addr}: {e}")
+            if self.running:  # else stop() shut the connection
+                print(f"[ERROR] Failed receiving from {addr}: {e}")
         finally:
             conn.close()
 
-    # -------------------- Sending --------------------
-    def send_file(self, peer_ip, filename):
+    def _serve_session(self, conn, addr, op, meta, session=None):
+        """Finish serving a framed connection whose first frame was read
+        elsewhere (the asyncio engine hands slow opcodes to the executor),
+        taking over the files `session` already has open"""
         try:
-            file_size = os.path.getsize(filename)
-            name_bytes = os.path.basename(filename).encode()
-            name_len = len(name_bytes)
+            self._handle_session(conn, addr, (op, meta), session)
+        except TransferInterrupted:
+            pass  # already reported by whoever paused or cancelled it
+        except Exception as e:
+            if self.running:  # else stop() shut the connection
+                print(f"[ERROR] Failed receiving from {addr}: {e}")
+        finally:
+            conn.close()
 
-            sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-            sock.connect((peer_ip, self.port))
+    def _handle_session(self, conn, addr, first=None, session=None):
+        """Serve a framed connection until the peer closes it"""
+        session = session or Session(conn, addr)
+        conn.settimeout(SESSION_IDLE_TIMEOUT)
+        with self._sessions_lock:
+            self._sessions.add(conn)
+        try:
+            while True:
+                if first:
+                    (op, meta), first = first, None
+                else:
+                    try:
+                        op, meta = recv_frame(conn)
+                    except socket.timeout:
+                        return  # an idle pooled connection the sender forgot
+                if op is None:
+                    return
+                handler = self._frame_handlers.get(op)
+                if handler is None:
+                    raise ProtocolError(f"unknown opcode {op}")
+                handler(session, meta)
+        finally:
+            with self._sessions_lock:
+                self._sessions.discard(conn)
+            for transfer_id, part in session.incoming.items():
+                self._release_incoming(transfer_id, part, session.addr[0])
+
+    def _recv_body(self, conn, f, count):
+        """Copy `count` bytes from `conn` into `f` through a pooled buffer.
 
-            sock.send(struct.pack("!II", name_len, file_size))
-            sock.send(name_bytes)
+        Returns the number of bytes received, which is less than `count` if
+        the peer closed the connection early.
+        """
+        received = 0
+        with self.buffer_pool.buffer() as buf:
+            while received < count:
+                n = conn.recv_into(buf, min(len(buf), count - received))
+                if not n:
+                    break
+                f.write(buf[:n])
+                received += n
+                self._count_download(conn, n)
+        return received
 
-            with open(filename, "rb") as f:
+    def _recv_range(self, conn, part, offset, count):
+        """Like _recv_body, but writes at `offset` of a PartialFile"""
+        received = 0
+        with self.buffer_pool.buffer() as buf:
+            while received < count:
+                n = conn.recv_into(buf, min(len(buf), count - received))
+                if not n:
+                    break
+                part.write_at(offset + received, buf[:n])
+                received += n
+                self._count_download(conn, n)
+        return received
+
+    def _recv_compressed(self, conn, part, offset, count, codec):
+        """Receive `count` raw bytes sent as compressed blocks, writing them
+        at `offset` of a PartialFile; returns the raw bytes written. A block
+        that is, or decodes to, more than BLOCK_SIZE bytes or more than the
+        stripe has left raises ProtocolError."""
+        received = 0
+        while received < count:
+            header = recv_exact(conn, BLOCK.size)
+            if not header:
+                break
+            kind, length = BLOCK.unpack(header)
+            limit = min(BLOCK_SIZE, count - received)
+            # Blocks are only sent packed if that makes them smaller
+            if length > limit:
+                raise ProtocolError(f"{length}-byte block with {limit} bytes to go")
+            payload = recv_exact(conn, length)
+            if len(payload) < length:
+                break
+            self._count_download(conn, BLOCK.size + length)
+            data = decode_block(codec, kind, payload, limit)
+            if received + len(data) > count:
+                raise ProtocolError(f"block overruns the stripe at {offset}")
+            part.write_at(offset + received, data)
+            received += len(data)
+        return received
+
+    def _recv_offer(self, session, meta):
+        """Tell the sender which byte ranges we still need, and that we
+        check stripe digests"""
+        part = self._acquire_incoming(session, meta)
+        self.incoming_control(meta, session.addr[0]).seek(part.received)
+        send_frame(session.conn, OP_MISSING,
+                   {"id": meta["id"], "ranges": part.missing(), "verify": True})
+
+    def _recv_stripe(self, session, meta):
+        part = self._acquire_incoming(session, meta)
+        offset, length = meta["offset"], meta["length"]
+        control = self.incoming_control(meta, session.addr[0])
+        try:
+            with self._controlled(session.conn, control):
+                if meta.get("codec"):
+                    received = self._recv_compressed(
+                        session.conn, part, offset, length, get_codec(meta["codec"]))
+                else:
+                    received = self._recv_range(session.conn, part, offset, length)
+        except Exception:
+            if control.cancelled:
+                self._discard_incoming(meta["id"], part)
+            raise
+        if control.cancelled:
+            # The cancel shut the socket, which ends the read short
+            self._discard_incoming(meta["id"], part)
+            raise TransferInterrupted("cancelled")
+        if received < length:
+            if not meta.get("hash"):
+                part.commit(offset, received)  # unchecked data is kept as before
+            raise ProtocolError(f"short stripe: {received}/{length} bytes at {offset}")
+        digest = None
+        if meta.get("hash"):
+            op, trailer = recv_frame(session.conn)
+            if op != OP_DIGEST:
+                raise ProtocolError(f"expected OP_DIGEST, got {op}")
+            digest = trailer["digest"]
+        self._settle_stripe(meta, part, digest, session.addr[0])
+
+    def _settle_stripe(self, meta, part, digest, ip):
+        """Commit a received stripe, first checking it against `digest` on
+        the hash executor when the sender supplied one"""
+        if digest is None:
+            self._commit_stripe(meta, part, ip)
+            return
+        with self._incoming_lock:
+            part.refs += 1  # keep the file open until the check has run
+        try:
+            self.hash_executor.submit(self._verify_stripe, meta, part, digest, ip)
+        except RuntimeError:  # shutting down
+            self._release_incoming(meta["id"], part, ip)
+            raise
+
+    def _commit_stripe(self, meta, part, ip):
+        if part.commit(meta["offset"], meta["length"]):
+            self._finish_incoming(meta["id"], part)
+            print(f"[OK] Received {meta['name']} from {ip}")
+
+    def _verify_stripe(self, meta, part, digest, ip):
+        offset, length = meta["offset"], meta["length"]
+        try:
+            data = part.read_at(offset, length)
+            if hashlib.new(meta["hash"], data).hexdigest() == digest:
+                self._commit_stripe(meta, part, ip)
+            else:
+                part.reject(offset, length)
+                print(f"[WARN] Stripe at {offset} of {meta['name']} from {ip} "
+                      f"failed its {meta['hash']} check")
+        except Exception as e:
+            part.reject(offset, length)
+            print(f"[ERROR] Verifying {meta['name']}: {e}")
+        finally:
+            self._release_incoming(meta["id"], part, ip)
+
+    def _recv_verify(self, session, meta):
+        """Once the sender's stripes have all been checked, answer with the
+        ranges that still need sending"""
+        part = session.incoming.get(meta["id"])
+        if part is None:
+            raise ProtocolError(f"OP_VERIFY for unknown transfer {meta['id']}")
+        part.wait_settled(meta["sent"], VERIFY_TIMEOUT)
+        send_frame(session.conn, OP_MISSING, {"id": meta["id"], "ranges": part.missing()})
+
+    def _recv_chunk_offer(self, session, meta):
+        """Reassemble a deduplicated file from stored chunks plus the ones
+        we ask the sender for"""
+        store = self.chunk_store
+        chunks = [(digest, int(length)) for digest, length in meta["chunks"]]
+        if any(not 0 < length <= MAX_CHUNK for _, length in chunks):
+            raise ProtocolError(f"chunk of {meta['name']} outside 1..{MAX_CHUNK} bytes")
+        if sum(length for _, length in chunks) != meta["size"]:
+            raise ProtocolError(f"chunks of {meta['name']} do not add up to its size")
+        digests = [digest for digest, _ in chunks]
+        control = self.incoming_control(meta, session.addr[0])
+        control.seek(0)
+        store.pin(digests)
+        try:
+            need = []
+            wanted = set()
+            for i, digest in enumerate(digests):
+                if digest not in wanted and not store.has(digest):
+                    wanted.add(digest)
+                    need.append(i)
+            send_frame(session.conn, OP_CHUNK_NEED, {"id": meta["id"], "need": need})
+
+            path = self._download_path(meta["name"])
+            need = set(need)
+            # Not ".part", which a resumable download of the same name owns
+            tmp = path + ".dedup.tmp"
+            try:
+                with open(tmp, "wb") as f, self.buffer_pool.buffer() as buf, \
+                        self._controlled(session.conn, control):
+                    for i, (digest, length) in enumerate(chunks):
+                        if i not in need:
+                            f.write(store.get(digest))
+                            control.moved(length)
+                            continue
+                        view = (buf[:length] if length <= len(buf)
+                                else memoryview(bytearray(length)))
+                        got = 0
+                        while got < length:
+                            n = session.conn.recv_into(view[got:], length - got)
+                            if not n:
+                                raise ProtocolError(f"connection closed in chunk {i}")
+                            got += n
+                        self._count_download(session.conn, length)
+                        if chunk_digest(view) != digest:
+                            raise ProtocolError(f"chunk {i} of {meta['name']} is corrupt")
+                        store.put(digest, view)
+                        f.write(view)
+            except Exception:
+                if os.path.exists(tmp):
+                    os.unlink(tmp)
+                raise
+            os.replace(tmp, path)
+        except Exception:
+            self._fail_incoming(meta["id"], control, session.addr[0])
+            raise
+        finally:
+            store.unpin(digests)
+        self._end_incoming(meta["id"], control, True)
+        saved = sum(length for i, (_, length) in enumerate(chunks) if i not in need)
+        print(f"[OK] Received {meta['name']} from {session.addr[0]} "
+              f"({saved} of {meta['size']} bytes deduplicated)")
+
+    def _recv_delta_offer(self, session, meta):
+        """Send signatures of our copy, then rebuild the new version from
+        block references and literal data. The rebuilt file replaces our
+        copy only if it matches the whole-file digest closing the stream;
+        the answer tells the sender whether to send the file in full."""
+        conn = session.conn
+        path = self._download_path(meta["name"])
+        # Not ".part", which a resumable download of the same name owns
+        tmp = path + ".delta.tmp"
+        control = self.incoming_control(meta, session.addr[0])
+        control.seek(0)
+        basis = open(path, "rb") if os.path.isfile(path) else None
+        try:
+            block_size = block_size_for(os.fstat(basis.fileno()).st_size if basis else 0)
+            sigs = signatures(basis, block_size) if basis else []
+            send_frame(conn, OP_SIGNATURES,
+                       {"id": meta["id"], "block_size": block_size, "sigs": sigs})
+            written = reused = 0
+            with open(tmp, "wb") as out, self.buffer_pool.buffer() as buf, \
+                    self._controlled(conn, control):
                 while True:
-                    data = f.read(65536)
-                    if not data:
+                    op, m = recv_frame(conn)
+                    if op == OP_DELTA_COPY and basis:
+                        basis.seek(m["first"] * block_size)
+                        remaining = m["count"] * block_size
+                        while remaining > 0:
+                            n = basis.readinto(buf[:min(len(buf), remaining)])
+                            if not n:
+                                break
+                            out.write(buf[:n])
+                            remaining -= n
+                            written += n
+                            reused += n
+                            control.moved(n)
+                            control.checkpoint()
+                    elif op == OP_DELTA_DATA:
+                        n = self._recv_body(conn, out, m["length"])
+                        written += n
+                        if n < m["length"]:
+                            raise ProtocolError("connection closed in delta data")
+                    elif op == OP_DELTA_END:
                         break
-                    sock.sendall(data)
-                    self._upload_bytes += len(data)
+                    else:
+                        raise ProtocolError(f"unexpected opcode {op} in delta stream")
+            if written != meta["size"]:
+                raise ProtocolError(f"delta rebuilt {written} of {meta['size']} bytes")
+            intact = not meta.get("hash") or \
+                self._hash_range(tmp, 0, written, meta["hash"]) == m.get("digest")
+            if not intact:
+                os.unlink(tmp)
+        except Exception:
+            if os.path.exists(tmp):
+                os.unlink(tmp)
+            self._fail_incoming(meta["id"], control, session.addr[0])
+            raise
+        finally:
+            if basis:
+                basis.close()
+        if intact:
+            # Only once the old copy is closed, which Windows needs to replace it
+            os.replace(tmp, path)
+            print(f"[OK] Received {meta['name']} from {session.addr[0]} "
+                  f"({reused} of {meta['size']} bytes reused from the old copy)")
+        else:
+            print(f"[WARN] {meta['name']} rebuilt from a delta by {session.addr[0]} "
+                  f"failed its {meta['hash']} check; kept the old copy")
+        # A failed rebuild is sent again in full, as a transfer of its own
+        self._end_incoming(meta["id"], control, intact)
+        send_frame(conn, OP_DELTA_END, {"id": meta["id"], "ok": intact})
 
-            sock.close()
+    def _recv_cancel(self, session, meta):
+        """The sender cancelled a transfer: drop whatever arrived of it"""
+        with self._incoming_lock:
+            part = self._incoming.get(meta["id"])
+            if part is None:
+                # A transfer we held, if any, ends here
+                self._holding.pop(meta["id"], None)
+                control = self._incoming_controls.pop(meta["id"], None)
+            else:
+                control = self._incoming_controls.get(meta["id"])
+        if control is not None:
+            control.cancel()
+        if part is not None:
+            self._discard_incoming(meta["id"], part)
+        else:
+            discard_partial(self._download_path(meta["name"]))
+            if control is not None:
+                control.finish(False)
+        print(f"[INFO] {meta['name']} cancelled by {session.addr[0]}")
+
+    def _recv_hold(self, session, meta):
+        """The receiver paused a file we are sending for longer than it
+        parks: stop sending it, and keep it queued, until OP_RESUME"""
+        key = session.addr[0], meta["id"]
+        control = self._outgoing.get(key)
+        if control is not None:
+            self._held[key] = control
+            control.hold()
+            print(f"[INFO] {session.addr[0]} paused a transfer; holding it until resumed")
+        send_frame(session.conn, OP_HOLD, {"id": meta["id"], "ok": control is not None})
+
+    def _recv_resume(self, session, meta):
+        """The receiver resumed a transfer it held: start it again"""
+        control = self._held.pop((session.addr[0], meta["id"]), None)
+        if control is not None:
+            control.release()
+            if self.release_handler:
+                self.release_handler()
+        send_frame(session.conn, OP_RESUME, {"id": meta["id"], "ok": control is not None})
+
+    def _recv_control(self, session, meta):
+        if self.control_handler:
+            self.control_handler(meta["message"].encode(), session.addr)
+
+    def _recv_browse(self, session, meta):
+        """Answer a peer's browse of our shared files with one page"""
+        offset = max(0, int(meta.get("offset", 0)))
+        limit = max(0, min(int(meta.get("limit", MAX_BROWSE_PAGE)), MAX_BROWSE_PAGE))
+        total, entries = 0, []
+        if self.browse_handler:
+            total, entries = self.browse_handler(meta.get("query", ""), offset, limit,
+                                                 meta.get("match") == "substring")
+        send_frame(session.conn, OP_RESULTS,
+                   {"total": total, "offset": offset, "entries": entries})
+
+    def _piece_source(self, content_hash):
+        """(size, ranges held, read(offset, count)) for a file we can give
+        pieces of, or None"""
+        part = self._swarms.get(content_hash)
+        if part is not None:
+            def read_part(offset, count):
+                with part.lock:  # held so the file cannot be closed meanwhile
+                    return part.read_at(offset, count) if part.fd is not None else b""
+            with part.lock:
+                return part.size, [list(r) for r in part.ranges], read_part
+        path = self.seeds.get(content_hash)
+        if path is None and self.content_handler:
+            path = self.content_handler(content_hash)
+        if path is None:
+            return None
+        try:
+            size = os.path.getsize(path)
+        except OSError:
+            return None
+
+        def read_file(offset, count):
+            with open(path, "rb") as f:  # a file object per read, so no lock
+                f.seek(offset)
+                return f.read(count)
+        return size, [[0, size]], read_file
+
+    def _recv_want(self, session, meta):
+        """Tell a swarm downloader which bytes of a file we can give it"""
+        source = self._piece_source(meta["hash"])
+        size, ranges = source[:2] if source else (0, [])
+        send_frame(session.conn, OP_HAVE, {"hash": meta["hash"], "size": size, "ranges": ranges})
+
+    def _recv_get(self, session, meta):
+        """Send a swarm downloader one piece, or length 0 if we lack it.
+        Pieces are read into memory, so a request for more than PIECE_SIZE
+        bytes, or for bytes past the end of the file, is refused."""
+        offset, length = int(meta["offset"]), int(meta["length"])
+        if offset < 0 or not 0 <= length <= PIECE_SIZE:
+            raise ProtocolError(f"bad piece request: {length} bytes at {offset}")
+        source = self._piece_source(meta["hash"])
+        if source is not None and offset + length > source[0]:
+            raise ProtocolError(f"piece request past the end of the file: "
+                                f"{length} bytes at {offset} of {source[0]}")
+        data = b""
+        if source is not None and covers(source[1], offset, offset + length):
+            data = source[2](offset, length)
+        if len(data) != length:
+            data = b""
+        send_frame(session.conn, OP_PIECE, {
+            "hash": meta["hash"], "offset": offset, "length": len(data), "algo": self.hash_name,
+            "digest": hashlib.new(self.hash_name, data).hexdigest()})
+        try:
+            session.conn.sendall(data)
+        except (BrokenPipeError, ConnectionResetError):
+            # The downloader got this piece elsewhere (endgame) or dropped us
+            raise TransferInterrupted("swarm peer left")
+        self._count_upload(session.conn, len(data))
+
+    def swarm_started(self, content_hash, part):
+        self._swarms[content_hash] = part
+
+    def swarm_finished(self, content_hash, part, path):
+        if self._swarms.get(content_hash) is part:
+            del self._swarms[content_hash]
+        if part.complete and not part.discarded and os.path.exists(path):
+            self.seeds[content_hash] = path
+
+    def swarm_download(self, content_hash, name, size, peers=None, control=None, **kwargs):
+        """Download a file by content hash from every peer holding some of
+        it (by default every known peer that serves swarms) at once; True
+        once it is complete and verified"""
+        if peers is None:
+            peers = [ip for ip in self.peers if self.peers.supports(ip, "swarm")]
+        try:
+            return SwarmDownload(self, content_hash, name, size, peers, control, **kwargs).run()
+        except Exception as e:
+            print(f"[ERROR] Swarm download of {name}: {e}")
+            return False
+
+    def _recv_relay(self, session, meta):
+        """Receive a file pushed down a fan-out tree, forwarding it to the
+        branch below us as it arrives; once the branch is done, answer with
+        who got it intact"""
+        tree = meta.pop("tree")
+        part = self._acquire_incoming(session, meta)
+        control = self.incoming_control(meta, session.addr[0])
+        stream = RelayStream(part.part_path, meta["size"])
+        branch = ([], tree_peers(tree))
+        unknown = [ip for ip in branch[1] if ip not in self.peers]
+        if unknown:
+            # Whoever can reach our port could otherwise have us push data
+            # at any address; the sender reaches this branch directly instead
+            print(f"[WARN] Not relaying {meta['name']} from {session.addr[0]} "
+                  f"on to peers we do not know: {', '.join(unknown)}")
+            tree = []
+
+        def forward():
+            nonlocal branch
+            if tree:
+                branch = fan_out(self, tree, meta, stream)
+        forwarder = threading.Thread(target=forward, daemon=True, name="relay-forward")
+        forwarder.start()
+        try:
+            intact = self._recv_relayed(session.conn, meta, part, stream, control)
+        except Exception:
+            stream.fail()
+            forwarder.join()
+            if control.cancelled:
+                self._discard_incoming(meta["id"], part)
+            raise
+        forwarder.join()
+        ok, failed = branch
+        if intact:
+            self._finish_incoming(meta["id"], part)
+            print(f"[OK] Received {meta['name']} from {session.addr[0]} "
+                  f"(relayed on to {len(ok)} of {len(ok) + len(failed)} peers)")
+        else:
+            self._discard_incoming(meta["id"], part)
+            print(f"[ERROR] Relayed {meta['name']} from {session.addr[0]} failed its "
+                  f"{meta['algo']} check; discarded")
+        send_frame(session.conn, OP_RELAY_DONE, {"received": intact, "ok": ok, "failed": failed})
+
+    def _recv_relayed(self, conn, meta, part, stream, control):
+        """Write a relayed file's bytes into `part`, announcing each chunk
+        to the forwarders; True if the whole file matches the digest that
+        follows it"""
+        size = meta["size"]
+        checksum = hashlib.new(meta["algo"])
+        received = 0
+        with self._controlled(conn, control), self.buffer_pool.buffer() as buf:
+            while received < size:
+                n = conn.recv_into(buf, min(len(buf), size - received))
+                if not n:
+                    raise ProtocolError(f"short relay: {received}/{size} bytes")
+                chunk = memoryview(buf)[:n]
+                part.write_at(received, chunk)
+                checksum.update(chunk)
+                # Committed as it lands, so a direct send after a broken
+                # relay only fills in the rest; moved into place only once
+                # the digest has been checked
+                part.commit(received, n)
+                received += n
+                stream.advance(n)
+                self._count_download(conn, n)
+        op, trailer = recv_frame(conn)
+        if op != OP_DIGEST:
+            raise ProtocolError(f"expected OP_DIGEST, got {op}")
+        stream.finish(trailer["digest"])
+        return checksum.hexdigest() == trailer["digest"]
+
+    def _recv_folder(self, session, meta):
+        """Extract a streamed folder into the download directory as it arrives"""
+        name = meta["name"]
+        if "/" in name:
+            raise ProtocolError(f"unsafe folder name: {name!r}")
+        # Refuses "", "." and "..", which would extract into or above download_dir
+        files, total = self._extract(session, meta, safe_join(self.download_dir, name))
+        print(f"[OK] Received folder {meta['name']} ({files} files, "
+              f"{total} bytes) from {session.addr[0]}")
+
+    def _recv_files(self, session, meta):
+        """Extract a batch of files sent with send_files(), then confirm it.
+        The sender writes nothing more until it reads that, so the buffered
+        reader cannot swallow the next frame of a pooled connection."""
+        files, total = self._extract(session, meta, self.download_dir)
+        send_frame(session.conn, OP_FOLDER_END, {"files": files, "bytes": total})
+        print(f"[OK] Received {files} files ({total} bytes) from {session.addr[0]}")
+
+    def _extract(self, session, meta, root):
+        """Extract archive entries under root until OP_FOLDER_END. That is the
+        last frame its sender writes, so the buffered reader cannot swallow
+        anything meant for the session. The transfer is listed by the id,
+        name and size in `meta`, which older senders leave out."""
+        meta = {"id": meta.get("id") or f"{session.addr[0]}:{session.addr[1]}",
+                "name": meta.get("name", "files"), "size": meta.get("size", 0)}
+        stream = session.conn.makefile("rb", buffering=RECV_BUFFER_SIZE)
+        control = self.incoming_control(meta, session.addr[0])
+        control.seek(0)
+
+        def count(n):
+            self._count_download(session.conn, n)
+
+        made = []
+        try:
+            with self._controlled(session.conn, control), self.buffer_pool.buffer() as buf:
+                extracted = extract_archive(stream, root, buf, count, made)
+        except Exception:
+            self._fail_incoming(meta["id"], control, session.addr[0],
+                                lambda: remove_extracted(made))
+            raise
+        self._end_incoming(meta["id"], control, True)
+        return extracted
+
+    def _download_path(self, name):
+        return os.path.join(self.download_dir, os.path.basename(name))
+
+    def has_local_copy(self, filename):
+        """Whether a file of this name was already received, so a delta
+        transfer would be worthwhile"""
+        return os.path.isfile(self._download_path(filename))
+
+    @property
+    def chunk_store(self):
+        with self._chunk_store_lock:
+            if self._chunk_store is None:
+                self._chunk_store = ChunkStore(
+                    os.path.join(self.download_dir, ".chunks"), chunk_store_mb * 1024 * 1024)
+            return self._chunk_store
+
+    def _acquire_incoming(self, session, meta):
+        """Open, resume or join the PartialFile for a transfer on behalf of a session"""
+        transfer_id = meta["id"]
+        with self._incoming_lock:
+            part = session.incoming.get(transfer_id)
+            if part is not None and part.discarded:
+                # Frames already in flight when the transfer was cancelled
+                raise TransferInterrupted("cancelled")
+            if part is not None and part.fd is not None:
+                return part
+            part = self._incoming.get(transfer_id)
+            if part is None:
+                path = self._download_path(meta["name"])
+                part = PartialFile(path, meta["size"], meta["fp"])
+                self._incoming[transfer_id] = part
+            if session.incoming.get(transfer_id) is not part:
+                session.incoming[transfer_id] = part
+                part.refs += 1
+            return part
+
+    def _finish_incoming(self, transfer_id, part):
+        """Move a completed file into place as soon as its last byte lands,
+        so a new offer for the same file starts a fresh transfer"""
+        control = None
+        with self._incoming_lock:
+            if self._incoming.get(transfer_id) is part:
+                del self._incoming[transfer_id]
+                control = self._incoming_controls.pop(transfer_id, None)
+                self._holding.pop(transfer_id, None)
+        part.close()
+        if control is not None:
+            control.finish(True)
+
+    def _discard_incoming(self, transfer_id, part):
+        """Delete a cancelled file's partial data"""
+        control = None
+        with self._incoming_lock:
+            if self._incoming.get(transfer_id) is part:
+                del self._incoming[transfer_id]
+                control = self._incoming_controls.pop(transfer_id, None)
+                self._holding.pop(transfer_id, None)
+        part.discard()
+        if control is not None:
+            control.finish(False)
+
+    def _end_incoming(self, transfer_id, control, ok):
+        """End an incoming transfer written without a PartialFile: a
+        folder, batch, delta or deduplicated file"""
+        with self._incoming_lock:
+            if self._incoming_controls.get(transfer_id) is control:
+                del self._incoming_controls[transfer_id]
+                self._holding.pop(transfer_id, None)
+        control.finish(ok)
+
+    def _fail_incoming(self, transfer_id, control, peer_ip, discard=lambda: None):
+        """_end_incoming() for one of those that broke off: discard() drops
+        what it wrote if it was cancelled, and one paused past its park
+        timeout is held at the sender and kept, like a PartialFile"""
+        if self._hold_at_sender(transfer_id, control, peer_ip):
+            self._keep_held(transfer_id, control, peer_ip, discard)
+            return
+        if control.cancelled:
+            discard()
+        self._end_incoming(transfer_id, control, False)
+
+    def incoming_control(self, meta, peer_ip):
+        """The pause/cancel switch for an incoming transfer, created (and
+        announced to incoming_handler) when the file starts arriving"""
+        with self._incoming_lock:
+            control = self._incoming_controls.get(meta["id"])
+            if control is None:
+                if self.incoming_handler:
+                    control = self.incoming_handler(meta, peer_ip)
+                if control is None:
+                    control = TransferControl(park=True)
+                self._incoming_controls[meta["id"]] = control
+            return control
+
+    def _release_incoming(self, transfer_id, part, peer_ip):
+        """Drop a session's reference; an unfinished file is closed (and its
+        manifest saved) with the last one. That happens under the lock, so a
+        resumed transfer cannot open the file before the manifest is saved.
+
+        A file paused past its park timeout is first held at the sender
+        (OP_HOLD), while its connection is still open, so the sender does
+        not take the dropped connection for a failure. A paused or held file
+        keeps its control, and stays paused rather than failed, until
+        resumed; then the sender is asked to offer it again."""
+        with self._incoming_lock:
+            control = self._incoming_controls.get(transfer_id)
+        if control is not None:
+            self._hold_at_sender(transfer_id, control, peer_ip)
+        with self._incoming_lock:
+            part.refs -= 1
+            if part.refs > 0:
+                return
+            control = kept = None
+            if self._incoming.get(transfer_id) is part:
+                del self._incoming[transfer_id]
+                control = self._incoming_controls.get(transfer_id)
+                kept = (control is not None and not control.cancelled and self.running
+                        and (control.paused or transfer_id in self._holding))
+                if not kept:
+                    self._incoming_controls.pop(transfer_id, None)
+            part.close()
+        if kept:
+            self._keep_held(transfer_id, control, peer_ip, lambda: discard_partial(part.path))
+        elif control is not None:
+            control.finish(False)
+
+    def _hold_at_sender(self, transfer_id, control, peer_ip):
+        """Ask the sender to hold a transfer paused past its park timeout;
+        returns whether it was paused that long"""
+        with self._incoming_lock:
+            hold = (control.paused and control.take_interrupted()
+                    and not control.cancelled and self.running
+                    and transfer_id not in self._holding)
+            if hold:
+                self._holding[transfer_id] = peer_ip
+        if hold and not self._ask_sender(peer_ip, OP_HOLD, transfer_id):
+            print(f"[WARN] {peer_ip} could not hold a paused transfer")
+        return hold
+
+    def _keep_held(self, transfer_id, control, peer_ip, discard):
+        """Keep a paused incoming transfer's control, listed as paused,
+        once its connections are gone: resumed, the sender is asked to send
+        it again; cancelled, discard() drops what arrived of it"""
+        with self._incoming_lock:
+            self._holding.setdefault(transfer_id, peer_ip)
+        control.on_resume = lambda: self._resume_soon(transfer_id)
+        control.on_cancel = lambda: self._cancel_held(transfer_id, control, discard)
+        if control.cancelled:  # meanwhile
+            self._cancel_held(transfer_id, control, discard)
+        elif not control.paused:
+            self._resume_soon(transfer_id)
+
+    def _cancel_held(self, transfer_id, control, discard):
+        with self._incoming_lock:
+            if self._incoming_controls.get(transfer_id) is not control \
+                    or transfer_id in self._incoming:
+                return  # finished, or being sent again, which the cancel stops
+            del self._incoming_controls[transfer_id]
+            self._holding.pop(transfer_id, None)
+        control.on_resume = control.on_cancel = None
+        discard()
+        control.finish(False)
+
+    def _resume_soon(self, transfer_id):
+        """Ask, off the caller's thread, for a held file to be sent again"""
+        try:
+            self.executor.submit(self._resume_held, transfer_id)
+        except RuntimeError:  # shutting down
+            pass
+
+    def _resume_held(self, transfer_id):
+        with self._incoming_lock:
+            peer_ip = self._holding.pop(transfer_id, None)
+            control = self._incoming_controls.get(transfer_id)
+            if peer_ip is None or control is None or transfer_id in self._incoming:
+                return  # already sent again, finished or cancelled
+            control.on_resume = control.on_cancel = None
+        if self._ask_sender(peer_ip, OP_RESUME, transfer_id):
+            return
+        print(f"[WARN] {peer_ip} no longer has a transfer we resumed")
+        with self._incoming_lock:
+            if transfer_id in self._incoming \
+                    or self._incoming_controls.get(transfer_id) is not control:
+                return
+            del self._incoming_controls[transfer_id]
+        control.finish(False)
+
+    def _ask_sender(self, peer_ip, op, transfer_id):
+        """Send OP_HOLD or OP_RESUME for a transfer; returns whether the
+        sender knew it"""
+        try:
+            with self.pool.connection(peer_ip, reuse=False) as sock:
+                sock.settimeout(HOLD_TIMEOUT)
+                send_frame(sock, op, {"id": transfer_id})
+                reply_op, reply = recv_frame(sock)
+        except (OSError, ProtocolError) as e:
+            print(f"[WARN] Could not reach {peer_ip}: {e}")
+            return False
+        return reply_op == op and bool(reply.get("ok"))
+
+    @contextmanager
+    def _controlled(self, sock, control):
+        """Let `control` pause or cancel the pumps using `sock` meanwhile"""
+        if control is None:
+            yield
+            return
+        control.bind(sock)
+        self._sock_controls[sock] = control
+        try:
+            yield
+        finally:
+            self._sock_controls.pop(sock, None)
+            control.unbind(sock)
+
+    @contextmanager
+    def _sending(self, peer_ip, transfer_id, control):
+        """Let the receiver hold (OP_HOLD) the transfer we are sending meanwhile"""
+        if control is None:
+            yield
+            return
+        self._outgoing[peer_ip, transfer_id] = control
+        try:
+            yield
+        finally:
+            self._outgoing.pop((peer_ip, transfer_id), None)
+
+    # -------------------- Sending --------------------
+    def offered_codecs(self):
+        """Codec names to offer in a transfer request, most preferred first"""
+        return [codec.name for codec, _ in self.compression]
+
+    def _compression_for(self, name, filename):
+        """(codec, level) to send `filename` with, or None when the codec is
+        unknown or a sample of the file does not compress"""
+        if not name:
+            return None
+        level = next((lvl for c, lvl in self.compression if c.name == name), None)
+        try:
+            codec = get_codec(name)
+        except KeyError:
+            return None
+        if level is None:
+            level = codec.default_level
+        with open(filename, "rb") as f:
+            sample = f.read(SAMPLE_SIZE)
+        if not worth_compressing(codec, level, sample):
+            print(f"[INFO] {os.path.basename(filename)} does not compress; sending raw")
+            return None
+        return codec, level
+
+    def send_file(self, peer_ip, filename, codec=None, control=None):
+        """Send a file (or folder); `codec` names the compression codec the
+        receiver agreed to and `control` can pause or cancel the transfer.
+        Returns True once the peer has it all."""
+        if os.path.isdir(filename):
+            return self.send_folder(peer_ip, filename, control)
+        meta = None
+        try:
+            file_size = os.path.getsize(filename)
+            meta = self._transfer_meta(filename, file_size)
+            with self._sending(peer_ip, meta["id"], control):
+                if self.dedup:
+                    self._send_dedup(peer_ip, filename, meta, control)
+                    return True
+                compression = self._compression_for(codec, filename)
+                if self._engine and not compression:
+                    if self._engine.run(self._engine.send_file(peer_ip, filename, meta, control)):
+                        return True
+                    if control is not None and control.stopped:
+                        self._stopped(peer_ip, filename, meta, control)
+                    return False
+                sock = self.pool.acquire(peer_ip)
+                try:
+                    with self._controlled(sock, control):
+                        self._send_verified(peer_ip, filename, meta, sock, compression, control)
+                except Exception:
+                    self.pool.release(peer_ip, sock, reuse=False)
+                    raise
+                self.pool.release(peer_ip, sock)
+                return True
+        except Exception as e:
+            if control is not None and control.stopped:
+                self._stopped(peer_ip, filename, meta, control)
+            else:
+                print(f"[ERROR] Sending to {peer_ip}: {e}")
+            return False
+
+    def _stopped(self, peer_ip, filename, meta, control):
+        """Report a paused or cancelled send; a cancelled file's partial
+        copy is deleted by the receiver"""
+        if not control.cancelled:
+            print(f"[INFO] Paused {filename} → {peer_ip}")
+            return
+        print(f"[INFO] Cancelled {filename} → {peer_ip}")
+        if meta is None:
+            return
+        try:
+            with self.pool.connection(peer_ip) as sock:
+                send_frame(sock, OP_CANCEL, {"id": meta["id"], "name": meta["name"]})
+        except OSError as e:
+            print(f"[WARN] Could not tell {peer_ip} about the cancel: {e}")
+
+    def _send_verified(self, peer_ip, filename, meta, sock, compression, control):
+        """Offer a file over `sock`, then send the ranges the receiver lacks
+        until it has verified them all"""
+        file_size = meta["size"]
+        send_frame(sock, OP_OFFER, meta)
+        reply = self._recv_missing(sock)
+        missing = reply["ranges"]
+        resent = sum(e - s for s, e in missing)
+        if control is not None:
+            control.seek(file_size - resent)
+        verify = self.verify and reply.get("verify", False)
+        for _ in range(VERIFY_RETRIES + 1):
+            self._send_ranges(peer_ip, filename, meta, missing, sock,
+                              compression, verify, control)
+            if not verify or not missing:
+                break
+            send_frame(sock, OP_VERIFY, {"id": meta["id"], "sent": missing})
+            missing = self._recv_missing(sock)["ranges"]
+            if control is not None:
+                control.seek(file_size - sum(e - s for s, e in missing))
+            if not missing:
+                break
+            print(f"[WARN] Re-sending {sum(e - s for s, e in missing)} corrupted "
+                  f"bytes of {filename} → {peer_ip}")
+        else:
+            raise ProtocolError(f"{filename} still corrupted after "
+                                f"{VERIFY_RETRIES} retries")
+        if resent < file_size:
+            print(f"[OK] Resumed {filename} → {peer_ip} "
+                  f"({file_size - resent} bytes already there)")
+        else:
             print(f"[OK] Sent {filename} → {peer_ip}")
+
+    @staticmethod
+    def _recv_missing(sock):
+        op, reply = recv_frame(sock)
+        if op != OP_MISSING:
+            raise ProtocolError(f"expected OP_MISSING, got {op}")
+        return reply
+
+    @staticmethod
+    def _transfer_meta(filename, file_size):
+        """Identify a transfer by name, size and source mtime, so that
+        re-sending an unchanged file resumes the receiver's partial copy"""
+        name = os.path.basename(filename)
+        fp = f"{file_size}:{os.stat(filename).st_mtime_ns}"
+        transfer_id = hashlib.sha1(f"{name}\0{fp}".encode()).hexdigest()
+        return {"id": transfer_id, "name": name, "size": file_size, "fp": fp}
+
+    @staticmethod
+    def _batch_meta(name, size):
+        """Identify a folder or batch transfer by the name the receiver lists
+        it under and its total file bytes"""
+        transfer_id = hashlib.sha1(f"{name}/\0{size}".encode()).hexdigest()
+        return {"id": transfer_id, "name": name, "size": size}
+
+    def send_file_delta(self, peer_ip, filename, control=None):
+        """Send a file as a delta against the copy the peer already has,
+        or in full if the delta fails or the file the peer rebuilds fails
+        its check"""
+        try:
+            file_size = os.path.getsize(filename)
+            meta = dict(self._transfer_meta(filename, file_size), hash=self.hash_name)
+            # Hashed alongside the scan, for the receiver to check its rebuild
+            digest = self.hash_executor.submit(self._hash_range, filename, 0, file_size)
+            with self.pool.connection(peer_ip) as sock, self._controlled(sock, control), \
+                    self._sending(peer_ip, meta["id"], control), \
+                    open(filename, "rb") as scan, open(filename, "rb") as f:
+                send_frame(sock, OP_DELTA_OFFER, meta)
+                op, reply = recv_frame(sock)
+                if op != OP_SIGNATURES:
+                    raise ProtocolError(f"expected OP_SIGNATURES, got {op}")
+                sent = 0
+                for op in delta_ops(scan, file_size, reply["block_size"], reply["sigs"]):
+                    if op[0] == "copy":
+                        send_frame(sock, OP_DELTA_COPY, {"first": op[1], "count": op[2]})
+                    else:
+                        send_frame(sock, OP_DELTA_DATA, {"length": op[2]})
+                        sent += self._send_body(sock, f, op[2], op[1])
+                send_frame(sock, OP_DELTA_END, {"digest": digest.result()})
+                op, reply = recv_frame(sock)
+                if op != OP_DELTA_END:
+                    raise ProtocolError(f"expected OP_DELTA_END, got {op}")
+            if not reply["ok"]:
+                print(f"[WARN] {peer_ip} could not rebuild {filename} from a delta; "
+                      f"sending it in full")
+                return self.send_file(peer_ip, filename, control=control)
+            print(f"[OK] Sent {filename} → {peer_ip} "
+                  f"({sent} of {file_size} bytes as delta)")
+            return True
+        except Exception as e:
+            if control is not None and control.stopped:
+                # The receiver rebuilds into a temporary file that it drops
+                # when the connection breaks, so there is nothing to discard
+                self._stopped(peer_ip, filename, None, control)
+                return False
+            print(f"[WARN] Sending a delta of {filename} to {peer_ip} failed ({e}); "
+                  f"sending it in full")
+            return self.send_file(peer_ip, filename, control=control)
+
+    def send_folder(self, peer_ip, folder, control=None):
+        """Stream a whole directory tree over one connection"""
+        name = os.path.basename(os.path.normpath(folder))
+        try:
+            meta = self._batch_meta(name, tree_size(folder))
+            # Not reused: the receiver reads archives through a buffered
+            # reader that may run ahead of the closing frame
+            with self.pool.connection(peer_ip, reuse=False) as sock, \
+                    self._controlled(sock, control), self._sending(peer_ip, meta["id"], control):
+                send_frame(sock, OP_FOLDER, meta)
+                files, total = send_archive(sock, folder, self._send_body,
+                                            lambda n: self._count_upload(sock, n))
+            print(f"[OK] Sent folder {name} → {peer_ip} ({files} files, {total} bytes)")
+            return True
+        except Exception as e:
+            if control is not None and control.stopped:
+                # Files already extracted stay; a resumed folder is sent again
+                self._stopped(peer_ip, folder, None, control)
+            else:
+                print(f"[ERROR] Sending folder to {peer_ip}: {e}")
+            return False
+
+    def send_files(self, peer_ip, paths, control=None):
+        """Send many files (and folders) back to back over one pooled
+        connection, without waiting on the receiver between them; it
+        confirms the whole batch at the end"""
+        try:
+            size = sum(tree_size(path) if os.path.isdir(path) else os.path.getsize(path)
+                       for path in paths)
+            meta = self._batch_meta(f"{len(paths)} files", size)
+            with self.pool.connection(peer_ip) as sock, self._controlled(sock, control), \
+                    self._sending(peer_ip, meta["id"], control):
+                send_frame(sock, OP_FILES, meta)
+                files, total = send_entries(sock, batch_entries(paths), self._send_body,
+                                            lambda n: self._count_upload(sock, n))
+                op, reply = recv_frame(sock)
+                if op != OP_FOLDER_END or reply.get("files") != files:
+                    raise ProtocolError(f"batch not confirmed: got {op} {reply}")
+            print(f"[OK] Sent {files} files → {peer_ip} ({total} bytes)")
+            return True
         except Exception as e:
-            print(f"[ERROR] Sending to {peer_ip}: {e}")
+            if control is not None and control.stopped:
+                # Files already extracted stay; a resumed batch is sent again
+                self._stopped(peer_ip, f"{len(paths)} files", None, control)
+            else:
+                print(f"[ERROR] Sending files to {peer_ip}: {e}")
+            return False
+
+    def relay_file(self, peer_ips, filename, control=None, fanout=relay_fanout):
+        """Send a file to many peers at once through a relay tree (see
+        relay.py): we send it to `fanout` of them, each of those passes it
+        on to `fanout` more as it arrives, and so on, so the time taken
+        grows with the depth of the tree rather than the number of peers.
+        Peers the tree did not reach, and those whose beacons say they do
+        not relay, are then sent the file directly. Returns {peer ip: True
+        once it has the file}."""
+        peer_ips = list(dict.fromkeys(peer_ips))
+        results = dict.fromkeys(peer_ips, False)
+        relaying = [ip for ip in peer_ips if self.peers.supports(ip, "relay")]
+        meta = None
+        try:
+            size = os.path.getsize(filename)
+            meta = dict(self._transfer_meta(filename, size), algo=self.hash_name)
+            stream = RelayStream(filename, size, size, self._hash_range(filename, 0, size))
+            ok, failed = fan_out(self, build_tree(relaying, fanout), meta, stream, control)
+            failed += [ip for ip in peer_ips if ip not in relaying]
+        except Exception as e:
+            if control is not None and control.stopped:
+                if control.cancelled:
+                    for peer_ip in peer_ips:
+                        self._stopped(peer_ip, filename, meta, control)
+                else:
+                    print(f"[INFO] Paused {filename} → {len(peer_ips)} peers")
+            else:
+                print(f"[ERROR] Relaying {filename}: {e}")
+            return results
+        results.update(dict.fromkeys(ok, True))
+        print(f"[OK] Relayed {filename} to {len(ok)} of {len(peer_ips)} peers")
+        for peer_ip in failed:
+            results[peer_ip] = self.send_file(peer_ip, filename, control=control)
+        return results
+
+    def send_control(self, peer_ip, message):
+        """Deliver a chat-protocol control message over a pooled connection.
+        Never waits for one to free up: returns False, for the caller to
+        send a datagram instead, when every connection to the peer is busy"""
+        sock = self.pool.acquire(peer_ip, block=False,
+                                 connect_timeout=CONTROL_CONNECT_TIMEOUT)
+        if sock is None:
+            return False
+        try:
+            send_frame(sock, OP_CONTROL, {"message": message})
+        except Exception:
+            self.pool.release(peer_ip, sock, reuse=False)
+            raise
+        self.pool.release(peer_ip, sock)
+        return True
+
+    def browse(self, peer_ip, query="", offset=0, limit=MAX_BROWSE_PAGE, substring=False):
+        """Ask a peer for a page of its shared files matching `query`;
+        returns its OP_RESULTS {total, offset, entries}"""
+        with self.pool.connection(peer_ip) as sock:
+            send_frame(sock, OP_BROWSE, {"query": query, "offset": offset, "limit": limit,
+                                         "match": "substring" if substring else "prefix"})
+            op, meta = recv_frame(sock)
+            if op != OP_RESULTS:
+                raise ProtocolError(f"expected OP_RESULTS, got {op}")
+            return meta
+
+    def _send_dedup(self, peer_ip, filename, meta, control=None):
+        """Send only the content-defined chunks the receiver does not hold"""
+        with open(filename, "rb") as f:
+            chunks = list(chunk_file(f))
+        offer = dict(meta, chunks=[[digest, length] for _, length, digest in chunks])
+        with self.pool.connection(peer_ip) as sock, self._controlled(sock, control), \
+                open(filename, "rb") as f:
+            send_frame(sock, OP_CHUNK_OFFER, offer)
+            op, reply = recv_frame(sock)
+            if op != OP_CHUNK_NEED:
+                raise ProtocolError(f"expected OP_CHUNK_NEED, got {op}")
+            sent = 0
+            for i in reply["need"]:
+                offset, length, _ = chunks[i]
+                sent += self._send_body(sock, f, length, offset)
+        print(f"[OK] Sent {filename} → {peer_ip} "
+              f"({sent} of {meta['size']} bytes after deduplication)")
+
+    def _send_ranges(self, peer_ip, filename, meta, ranges, sock, compression=None,
+                     verify=False, control=None):
+        """Send byte ranges as OP_STRIPE frames, cut into STRIPE_SIZE pieces.
+
+        `sock` is a pooled connection and carries the first stream; with
+        `self.streams` > 1 further pooled connections, as many as the peer's
+        pool limit allows, pull pieces from the same queue and go back to the
+        pool on return (`sock` stays with the caller). With `compression`
+        (codec, level) every stripe is sent as compressed blocks. With
+        `verify` every stripe is followed by an OP_DIGEST of its raw bytes,
+        hashed on the hash executor while the stripe itself is being sent.
+        Every connection is bound to `control` while it sends.
+        """
+        pieces = queue.Queue()
+        for start, end in ranges:
+            for offset in range(start, end, STRIPE_SIZE):
+                pieces.put((offset, min(STRIPE_SIZE, end - offset)))
+        errors = []
+
+        def worker(conn):
+            ok = False
+            try:
+                with self._controlled(conn, control), open(filename, "rb") as f:
+                    while True:
+                        try:
+                            offset, length = pieces.get_nowait()
+                        except queue.Empty:
+                            break
+                        stripe = dict(meta, offset=offset, length=length)
+                        if verify:
+                            digest = self.hash_executor.submit(
+                                self._hash_range, filename, offset, length)
+                            stripe["hash"] = self.hash_name
+                        if compression:
+                            stripe["codec"] = compression[0].name
+                            send_frame(conn, OP_STRIPE, stripe)
+                            self._send_compressed(conn, f, length, offset, *compression)
+                        else:
+                            send_frame(conn, OP_STRIPE, stripe)
+                            self._send_body(conn, f, length, offset)
+                        if verify:
+                            send_frame(conn, OP_DIGEST, {"digest": digest.result()})
+                ok = True
+            except Exception as e:
+                errors.append(e)
+            finally:
+                if conn is not sock:
+                    self.pool.release(peer_ip, conn, reuse=ok)
+
+        extra = []
+        for _ in range(min(self.streams, pieces.qsize()) - 1):
+            # Never wait for a connection while holding one: two sends to
+            # the same peer could otherwise deadlock on its pool limit
+            conn = self.pool.acquire(peer_ip, block=False)
+            if conn is None:
+                break
+            extra.append(conn)
+        threads = [threading.Thread(target=worker, daemon=True, args=(conn,))
+                   for conn in extra]
+        for t in threads:
+            t.start()
+        worker(sock)
+        for t in threads:
+            t.join()
+        if errors:
+            raise errors[0]
+
+    def _hash_range(self, filename, offset, length, algo=None):
+        """Hex digest of `length` bytes of `filename` from `offset`, by
+        `algo` or else our configured hash"""
+        h = hashlib.new(algo or self.hash_name)
+        with open(filename, "rb") as f:
+            f.seek(offset)
+            while length > 0:
+                data = f.read(min(RECV_BUFFER_SIZE, length))
+                if not data:
+                    break
+                h.update(data)
+                length -= len(data)
+        return h.hexdigest()
+
+    def _send_compressed(self, sock, f, count, offset, codec, level):
+        """Send `count` bytes from `offset` as compressed blocks of up to
+        BLOCK_SIZE raw bytes; returns the raw bytes sent"""
+        f.seek(offset)
+        sent = 0
+        while sent < count:
+            data = f.read(min(BLOCK_SIZE, count - sent))
+            if not data:
+                break
+            block = encode_block(codec, level, data)
+            sock.sendall(block)
+            self._count_upload(sock, len(block))
+            sent += len(data)
+        return sent
+
+    def _send_body(self, sock, f, count, offset=0):
+        """Send `count` bytes of `f` starting at `offset`.
+
+        Uses the kernel zero-copy path when enabled and supported, and the
+        chunked read/sendall loop otherwise. Returns the number of bytes sent.
+        """
+        sent = 0
+        if self.zero_copy:
+            sent = self._sendfile_loop(sock, f, offset, count)
+        if sent < count:
+            sent += self._send_chunked(sock, f, offset + sent, count - sent)
+        return sent
+
+    def _sendfile_loop(self, sock, f, offset, count):
+        # Smaller calls while throttled keep each wait for tokens short
+        step = CHUNK_SIZE if self.upload_limit.enabled else SENDFILE_CHUNK
+        sent = 0
+        while sent < count:
+            try:
+                n = os.sendfile(sock.fileno(), f.fileno(), offset + sent,
+                                min(step, count - sent))
+            except OSError as e:
+                if e.errno in _SENDFILE_UNSUPPORTED and sent == 0:
+                    return 0
+                raise
+            if n == 0:  # EOF: file shrank underneath us
+                break
+            sent += n
+            self._count_upload(sock, n)
+        return sent
+
+    def _send_chunked(self, sock, f, offset, count):
+        f.seek(offset)
+        sent = 0
+        while sent < count:
+            data = f.read(min(CHUNK_SIZE, count - sent))
+            if not data:
+                break
+            sock.sendall(data)
+            sent += len(data)
+            self._count_upload(sock, len(data))
+        return sent
+
+    def _count_upload(self, sock, n):
+        """Add to the upload counter, then wait out the upload caps and
+        honour a pause or cancel of the transfer using `sock`"""
+        self._upload_bytes += n
+        self._pace(self.upload_limit, sock, n)
+
+    def _count_download(self, sock, n):
+        """Like _count_upload; while we wait the sender is held back by TCP
+        flow control"""
+        self._download_bytes += n
+        self._pace(self.download_limit, sock, n)
+
+    def _pace(self, limiter, sock, n):
+        delay = limiter.reserve(peer_ip_of(sock), n) if limiter.enabled else 0
+        control = self._sock_controls.get(sock)
+        if control is not None:
+            control.moved(n)
+            control.checkpoint(delay)
+        elif delay > 0:
+            time.sleep(delay)
+
+    def get_rate_limits(self):
+        """(download, upload, per-peer download, per-peer upload) caps in
+        bytes per second"""
+        return (self.download_limit.total.rate, self.upload_limit.total.rate,
+                self.download_limit.peer_rate, self.upload_limit.peer_rate)
+
+    def set_rate_limits(self, download=None, upload=None, peer_download=None,
+                        peer_upload=None):
+        """Change the bandwidth caps, in bytes per second (0 is unlimited);
+        None leaves a cap as it is"""
+        if download is not None:
+            self.download_limit.set_rate(download)
+        if upload is not None:
+            self.upload_limit.set_rate(upload)
+        if peer_download is not None:
+            self.download_limit.set_default_peer_rate(peer_download)
+        if peer_upload is not None:
+            self.upload_limit.set_default_peer_rate(peer_upload)
 
     def get_peers(self):
         return list(self.peers)
 
+    def get_peer_info(self, peer_ip):
+        """What a peer advertises ({port, name, caps}, None where it did
+        not say), or None for a peer we do not know"""
+        info = self.peers.get(peer_ip)
+        return None if info is None else info.advertised()
+
     def get_lan_status(self):
         local_ip = self._get_local_ip()
         if local_ip and not local_ip.startswith("127."):
@@ -152,15 +1670,7 @@ class NetworkManager:
 
     # -------------------- Utils --------------------
     def _get_local_ip(self):
-        s = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-        try:
-            s.connect(("8.8.8.8", 80))
-            ip = s.getsockname()[0]
-        except:
-            ip = "127.0.0.1"
-        finally:
-            s.close()
-        return ip
+        return self.interfaces.primary
 
     def add_peer(self, peer_ip):
         self.peers.add(peer_ip)
@@ -170,8 +1680,12 @@ class NetworkManager:
 
     def _bandwidth_monitor(self):
         from src.controller import bandwidth_signal
-        while True:
-            time.sleep(self._bandwidth_interval)
+        while not self._closed.wait(self._bandwidth_interval):
+            self.pool.prune()
+            self.peers.expire()
+            if self.interfaces.poll():
+                self.beacons.reset()  # announce ourselves on the new network
+                self._wake_beacons()
             now = time.time()
             interval = now - self._last_bandwidth_emit
             if interval > 0:
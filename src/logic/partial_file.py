@@ -0,0 +1,207 @@
+import json
+import os
+import threading
+
+# Committed ranges are persisted to the manifest after at least this many
+# new bytes, so a crash of the app loses at most this much received data.
+# Periodic saves skip fsync (the page cache survives a process crash); the
+# save made when an interrupted transfer is closed is fsynced.
+MANIFEST_INTERVAL = 16 * 1024 * 1024
+
+
+def add_range(ranges, start, end):
+    """Insert [start, end) into a sorted list of disjoint ranges, merging"""
+    merged = []
+    placed = False
+    for s, e in ranges:
+        if e < start:
+            merged.append([s, e])
+        elif s > end:
+            if not placed:
+                merged.append([start, end])
+                placed = True
+            merged.append([s, e])
+        else:
+            start, end = min(s, start), max(e, end)
+    if not placed:
+        merged.append([start, end])
+    return merged
+
+
+def covers(ranges, start, end):
+    """Whether [start, end) lies inside one of a sorted list of disjoint ranges"""
+    return start >= end or any(s <= start and end <= e for s, e in ranges)
+
+
+def missing_ranges(ranges, size):
+    """Complement of `ranges` within [0, size)"""
+    missing = []
+    pos = 0
+    for s, e in ranges:
+        if s > pos:
+            missing.append([pos, s])
+        pos = max(pos, e)
+    if pos < size:
+        missing.append([pos, size])
+    return missing
+
+
+def discard_partial(path):
+    """Delete the partial data and manifest kept for `path`, if any"""
+    for leftover in (path + ".part", path + ".part.json"):
+        try:
+            os.unlink(leftover)
+        except FileNotFoundError:
+            pass
+
+
+class PartialFile:
+    """A preallocated file being filled in at arbitrary offsets.
+
+    Data is written to `<path>.part` and the byte ranges committed so far are
+    kept in a `<path>.part.json` sidecar manifest. Reopening the same path
+    with the same size and fingerprint picks up where the last attempt left
+    off; once every byte is committed, close() renames the file into place.
+
+    Several connections may write disjoint ranges concurrently; positional
+    writes (pwrite) mean they never share a file offset.
+
+    Data whose checksum failed is recorded with reject() instead of being
+    committed, so wait_settled() can tell when every range a sender wrote
+    has been either accepted or refused.
+    """
+
+    def __init__(self, path, size, fingerprint=""):
+        self.path = path
+        self.part_path = path + ".part"
+        self.manifest_path = path + ".part.json"
+        self.size = size
+        self.fingerprint = fingerprint
+        self.refs = 0
+        self.lock = threading.RLock()  # read_at() may be called with it held
+        self.settled = threading.Condition(self.lock)
+        self.rejected = []
+        self.discarded = False
+        self.ranges = self._load_manifest()
+        self._unsaved = 0
+        flags = os.O_RDWR | os.O_CREAT | getattr(os, "O_BINARY", 0)
+        if not self.ranges:
+            flags |= os.O_TRUNC
+        self.fd = os.open(self.part_path, flags, 0o644)
+        os.ftruncate(self.fd, size)
+        if size and hasattr(os, "posix_fallocate"):
+            try:
+                os.posix_fallocate(self.fd, 0, size)
+            except OSError:
+                pass  # not supported by this filesystem; ftruncate suffices
+
+    def _load_manifest(self):
+        try:
+            with open(self.manifest_path) as f:
+                manifest = json.load(f)
+        except (OSError, ValueError):
+            return []
+        if (manifest.get("size") != self.size
+                or manifest.get("fingerprint") != self.fingerprint
+                or not os.path.exists(self.part_path)):
+            return []
+        return [list(r) for r in manifest.get("ranges", [])]
+
+    def _save_manifest(self, sync=False):
+        """Atomically replace the manifest, optionally fsyncing the data first"""
+        if sync:
+            os.fsync(self.fd)
+        tmp = self.manifest_path + ".tmp"
+        with open(tmp, "w") as f:
+            json.dump({"size": self.size, "fingerprint": self.fingerprint,
+                       "ranges": self.ranges}, f)
+        os.replace(tmp, self.manifest_path)
+        self._unsaved = 0
+
+    @property
+    def received(self):
+        return sum(e - s for s, e in self.ranges)
+
+    @property
+    def complete(self):
+        return self.ranges == [[0, self.size]] or self.size == 0
+
+    def missing(self):
+        with self.lock:
+            return missing_ranges(self.ranges, self.size)
+
+    def read_at(self, offset, count):
+        if hasattr(os, "pread"):
+            return os.pread(self.fd, count, offset)
+        with self.lock:
+            os.lseek(self.fd, offset, os.SEEK_SET)
+            return os.read(self.fd, count)
+
+    def write_at(self, offset, data):
+        view = memoryview(data)
+        while view:
+            if hasattr(os, "pwrite"):
+                n = os.pwrite(self.fd, view, offset)
+            else:
+                with self.lock:
+                    os.lseek(self.fd, offset, os.SEEK_SET)
+                    n = os.write(self.fd, view)
+            view = view[n:]
+            offset += n
+
+    def commit(self, offset, count):
+        """Record [offset, offset + count) as written; True once the file is full"""
+        with self.lock:
+            if count:
+                self.ranges = add_range(self.ranges, offset, offset + count)
+                self._unsaved += count
+                if self._unsaved >= MANIFEST_INTERVAL and not self.complete:
+                    self._save_manifest()
+                self.settled.notify_all()
+            return self.complete
+
+    def reject(self, offset, count):
+        """Record [offset, offset + count) as received but corrupt"""
+        with self.lock:
+            self.rejected = add_range(self.rejected, offset, offset + count)
+            self.settled.notify_all()
+
+    def wait_settled(self, ranges, timeout=None):
+        """Wait until each range is committed or rejected, then forget the
+        rejections; returns False on timeout"""
+        def settled():
+            done = self.ranges
+            for start, end in self.rejected:
+                done = add_range(done, start, end)
+            return all(covers(done, start, end) for start, end in ranges)
+
+        with self.settled:
+            ok = self.settled.wait_for(settled, timeout)
+            self.rejected = []
+            return ok
+
+    def discard(self):
+        """Close the file and delete it along with its manifest"""
+        with self.lock:
+            if self.fd is not None:
+                os.close(self.fd)
+                self.fd = None
+            if not self.discarded:
+                self.discarded = True
+                discard_partial(self.path)
+
+    def close(self):
+        """Close the file, moving it into place if complete or saving the
+        manifest so a later transfer can resume it"""
+        with self.lock:
+            if self.fd is None:
+                return
+            if self.complete:
+                os.close(self.fd)
+                os.replace(self.part_path, self.path)
+                if os.path.exists(self.manifest_path):
+                    os.unlink(self.manifest_path)
+            else:
+                self._save_manifest(sync=True)
+                os.close(self.fd)
+            self.fd = None
@@ -0,0 +1,199 @@
+import threading
+import time
+
+from decouple import config
+
+# Seconds a peer stays listed after its last discovery beacon
+peer_ttl = config("P2P_PEER_TTL", default=15, cast=float)
+# Expiry is checked on a timer wheel of WHEEL_SLOTS slots, WHEEL_TICK
+# seconds each
+WHEEL_TICK = 1.0
+WHEEL_SLOTS = 64
+
+
+class TimerWheel:
+    """Deadlines bucketed by the tick they fall in, so scheduling is O(1)
+    and advance() only looks at the slots whose time has come rather than
+    at every key. A deadline more than one turn of the wheel away stays in
+    its slot until the turn it is due."""
+
+    def __init__(self, tick=WHEEL_TICK, slots=WHEEL_SLOTS, now=None):
+        self.tick = tick
+        self.slots = [{} for _ in range(slots)]  # key -> deadline
+        self._slot_of = {}
+        self._current = int((time.monotonic() if now is None else now) / tick)
+
+    def __len__(self):
+        return len(self._slot_of)
+
+    def schedule(self, key, deadline):
+        """Fire `key` at `deadline`, replacing any earlier schedule"""
+        self.cancel(key)
+        slot = self.slots[max(int(deadline / self.tick), self._current) % len(self.slots)]
+        slot[key] = deadline
+        self._slot_of[key] = slot
+
+    def cancel(self, key):
+        slot = self._slot_of.pop(key, None)
+        if slot is not None:
+            del slot[key]
+
+    def advance(self, now):
+        """Remove and return the keys whose deadline is `now` or earlier"""
+        target = int(now / self.tick)
+        due = []
+        # Past ticks in order, but each slot at most once however long
+        # it has been since the last call
+        for tick in range(max(self._current, target - len(self.slots) + 1), target + 1):
+            slot = self.slots[tick % len(self.slots)]
+            for key, deadline in list(slot.items()):
+                if deadline <= now:
+                    del slot[key]
+                    del self._slot_of[key]
+                    due.append(key)
+        self._current = target
+        return due
+
+
+class PeerInfo:
+    """A peer and what its discovery beacons say about it"""
+
+    __slots__ = ("ip", "port", "name", "caps", "last_seen", "ttl")
+
+    def __init__(self, ip, port=None, name=None, caps=None, last_seen=None, ttl=None):
+        self.ip = ip
+        self.port = port  # its transfer server, None if not advertised
+        self.name = name
+        self.caps = caps  # list of features, None if not advertised
+        self.last_seen = last_seen  # None for peers added by hand, which never expire
+        self.ttl = ttl  # how long it asked to be kept, None for the table's default
+
+    def advertised(self):
+        return {"port": self.port, "name": self.name, "caps": self.caps}
+
+
+class PeerTable:
+    """The peers we know of, each dropped `ttl` seconds after we last heard
+    from it, or after the ttl its beacons ask for.
+
+    Beacons only refresh a peer's last_seen; its entry on the timer wheel
+    is moved forward lazily, when it comes due, so a steady stream of
+    beacons costs O(1) each. on_change is called with (added, removed,
+    changed) lists of IPs, and only when one of them is non-empty: when a
+    peer appears, expires or advertises something new.
+
+    Iterating, `in` and len() work as they did on the plain set of IPs
+    this replaces.
+    """
+
+    def __init__(self, ttl=peer_ttl, tick=WHEEL_TICK, slots=WHEEL_SLOTS):
+        self.ttl = ttl
+        self.on_change = None
+        self._peers = {}
+        self._wheel = TimerWheel(tick, slots)
+        self._lock = threading.Lock()
+
+    def __contains__(self, ip):
+        return ip in self._peers
+
+    def __iter__(self):
+        with self._lock:
+            return iter(list(self._peers))
+
+    def __len__(self):
+        return len(self._peers)
+
+    def get(self, ip):
+        return self._peers.get(ip)
+
+    def seen(self, ip, meta=None, now=None):
+        """Record a beacon from `ip` with its advertised `meta` ({port,
+        name, caps, ttl}, any of them missing); returns whether the peer
+        is new"""
+        now = time.monotonic() if now is None else now
+        meta = meta or {}
+        ttl = meta.get("ttl")
+        if not isinstance(ttl, (int, float)) or ttl <= 0:
+            ttl = None
+        with self._lock:
+            info = self._peers.get(ip)
+            added = info is None
+            if added:
+                info = self._peers[ip] = PeerInfo(ip, last_seen=now, ttl=ttl)
+                self._wheel.schedule(ip, now + self._ttl_of(info))
+            elif info.last_seen is not None:  # peers added by hand stay
+                info.last_seen = now
+                info.ttl = ttl  # a later deadline is picked up lazily too
+            before = info.advertised()
+            info.port = meta.get("port", info.port)
+            info.name = meta.get("name", info.name)
+            info.caps = meta.get("caps", info.caps)
+            changed = not added and info.advertised() != before
+        if added:
+            self._changed([ip], [], [])
+        elif changed:
+            self._changed([], [], [ip])
+        return added
+
+    def add(self, ip):
+        """List a peer that does not expire, e.g. one entered by hand"""
+        with self._lock:
+            if ip in self._peers:
+                self._peers[ip].last_seen = None
+                self._wheel.cancel(ip)
+                return
+            self._peers[ip] = PeerInfo(ip)
+        self._changed([ip], [], [])
+
+    def discard(self, ip):
+        with self._lock:
+            if self._peers.pop(ip, None) is None:
+                return
+            self._wheel.cancel(ip)
+        self._changed([], [ip], [])
+
+    def expire(self, now=None):
+        """Drop the peers not heard from for `ttl` seconds; returns them"""
+        now = time.monotonic() if now is None else now
+        removed = []
+        with self._lock:
+            for ip in self._wheel.advance(now):
+                info = self._peers.get(ip)
+                if info is None or info.last_seen is None:
+                    continue
+                deadline = info.last_seen + self._ttl_of(info)
+                if deadline <= now:
+                    del self._peers[ip]
+                    removed.append(ip)
+                else:  # heard from since it was scheduled
+                    self._wheel.schedule(ip, deadline)
+        if removed:
+            self._changed([], removed, [])
+        return removed
+
+    def stale(self, now=None):
+        """The peers worth a unicast beacon: those silent for two thirds of
+        their ttl, and those added by hand, which broadcasts may not reach"""
+        now = time.monotonic() if now is None else now
+        with self._lock:
+            return [ip for ip, info in self._peers.items()
+                    if info.last_seen is None
+                    or now - info.last_seen > self._ttl_of(info) * 2 / 3]
+
+    def supports(self, ip, capability):
+        """Whether a peer advertises `capability`; peers that advertise
+        nothing are given the benefit of the doubt"""
+        info = self._peers.get(ip)
+        return info is None or info.caps is None or capability in info.caps
+
+    def port_of(self, ip, default):
+        """The transfer port a peer advertises, or `default`"""
+        info = self._peers.get(ip)
+        return default if info is None or info.port is None else info.port
+
+    def _ttl_of(self, info):
+        return self.ttl if info.ttl is None else info.ttl
+
+    def _changed(self, added, removed, changed):
+        if self.on_change is not None:
+            self.on_change(added, removed, changed)
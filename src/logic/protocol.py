@@ -0,0 +1,135 @@
+import json
+import struct
+
+# Framed connections start with MAGIC. Legacy connections start with the
+# 8-byte "!II" (name_len, file_size) header instead; a name length equal to
+# MAGIC read as an integer (~1.4 GB) never occurs in practice, so the first
+# four bytes are enough to tell the two apart.
+MAGIC = b"SSP1"
+
+# Every frame is (opcode, metadata length) followed by UTF-8 JSON metadata.
+# Frames that carry file data are followed by the raw bytes they describe.
+FRAME = struct.Struct("!BI")
+
+# Every transfer is identified by (id, name, size, fp), where fp fingerprints
+# the source file so a resumed transfer never mixes two versions of it.
+OP_STRIPE = 1  # {id, name, size, fp, offset, length} + `length` raw bytes
+OP_OFFER = 2  # {id, name, size, fp}; answered with OP_MISSING
+OP_MISSING = 3  # {id, ranges: [[start, end], ...]} still needed by the receiver
+# Deduplicated transfer: the sender lists the file's content-defined chunks,
+# the receiver answers with the indexes it lacks, and the sender streams
+# exactly those chunks, raw and in index order. Each chunk is at most
+# chunk_store.MAX_CHUNK bytes, and their lengths add up to `size`.
+OP_CHUNK_OFFER = 4  # {id, name, size, fp, chunks: [[digest, length], ...]}
+OP_CHUNK_NEED = 5  # {id, need: [index, ...]}
+# Delta transfer against the receiver's existing copy (see delta.py): the
+# receiver answers an offer with block signatures, then the sender streams
+# block references and literal data, closed by OP_DELTA_END with the `hash`
+# digest of the whole file. The receiver answers with its own OP_DELTA_END,
+# saying whether the rebuilt file matched it and replaced the old copy.
+OP_DELTA_OFFER = 6  # {id, name, size, fp, hash}
+OP_SIGNATURES = 7  # {id, block_size, sigs: [[weak, strong], ...]}
+OP_DELTA_COPY = 8  # {first, count}: reuse `count` receiver blocks from `first`
+OP_DELTA_DATA = 9  # {length} + `length` raw bytes
+OP_DELTA_END = 10  # {digest} from the sender; {id, ok} in answer
+# Folder transfer: one connection carries a whole tree as a stream of entry
+# frames (see archive.py), each file's bytes right after its frame. `size`
+# totals the file bytes, and with `id` lets the receiver track progress.
+OP_FOLDER = 11  # {id, name, size}
+OP_ENTRY = 12  # {path, mode, mtime, dir: true} or {..., size} + `size` raw bytes
+OP_FOLDER_END = 13  # {files, bytes}; also ends OP_FILES
+# A batch of files and folders sent together, as entries relative to the
+# receiver's download directory. The receiver answers the closing
+# OP_FOLDER_END with its own once everything is written.
+OP_FILES = 14  # {id, name, size}, as for OP_FOLDER
+# A chat-protocol control message (transfer request or response) delivered
+# over a pooled connection instead of a UDP datagram.
+OP_CONTROL = 15  # {message}
+# Verified transfers: a stripe whose frame names a "hash" algorithm is
+# followed, after its raw bytes, by OP_DIGEST with that hash of the raw data.
+# Once every stripe is out the sender asks OP_VERIFY and the receiver answers
+# OP_MISSING with the ranges that failed their check, to be sent again.
+OP_DIGEST = 16  # {digest}
+OP_VERIFY = 17  # {id, sent: [[start, end], ...]}
+# Sent on a fresh connection after a transfer is cancelled mid-way, so the
+# receiver deletes the partial file instead of keeping it for a resume.
+OP_CANCEL = 18  # {id, name}
+# Browsing a peer's shared files: each OP_BROWSE asks for one page of the
+# files matching `query` ("" lists everything) and is answered by one
+# OP_RESULTS, so a large library is fetched a page at a time on demand.
+# `match` is "prefix" (words starting name tokens) or "substring".
+OP_BROWSE = 19  # {query, match, offset, limit}
+OP_RESULTS = 20  # {total, offset, entries: [[id, name, size, hash, tags], ...]}
+# Swarm downloads (see swarm.py) pull a file by content hash from every
+# peer holding some of it. OP_WANT is answered with the byte ranges the
+# peer has; each OP_GET with one OP_PIECE frame followed by the bytes and
+# checked against its `algo` digest, or with length 0 if the peer lacks it.
+OP_WANT = 21  # {hash}
+OP_HAVE = 22  # {hash, size, ranges: [[start, end], ...]}
+OP_GET = 23  # {hash, offset, length}: at most swarm.PIECE_SIZE bytes, within the file
+OP_PIECE = 24  # {hash, offset, length, algo, digest} + `length` raw bytes
+# Fan-out (see relay.py): a file pushed to many peers travels down a tree
+# of them. OP_RELAY names the branch below the receiver and is followed by
+# the file's raw bytes and an OP_DIGEST of all of them; the receiver writes
+# and forwards the bytes as they arrive, and once its branch is done
+# answers OP_RELAY_DONE with whether its own copy checked out and which
+# peers below it got theirs.
+OP_RELAY = 25  # {id, name, size, fp, algo, tree: [[ip, tree], ...]} + `size` raw bytes
+OP_RELAY_DONE = 26  # {received, ok: [ip, ...], failed: [ip, ...]}
+# A receiver paused for longer than it parks a transfer's connections sends
+# OP_HOLD on a fresh connection before dropping them, so the sender queues
+# the transfer up again instead of failing it, and OP_RESUME once the user
+# resumes, so the sender offers it again. Each is answered with its own
+# opcode, saying whether the sender knew the transfer.
+OP_HOLD = 27  # {id}; answered with {id, ok}
+OP_RESUME = 28  # {id}; answered with {id, ok}
+
+
+class ProtocolError(Exception):
+    pass
+
+
+def recv_exact(conn, n):
+    """Read exactly n bytes, or return b"" if the peer closed first"""
+    data = bytearray()
+    while len(data) < n:
+        chunk = conn.recv(n - len(data))
+        if not chunk:
+            return b""
+        data.extend(chunk)
+    return bytes(data)
+
+
+def encode_frame(op, meta=None):
+    payload = json.dumps(meta or {}, separators=(",", ":")).encode()
+    return FRAME.pack(op, len(payload)) + payload
+
+
+def send_frame(sock, op, meta=None):
+    sock.sendall(encode_frame(op, meta))
+
+
+def recv_frame(conn):
+    """Read one frame and return (op, meta), or (None, None) on clean EOF"""
+    return _parse_frame(lambda n: recv_exact(conn, n))
+
+
+def read_frame(stream):
+    """recv_frame for a buffered file object such as socket.makefile("rb")"""
+    return _parse_frame(lambda n: _read_exact(stream, n))
+
+
+def _read_exact(stream, n):
+    data = stream.read(n)
+    return data if len(data) == n else b""
+
+
+def _parse_frame(read):
+    header = read(FRAME.size)
+    if not header:
+        return None, None
+    op, length = FRAME.unpack(header)
+    payload = read(length) if length else b"{}"
+    if length and not payload:
+        raise ProtocolError("connection closed inside a frame")
+    return op, json.loads(payload)
@@ -0,0 +1,101 @@
+import threading
+import time
+
+# A bucket holds at most this many seconds' worth of tokens, so an idle
+# connection can only burst briefly above its cap when traffic resumes.
+BURST_SECONDS = 0.1
+
+
+class TokenBucket:
+    """Token bucket refilled at `rate` bytes per second; 0 means unlimited.
+
+    reserve() takes tokens up front and may leave the bucket in debt; the
+    returned delay is how long the caller must wait before moving the bytes.
+    Concurrent callers therefore queue behind each other's reservations and
+    the long-run rate stays at `rate` whatever the chunk sizes.
+    """
+
+    def __init__(self, rate=0):
+        self._lock = threading.Lock()
+        self.rate = 0
+        self.tokens = 0.0
+        self._last = time.monotonic()
+        self.set_rate(rate)
+
+    def set_rate(self, rate):
+        """Change the rate; outstanding debt is forgiven so a raised cap
+        applies at once"""
+        with self._lock:
+            self.rate = max(0, rate)
+            self._last = time.monotonic()
+            self.tokens = self.rate * BURST_SECONDS
+
+    def reserve(self, n):
+        """Take `n` tokens and return the seconds to wait before using them"""
+        if not self.rate:
+            return 0.0
+        with self._lock:
+            now = time.monotonic()
+            self.tokens = min(self.rate * BURST_SECONDS,
+                              self.tokens + (now - self._last) * self.rate)
+            self._last = now
+            self.tokens -= n
+            return -self.tokens / self.rate if self.tokens < 0 else 0.0
+
+
+class RateLimiter:
+    """A global cap plus per-peer caps on one direction of traffic.
+
+    Every peer gets its own bucket at `peer_rate` unless set_peer_rate()
+    gave it a different cap. Rates are in bytes per second; 0 is unlimited.
+    """
+
+    def __init__(self, rate=0, peer_rate=0):
+        self.total = TokenBucket(rate)
+        self.peer_rate = peer_rate
+        self._peers = {}
+        self._overrides = {}
+        self._lock = threading.Lock()
+
+    @property
+    def enabled(self):
+        return bool(self.total.rate or self.peer_rate or self._overrides)
+
+    def set_rate(self, rate):
+        self.total.set_rate(rate)
+
+    def set_default_peer_rate(self, rate):
+        with self._lock:
+            self.peer_rate = max(0, rate)
+            for peer_ip, bucket in self._peers.items():
+                if peer_ip not in self._overrides:
+                    bucket.set_rate(self.peer_rate)
+
+    def set_peer_rate(self, peer_ip, rate):
+        """Cap one peer; None returns it to the default per-peer cap"""
+        with self._lock:
+            if rate is None:
+                self._overrides.pop(peer_ip, None)
+                rate = self.peer_rate
+            else:
+                self._overrides[peer_ip] = rate
+            self._bucket(peer_ip).set_rate(rate)
+
+    def _bucket(self, peer_ip):
+        bucket = self._peers.get(peer_ip)
+        if bucket is None:
+            bucket = self._peers[peer_ip] = TokenBucket(
+                self._overrides.get(peer_ip, self.peer_rate))
+        return bucket
+
+    def reserve(self, peer_ip, n):
+        """Charge `n` bytes to the peer and the total; returns the delay"""
+        with self._lock:
+            bucket = self._bucket(peer_ip)
+        return max(bucket.reserve(n), self.total.reserve(n))
+
+    def throttle(self, peer_ip, n):
+        """Charge `n` bytes and sleep off any delay"""
+        delay = self.reserve(peer_ip, n)
+        if delay > 0:
+            time.sleep(delay)
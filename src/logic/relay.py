@@ -0,0 +1,154 @@
+import threading
+
+from decouple import config
+
+from .protocol import OP_DIGEST, OP_RELAY, OP_RELAY_DONE, ProtocolError, recv_frame, send_frame
+from .transfer_control import TransferInterrupted
+
+# Peers each peer passes a fanned-out file on to. With a fan-out of k the
+# file reaches n peers in about log_k(n) hops, and since every hop forwards
+# bytes as they arrive, adding a level costs little more than its latency.
+relay_fanout = config("P2P_RELAY_FANOUT", default=2, cast=int)
+
+
+def build_tree(peers, fanout=relay_fanout):
+    """Arrange peers in a complete tree below us, breadth first: the first
+    `fanout` are our children, the next ones theirs, and so on. Returns the
+    [[ip, subtree], ...] form carried by OP_RELAY."""
+    peers = list(peers)
+    fanout = max(1, fanout)
+
+    def children(node):  # node 0 is us, node i > 0 is peers[i - 1]
+        first = node * fanout + 1
+        return [[peers[i - 1], children(i)]
+                for i in range(first, min(first + fanout, len(peers) + 1))]
+    return children(0)
+
+
+def tree_peers(tree):
+    """Every peer in a tree, parents before their children"""
+    peers = []
+    for peer_ip, subtree in tree:
+        peers.append(peer_ip)
+        peers.extend(tree_peers(subtree))
+    return peers
+
+
+class RelayStream:
+    """How much of a relayed file has arrived, shared by the thread that
+    receives it and the threads forwarding it down the tree, which send
+    whatever is on disk so far and then wait for more"""
+
+    def __init__(self, path, size, received=0, digest=None):
+        self.path = path
+        self.size = size
+        self.received = received
+        self.digest = digest  # of the whole file, once the sender gave it
+        self.failed = False
+        self._cond = threading.Condition()
+
+    def advance(self, n):
+        with self._cond:
+            self.received += n
+            self._cond.notify_all()
+
+    def finish(self, digest):
+        with self._cond:
+            self.digest = digest
+            self._cond.notify_all()
+
+    def fail(self):
+        with self._cond:
+            self.failed = True
+            self._cond.notify_all()
+
+    def wait(self, position):
+        """Block until more than `position` bytes have arrived, or all of
+        them and the digest, and return how many have"""
+        with self._cond:
+            self._cond.wait_for(lambda: self.failed or self.received > position
+                                or (self.received == self.size and self.digest is not None))
+            if self.failed:
+                raise ProtocolError("the relayed file broke off upstream")
+            return self.received
+
+
+def relay_to(network_manager, peer_ip, subtree, meta, stream, control=None, progress=None):
+    """Send a file to one child, which passes it on to `subtree`; returns
+    (peers that got it intact, peers that did not). A child that cannot be
+    reached is skipped and its own children are sent the file directly.
+    `progress`, if given, is called with the bytes this child has been
+    sent."""
+    nm = network_manager
+    try:
+        sock = nm.pool.acquire(peer_ip)
+    except OSError as e:
+        print(f"[WARN] Relay to {peer_ip} failed: {e}; sending to its children instead")
+        ok, failed = fan_out(nm, subtree, meta, stream, control)
+        return ok, [peer_ip] + failed
+    reuse = False
+    if control is not None:
+        control.bind(sock)
+    try:
+        send_frame(sock, OP_RELAY, dict(meta, tree=subtree))
+        sent = 0
+        with open(stream.path, "rb") as f:
+            while sent < stream.size:
+                available = stream.wait(sent)
+                n = nm._send_body(sock, f, available - sent, sent)
+                if not n:
+                    raise ProtocolError(f"{stream.path} is shorter than {stream.size} bytes")
+                sent += n
+                if control is not None:
+                    control.checkpoint()
+                if progress is not None:
+                    progress(sent)
+        stream.wait(sent)
+        send_frame(sock, OP_DIGEST, {"digest": stream.digest})
+        op, reply = recv_frame(sock)
+        if op != OP_RELAY_DONE:
+            raise ProtocolError(f"expected OP_RELAY_DONE, got {op}")
+        reuse = True
+        if reply["received"]:
+            return [peer_ip] + reply["ok"], reply["failed"]
+        return reply["ok"], [peer_ip] + reply["failed"]
+    except (OSError, ProtocolError) as e:
+        if control is not None and control.stopped:
+            raise TransferInterrupted("cancelled" if control.cancelled else "paused")
+        print(f"[WARN] Relay to {peer_ip} failed: {e}")
+        return [], [peer_ip] + tree_peers(subtree)
+    finally:
+        if control is not None:
+            control.unbind(sock)
+        nm.pool.release(peer_ip, sock, reuse)
+
+
+def fan_out(network_manager, tree, meta, stream, control=None):
+    """Relay a file down every branch of `tree` at once; returns (peers
+    that got it intact, peers that did not). Progress reported to
+    `control` follows the first branch."""
+    results = [([], [])] * len(tree)
+    interrupted = []
+
+    def branch(i, peer_ip, subtree):
+        progress = control.seek if control is not None and i == 0 else None
+        try:
+            results[i] = relay_to(network_manager, peer_ip, subtree, meta, stream,
+                                  control, progress)
+        except TransferInterrupted as e:
+            interrupted.append(e)
+
+    threads = [threading.Thread(target=branch, args=(i, peer_ip, subtree), daemon=True,
+                                name=f"relay-{peer_ip}")
+               for i, (peer_ip, subtree) in enumerate(tree)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    if interrupted:
+        raise interrupted[0]
+    ok, failed = [], []
+    for branch_ok, branch_failed in results:
+        ok.extend(branch_ok)
+        failed.extend(branch_failed)
+    return ok, failed
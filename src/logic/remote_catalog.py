@@ -0,0 +1,122 @@
+import threading
+import time
+from collections import OrderedDict
+
+from decouple import config
+
+from .shared_library import tokenize
+
+# Files asked of a peer per OP_BROWSE
+browse_page = config("P2P_BROWSE_PAGE", default=200, cast=int)
+# Seconds a peer's answer is reused for the same query and page
+browse_cache_ttl = config("P2P_BROWSE_CACHE_TTL", default=5, cast=float)
+# Answers kept at most, least recently used dropped first
+CACHE_ENTRIES = 256
+
+
+def _words(query, substring):
+    """The words a query is made of, in a canonical order, so "Rep 20" and
+    "20  rep" share a cache entry"""
+    return tuple(sorted(set(query.lower().split() if substring else tokenize(query))))
+
+
+def _matches(words, entry, substring):
+    """Whether a browse entry would match `words` on the peer too: by
+    name for a substring query, by name and tag tokens otherwise"""
+    if substring:
+        name = entry["name"].lower()
+        return all(w in name for w in words)
+    tokens = tokenize(f"{entry['name']} {' '.join(entry['tags'])}")
+    return all(any(t.startswith(w) for t in tokens) for w in words)
+
+
+def _narrows(words, old, substring):
+    """Whether everything matching `words` also matches `old`: each old
+    word is part of (substring) or starts (prefix) some new one"""
+    if substring:
+        return all(any(o in w for w in words) for o in old)
+    return all(any(w.startswith(o) for w in words) for o in old)
+
+
+class RemoteCatalog:
+    """Other peers' shared files, fetched a page at a time with OP_BROWSE.
+
+    Each answer is cached for `ttl` seconds, so a search box re-run on
+    every keystroke asks a peer once per distinct query and page. When a
+    cached answer already held every match of a shorter query ("rep"), a
+    longer one ("repo") is answered from it without asking at all.
+    """
+
+    def __init__(self, network_manager, page_size=browse_page, ttl=browse_cache_ttl,
+                 max_entries=CACHE_ENTRIES):
+        self.network_manager = network_manager
+        self.page_size = page_size
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.requests = 0  # OP_BROWSE round trips made
+        self._cache = OrderedDict()  # (peer, substring, words, page) -> (expires, total, entries)
+        self._lock = threading.Lock()
+
+    def page(self, peer_ip, query="", page=0, substring=False):
+        """Page number `page` of a peer's files matching `query`:
+        (total matches, [{id, name, size, hash, tags}, ...]). Raises what
+        NetworkManager.browse() raises if the peer cannot be asked."""
+        words = _words(query, substring)
+        key = (peer_ip, substring, words, page)
+        now = time.monotonic()
+        with self._lock:
+            cached = self._lookup(key, now)
+        if cached is not None:
+            return cached
+        meta = self.network_manager.browse(peer_ip, " ".join(words), page * self.page_size,
+                                           self.page_size, substring)
+        entries = [{"id": e[0], "name": e[1], "size": e[2], "hash": e[3], "tags": e[4]}
+                   for e in meta["entries"]]
+        with self._lock:
+            self.requests += 1
+            self._store(key, now + self.ttl, meta["total"], entries)
+        return meta["total"], entries
+
+    def pages(self, peer_ip, query="", substring=False):
+        """Every match, one page of entries at a time, fetching each page
+        only when the caller asks for it"""
+        page = 0
+        while True:
+            total, entries = self.page(peer_ip, query, page, substring)
+            if entries:
+                yield entries
+            page += 1
+            if not entries or page * self.page_size >= total:
+                return
+
+    def forget(self, peer_ip=None):
+        """Drop cached answers, from one peer or all of them"""
+        with self._lock:
+            for key in [k for k in self._cache if peer_ip in (None, k[0])]:
+                del self._cache[key]
+
+    def _lookup(self, key, now):
+        hit = self._cache.get(key)
+        if hit is not None:
+            if hit[0] > now:
+                self._cache.move_to_end(key)
+                return hit[1:]
+            del self._cache[key]
+        peer_ip, substring, words, page = key
+        # A complete answer to a broader query, filtered here
+        broader = next((hit for (p, s, old, n), hit in reversed(self._cache.items())
+                        if (p, s, n) == (peer_ip, substring, 0) and hit[0] > now
+                        and hit[1] <= len(hit[2]) and _narrows(words, old, substring)), None)
+        if broader is None:
+            return None
+        expires, _, entries = broader
+        matched = [e for e in entries if _matches(words, e, substring)]
+        result = (len(matched), matched[page * self.page_size:(page + 1) * self.page_size])
+        self._store(key, expires, *result)
+        return result
+
+    def _store(self, key, expires, total, entries):
+        self._cache[key] = (expires, total, entries)
+        self._cache.move_to_end(key)
+        while len(self._cache) > self.max_entries:
+            self._cache.popitem(last=False)
@@ -0,0 +1,139 @@
+import bisect
+import itertools
+import threading
+from decouple import config
+
+# Priority classes; lower runs first
+PRIORITY_HIGH = 0
+PRIORITY_NORMAL = 1
+PRIORITY_LOW = 2
+
+# Within a priority class, "fifo" runs transfers in submission order and
+# "shortest" runs the smallest first
+POLICIES = ("fifo", "shortest")
+
+max_running = config("P2P_MAX_TRANSFERS", default=3, cast=int)
+max_per_peer = config("P2P_MAX_TRANSFERS_PER_PEER", default=2, cast=int)
+policy = config("P2P_SCHEDULE_POLICY", default="fifo")
+
+
+class TransferScheduler:
+    """Runs queued transfers on a limited number of worker slots.
+
+    submit() queues a FileTransfer with the job that performs it. A queued
+    transfer starts, on its own worker thread, once fewer than `max_running`
+    transfers run in total and fewer than `max_per_peer` run to its peer;
+    it then moves from Queued to Running, and to Completed or Failed by the
+    job's return value. Paused transfers keep their place in the queue and
+    cancelled ones are dropped from it; a transfer paused while running
+    stops its byte pumps, gives up its slot and thread, and goes back to its
+    place in the queue to continue from where it stopped once resumed. One
+    the receiver holds (see TransferControl.hold) waits the same way, until
+    the receiver releases it.
+    Nothing here blocks the caller, so transfers can be started from the
+    GUI thread.
+    """
+
+    def __init__(self, file_manager, max_running=max_running, max_per_peer=max_per_peer,
+                 policy=policy):
+        if policy not in POLICIES:
+            raise ValueError(f"unknown scheduling policy {policy!r}")
+        self.file_manager = file_manager
+        self.max_running = max(1, max_running)
+        self.max_per_peer = max(1, max_per_peer)
+        self.policy = policy
+        self._pending = []  # sorted [(key, transfer, job)]
+        self._running = {}  # peer ip -> number of running transfers
+        self._seq = itertools.count()
+        self._cond = threading.Condition()
+
+    @property
+    def running(self):
+        with self._cond:
+            return sum(self._running.values())
+
+    def queued(self):
+        """Queued transfers, in the order they would start"""
+        with self._cond:
+            return [transfer for _, transfer, _ in self._pending]
+
+    def submit(self, transfer, job, priority=PRIORITY_NORMAL):
+        """Queue `transfer`; job() performs it and returns True on success"""
+        if self.policy == "shortest":
+            key = (priority, transfer.size, next(self._seq))
+        else:
+            key = (priority, next(self._seq))
+        with self._cond:
+            bisect.insort(self._pending, (key, transfer, job))  # keys are unique
+        self.dispatch()
+
+    def set_limits(self, max_running=None, max_per_peer=None):
+        with self._cond:
+            if max_running is not None:
+                self.max_running = max(1, max_running)
+            if max_per_peer is not None:
+                self.max_per_peer = max(1, max_per_peer)
+        self.dispatch()
+
+    def dispatch(self):
+        """Start every queued transfer that a free slot allows; call again
+        after resuming a paused transfer or releasing a held one"""
+        started = []
+        with self._cond:
+            for entry in list(self._pending):
+                if sum(self._running.values()) >= self.max_running:
+                    break
+                _, transfer, _ = entry
+                if transfer.cancelled:
+                    self._pending.remove(entry)
+                    continue
+                if transfer.paused or transfer.control.held or \
+                        self._running.get(transfer.peer_ip, 0) >= self.max_per_peer:
+                    continue
+                self._pending.remove(entry)
+                self._running[transfer.peer_ip] = self._running.get(transfer.peer_ip, 0) + 1
+                started.append(entry)
+            self._cond.notify_all()
+        for entry in started:
+            transfer = entry[1]
+            transfer.control.take_interrupted()  # forget pauses while queued
+            self.file_manager.set_status(transfer, "Running")
+            threading.Thread(target=self._run, args=(entry,), daemon=True,
+                             name=f"transfer-{transfer.filename}").start()
+
+    def _run(self, entry):
+        _, transfer, job = entry
+        ok = False
+        try:
+            ok = job()
+        except Exception as e:
+            print(f"[ERROR] Transfer of {transfer.filename} to {transfer.peer_ip}: {e}")
+        finally:
+            interrupted = transfer.control.take_interrupted()
+            if ok:
+                self.file_manager.set_status(transfer, "Completed")
+            elif transfer.cancelled:
+                pass
+            elif interrupted:
+                self.file_manager.set_status(
+                    transfer, "Paused" if transfer.paused or transfer.control.held
+                    else "Queued")
+                with self._cond:
+                    bisect.insort(self._pending, entry)
+            else:
+                self.file_manager.set_status(transfer, "Failed")
+            with self._cond:
+                self._running[transfer.peer_ip] -= 1
+                if not self._running[transfer.peer_ip]:
+                    del self._running[transfer.peer_ip]
+            self.dispatch()
+
+    def wait_idle(self, timeout=None):
+        """Wait until no transfer is running or ready to start; returns
+        False on timeout"""
+        def idle():
+            return not self._running and all(
+                t.paused or t.control.held for _, t, _ in self._pending if not t.cancelled)
+
+        with self._cond:
+            return self._cond.wait_for(idle, timeout)
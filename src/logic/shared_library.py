@@ -0,0 +1,414 @@
+import bisect
+import json
+import os
+import re
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from decouple import config
+from PyQt5.QtCore import QObject, pyqtSignal
+
+from .catalog import Catalog, file_hash
+
+# The catalog; a JSON list next to it with the same name (the old format)
+# is imported when the catalog is first created
+CATALOG_FILE = "src/shared_files.db"
+
+# Paths stat'ed per background task; large enough that 200k shared files
+# cost a few hundred tasks rather than one each
+STAT_BATCH = 512
+# Files hashed per background task
+HASH_BATCH = 16
+
+# Most files listed in one page of a peer's browse
+BROWSE_PAGE = 1000
+
+# Seconds between re-stats of every shared file (0 to only stat on load)
+rescan_interval = config("P2P_RESCAN_INTERVAL", default=300, cast=float)
+
+_TOKEN = re.compile(r"[^\W_]+")
+
+
+def tokenize(text):
+    """Lower-case words and numbers of a file name or search query"""
+    return _TOKEN.findall(text.lower())
+
+
+class SearchIndex:
+    """Inverted index from name tokens to ids, searched by token prefix.
+
+    "rep 20" matches "Quarterly Report 2024.pdf": every query token must
+    be a prefix of some token of the name. Tokens are kept sorted, so each
+    query token costs a binary search plus the postings it matches rather
+    than a scan over every name.
+    """
+
+    def __init__(self):
+        self._postings = {}  # token -> set of ids
+        self._sorted = []  # tokens in order, rebuilt lazily after changes
+        self._dirty = False
+
+    def add(self, item_id, text):
+        for token in set(tokenize(text)):
+            ids = self._postings.get(token)
+            if ids is None:
+                ids = self._postings[token] = set()
+                self._dirty = True
+            ids.add(item_id)
+
+    def remove(self, item_id, text):
+        for token in set(tokenize(text)):
+            ids = self._postings.get(token)
+            if ids is not None:
+                ids.discard(item_id)
+                if not ids:
+                    del self._postings[token]
+                    self._dirty = True
+
+    def _prefixed(self, prefix):
+        if self._dirty:
+            self._sorted = sorted(self._postings)
+            self._dirty = False
+        lo = bisect.bisect_left(self._sorted, prefix)
+        hi = bisect.bisect_left(self._sorted, prefix + "\U0010ffff")
+        return self._sorted[lo:hi]
+
+    def search(self, query):
+        """Ids matching every token of `query`, or None when the query has
+        no tokens (everything matches)"""
+        result = None
+        for prefix in sorted(set(tokenize(query)), key=len, reverse=True):
+            tokens = self._prefixed(prefix)
+            matched = set().union(*(self._postings[t] for t in tokens)) if tokens else set()
+            result = matched if result is None else result & matched
+            if not result:
+                return set()
+        return result
+
+
+def _entry_text(path, tags):
+    """What a search matches a shared file against: its name and tags"""
+    name = os.path.basename(path)
+    return f"{name} {tags}" if tags else name
+
+
+class SharedLibrary(QObject):
+    """The files this app shares, with their sizes and a search index.
+
+    The files live in a Catalog, whose row ids are their ids here. At
+    startup ids and paths are read first, then sizes, then the search
+    index is built, searches falling back to a scan until it is ready.
+    Files are stat'ed in batches on a background pool, on load, every
+    `rescan_interval` seconds and when added, never on the caller's
+    thread. Only files whose size or mtime differ from the catalog are
+    updated there, reported (each batch that changed anything emits
+    metadata_changed; take_changed() returns the ids concerned) and
+    re-hashed. Files found missing are dropped from the library.
+    """
+
+    metadata_changed = pyqtSignal()
+    files_changed = pyqtSignal()  # files added or removed
+
+    def __init__(self, catalog_path=CATALOG_FILE, stat_workers=4,
+                 rescan_interval=rescan_interval):
+        super().__init__()
+        self.catalog = Catalog(catalog_path)
+        self._paths = {}  # id -> path, in id order
+        self._sizes = {}  # id -> size, once known
+        self._tags = {}  # id -> comma-separated tags, for tagged files
+        self._changed = set()
+        self.index = SearchIndex()
+        self._indexed = False
+        self.lock = threading.Lock()
+        self._idle = threading.Condition(self.lock)
+        self._batches = 0  # background tasks queued or running
+        self._loaded = threading.Event()
+        self._stopped = threading.Event()
+        self._executor = ThreadPoolExecutor(max_workers=stat_workers,
+                                            thread_name_prefix="stat")
+        self._submit(self._load)
+        if rescan_interval > 0:
+            threading.Thread(target=self._rescan, args=(rescan_interval,),
+                             name="rescan", daemon=True).start()
+
+    def _load(self):
+        if self.catalog.created:
+            self._import(os.path.splitext(self.catalog.path)[0] + ".json")
+        # Paths first, so the list can be shown; sizes and tags follow
+        paths = self.catalog.paths()
+        with self.lock:
+            paths.update(self._paths)  # files added meanwhile have the highest ids
+            self._paths = paths
+        self._loaded.set()
+        if paths:
+            self.files_changed.emit()
+        sizes = self.catalog.sizes()
+        tags = self.catalog.tagged()
+        with self.lock:
+            sizes.update(self._sizes)
+            self._sizes, self._tags = sizes, tags
+        if sizes:
+            self.files_changed.emit()
+        self._build_index(list(paths.items()), tags)
+        self.refresh()
+
+    def _import(self, legacy_path):
+        try:
+            with open(legacy_path) as f:
+                paths = json.load(f)
+        except FileNotFoundError:
+            return
+        except (OSError, ValueError) as e:
+            print(f"[ERROR] Importing shared files: {e}")
+            return
+        self.catalog.add(paths)
+        print(f"[INFO] Imported {len(paths)} shared files from {legacy_path}")
+
+    def _build_index(self, rows, tags):
+        # The lock is taken per batch so searches need not wait for a
+        # large library to finish indexing
+        for start in range(0, len(rows), STAT_BATCH):
+            if self._stopped.is_set():
+                return
+            with self.lock:
+                for item_id, path in rows[start:start + STAT_BATCH]:
+                    if self._paths.get(item_id) == path:  # not removed meanwhile
+                        self.index.add(item_id, _entry_text(path, tags.get(item_id)))
+        with self.lock:
+            self._indexed = True
+
+    def add(self, paths):
+        """Share more files; their sizes are looked up in the background"""
+        added = self.catalog.add(paths)
+        for start in range(0, len(added), STAT_BATCH):
+            with self.lock:
+                for item_id, path in added[start:start + STAT_BATCH]:
+                    self._paths[item_id] = path
+                    self.index.add(item_id, os.path.basename(path))
+        ids = [item_id for item_id, _ in added]
+        if ids:
+            self.files_changed.emit()
+            self._stat(ids)
+        return ids
+
+    def remove(self, ids):
+        with self.lock:
+            removed = [i for i in ids if i in self._paths]
+            for item_id in removed:
+                path = self._paths.pop(item_id)
+                self.index.remove(item_id, _entry_text(path, self._tags.pop(item_id, None)))
+                self._sizes.pop(item_id, None)
+                self._changed.discard(item_id)
+        if removed:
+            self.catalog.remove(removed)
+            self.files_changed.emit()
+
+    def set_tags(self, item_id, tags):
+        """Replace the tags of a shared file; searches match them too"""
+        text = ",".join(tags)
+        with self.lock:
+            path = self._paths.get(item_id)
+            if path is None:
+                return
+            self.index.remove(item_id, _entry_text(path, self._tags.pop(item_id, None)))
+            if text:
+                self._tags[item_id] = text
+            self.index.add(item_id, _entry_text(path, text))
+        self.catalog.set_tags(item_id, tags)
+
+    def tags(self, item_id):
+        text = self._tags.get(item_id)
+        return text.split(",") if text else []
+
+    def __len__(self):
+        return len(self._paths)
+
+    def paths(self):
+        with self.lock:
+            return list(self._paths.values())
+
+    def ids(self):
+        with self.lock:
+            return list(self._paths)
+
+    def path(self, item_id):
+        """Path of a shared file, or None once it was removed"""
+        return self._paths.get(item_id)
+
+    def size(self, item_id):
+        """Size in bytes, or None until the file has been stat'ed"""
+        return self._sizes.get(item_id)
+
+    def entries(self, ids):
+        """{id: (path, size, hash, tags)} from the catalog; the hash is
+        None until the file has been read"""
+        return self.catalog.entries(ids)
+
+    def path_for_hash(self, digest):
+        """Path of a shared file with that content hash (see catalog.py),
+        or None; swarm downloads ask for files this way"""
+        return self.catalog.path_for_hash(digest)
+
+    def search(self, query):
+        """Ids of shared files matching `query`, in the order added"""
+        if not self._indexed:
+            return self._scan(query)
+        with self.lock:
+            matched = self.index.search(query)
+            if matched is None:
+                return list(self._paths)
+            return sorted(matched)
+
+    def _scan(self, query):
+        """search() while the index is still being built: the catalog
+        narrows the files down to those containing each query token, then
+        the token-prefix rule is checked on each of them"""
+        prefixes = set(tokenize(query))
+        if not prefixes:
+            return self.ids()
+        candidates = self.catalog.containing([p for p in prefixes if p.isascii()])
+        # A token starts the text or follows a character that is not part of one
+        patterns = [re.compile(r"(?:^|[\W_])" + re.escape(p)).search for p in prefixes]
+        with self.lock:
+            return sorted(item_id for item_id, (path, tags) in candidates.items()
+                          if item_id in self._paths
+                          and all(match(_entry_text(path, tags).lower()) for match in patterns))
+
+    def find(self, query):
+        """Ids of shared files whose name contains every word of `query`,
+        ignoring case, in the order added"""
+        words = query.lower().split()
+        if not words:
+            return self.ids()
+        # LIKE treats % and _ as wildcards; that only lets extra candidates
+        # through, and they are dropped below
+        candidates = self.catalog.containing([w for w in words if w.isascii()])
+        with self.lock:
+            return sorted(item_id for item_id, (path, _) in candidates.items()
+                          if item_id in self._paths
+                          and all(w in os.path.basename(path).lower() for w in words))
+
+    def browse(self, query="", offset=0, limit=BROWSE_PAGE, substring=False):
+        """A page of the files matching `query`, as shown to a peer:
+        (total matches, [[id, name, size, hash, tags], ...]). The query is
+        a search() one, or a find() one with `substring`; names go without
+        their directories."""
+        ids = self.find(query) if substring else self.search(query)
+        page = ids[offset:offset + min(limit, BROWSE_PAGE)]
+        entries = self.catalog.entries(page)
+        return len(ids), [[i, os.path.basename(entries[i][0]), *entries[i][1:]]
+                          for i in page if i in entries]
+
+    def refresh(self):
+        """Re-stat every shared file in the background"""
+        self._stat(self.ids())
+
+    def _rescan(self, interval):
+        while not self._stopped.wait(interval):
+            self.refresh()
+
+    def _stat(self, ids):
+        for start in range(0, len(ids), STAT_BATCH):
+            if not self._submit(self._stat_batch, ids[start:start + STAT_BATCH]):
+                return
+
+    def _submit(self, task, *args):
+        with self.lock:
+            self._batches += 1
+        try:
+            self._executor.submit(self._run, task, *args)
+            return True
+        except RuntimeError:  # shut down
+            self._batch_done()
+            return False
+
+    def _run(self, task, *args):
+        try:
+            if not self._stopped.is_set():
+                task(*args)
+        except Exception as e:
+            print(f"[ERROR] Shared files: {e}")
+        finally:
+            self._batch_done()
+
+    def _batch_done(self):
+        with self.lock:
+            self._batches -= 1
+            if not self._batches:
+                self._idle.notify_all()
+
+    def _stat_batch(self, ids):
+        with self.lock:
+            paths = [(i, self._paths.get(i)) for i in ids]
+        known = self.catalog.stats(ids)
+        updates, missing, rehash = [], [], []
+        for item_id, path in paths:
+            if path is None or item_id not in known:
+                continue
+            try:
+                st = os.stat(path)
+            except OSError:
+                missing.append(item_id)
+                continue
+            size, mtime_ns, digest = known[item_id]
+            if (size, mtime_ns) != (st.st_size, st.st_mtime_ns):
+                updates.append((item_id, st.st_size, st.st_mtime_ns))
+                rehash.append(item_id)
+            elif digest is None:
+                rehash.append(item_id)  # hashing was cut short last time
+        if updates:
+            self.catalog.update_stats(updates)
+            with self.lock:
+                for item_id, size, _ in updates:
+                    if item_id in self._paths:
+                        self._sizes[item_id] = size
+                        self._changed.add(item_id)
+        if missing:
+            self.remove(missing)
+        if updates:
+            self.metadata_changed.emit()
+        for start in range(0, len(rehash), HASH_BATCH):
+            if not self._submit(self._hash_batch, rehash[start:start + HASH_BATCH]):
+                return
+
+    def _hash_batch(self, ids):
+        with self.lock:
+            paths = [(i, self._paths.get(i)) for i in ids]
+        hashes = []
+        for item_id, path in paths:
+            if path is None:
+                continue
+            try:
+                before = os.stat(path)
+                digest = file_hash(path, self._stopped)
+                after = os.stat(path)
+            except OSError:
+                continue  # the next rescan drops it if it is gone
+            if digest is None:
+                break
+            if (before.st_size, before.st_mtime_ns) == (after.st_size, after.st_mtime_ns):
+                hashes.append((item_id, after.st_size, after.st_mtime_ns, digest))
+        if hashes:
+            self.catalog.set_hashes(hashes)
+
+    def take_changed(self):
+        """Ids whose metadata changed since the last call"""
+        with self.lock:
+            changed, self._changed = self._changed, set()
+            return changed
+
+    def wait_loaded(self, timeout=None):
+        """Wait until the catalog has been read (the index may still be
+        building); returns False on timeout"""
+        return self._loaded.wait(timeout)
+
+    def wait_idle(self, timeout=None):
+        """Wait until loading, indexing and every queued stat and hash
+        batch are done; returns False on timeout"""
+        with self._idle:
+            return self._idle.wait_for(lambda: not self._batches, timeout)
+
+    def stop(self):
+        self._stopped.set()
+        self._executor.shutdown(wait=True, cancel_futures=True)
+        self.catalog.close()
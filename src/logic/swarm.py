@@ -0,0 +1,292 @@
+import hashlib
+import random
+import socket
+import threading
+import time
+
+from .catalog import file_hash
+from .partial_file import PartialFile, covers
+from .protocol import OP_GET, OP_HAVE, OP_PIECE, OP_WANT, ProtocolError, recv_exact, recv_frame, send_frame
+from .transfer_control import TransferInterrupted
+
+# Files are fetched in pieces of this size, each from whichever peer the
+# picker chooses
+PIECE_SIZE = 4 * 1024 * 1024
+# A peer whose download rate falls below this fraction of the median
+# peer's, once it and at least two others have delivered MIN_SAMPLES
+# pieces, is dropped, unless it is the only one holding some piece we
+# still need
+SLOW_FRACTION = 0.25
+MIN_SAMPLES = 3
+# Seconds between asking a peer again what it has, while it has nothing
+# we need; and how long a peer may go without anything to give us before
+# it is let go
+HAVE_REFRESH = 0.5
+STALL_TIMEOUT = 10
+# A piece not delivered within this many seconds drops the peer
+PIECE_TIMEOUT = 30
+
+
+class PiecePicker:
+    """Decides which piece each peer fetches next.
+
+    Rarest first: of the pieces a peer has that nobody is fetching yet, it
+    gets one held by the fewest peers (ties broken at random), so rare
+    pieces spread before their holders leave and downloaders that started
+    together end up with different pieces to trade. Endgame: once every
+    missing piece is being fetched, an idle peer fetches one of them again,
+    the one with the fewest fetchers, and the first copy to arrive wins, so
+    the last pieces do not wait on the slowest peer.
+    """
+
+    def __init__(self, count, done=()):
+        self.count = count
+        self.done = set(done)
+        self.availability = [0] * count
+        self.fetching = [0] * count
+        self.lock = threading.Lock()
+
+    @property
+    def complete(self):
+        return len(self.done) == self.count
+
+    def add_peer(self, pieces):
+        with self.lock:
+            for i in pieces:
+                self.availability[i] += 1
+
+    def remove_peer(self, pieces):
+        with self.lock:
+            for i in pieces:
+                self.availability[i] -= 1
+
+    def unique(self, pieces):
+        """Whether some missing piece of `pieces` is held by no other peer"""
+        with self.lock:
+            return any(self.availability[i] == 1 for i in pieces if i not in self.done)
+
+    def pick(self, pieces):
+        """A piece for a peer holding `pieces` to fetch, marked as being
+        fetched, or None if it has nothing we need"""
+        with self.lock:
+            wanted = [i for i in pieces if i not in self.done]
+            if not wanted:
+                return None
+            idle = [i for i in wanted if not self.fetching[i]]
+            if idle:
+                rarest = min(self.availability[i] for i in idle)
+                choice = random.choice([i for i in idle if self.availability[i] == rarest])
+            else:  # endgame
+                choice = min(wanted, key=lambda i: self.fetching[i])
+            self.fetching[choice] += 1
+            return choice
+
+    def finished(self, index):
+        """Record a fetched piece; True for the first copy of it"""
+        with self.lock:
+            self.fetching[index] -= 1
+            if index in self.done:
+                return False
+            self.done.add(index)
+            return True
+
+    def failed(self, index):
+        with self.lock:
+            self.fetching[index] -= 1
+
+
+class SwarmDownload:
+    """One file fetched from every peer that has some of it, in parallel.
+
+    The file is identified by its content hash (see catalog.py): peers
+    answer OP_WANT with the byte ranges they hold, from a shared file with
+    that hash or from a swarm download of their own, and a thread per peer
+    fetches pieces with OP_GET as the PiecePicker deals them out. Pieces
+    land in a PartialFile, so an interrupted download resumes, and while
+    downloading the pieces already here are served to the rest of the
+    swarm. Peers that fail, time out or fall well behind the others are
+    dropped; the finished file is checked against the content hash.
+    """
+
+    def __init__(self, network_manager, content_hash, name, size, peers,
+                 control=None, piece_size=PIECE_SIZE):
+        self.nm = network_manager
+        self.content_hash = content_hash
+        self.name = name
+        self.size = size
+        self.peers = list(peers)
+        self.control = control
+        self.piece_size = piece_size
+        self.count = (size + piece_size - 1) // piece_size
+        self.rates = {}  # peer ip -> bytes per second over its pieces, while active
+        self.samples = {}  # peer ip -> pieces delivered
+        self._received = {}  # peer ip -> (bytes, seconds) spent on its pieces
+        self.dropped = []  # peers let go for being slow or failing
+        self.picker = None
+        self.part = None
+        self._socks = set()
+        self._lock = threading.Lock()
+        self._interrupted = None
+
+    def piece_range(self, index):
+        start = index * self.piece_size
+        return start, min(start + self.piece_size, self.size)
+
+    def pieces_in(self, ranges):
+        return [i for i in range(self.count) if covers(ranges, *self.piece_range(i))]
+
+    def run(self):
+        """Fetch the file; True once it is complete and verified"""
+        path = self.nm._download_path(self.name)
+        self.part = PartialFile(path, self.size, self.content_hash)
+        with self.part.lock:
+            have = self.pieces_in(self.part.ranges)
+        self.picker = PiecePicker(self.count, have)
+        if self.control is not None:
+            self.control.seek(self.part.received)
+        self.nm.swarm_started(self.content_hash, self.part)
+        try:
+            threads = [threading.Thread(target=self._fetch_from, args=(peer,), daemon=True,
+                                        name=f"swarm-{peer}") for peer in self.peers]
+            for t in threads:
+                t.start()
+            for t in threads:
+                t.join()
+            if self._interrupted is not None:
+                if self.control.cancelled:
+                    self.part.discard()
+                return False  # a resumed download starts from what is here
+            if not self.picker.complete:
+                print(f"[ERROR] Swarm download of {self.name}: "
+                      f"{self.count - len(self.picker.done)} pieces nobody could give us")
+                return False
+            if file_hash(self.part.part_path) != self.content_hash:
+                print(f"[ERROR] Swarm download of {self.name} does not match its hash; discarded")
+                self.part.discard()
+                return False
+            self.part.close()
+            print(f"[OK] Received {self.name} ({self.size} bytes) from "
+                  f"{len(self.samples)} peers by swarm")
+            return True
+        finally:
+            self.nm.swarm_finished(self.content_hash, self.part, path)
+            self.part.close()
+
+    def _fetch_from(self, peer_ip):
+        pieces = []
+        index = None
+        try:
+            with self.nm.pool.connection(peer_ip, reuse=False) as sock:
+                sock.settimeout(PIECE_TIMEOUT)
+                with self._lock:
+                    self._socks.add(sock)
+                if self.control is not None:
+                    self.control.bind(sock)
+                try:
+                    pieces = self._ask_have(sock)
+                    self.picker.add_peer(pieces)
+                    idle_since = time.monotonic()
+                    while not self.picker.complete:
+                        if self.control is not None:
+                            self.control.checkpoint()
+                        index = self.picker.pick(pieces)
+                        if index is None:
+                            if time.monotonic() - idle_since > STALL_TIMEOUT:
+                                return
+                            time.sleep(HAVE_REFRESH)
+                            fresh = self._ask_have(sock)
+                            self.picker.add_peer(set(fresh) - set(pieces))
+                            pieces = fresh
+                            continue
+                        self._fetch_piece(sock, peer_ip, index)
+                        index = None
+                        idle_since = time.monotonic()
+                        if self._too_slow(peer_ip, pieces):
+                            print(f"[WARN] Swarm download of {self.name}: dropping slow peer {peer_ip}")
+                            self.dropped.append(peer_ip)
+                            return
+                finally:
+                    if self.control is not None:
+                        self.control.unbind(sock)
+                    with self._lock:
+                        self._socks.discard(sock)
+        except TransferInterrupted as e:
+            self._interrupted = e
+            self._stop_all()  # the other peers' threads see the same
+        except (OSError, ProtocolError, ValueError) as e:
+            if not self.picker.complete:
+                if self.control is not None and self.control.stopped:
+                    self._interrupted = TransferInterrupted("paused")
+                else:
+                    print(f"[WARN] Swarm download of {self.name}: dropping {peer_ip}: {e}")
+                    self.dropped.append(peer_ip)
+        finally:
+            if index is not None:
+                self.picker.failed(index)
+            self.picker.remove_peer(pieces)
+            with self._lock:
+                self.rates.pop(peer_ip, None)
+
+    def _ask_have(self, sock):
+        send_frame(sock, OP_WANT, {"hash": self.content_hash})
+        op, meta = recv_frame(sock)
+        if op != OP_HAVE:
+            raise ProtocolError(f"expected OP_HAVE, got {op}")
+        if meta["size"] != self.size:
+            return []
+        return self.pieces_in(meta["ranges"])
+
+    def _fetch_piece(self, sock, peer_ip, index):
+        start, end = self.piece_range(index)
+        began = time.monotonic()
+        send_frame(sock, OP_GET, {"hash": self.content_hash, "offset": start,
+                                  "length": end - start})
+        op, meta = recv_frame(sock)
+        if op != OP_PIECE:
+            raise ProtocolError(f"expected OP_PIECE, got {op}")
+        if meta["length"] != end - start:
+            raise ProtocolError(f"peer no longer has piece {index}")
+        data = recv_exact(sock, end - start)
+        if len(data) < end - start:
+            raise ProtocolError("connection closed inside a piece")
+        self.nm._count_download(sock, len(data))
+        if hashlib.new(meta["algo"], data).hexdigest() != meta["digest"]:
+            raise ProtocolError(f"piece {index} arrived corrupted")
+        self._record_rate(peer_ip, len(data), time.monotonic() - began)
+        if self.picker.finished(index):
+            self.part.write_at(start, data)
+            self.part.commit(start, len(data))
+            if self.control is not None:
+                self.control.moved(len(data))
+        if self.picker.complete:
+            self._stop_all()  # endgame fetches still running are not needed
+
+    def _record_rate(self, peer_ip, count, elapsed):
+        # Totals rather than a moving average: a first piece sent from a
+        # rate limiter's burst allowance would otherwise hide a slow peer
+        with self._lock:
+            total, seconds = self._received.get(peer_ip, (0, 0.0))
+            total, seconds = total + count, seconds + elapsed
+            self._received[peer_ip] = (total, seconds)
+            self.rates[peer_ip] = total / max(seconds, 1e-6)
+            self.samples[peer_ip] = self.samples.get(peer_ip, 0) + 1
+
+    def _too_slow(self, peer_ip, pieces):
+        # Judged only among peers with MIN_SAMPLES pieces behind them, and
+        # only once there are three, so one lucky early piece sets no bar
+        with self._lock:
+            rates = sorted(rate for ip, rate in self.rates.items()
+                           if self.samples[ip] >= MIN_SAMPLES)
+            if len(rates) < 3 or self.samples[peer_ip] < MIN_SAMPLES:
+                return False
+            slow = self.rates[peer_ip] < SLOW_FRACTION * rates[len(rates) // 2]
+        return slow and not self.picker.unique(pieces)
+
+    def _stop_all(self):
+        with self._lock:
+            socks = list(self._socks)
+        for sock in socks:
+            try:
+                sock.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
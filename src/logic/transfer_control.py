@@ -0,0 +1,175 @@
+import socket
+import threading
+
+from decouple import config
+
+# Longest a receiving pump stays parked, in seconds (0 waits for good). Past
+# that it drops the connection, so a long pause does not hold a worker
+# thread; the saved manifest lets the sender's next offer carry on.
+park_timeout = config("P2P_PARK_TIMEOUT", default=30, cast=float)
+
+
+class TransferInterrupted(Exception):
+    """A byte pump stopped because its transfer was paused or cancelled"""
+
+
+class TransferControl:
+    """Pause and cancel switch shared by the GUI and a transfer's byte pumps,
+    through which the pumps also report how far the transfer has got.
+
+    Pumps call checkpoint() between chunks. When sending (park=False) a
+    pause or cancel raises TransferInterrupted, so the worker gives up its
+    thread; the scheduler requeues a paused transfer and the receiver's
+    manifest lets the next attempt continue where this one stopped. When
+    receiving (park=True) a pause blocks the pump instead: the socket is not
+    read, and TCP backpressure stalls the sender, for up to `park_timeout`
+    seconds, after which it is interrupted too. Sockets bound to the
+    control are shut down on cancel, and when sending on pause too, so a
+    pump blocked in the kernel wakes at once.
+
+    A receiver paused past its park timeout holds the transfer at the
+    sender: hold() stops the sending pumps as a pause would, without the
+    sender's own user having paused anything, until release().
+
+    Pumps report each chunk with moved(), and the byte count the peer
+    already had with seek(); whoever owns the transfer sets on_progress to
+    hear of it, and on_finish to learn how a receiving transfer ended.
+    on_resume is called whenever resume() lifts a pause, and on_cancel
+    when cancel() is called.
+    """
+
+    def __init__(self, park=False, park_timeout=park_timeout):
+        self.park = park
+        self.park_timeout = park_timeout
+        self.paused = False
+        self.cancelled = False
+        self.held = False  # paused at the receiver's end
+        self.interrupted = False  # set when a pause stopped a pump
+        self.transferred = 0
+        self.on_progress = None  # called with the byte count as it grows
+        self.on_finish = None  # called with True/False when a receive ends
+        self.on_resume = None
+        self.on_cancel = None
+        self._socks = set()
+        self._cond = threading.Condition()
+
+    @property
+    def stopped(self):
+        return self.cancelled or ((self.paused or self.held) and not self.park)
+
+    def pause(self):
+        with self._cond:
+            self.paused = True
+            if not self.park:
+                self.interrupted = True
+            self._cond.notify_all()
+        if not self.park:
+            self._interrupt()
+
+    def resume(self):
+        with self._cond:
+            was_paused, self.paused = self.paused, False
+            self._cond.notify_all()
+        if was_paused and self.on_resume is not None:
+            self.on_resume()
+
+    def hold(self):
+        """The receiver paused the transfer for longer than it parks"""
+        with self._cond:
+            self.held = True
+            if not self.park:
+                self.interrupted = True
+            self._cond.notify_all()
+        if not self.park:
+            self._interrupt()
+
+    def release(self):
+        """The receiver resumed a held transfer"""
+        with self._cond:
+            self.held = False
+            self._cond.notify_all()
+
+    def cancel(self):
+        with self._cond:
+            self.cancelled = True
+            self._cond.notify_all()
+        self._interrupt()
+        if self.on_cancel is not None:
+            self.on_cancel()
+
+    def moved(self, n):
+        """Report `n` more bytes of the transfer sent or received"""
+        with self._cond:
+            self.transferred += n
+            transferred = self.transferred
+        if self.on_progress is not None:
+            self.on_progress(transferred)
+
+    def seek(self, transferred):
+        """Report how much of the transfer is done in total, e.g. what a
+        resumed transfer's peer already has"""
+        with self._cond:
+            self.transferred = transferred
+        if self.on_progress is not None:
+            self.on_progress(transferred)
+
+    def finish(self, ok):
+        if self.on_finish is not None:
+            self.on_finish(ok)
+
+    def take_interrupted(self):
+        """Whether a pause stopped the pumps since the last call"""
+        with self._cond:
+            interrupted, self.interrupted = self.interrupted, False
+            return interrupted
+
+    def bind(self, sock):
+        with self._cond:
+            self._socks.add(sock)
+            stopped = self.stopped
+        if stopped:
+            self._interrupt()
+
+    def unbind(self, sock):
+        with self._cond:
+            self._socks.discard(sock)
+
+    def _interrupt(self):
+        with self._cond:
+            socks = list(self._socks)
+        for sock in socks:
+            try:
+                sock.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+
+    def checkpoint(self, delay=0):
+        """Wait `delay` seconds, cut short by a pause or cancel, then wait
+        out any pause when parking (up to park_timeout); raises
+        TransferInterrupted once stopped"""
+        with self._cond:
+            if delay > 0:
+                self._cond.wait_for(lambda: self.stopped or self.paused, delay)
+            if self.park:
+                self._cond.wait_for(lambda: not self.paused or self.cancelled,
+                                    self.park_timeout or None)
+            self.poll(self.park_timeout)
+
+    def poll(self, parked_for=0):
+        """checkpoint() without the waiting, for pumps that wait elsewhere
+        (the asyncio engine): raises TransferInterrupted once stopped, and
+        returns whether a parking pump, parked `parked_for` seconds so far,
+        should wait on"""
+        with self._cond:
+            if self.cancelled:
+                raise TransferInterrupted("cancelled")
+            if self.held and not self.park:
+                raise TransferInterrupted("held by the receiver")
+            if not self.paused:
+                return False
+            if not self.park:
+                raise TransferInterrupted("paused")
+            if self.park_timeout and parked_for >= self.park_timeout:
+                self.interrupted = True
+                raise TransferInterrupted("paused too long")
+            return True
@@ -2,9 +2,17 @@
 
 import unittest
 import os
+import shutil
+import socket
 import tempfile
-from unittest.mock import Mock, patch
+import time
+from functools import partial
+from unittest.mock import ANY, Mock, patch
 from src.controller.index import AppLogic
+from src.logic.chat import ChatManager
+from src.logic.file_manager import FileTransfer
+from src.logic.scheduler import TransferScheduler
+from tests.test_network import free_port, quiet_manager
 
 
 class TestAppLogic(unittest.TestCase):
@@ -13,12 +21,22 @@ class TestAppLogic(unittest.TestCase):
         with patch('src.logic.NetworkManager'), \
                 patch('src.logic.ChatManager'), \
                 patch('src.logic.FileManager'):
-            self.app_logic = AppLogic()
+            self.catalog_dir = tempfile.mkdtemp()
+            self.app_logic = AppLogic(
+                catalog_path=os.path.join(self.catalog_dir, "shared_files.db"))
 
             # Mock the manager methods
             self.app_logic.network_manager = Mock()
             self.app_logic.chat_manager = Mock()
+            self.app_logic.chat_manager.offered_codecs = {}
+            self.app_logic.chat_manager.offered_features = {}
             self.app_logic.file_manager = Mock()
+            self.app_logic.file_manager.add_transfer.side_effect = FileTransfer
+            self.app_logic.scheduler = TransferScheduler(self.app_logic.file_manager)
+
+    def tearDown(self):
+        self.app_logic.shared_library.stop()
+        shutil.rmtree(self.catalog_dir)
 
     def test_initialization(self):
         """Test that AppLogic initializes with all managers"""
@@ -46,8 +64,9 @@ class TestAppLogic(unittest.TestCase):
             self.app_logic.network_manager.send_file.return_value = True
             result = self.app_logic.send_file("192.168.1.100", temp_path)
             self.assertTrue(result)
+            self.assertTrue(self.app_logic.scheduler.wait_idle(2))
             self.app_logic.network_manager.send_file.assert_called_once_with(
-                "192.168.1.100", temp_path)
+                "192.168.1.100", temp_path, control=ANY)
         finally:
             os.unlink(temp_path)
 
@@ -110,6 +129,68 @@ class TestAppLogic(unittest.TestCase):
         self.app_logic.file_manager.cancel_transfer.assert_called_once_with(
             filename, peer_ip)
 
+    def test_browse_peer(self):
+        """Browsing goes through the remote catalog's cache"""
+        self.app_logic.remote_catalog = Mock()
+        self.app_logic.remote_catalog.page.return_value = (1, [{"name": "a.txt"}])
+        self.assertEqual(self.app_logic.browse_peer("192.168.1.100", "a"),
+                         (1, [{"name": "a.txt"}]))
+        self.app_logic.remote_catalog.page.assert_called_once_with(
+            "192.168.1.100", "a", 0, False)
+        self.app_logic.remote_catalog.page.side_effect = OSError("unreachable")
+        self.assertIsNone(self.app_logic.browse_peer("192.168.1.100", "a"))
+
+    def test_swarm_download(self):
+        """A swarm download is queued like a send and pulls through the network manager"""
+        self.app_logic.network_manager.swarm_download.return_value = True
+        transfer = self.app_logic.swarm_download("ab12", "image.iso", 1000, ["192.168.1.100"])
+        self.assertTrue(self.app_logic.scheduler.wait_idle(2))
+        self.app_logic.network_manager.swarm_download.assert_called_once_with(
+            "ab12", "image.iso", 1000, ["192.168.1.100"], control=transfer.control)
+        self.assertFalse(transfer.control.park)
+
+    def test_send_files(self):
+        """Several files are queued as one batch over one connection"""
+        temp_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, temp_dir)
+        paths = []
+        for name in ("a.txt", "b.txt"):
+            paths.append(os.path.join(temp_dir, name))
+            with open(paths[-1], "wb") as f:
+                f.write(b"test content")
+        self.app_logic.network_manager.send_files.return_value = True
+        self.assertTrue(self.app_logic.send_files("192.168.1.100", paths))
+        self.assertTrue(self.app_logic.scheduler.wait_idle(2))
+        self.app_logic.network_manager.send_files.assert_called_once_with(
+            "192.168.1.100", paths, control=ANY)
+        self.app_logic.file_manager.add_transfer.assert_called_once_with(
+            "2 files", "192.168.1.100", 24)
+        self.assertFalse(self.app_logic.send_files(
+            "192.168.1.100", paths + [os.path.join(temp_dir, "missing")]))
+
+    def test_send_file_to_peers(self):
+        """Several peers share one queued relay; a single peer is a plain send"""
+        with tempfile.NamedTemporaryFile(delete=False) as temp_file:
+            temp_file.write(b"test content")
+            temp_path = temp_file.name
+
+        try:
+            peers = ["192.168.1.100", "192.168.1.101", "192.168.1.102"]
+            self.app_logic.network_manager.relay_file.return_value = dict.fromkeys(peers, True)
+            self.assertTrue(self.app_logic.send_file_to_peers(peers, temp_path))
+            self.assertTrue(self.app_logic.scheduler.wait_idle(2))
+            self.app_logic.network_manager.relay_file.assert_called_once_with(
+                peers, temp_path, control=ANY)
+            self.app_logic.file_manager.add_transfer.assert_called_once_with(
+                temp_path, "3 peers", 12)
+
+            self.app_logic.send_file_to_peers(peers[:1], temp_path)
+            self.assertTrue(self.app_logic.scheduler.wait_idle(2))
+            self.app_logic.network_manager.send_file.assert_called_once_with(
+                peers[0], temp_path, control=ANY)
+        finally:
+            os.unlink(temp_path)
+
     def test_update_transfer_progress(self):
         """Test updating transfer progress"""
         filename = "test.txt"
@@ -172,14 +253,82 @@ class TestAppLogic(unittest.TestCase):
         try:
             self.app_logic.pending_transfers[request_id] = (peer_ip, file_path)
             self.app_logic.handle_transfer_response(request_id, "accept")
+            self.assertTrue(self.app_logic.scheduler.wait_idle(2))
 
             # Should start file transfer and remove from pending
             self.app_logic.network_manager.send_file.assert_called_once_with(
-                peer_ip, file_path)
+                peer_ip, file_path, codec=None, control=ANY)
             self.assertNotIn(request_id, self.app_logic.pending_transfers)
         finally:
             os.unlink(file_path)
 
+    def test_respond_asks_for_delta_when_copy_exists(self):
+        """Accepting a file we already hold requests a delta transfer"""
+        self.app_logic.handle_transfer_request(
+            "192.168.1.100", "report.pdf", "1024", "request_123")
+        self.app_logic.chat_manager.offered_features["request_123"] = ["delta"]
+        self.app_logic.network_manager.has_local_copy.return_value = True
+
+        self.app_logic.respond_to_transfer_request(
+            "192.168.1.100", "request_123", "accept")
+        self.app_logic.chat_manager.send_transfer_response.assert_called_once_with(
+            "192.168.1.100", "request_123", "accept_delta")
+        self.app_logic.network_manager.has_local_copy.assert_called_once_with(
+            "report.pdf")
+
+    def test_respond_plain_accept_to_peer_without_delta(self):
+        """A requester that did not offer deltas is never asked for one"""
+        self.app_logic.handle_transfer_request(
+            "192.168.1.100", "report.pdf", "1024", "request_123")
+        self.app_logic.network_manager.has_local_copy.return_value = True
+
+        self.app_logic.respond_to_transfer_request(
+            "192.168.1.100", "request_123", "accept")
+        self.app_logic.chat_manager.send_transfer_response.assert_called_once_with(
+            "192.168.1.100", "request_123", "accept")
+
+    def test_respond_picks_offered_codec(self):
+        """Accepting a request that offered compression names the codec"""
+        self.app_logic.handle_transfer_request(
+            "192.168.1.100", "app.log", "1024", "request_123")
+        self.app_logic.chat_manager.offered_codecs["request_123"] = ["brotli", "zlib"]
+        self.app_logic.network_manager.has_local_copy.return_value = False
+
+        self.app_logic.respond_to_transfer_request(
+            "192.168.1.100", "request_123", "accept")
+        self.app_logic.chat_manager.send_transfer_response.assert_called_once_with(
+            "192.168.1.100", "request_123", "accept|zlib")
+
+    def test_handle_transfer_response_with_codec(self):
+        with tempfile.NamedTemporaryFile(delete=False) as temp_file:
+            temp_file.write(b"test content")
+            file_path = temp_file.name
+
+        try:
+            self.app_logic.pending_transfers["request_123"] = ("192.168.1.100", file_path)
+            self.app_logic.handle_transfer_response("request_123", "accept|zlib")
+            self.assertTrue(self.app_logic.scheduler.wait_idle(2))
+            self.app_logic.network_manager.send_file.assert_called_once_with(
+                "192.168.1.100", file_path, codec="zlib", control=ANY)
+        finally:
+            os.unlink(file_path)
+
+    def test_handle_transfer_response_accept_delta(self):
+        """A delta acceptance sends the file as a delta"""
+        with tempfile.NamedTemporaryFile(delete=False) as temp_file:
+            temp_file.write(b"test content")
+            file_path = temp_file.name
+
+        try:
+            self.app_logic.pending_transfers["request_123"] = ("192.168.1.100", file_path)
+            self.app_logic.handle_transfer_response("request_123", "accept_delta")
+            self.assertTrue(self.app_logic.scheduler.wait_idle(2))
+            self.app_logic.network_manager.send_file_delta.assert_called_once_with(
+                "192.168.1.100", file_path, control=ANY)
+            self.app_logic.network_manager.send_file.assert_not_called()
+        finally:
+            os.unlink(file_path)
+
     def test_handle_transfer_response_decline(self):
         """Test handling declined transfer response"""
         request_id = "request_123"
@@ -193,6 +342,21 @@ class TestAppLogic(unittest.TestCase):
         self.app_logic.network_manager.send_file.assert_not_called()
         self.assertNotIn(request_id, self.app_logic.pending_transfers)
 
+    def test_transfers_run_off_the_calling_thread(self):
+        """send_file returns while the transfer is still running"""
+        import threading
+        release = threading.Event()
+        self.app_logic.network_manager.send_file.side_effect = lambda *a, **k: release.wait(2)
+        with tempfile.NamedTemporaryFile(delete=False) as temp_file:
+            file_path = temp_file.name
+        try:
+            self.assertTrue(self.app_logic.send_file("192.168.1.100", file_path))
+            self.assertEqual(self.app_logic.scheduler.running, 1)
+            release.set()
+            self.assertTrue(self.app_logic.scheduler.wait_idle(2))
+        finally:
+            os.unlink(file_path)
+
     def test_add_peer(self):
         """Test adding a peer"""
         peer = "192.168.1.101"
@@ -212,5 +376,31 @@ class TestAppLogic(unittest.TestCase):
         self.app_logic.network_manager.stop.assert_called_once()
 
 
+class TestAppLogicAsyncio(unittest.TestCase):
+    """AppLogic with real managers on the asyncio engine"""
+
+    @patch("src.controller.chat_signal")
+    def test_chat_shares_the_discovery_port(self, chat_signal):
+        """Chat and discovery both default to port 5002; starting both
+        must not fail with EADDRINUSE, and chat still arrives"""
+        received = []
+        chat_signal.message_received.emit.side_effect = lambda *args: received.append(args)
+        udp_port = free_port(socket.SOCK_DGRAM)
+        catalog_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, catalog_dir)
+        with patch("src.logic.NetworkManager", partial(
+                quiet_manager, port=free_port(), broadcast_port=udp_port, use_asyncio=True)), \
+                patch("src.logic.ChatManager", partial(
+                    ChatManager, port=udp_port, use_asyncio=True)):
+            app_logic = AppLogic(catalog_path=os.path.join(catalog_dir, "shared_files.db"))
+        self.addCleanup(app_logic.stop)
+        with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as s:
+            s.sendto(b"CHAT:alice:hello there", ("127.0.0.1", udp_port))
+        deadline = time.time() + 2
+        while not received and time.time() < deadline:
+            time.sleep(0.02)
+        self.assertEqual(received, [("alice", "hello there")])
+
+
 if __name__ == "__main__":
     unittest.main()
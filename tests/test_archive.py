@@ -0,0 +1,89 @@
+import unittest
+import os
+import shutil
+import socket
+import tempfile
+import threading
+
+from src.logic.archive import (
+    SMALL_FILE, batch_entries, extract_archive, safe_join, send_archive, tree_size, walk
+)
+from src.logic.protocol import ProtocolError
+
+
+def send_body(sock, f, count, offset=0):
+    f.seek(offset)
+    data = f.read(count)
+    sock.sendall(data)
+    return len(data)
+
+
+class TestArchive(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.src = os.path.join(self.dir, "src")
+        self.dst = os.path.join(self.dir, "dst")
+        self.files = {
+            "a.txt": b"hello",
+            "empty": b"",
+            "sub/b.bin": os.urandom(1000),
+            "sub/deeper/c.bin": os.urandom(SMALL_FILE * 3 + 5),
+        }
+        for rel, data in self.files.items():
+            path = os.path.join(self.src, *rel.split("/"))
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            with open(path, "wb") as f:
+                f.write(data)
+        os.makedirs(os.path.join(self.src, "empty_dir"))
+        os.utime(os.path.join(self.src, "a.txt"), ns=(10**18, 10**18))
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def test_walk_lists_parents_first(self):
+        paths = [rel for rel, _ in walk(self.src)]
+        self.assertEqual(sorted(paths), sorted(
+            list(self.files) + ["sub", "sub/deeper", "empty_dir"]))
+        self.assertLess(paths.index("sub"), paths.index("sub/b.bin"))
+        self.assertLess(paths.index("sub/deeper"), paths.index("sub/deeper/c.bin"))
+
+    def test_batch_entries_use_base_names(self):
+        a = os.path.join(self.src, "a.txt")
+        sub = os.path.join(self.src, "sub") + os.sep
+        names = [rel for rel, _ in batch_entries([a, sub])]
+        self.assertEqual(names[:2], ["a.txt", "sub"])
+        self.assertIn("sub/deeper/c.bin", names)
+
+    def test_tree_size(self):
+        self.assertEqual(tree_size(self.src), sum(len(d) for d in self.files.values()))
+
+    def test_safe_join_rejects_escapes(self):
+        for rel in ("../x", "a/../../x", "/etc/passwd", "a//b", "."):
+            with self.assertRaises(ProtocolError):
+                safe_join(self.dst, rel)
+        self.assertEqual(safe_join(self.dst, "a/b"), os.path.join(self.dst, "a", "b"))
+
+    def test_round_trip(self):
+        a, b = socket.socketpair()
+        result = {}
+
+        def receive():
+            with b, b.makefile("rb") as stream:
+                result["counts"] = extract_archive(stream, self.dst, bytearray(4096))
+
+        t = threading.Thread(target=receive)
+        t.start()
+        with a:
+            sent = send_archive(a, self.src, send_body)
+        t.join(5)
+        self.assertEqual(result["counts"], sent)
+        self.assertEqual(sent, (4, sum(len(d) for d in self.files.values())))
+        for rel, data in self.files.items():
+            with open(os.path.join(self.dst, *rel.split("/")), "rb") as f:
+                self.assertEqual(f.read(), data)
+        self.assertTrue(os.path.isdir(os.path.join(self.dst, "empty_dir")))
+        self.assertEqual(os.stat(os.path.join(self.dst, "a.txt")).st_mtime_ns, 10**18)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,295 @@
+import unittest
+import asyncio
+import os
+import shutil
+import socket
+import struct
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from unittest.mock import Mock, patch
+
+from src.logic.chat import ChatManager
+from src.logic.partial_file import PartialFile
+from src.logic.protocol import MAGIC, OP_STRIPE, send_frame
+from src.logic.transfer_control import TransferControl
+from tests.test_network import free_port, quiet_manager
+
+
+class TestAsyncTransport(unittest.TestCase):
+    """Transfers against the asyncio engine on free ports"""
+
+    def setUp(self):
+        self.download_dir = tempfile.mkdtemp()
+        self.network_manager = quiet_manager(
+            port=free_port(), broadcast_port=free_port(socket.SOCK_DGRAM),
+            max_workers=2, download_dir=self.download_dir, use_asyncio=True)
+        self.network_manager.start()
+
+    def tearDown(self):
+        self.network_manager.stop()
+        shutil.rmtree(self.download_dir)
+
+    def make_source(self, data):
+        tmp = tempfile.NamedTemporaryFile(delete=False, suffix=".bin")
+        tmp.write(data)
+        tmp.close()
+        self.addCleanup(os.unlink, tmp.name)
+        return tmp.name
+
+    def wait_for(self, name, size, timeout=10):
+        path = os.path.join(self.download_dir, name)
+        deadline = time.time() + timeout
+        while time.time() < deadline:
+            if os.path.exists(path) and os.path.getsize(path) == size:
+                time.sleep(0.05)
+                return path
+            time.sleep(0.02)
+        self.fail(f"{name} did not arrive")
+
+    def test_many_concurrent_transfers(self):
+        """Far more transfers than worker threads all complete intact"""
+        files = {self.make_source(os.urandom(50000 + i)): 50000 + i for i in range(100)}
+        with ThreadPoolExecutor(50) as pool:
+            list(pool.map(lambda path: self.network_manager.send_file("127.0.0.1", path),
+                          files))
+        for source, size in files.items():
+            path = self.wait_for(os.path.basename(source), size)
+            with open(source, "rb") as a, open(path, "rb") as b:
+                self.assertEqual(a.read(), b.read())
+        self.assertEqual(self.network_manager._incoming, {})
+
+    def test_offer_does_not_block_the_loop(self):
+        """Opening the file for an offer happens off the event loop"""
+        engine = self.network_manager._engine
+        source = self.make_source(os.urandom(100000))
+        init = PartialFile.__init__
+
+        def slow_init(part, *args):
+            time.sleep(0.5)  # a slow preallocation
+            init(part, *args)
+
+        with patch.object(PartialFile, "__init__", slow_init):
+            sender = threading.Thread(
+                target=self.network_manager.send_file, args=("127.0.0.1", source))
+            sender.start()
+            time.sleep(0.2)
+            start = time.monotonic()
+            engine.run(asyncio.sleep(0))
+            self.assertLess(time.monotonic() - start, 0.2)
+            sender.join(5)
+        self.wait_for(os.path.basename(source), 100000)
+
+    def test_idle_session_closed(self):
+        with patch("src.logic.network.SESSION_IDLE_TIMEOUT", 0.2):
+            with socket.create_connection(("127.0.0.1", self.network_manager.port)) as s:
+                s.sendall(MAGIC)
+                s.settimeout(3)
+                self.assertEqual(s.recv(1), b"")
+
+    def test_listener_survives_a_failed_accept(self):
+        loop = self.network_manager._engine.loop
+        accept = loop.sock_accept
+        calls = []
+
+        async def flaky_accept(sock):
+            calls.append(sock)
+            if len(calls) == 1:
+                raise OSError(24, "Too many open files")
+            return await accept(sock)
+
+        with patch.object(loop, "sock_accept", flaky_accept):
+            # The accept already waiting takes this one; the next one fails
+            socket.create_connection(("127.0.0.1", self.network_manager.port)).close()
+            time.sleep(0.2)
+            data = b"after the failure"
+            with socket.create_connection(("127.0.0.1", self.network_manager.port)) as s:
+                s.sendall(struct.pack("!II", 5, len(data)) + b"x.bin" + data)
+            path = self.wait_for("x.bin", len(data))
+        self.assertGreaterEqual(len(calls), 2)
+        with open(path, "rb") as f:
+            self.assertEqual(f.read(), data)
+
+    def test_receiver_cancel_removes_partial_download(self):
+        data = os.urandom(256 * 1024)
+        meta = self.network_manager._transfer_meta(self.make_source(data), len(data))
+        receiving = []
+
+        def track(meta, peer_ip):
+            receiving.append(TransferControl(park=True))
+            return receiving[-1]
+
+        self.network_manager.incoming_handler = track
+        with socket.create_connection(("127.0.0.1", self.network_manager.port)) as s:
+            s.sendall(MAGIC)
+            send_frame(s, OP_STRIPE, dict(meta, offset=0, length=len(data)))
+            s.sendall(data[:100000])
+            deadline = time.time() + 2
+            while not (receiving and receiving[0].transferred == 100000) \
+                    and time.time() < deadline:
+                time.sleep(0.02)
+            receiving[0].cancel()
+            deadline = time.time() + 2
+            while os.listdir(self.download_dir) and time.time() < deadline:
+                time.sleep(0.02)
+        self.assertEqual(os.listdir(self.download_dir), [])
+        self.assertEqual(self.network_manager._incoming, {})
+
+    def test_long_pause_held_until_resumed(self):
+        """Holding a paused transfer at the sender happens off the loop,
+        which serves the sender's OP_HOLD meanwhile"""
+        data = os.urandom(2 * 1024 * 1024)
+        source = self.make_source(data)
+        receiving = []
+
+        def track(meta, peer_ip):
+            receiving.append(TransferControl(park=True, park_timeout=0.2))
+            return receiving[-1]
+
+        self.network_manager.incoming_handler = track
+        control = TransferControl()
+        released = threading.Event()
+        self.network_manager.release_handler = released.set
+        self.network_manager.set_rate_limits(upload=1024 * 1024)
+        result = []
+        with patch("src.logic.network.STRIPE_SIZE", 64 * 1024):
+            sender = threading.Thread(target=lambda: result.append(
+                self.network_manager.send_file("127.0.0.1", source, control=control)))
+            sender.start()
+            time.sleep(0.5)
+            receiving[0].pause()
+            sender.join(3)
+            self.assertEqual(result, [False])
+            self.assertTrue(control.held)
+            receiving[0].resume()
+            self.assertTrue(released.wait(2))
+            self.network_manager.set_rate_limits(upload=0)
+            self.assertTrue(self.network_manager.send_file("127.0.0.1", source, control=control))
+        path = self.wait_for(os.path.basename(source), len(data))
+        with open(path, "rb") as f:
+            self.assertEqual(f.read(), data)
+        self.assertEqual(len(receiving), 1)
+
+    def test_compressed_transfer(self):
+        """Compressed stripes are handed to a worker, which keeps the
+        transfer the event loop opened instead of starting a second one"""
+        data = b"".join(b"2024-01-01,host%03d,%d,ok\n" % (i % 100, i) for i in range(100000))
+        source = self.make_source(data)
+        incoming = []
+
+        def track(meta, peer_ip):
+            control = TransferControl(park=True)
+            finished = []
+            control.on_finish = finished.append
+            incoming.append(finished)
+            return control
+
+        self.network_manager.incoming_handler = track
+        with patch("src.logic.network.STRIPE_SIZE", 512 * 1024):
+            self.assertTrue(self.network_manager.send_file("127.0.0.1", source, codec="zlib"))
+        path = self.wait_for(os.path.basename(source), len(data))
+        with open(path, "rb") as f:
+            self.assertEqual(f.read(), data)
+        self.assertEqual(incoming, [[True]])
+        self.assertEqual(os.listdir(self.download_dir), [os.path.basename(source)])
+
+    def test_striped_transfer(self):
+        data = os.urandom(10 * 64 * 1024 + 99)
+        source = self.make_source(data)
+        self.network_manager.streams = 4
+        with patch("src.logic.network.STRIPE_SIZE", 64 * 1024):
+            self.network_manager.send_file("127.0.0.1", source)
+        path = self.wait_for(os.path.basename(source), len(data))
+        with open(path, "rb") as f:
+            self.assertEqual(f.read(), data)
+
+    def test_corrupted_stripe_resent(self):
+        data = os.urandom(4 * 64 * 1024)
+        source = self.make_source(data)
+        write_at = PartialFile.write_at
+        corrupted = []
+
+        def flaky_write(part, offset, chunk):
+            if offset == 64 * 1024 and not corrupted:
+                corrupted.append(offset)
+                chunk = b"\xff" + bytes(chunk[1:])
+            write_at(part, offset, chunk)
+
+        with patch("src.logic.network.STRIPE_SIZE", 64 * 1024), \
+                patch.object(PartialFile, "write_at", flaky_write):
+            self.network_manager.send_file("127.0.0.1", source)
+        path = self.wait_for(os.path.basename(source), len(data))
+        with open(path, "rb") as f:
+            self.assertEqual(f.read(), data)
+        self.assertEqual(self.network_manager._upload_bytes, len(data) + 64 * 1024)
+
+    def test_cancel_stops_send_and_removes_partial(self):
+        data = os.urandom(2 * 1024 * 1024)
+        source = self.make_source(data)
+        control = TransferControl()
+        self.network_manager.set_rate_limits(upload=1024 * 1024)
+        result = []
+        with patch("src.logic.network.STRIPE_SIZE", 64 * 1024):
+            sender = threading.Thread(target=lambda: result.append(
+                self.network_manager.send_file("127.0.0.1", source, control=control)))
+            sender.start()
+            time.sleep(0.5)
+            start = time.monotonic()
+            control.cancel()
+            sender.join(2)
+            self.assertLess(time.monotonic() - start, 0.1)
+        self.assertEqual(result, [False])
+        deadline = time.time() + 2
+        while os.listdir(self.download_dir) and time.time() < deadline:
+            time.sleep(0.02)
+        self.assertEqual(os.listdir(self.download_dir), [])
+
+    def test_dedup_handed_to_executor(self):
+        """Opcodes the loop does not pump natively still complete"""
+        data = os.urandom(1024 * 1024)
+        source = self.make_source(data)
+        self.network_manager.dedup = True
+        self.network_manager.send_file("127.0.0.1", source)
+        path = self.wait_for(os.path.basename(source), len(data))
+        with open(path, "rb") as f:
+            self.assertEqual(f.read(), data)
+
+    def test_legacy_header_still_received(self):
+        data = b"legacy payload"
+        with socket.create_connection(("127.0.0.1", self.network_manager.port)) as s:
+            s.sendall(struct.pack("!II", 8, len(data)) + b"old.name" + data)
+        path = self.wait_for("old.name", len(data))
+        with open(path, "rb") as f:
+            self.assertEqual(f.read(), data)
+
+    def test_discovery_datagram_adds_peer(self):
+        with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as s:
+            s.sendto(b"PEER_DISCOVERY", ("127.0.0.1", self.network_manager.broadcast_port))
+        deadline = time.time() + 2
+        while "127.0.0.1" not in self.network_manager.peers and time.time() < deadline:
+            time.sleep(0.02)
+        self.assertIn("127.0.0.1", self.network_manager.peers)
+
+
+class TestAsyncChat(unittest.TestCase):
+    @patch("src.controller.chat_signal")
+    def test_chat_datagram_emits_signal(self, chat_signal):
+        received = []
+        chat_signal.message_received.emit.side_effect = lambda *args: received.append(args)
+        chat = ChatManager(Mock(), username="me", port=free_port(socket.SOCK_DGRAM),
+                           use_asyncio=True)
+        chat.start()
+        try:
+            with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as s:
+                s.sendto(b"CHAT:alice:hello there", ("127.0.0.1", chat.port))
+            deadline = time.time() + 2
+            while not received and time.time() < deadline:
+                time.sleep(0.02)
+        finally:
+            chat.stop()
+        self.assertEqual(received, [("alice", "hello there")])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,228 @@
+import unittest
+import heapq
+import itertools
+import random
+import time
+
+from src.logic.beacon import REPLY_SPREAD, BeaconScheduler
+from src.logic.network import NetworkManager
+from src.logic.peer_table import PeerTable
+from tests.test_network import free_port, quiet_manager
+
+PORT = 5002
+
+
+class TestBeaconScheduler(unittest.TestCase):
+    def setUp(self):
+        self.table = PeerTable(ttl=15)
+        self.beacons = BeaconScheduler(self.table, PORT, min_interval=1, max_interval=30,
+                                       jitter=0, rng=random.Random(1))
+        # A whole second, so offsets from it add up exactly
+        self.t0 = float(int(time.monotonic()))
+        self.beacons.reset(self.t0)
+
+    def broadcast_times(self, until):
+        times = []
+        now = self.beacons.next_time()
+        while now < until:
+            if (None, "beacon") in self.beacons.due(now):
+                times.append(now - self.t0)
+            now = self.beacons.next_time()
+        return times
+
+    def test_backs_off_to_the_maximum(self):
+        self.assertEqual(self.broadcast_times(self.t0 + 200),
+                         [0, 1, 3, 7, 15, 31, 61, 91, 121, 151, 181])
+        self.assertEqual(self.beacons.ttl(), 90)
+
+    def test_held_while_peers_turn_up(self):
+        self.beacons.due(self.t0)
+        for i in range(3):
+            now = self.beacons.next_time()
+            added = self.table.seen(f"10.0.0.{i + 2}", {"reply": True}, now)
+            self.beacons.heard((f"10.0.0.{i + 2}", PORT), {"reply": True}, added, now)
+            self.beacons.due(now)
+        self.assertEqual(self.beacons.interval, 1)
+        self.beacons.due(self.beacons.next_time())
+        self.assertEqual(self.beacons.interval, 2)
+        self.beacons.reset(self.t0 + 10)
+        self.assertEqual(self.beacons.interval, 1)
+        self.assertEqual(self.beacons.next_time(), self.t0 + 10)
+
+    def test_replies_and_probes(self):
+        self.broadcast_times(self.t0 + 100)  # backed off: next broadcast at 121
+        now = self.t0 + 100
+        newcomer, known = ("10.0.0.2", PORT), ("10.0.0.3", PORT)
+        self.table.seen("10.0.0.3", now=now)
+        self.assertTrue(self.beacons.heard(newcomer, {}, True, now))
+        self.assertFalse(self.beacons.heard(known, {}, False, now))
+        self.assertFalse(self.beacons.heard(("10.0.0.4", PORT), {"reply": True}, True, now))
+        self.assertTrue(self.beacons.heard(known, {"probe": True}, False, now))
+        self.assertLessEqual(self.beacons.next_time(), now + REPLY_SPREAD)
+        self.assertEqual(sorted(self.beacons.due(now + REPLY_SPREAD)),
+                         [(newcomer, "reply"), (known, "reply")])
+        # Silent for two thirds of its ttl: probed on the next probe round
+        self.table.add("10.0.0.9")
+        probes = []
+        while self.beacons.next_time() < now + 15:
+            probes.append(self.beacons.due(self.beacons.next_time()))
+        self.assertEqual(probes[-1], [(("10.0.0.3", PORT), "probe"), (("10.0.0.9", PORT), "probe")])
+        self.assertEqual(probes[0], [(("10.0.0.9", PORT), "probe")])
+
+    def test_newcomers_hear_our_broadcast_instead_while_we_are_fast(self):
+        self.beacons.due(self.t0)
+        self.assertFalse(self.beacons.heard(("10.0.0.2", PORT), {}, True, self.t0))
+        self.assertEqual(self.beacons.next_time(), self.t0 + 1)
+
+
+class Node:
+    def __init__(self, ip, seed):
+        self.ip = ip
+        self.table = PeerTable(ttl=15)
+        self.table.on_change = lambda added, removed, changed: self.removed.extend(removed)
+        self.removed = []
+        self.beacons = BeaconScheduler(self.table, PORT, min_interval=1, max_interval=30,
+                                       rng=random.Random(seed))
+
+
+class SimulatedLan:
+    """Peers on one broadcast domain, on a virtual clock. Packets arrive at
+    once; a fraction `loss` of deliveries is dropped."""
+
+    def __init__(self, loss=0.0, seed=1):
+        self.rng = random.Random(seed)
+        self.loss = loss
+        self.nodes = {}  # ip -> Node; a peer that leaves is removed
+        self.now = time.monotonic()
+        self.t0 = self.now
+        self.sent = []  # time of every packet sent
+        self._events = []
+        self._seq = itertools.count()
+        self._expire_at = self.now
+
+    def join(self, at=None):
+        node = Node(f"10.0.{len(self.nodes) // 250}.{len(self.nodes) % 250 + 1}",
+                    self.rng.random())
+        self.nodes[node.ip] = node
+        node.beacons.reset(self.now if at is None else at)
+        self._schedule(node)
+        return node
+
+    def run_until(self, until):
+        while self._events and self._events[0][0] <= until:
+            when, _, node = heapq.heappop(self._events)
+            while self._expire_at <= when:
+                for other in self.nodes.values():
+                    other.table.expire(self._expire_at)
+                self._expire_at += 1
+            self.now = when
+            if node.beacons.next_time() != when:
+                continue  # rescheduled since
+            for addr, kind in node.beacons.due(when):
+                self.sent.append(when)
+                meta = {"ttl": node.beacons.ttl()}
+                if kind != "beacon":
+                    meta[kind] = True
+                targets = [n for n in self.nodes.values() if n is not node] \
+                    if addr is None else [self.nodes.get(addr[0])]
+                for target in targets:
+                    if target is not None and self.rng.random() >= self.loss:
+                        self._deliver(target, node.ip, meta, when)
+            self._schedule(node)
+        self.now = until
+
+    def pps(self, start, end):
+        """Packets sent per second by all peers between two offsets from t0"""
+        return sum(start <= t - self.t0 < end for t in self.sent) / (end - start)
+
+    def converged(self):
+        return all(len(node.table) == len(self.nodes) - 1 for node in self.nodes.values())
+
+    def _deliver(self, node, sender, meta, now):
+        added = node.table.seen(sender, meta, now)
+        if node.beacons.heard((sender, PORT), meta, added, now):
+            self._schedule(node)
+
+    def _schedule(self, node):
+        heapq.heappush(self._events, (node.beacons.next_time(), next(self._seq), node))
+
+
+class TestDiscoverySimulation(unittest.TestCase):
+    def start(self, peers, loss=0.0):
+        lan = SimulatedLan(loss)
+        for _ in range(peers):
+            lan.join(lan.t0 + lan.rng.uniform(0, 2))
+        return lan
+
+    def test_converges_fast_then_quiets_down(self):
+        lan = self.start(30, loss=0.02)
+        lan.run_until(lan.t0 + 5)
+        self.assertTrue(lan.converged())
+        lan.run_until(lan.t0 + 300)
+        self.assertTrue(lan.converged())
+        # Nobody was dropped for a few lost broadcasts; probes covered them
+        self.assertEqual([ip for node in lan.nodes.values() for ip in node.removed], [])
+        # Beacons every 3 s would be 10 packets per second
+        self.assertLess(lan.pps(200, 300), 30 / 3 / 5)
+
+    def test_packets_per_second_against_peer_count(self):
+        per_peer = {}
+        for peers in (10, 40, 120):
+            lan = self.start(peers)
+            lan.run_until(lan.t0 + 240)
+            self.assertTrue(lan.converged())
+            per_peer[peers] = lan.pps(120, 240) / peers
+        # Each peer settles at about one broadcast per 30 s however many
+        # peers there are
+        for rate in per_peer.values():
+            self.assertLess(rate, 2 / 30)
+        self.assertLess(per_peer[120], 1.5 * per_peer[10])
+
+    def test_newcomer_learns_everyone_quickly(self):
+        lan = self.start(40)
+        lan.run_until(lan.t0 + 200)
+        sent = len(lan.sent)
+        newcomer = lan.join()
+        # Answered at once, or by a broadcast due within two seconds
+        lan.run_until(lan.now + 2)
+        self.assertTrue(lan.converged())
+        self.assertEqual(len(newcomer.table), 40)
+        # About one broadcast and one reply from each peer
+        self.assertLess(len(lan.sent) - sent, 40 + 10)
+
+    def test_departed_peer_expires(self):
+        lan = self.start(10)
+        lan.run_until(lan.t0 + 200)
+        gone = lan.nodes.pop("10.0.0.1")
+        gone.beacons.next_time = lambda: None  # its pending rounds are skipped
+        lan.run_until(lan.now + 30 * 3 * 1.2 + 2)
+        self.assertTrue(all("10.0.0.1" in node.removed for node in lan.nodes.values()))
+
+
+class TestDiscoveryShutdown(unittest.TestCase):
+    def test_stop_ends_every_thread(self):
+        nm = NetworkManager(port=free_port(), broadcast_port=free_port())
+        nm.start()
+        time.sleep(0.3)
+        nm.stop()
+        for thread in nm._threads:
+            thread.join(2)
+            self.assertFalse(thread.is_alive(), thread)
+
+    def test_answers_a_newcomer(self):
+        nm = quiet_manager(port=free_port(), broadcast_port=free_port())
+        self.addCleanup(nm.stop)
+        sent = []
+        nm.beacons.due()
+        nm.beacons._next_broadcast = time.monotonic() + 30  # backed off
+        nm._on_discovery_datagram(b"PEER_DISCOVERY", ("10.0.0.2", 5002))
+        now = time.monotonic() + REPLY_SPREAD
+        for addr, kind in nm.beacons.due(now):
+            sent.append((addr, nm._beacon(kind)))
+        self.assertEqual(sent[0][0], ("10.0.0.2", 5002))
+        self.assertIn(b'"reply":true', sent[0][1])
+        self.assertIn(b'"ttl":', sent[0][1])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,56 @@
+import unittest
+import threading
+
+from src.logic.buffer_pool import BufferPool
+
+
+class TestBufferPool(unittest.TestCase):
+    def setUp(self):
+        self.pool = BufferPool(2, 1024)
+
+    def test_buffers_are_reused(self):
+        """A released buffer is handed out again"""
+        with self.pool.buffer() as buf:
+            first = buf
+        with self.pool.buffer() as buf:
+            self.assertIs(buf, first)
+        self.assertEqual(self.pool.misses, 0)
+
+    def test_exhausted_pool_allocates_temporary(self):
+        """Callers never block when every pooled buffer is busy"""
+        a = self.pool.acquire()
+        b = self.pool.acquire()
+        c = self.pool.acquire()
+        self.assertEqual(self.pool.misses, 1)
+        self.assertEqual(len(c), 1024)
+        for buf in (a, b, c):
+            self.pool.release(buf)
+        self.assertEqual(self.pool.available(), 2)
+
+    def test_concurrent_use(self):
+        """Buffers are never shared between simultaneous holders"""
+        held = []
+        lock = threading.Lock()
+        errors = []
+
+        def worker():
+            for _ in range(200):
+                with self.pool.buffer() as buf:
+                    with lock:
+                        if any(h is buf for h in held):
+                            errors.append(buf)
+                        held.append(buf)
+                    with lock:
+                        held.remove(buf)
+
+        threads = [threading.Thread(target=worker) for _ in range(4)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        self.assertEqual(errors, [])
+        self.assertLessEqual(self.pool.available(), 2)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -4,6 +4,8 @@ import threading
 import time
 from unittest.mock import Mock, patch
 from src.logic.chat import ChatManager
+from src.logic.interfaces import InterfaceRegistry
+from tests.test_network import quiet_manager
 
 
 class TestChatManager(unittest.TestCase):
@@ -56,24 +58,21 @@ class TestChatManager(unittest.TestCase):
     #     pass
 
     def test_get_local_ip_success(self):
-        """Test getting local IP address successfully"""
-        with patch('socket.socket') as mock_socket_class:
-            mock_sock = Mock()
-            mock_socket_class.return_value = mock_sock
-            mock_sock.getsockname.return_value = ("192.168.1.100", 12345)
-
+        """Test the local IP comes from the cached interface registry"""
+        registry = InterfaceRegistry(list_addresses=lambda: {"192.168.1.100"},
+                                     route=lambda: "192.168.1.100", watch=False)
+        with patch("src.logic.chat.shared_registry", return_value=registry), \
+                patch("socket.socket") as mock_socket_class:
             ip = self.chat_manager._get_local_ip()
-            self.assertEqual(ip, "192.168.1.100")
+        self.assertEqual(ip, "192.168.1.100")
+        mock_socket_class.assert_not_called()
 
     def test_get_local_ip_fallback(self):
-        """Test fallback when getting local IP fails"""
-        with patch('socket.socket') as mock_socket_class:
-            mock_sock = Mock()
-            mock_socket_class.return_value = mock_sock
-            mock_sock.connect.side_effect = Exception("Connection failed")
-
+        """Test fallback when the host has no network"""
+        registry = InterfaceRegistry(list_addresses=set, route=lambda: None, watch=False)
+        with patch("src.logic.chat.shared_registry", return_value=registry):
             ip = self.chat_manager._get_local_ip()
-            self.assertEqual(ip, "127.0.0.1")
+        self.assertEqual(ip, "127.0.0.1")
 
     def test_send_transfer_request(self):
         """Test sending a transfer request"""
@@ -110,6 +109,74 @@ class TestChatManager(unittest.TestCase):
             expected_message = f"TRANSFER_RESPONSE:{self.username}:{request_id}:{response}"
             mock_sock.sendto.assert_called_once_with(expected_message.encode(), (peer_ip, self.chat_manager.port))
 
+    def test_transfer_request_offers_codecs(self):
+        with patch('socket.socket') as mock_socket_class:
+            mock_sock = Mock()
+            mock_socket_class.return_value = mock_sock
+            request_id = self.chat_manager.send_transfer_request(
+                "192.168.1.100", "app.log", "1024", codecs=["zlib", "lzma"])
+            message = mock_sock.sendto.call_args[0][0].decode()
+        self.assertTrue(message.endswith(":app.log:1024:False:zlib,lzma"))
+
+        with patch('src.controller.transfer_request_signal') as signal:
+            self.chat_manager._dispatch(message.encode(), ("192.168.1.5", 5002))
+            signal.transfer_request_received.emit.assert_called_once_with(
+                "192.168.1.5", "app.log", "1024", request_id)
+        self.assertEqual(self.chat_manager.offered_codecs[request_id], ["zlib", "lzma"])
+        self.assertNotIn(request_id, self.chat_manager.offered_features)
+
+    def test_transfer_request_offers_features(self):
+        with patch('socket.socket') as mock_socket_class:
+            mock_sock = Mock()
+            mock_socket_class.return_value = mock_sock
+            request_id = self.chat_manager.send_transfer_request(
+                "192.168.1.100", "app.log", "1024", features=["delta"])
+            message = mock_sock.sendto.call_args[0][0].decode()
+        self.assertTrue(message.endswith(":app.log:1024:False::delta"))
+
+        with patch('src.controller.transfer_request_signal'):
+            self.chat_manager._dispatch(message.encode(), ("192.168.1.5", 5002))
+        self.assertNotIn(request_id, self.chat_manager.offered_codecs)
+        self.assertEqual(self.chat_manager.offered_features[request_id], ["delta"])
+
+    def test_transfer_response_uses_pooled_connection(self):
+        """With a network manager, control messages go over its TCP pool"""
+        network_manager = Mock()
+        self.chat_manager.network_manager = network_manager
+        with patch('socket.socket') as mock_socket_class:
+            self.chat_manager.send_transfer_response("192.168.1.100", "req_123", "accept")
+            mock_socket_class.assert_not_called()
+        network_manager.send_control.assert_called_once_with(
+            "192.168.1.100", f"TRANSFER_RESPONSE:{self.username}:req_123:accept")
+
+    def test_transfer_response_falls_back_to_udp(self):
+        network_manager = Mock()
+        network_manager.send_control.side_effect = ConnectionRefusedError()
+        self.chat_manager.network_manager = network_manager
+        with patch('socket.socket') as mock_socket_class:
+            mock_sock = Mock()
+            mock_socket_class.return_value = mock_sock
+            self.chat_manager.send_transfer_response("192.168.1.100", "req_123", "accept")
+            mock_sock.sendto.assert_called_once()
+
+    def test_transfer_response_does_not_wait_for_a_full_pool(self):
+        """With every pooled connection to the peer busy (say, running
+        transfers), a datagram goes at once rather than after them"""
+        with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as server:
+            server.bind(("127.0.0.1", 0))
+            server.listen()
+            network_manager = quiet_manager(port=server.getsockname()[1], pool_size=1)
+            busy = network_manager.pool.acquire("127.0.0.1")
+            self.addCleanup(network_manager.pool.release, "127.0.0.1", busy, False)
+            self.chat_manager.network_manager = network_manager
+            with patch('socket.socket') as mock_socket_class:
+                mock_sock = Mock()
+                mock_socket_class.return_value = mock_sock
+                start = time.monotonic()
+                self.chat_manager.send_transfer_response("127.0.0.1", "req_123", "accept")
+                self.assertLess(time.monotonic() - start, 0.5)
+            mock_sock.sendto.assert_called_once()
+
 
 if __name__ == "__main__":
     unittest.main()
\ No newline at end of file
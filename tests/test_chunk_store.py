@@ -0,0 +1,85 @@
+import unittest
+import io
+import os
+import shutil
+import tempfile
+
+from src.logic.chunk_store import (
+    MAX_CHUNK, MIN_CHUNK, ChunkStore, chunk_digest, chunk_file
+)
+
+
+class TestChunking(unittest.TestCase):
+    def setUp(self):
+        self.data = os.urandom(4 * 1024 * 1024)
+
+    def chunks(self, data):
+        return list(chunk_file(io.BytesIO(data)))
+
+    def test_chunks_cover_file(self):
+        chunks = self.chunks(self.data)
+        offset = 0
+        for start, length, digest in chunks:
+            self.assertEqual(start, offset)
+            self.assertLessEqual(length, MAX_CHUNK)
+            self.assertEqual(digest, chunk_digest(self.data[start:start + length]))
+            offset += length
+        self.assertEqual(offset, len(self.data))
+        for _, length, _ in chunks[:-1]:
+            self.assertGreaterEqual(length, MIN_CHUNK)
+
+    def test_insertion_only_changes_nearby_chunks(self):
+        """Boundaries are content-defined, so an insertion does not shift
+        every later chunk"""
+        before = {d for _, _, d in self.chunks(self.data)}
+        edited = self.data[:100000] + b"inserted bytes" + self.data[100000:]
+        after = [d for _, _, d in self.chunks(edited)]
+        changed = [d for d in after if d not in before]
+        self.assertLessEqual(len(changed), 2)
+
+    def test_empty_file(self):
+        self.assertEqual(self.chunks(b""), [])
+
+
+class TestChunkStore(unittest.TestCase):
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.root)
+
+    def test_put_get(self):
+        store = ChunkStore(self.root, 1024)
+        store.put("ab" * 16, b"hello")
+        self.assertTrue(store.has("ab" * 16))
+        self.assertEqual(store.get("ab" * 16), b"hello")
+
+    def test_lru_eviction(self):
+        store = ChunkStore(self.root, 300)
+        for i in range(3):
+            store.put(f"{i:032x}", b"x" * 100)
+        store.get(f"{0:032x}")  # most recently used now
+        store.put(f"{3:032x}", b"x" * 100)
+        self.assertTrue(store.has(f"{0:032x}"))
+        self.assertFalse(store.has(f"{1:032x}"))
+        self.assertLessEqual(store.total, 300)
+
+    def test_pinned_chunks_survive(self):
+        store = ChunkStore(self.root, 100)
+        store.put(f"{1:032x}", b"x" * 100)
+        store.pin([f"{1:032x}"])
+        store.put(f"{2:032x}", b"y" * 100)
+        self.assertTrue(store.has(f"{1:032x}"))
+        store.unpin([f"{1:032x}"])
+        self.assertLessEqual(store.total, 100)
+
+    def test_index_rebuilt_on_restart(self):
+        store = ChunkStore(self.root, 1024)
+        store.put("cd" * 16, b"persist")
+        store = ChunkStore(self.root, 1024)
+        self.assertEqual(store.total, 7)
+        self.assertEqual(store.get("cd" * 16), b"persist")
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,82 @@
+import unittest
+import os
+
+from src.logic import codecs
+from src.logic.codecs import (
+    BLOCK, BLOCK_SIZE, PACKED, RAW, available_codecs, decode_block, encode_block, get_codec,
+    negotiate, parse_spec, register_codec, worth_compressing
+)
+from src.logic.protocol import ProtocolError
+
+
+class TestCodecs(unittest.TestCase):
+    def test_builtin_codecs_round_trip(self):
+        data = b"timestamp,level,message\n" * 5000
+        for name in ("zlib", "lzma"):
+            codec, level = parse_spec(name)
+            block = encode_block(codec, level, data)
+            kind, length = BLOCK.unpack(block[:BLOCK.size])
+            self.assertEqual(kind, PACKED)
+            self.assertLess(length, len(data) // 10)
+            self.assertEqual(decode_block(codec, kind, block[BLOCK.size:]), data)
+
+    def test_full_block_decodes(self):
+        data = b"x" * BLOCK_SIZE
+        for name in ("zlib", "lzma"):
+            codec, level = parse_spec(name)
+            block = encode_block(codec, level, data)
+            self.assertEqual(decode_block(codec, PACKED, block[BLOCK.size:]), data)
+
+    def test_decompression_bomb_refused(self):
+        """A small block never expands past its limit"""
+        for name in ("zlib", "lzma"):
+            codec, level = parse_spec(name)
+            bomb = codec.compress(b"\0" * (64 * BLOCK_SIZE), level)
+            with self.assertRaises(ProtocolError):
+                decode_block(codec, PACKED, bomb)
+            packed = codec.compress(b"\0" * 1000, level)
+            with self.assertRaises(ProtocolError):
+                decode_block(codec, PACKED, packed, limit=999)
+            self.assertEqual(decode_block(codec, PACKED, packed, limit=1000), b"\0" * 1000)
+
+    def test_truncated_or_padded_block_refused(self):
+        for name in ("zlib", "lzma"):
+            codec, level = parse_spec(name)
+            packed = codec.compress(b"timestamp,level,message\n" * 100, level)
+            for bad in (packed[:-4], packed + b"junk"):
+                with self.assertRaises(ProtocolError):
+                    decode_block(codec, PACKED, bad)
+        with self.assertRaises(ProtocolError):
+            decode_block(get_codec("zlib"), RAW, b"12345", limit=4)
+
+    def test_incompressible_block_sent_raw(self):
+        data = os.urandom(100000)
+        codec, level = parse_spec("zlib:9")
+        block = encode_block(codec, level, data)
+        self.assertEqual(BLOCK.unpack(block[:BLOCK.size]), (RAW, len(data)))
+        self.assertEqual(block[BLOCK.size:], data)
+
+    def test_sample_decides_compression(self):
+        codec, level = parse_spec("zlib:1")
+        self.assertTrue(worth_compressing(codec, level, b"a,b,c\n" * 10000))
+        self.assertFalse(worth_compressing(codec, level, os.urandom(65536)))
+        self.assertFalse(worth_compressing(codec, level, b""))
+
+    def test_parse_spec_levels(self):
+        self.assertEqual(parse_spec("lzma:3")[1], 3)
+        self.assertEqual(parse_spec("zlib")[1], get_codec("zlib").default_level)
+        with self.assertRaises(KeyError):
+            parse_spec("nope")
+
+    def test_negotiate_and_register(self):
+        self.assertEqual(negotiate(["brotli", "lzma", "zlib"]), "lzma")
+        self.assertIsNone(negotiate(["brotli"]))
+        register_codec("identity", lambda data, level: bytes(data),
+                       lambda data, limit: bytes(data), 0, range(1))
+        self.addCleanup(codecs._codecs.pop, "identity")
+        self.assertEqual(available_codecs()[-1], "identity")
+        self.assertEqual(negotiate(["identity"]), "identity")
+
+
+if __name__ == "__main__":
+    unittest.main()
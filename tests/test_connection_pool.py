@@ -0,0 +1,91 @@
+import unittest
+import socket
+import threading
+import time
+
+from src.logic.connection_pool import ConnectionPool
+from src.logic.protocol import MAGIC
+
+
+class TestConnectionPool(unittest.TestCase):
+    def setUp(self):
+        self.server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.server.bind(("127.0.0.1", 0))
+        self.server.listen(16)
+        self.accepted = []
+        threading.Thread(target=self._accept, daemon=True).start()
+        self.pool = ConnectionPool(self.server.getsockname()[1], max_per_peer=2,
+                                   idle_timeout=0.2)
+
+    def tearDown(self):
+        self.pool.close()
+        self.server.close()
+        for conn in self.accepted:
+            conn.close()
+
+    def _accept(self):
+        while True:
+            try:
+                conn, _ = self.server.accept()
+            except OSError:
+                return
+            self.accepted.append(conn)
+
+    def test_connection_reused(self):
+        with self.pool.connection("127.0.0.1") as first:
+            pass
+        with self.pool.connection("127.0.0.1") as second:
+            pass
+        self.assertIs(first, second)
+        self.assertEqual((self.pool.created, self.pool.reused), (1, 1))
+        time.sleep(0.1)
+        self.assertEqual(self.accepted[0].recv(4), MAGIC)
+
+    def test_failed_exchange_not_reused(self):
+        with self.assertRaises(RuntimeError):
+            with self.pool.connection("127.0.0.1"):
+                raise RuntimeError("broken")
+        self.assertEqual(self.pool.idle_count("127.0.0.1"), 0)
+
+    def test_max_per_peer(self):
+        a = self.pool.acquire("127.0.0.1")
+        b = self.pool.acquire("127.0.0.1")
+        self.assertIsNone(self.pool.acquire("127.0.0.1", block=False))
+        got = []
+        waiter = threading.Thread(target=lambda: got.append(self.pool.acquire("127.0.0.1")))
+        waiter.start()
+        time.sleep(0.1)
+        self.assertEqual(got, [])
+        self.pool.release("127.0.0.1", a)
+        waiter.join(2)
+        self.assertEqual(got, [a])
+        self.pool.release("127.0.0.1", b)
+        self.pool.release("127.0.0.1", a)
+
+    def test_connect_timeout_leaves_socket_blocking(self):
+        sock = self.pool.acquire("127.0.0.1", connect_timeout=2)
+        self.assertIsNone(sock.gettimeout())
+        self.pool.release("127.0.0.1", sock)
+
+    def test_idle_connections_pruned(self):
+        with self.pool.connection("127.0.0.1"):
+            pass
+        self.pool.prune()
+        self.assertEqual(self.pool.idle_count("127.0.0.1"), 1)
+        time.sleep(0.3)
+        self.pool.prune()
+        self.assertEqual(self.pool.idle_count("127.0.0.1"), 0)
+
+    def test_connection_closed_by_peer_replaced(self):
+        with self.pool.connection("127.0.0.1") as first:
+            pass
+        time.sleep(0.1)
+        self.accepted[0].close()
+        time.sleep(0.1)
+        with self.pool.connection("127.0.0.1") as second:
+            self.assertIsNot(first, second)
+        self.assertEqual(self.pool.created, 2)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,84 @@
+import unittest
+import io
+import os
+import random
+from unittest.mock import patch
+
+from src.logic.delta import block_size_for, delta_ops, signatures
+
+
+def rebuild(basis, ops, new, block_size):
+    out = bytearray()
+    for op in ops:
+        if op[0] == "copy":
+            out += basis[op[1] * block_size:(op[1] + op[2]) * block_size]
+        else:
+            out += new[op[1]:op[1] + op[2]]
+    return bytes(out)
+
+
+class TestDelta(unittest.TestCase):
+    block_size = 1024
+
+    def delta(self, basis, new):
+        sigs = signatures(io.BytesIO(basis), self.block_size)
+        ops = list(delta_ops(io.BytesIO(new), len(new), self.block_size, sigs))
+        self.assertEqual(rebuild(basis, ops, new, self.block_size), new)
+        return ops
+
+    def literal_bytes(self, ops):
+        return sum(op[2] for op in ops if op[0] == "data")
+
+    def test_identical_file_is_all_copies(self):
+        basis = os.urandom(50 * 1024 + 17)
+        ops = self.delta(basis, basis)
+        self.assertEqual(self.literal_bytes(ops), 0)
+        self.assertEqual(ops, [("copy", 0, 51)])
+
+    def test_insertion_resynchronises(self):
+        basis = os.urandom(64 * 1024)
+        new = basis[:30000] + b"inserted" + basis[30000:]
+        ops = self.delta(basis, new)
+        self.assertLessEqual(self.literal_bytes(ops), self.block_size + 8)
+
+    def test_no_basis_sends_everything(self):
+        new = os.urandom(5000)
+        sigs = []
+        self.assertEqual(list(delta_ops(io.BytesIO(new), len(new), 1024, sigs)),
+                         [("data", 0, 5000)])
+
+    def test_random_mutations_round_trip(self):
+        """Edits that straddle read-buffer refills still rebuild exactly"""
+        rng = random.Random(7)
+        with patch("src.logic.delta.READ_SIZE", 3000):
+            for _ in range(100):
+                basis = os.urandom(rng.randint(0, 20000))
+                new = bytearray(basis)
+                for _ in range(rng.randint(0, 3)):
+                    k = rng.randint(0, len(new))
+                    kind = rng.choice("ido")
+                    if kind == "i":
+                        new[k:k] = os.urandom(rng.randint(1, 500))
+                    elif kind == "d":
+                        del new[k:k + rng.randint(1, 500)]
+                    else:
+                        new[k:k + 5] = b"xxxxx"
+                self.delta(basis, bytes(new))
+
+    def test_unrelated_file_streams_literals(self):
+        """Without a single match, data is still yielded a window at a time"""
+        basis, new = os.urandom(20000), os.urandom(50000)
+        with patch("src.logic.delta.READ_SIZE", 3000):
+            ops = self.delta(basis, new)
+        self.assertEqual(self.literal_bytes(ops), len(new))
+        self.assertGreater(len(ops), 10)
+        self.assertTrue(all(op[0] == "data" and op[2] < 2 * 3000 for op in ops))
+
+    def test_block_size_scales(self):
+        self.assertEqual(block_size_for(0), 1024)
+        self.assertEqual(block_size_for(1024 ** 3), 32 * 1024)
+        self.assertEqual(block_size_for(1024 ** 4), 64 * 1024)
+
+
+if __name__ == "__main__":
+    unittest.main()
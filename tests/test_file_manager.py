@@ -1,7 +1,7 @@
 import unittest
 import time
 from unittest.mock import Mock
-from src.logic.file_manager import FileManager, FileTransfer
+from src.logic.file_manager import FileManager, FileTransfer, progress_rate
 
 
 class TestFileTransfer(unittest.TestCase):
@@ -25,7 +25,7 @@ class TestFileTransfer(unittest.TestCase):
         """Test updating progress to partial completion"""
         self.transfer.update_progress(50)
         self.assertEqual(self.transfer.progress, 50)
-        self.assertEqual(self.transfer.status, "Downloading")
+        self.assertEqual(self.transfer.status, "Running")
 
     def test_update_progress_complete(self):
         """Test updating progress to completion"""
@@ -77,9 +77,9 @@ class TestFileManager(unittest.TestCase):
         # Add a queued transfer
         transfer1 = self.file_manager.add_transfer(self.filename, self.peer_ip, self.size)
 
-        # Add a downloading transfer
+        # Add a running transfer
         transfer2 = self.file_manager.add_transfer("file2.txt", "192.168.1.101", 2048)
-        transfer2.status = "Downloading"
+        transfer2.status = "Running"
 
         # Add a completed transfer
         transfer3 = self.file_manager.add_transfer("file3.txt", "192.168.1.102", 512)
@@ -87,7 +87,7 @@ class TestFileManager(unittest.TestCase):
 
         active = self.file_manager.get_active_transfers()
 
-        # Should only include queued and downloading transfers
+        # Should only include queued and running transfers
         self.assertEqual(len(active), 2)
         self.assertIn(transfer1, active)
         self.assertIn(transfer2, active)
@@ -119,7 +119,15 @@ class TestFileManager(unittest.TestCase):
         key = (self.filename, self.peer_ip)
         transfer = self.file_manager.transfers[key]
         self.assertFalse(transfer.paused)
-        self.assertEqual(transfer.status, "Downloading")
+        self.assertEqual(transfer.status, "Queued")
+
+    def test_resume_started_transfer(self):
+        """A transfer paused while running goes back to Running"""
+        transfer = self.file_manager.add_transfer(self.filename, self.peer_ip, self.size)
+        self.file_manager.set_status(transfer, "Running")
+        self.file_manager.pause_transfer(self.filename, self.peer_ip)
+        self.file_manager.resume_transfer(self.filename, self.peer_ip)
+        self.assertEqual(transfer.status, "Running")
 
     def test_resume_nonexistent_transfer(self):
         """Test resuming a nonexistent transfer"""
@@ -151,13 +159,57 @@ class TestFileManager(unittest.TestCase):
         key = (self.filename, self.peer_ip)
         transfer = self.file_manager.transfers[key]
         self.assertEqual(transfer.progress, 75)
-        self.assertEqual(transfer.status, "Downloading")
+        self.assertEqual(transfer.status, "Running")
 
     def test_update_progress_nonexistent(self):
         """Test updating progress for nonexistent transfer"""
         # Should not raise an error
         self.file_manager.update_progress("nonexistent.txt", "192.168.1.100", 50)
 
+    def test_pump_progress_coalesced(self):
+        """Per-chunk reports from the byte pumps reach the GUI at most
+        progress_rate times a second"""
+        transfer = self.file_manager.add_transfer(self.filename, self.peer_ip, 10**9)
+        self.file_manager.set_status(transfer, "Running")
+        updates = []
+        self.file_manager.transfers_changed.connect(lambda: updates.append(1))
+        deadline = time.monotonic() + 0.5
+        while time.monotonic() < deadline:
+            transfer.control.moved(1000)
+        self.assertLessEqual(len(updates), 0.5 * progress_rate + 1)
+        self.assertGreater(transfer.progress, 0)
+        self.assertEqual(transfer.transferred, transfer.control.transferred)
+
+    def test_speed_is_smoothed(self):
+        """A burst moves the reported speed only part of the way"""
+        transfer = self.file_manager.add_transfer(self.filename, self.peer_ip, 10**9)
+        self.file_manager.set_status(transfer, "Running")
+        for _ in range(5):
+            time.sleep(0.11)
+            transfer.control.moved(11000)  # ~100 KB/s
+        steady = transfer.rate
+        self.assertAlmostEqual(steady, 100000, delta=20000)
+        time.sleep(0.11)
+        transfer.control.moved(1100000)  # one ~10 MB/s sample
+        self.assertLess(transfer.rate, 10 * steady)
+        self.assertGreater(transfer.rate, steady)
+
+    def test_incoming_transfer_tracked(self):
+        transfer = self.file_manager.add_incoming(self.filename, self.peer_ip, self.size)
+        self.assertEqual(self.file_manager.get_active_transfers(), [transfer])
+        self.assertTrue(transfer.control.park)
+        time.sleep(1 / progress_rate)
+        transfer.control.seek(512)
+        self.assertEqual(transfer.progress, 50)
+        transfer.control.finish(True)
+        self.assertEqual(transfer.status, "Completed")
+        self.assertEqual(transfer.progress, 100)
+
+    def test_interrupted_incoming_transfer_fails(self):
+        transfer = self.file_manager.add_incoming(self.filename, self.peer_ip, self.size)
+        transfer.control.finish(False)
+        self.assertEqual(transfer.status, "Failed")
+
     def test_remove_completed_transfers(self):
         """Test removing completed and cancelled transfers"""
         # Add various transfers
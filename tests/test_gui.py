@@ -1,7 +1,10 @@
 import unittest
 from unittest.mock import Mock, patch
 from PyQt5.QtWidgets import QApplication
+import os
+import shutil
 import sys
+import tempfile
 
 # Import GUI components
 from src.gui.gui_main import ModernP2PGui
@@ -15,15 +18,21 @@ class TestGUIMain(unittest.TestCase):
         cls.app = QApplication(sys.argv) if not QApplication.instance() else QApplication.instance()
 
     def setUp(self):
+        self.catalog_dir = tempfile.mkdtemp()
         # Mock AppLogic to avoid actual network operations
         with patch('src.logic.NetworkManager') as mock_network, \
              patch('src.logic.ChatManager') as mock_chat, \
-             patch('src.logic.FileManager') as mock_file:
+             patch('src.logic.FileManager') as mock_file, \
+             patch('src.controller.index.CATALOG_FILE',
+                   os.path.join(self.catalog_dir, "shared_files.db")):
             
             # Configure the mock NetworkManager
             mock_network_instance = Mock()
             mock_network_instance.get_lan_status.return_value = (True, "192.168.1.100")
             mock_network_instance.get_peers.return_value = ["192.168.1.101", "192.168.1.102"]
+            mock_network_instance.get_peer_info.return_value = {
+                "port": 5001, "name": "alice", "caps": ["browse"]}
+            mock_network_instance.get_rate_limits.return_value = (0, 0, 0, 0)
             mock_network.return_value = mock_network_instance
             
             # Configure other mocks
@@ -36,8 +45,14 @@ class TestGUIMain(unittest.TestCase):
             
             self.mock_app_logic = AppLogic()
             self.gui = ModernP2PGui()
+            self.own_app_logic = self.gui.applogic
             self.gui.applogic = self.mock_app_logic
 
+    def tearDown(self):
+        self.mock_app_logic.shared_library.stop()
+        self.own_app_logic.shared_library.stop()
+        shutil.rmtree(self.catalog_dir)
+
     def test_initialization(self):
         """Test GUI initialization"""
         self.assertIsNotNone(self.gui)
@@ -145,14 +160,19 @@ class TestGUIIntegration(unittest.TestCase):
 
     def test_gui_app_logic_integration(self):
         """Test that GUI can be created with AppLogic"""
+        catalog_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, catalog_dir)
         with patch('src.logic.NetworkManager') as mock_network, \
              patch('src.logic.ChatManager') as mock_chat, \
-             patch('src.logic.FileManager') as mock_file:
+             patch('src.logic.FileManager') as mock_file, \
+             patch('src.controller.index.CATALOG_FILE',
+                   os.path.join(catalog_dir, "shared_files.db")):
             
             # Configure mocks
             mock_network_instance = Mock()
             mock_network_instance.get_lan_status.return_value = (True, "192.168.1.100")
             mock_network_instance.get_peers.return_value = []
+            mock_network_instance.get_rate_limits.return_value = (0, 0, 0, 0)
             mock_network.return_value = mock_network_instance
             
             mock_chat_instance = Mock()
@@ -164,7 +184,9 @@ class TestGUIIntegration(unittest.TestCase):
             
             app_logic = AppLogic()
             gui = ModernP2PGui()
+            self.addCleanup(gui.applogic.shared_library.stop)
             gui.applogic = app_logic
+            self.addCleanup(app_logic.shared_library.stop)
             
             self.assertIsNotNone(gui)
             self.assertIsNotNone(gui.applogic)
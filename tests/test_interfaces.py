@@ -0,0 +1,71 @@
+import unittest
+import socket
+from unittest.mock import patch
+
+from src.logic.interfaces import InterfaceRegistry, local_addresses, shared_registry
+
+
+class TestInterfaceRegistry(unittest.TestCase):
+    def setUp(self):
+        self.addresses = {"127.0.0.1", "192.168.1.10", "10.8.0.2"}
+        self.calls = 0
+
+        def list_addresses():
+            self.calls += 1
+            return set(self.addresses)
+
+        self.registry = InterfaceRegistry(refresh=30, list_addresses=list_addresses,
+                                          route=lambda: "192.168.1.10", watch=False)
+
+    def test_every_nic_is_local(self):
+        self.assertTrue(self.registry.is_local("192.168.1.10"))
+        self.assertTrue(self.registry.is_local("10.8.0.2"))
+        self.assertFalse(self.registry.is_local("192.168.1.11"))
+        # Loopback is left out so peers on one host see each other
+        self.assertFalse(self.registry.is_local("127.0.0.1"))
+        self.assertEqual(self.registry.primary, "192.168.1.10")
+
+    def test_lookups_do_not_enumerate(self):
+        for _ in range(1000):
+            self.registry.is_local("192.168.1.20")
+        self.assertEqual(self.calls, 1)
+
+    def test_refreshed_when_due(self):
+        self.addresses.add("172.16.0.5")
+        self.assertFalse(self.registry.poll(self.registry._checked + 10))
+        self.assertFalse(self.registry.is_local("172.16.0.5"))
+        self.assertTrue(self.registry.poll(self.registry._checked + 30))
+        self.assertTrue(self.registry.is_local("172.16.0.5"))
+        self.assertEqual(self.calls, 2)
+
+    def test_refreshed_on_change_notification(self):
+        notifier, self.registry._monitor = socket.socketpair()
+        self.addCleanup(notifier.close)
+        self.addCleanup(self.registry.close)
+        self.addresses.discard("10.8.0.2")
+        self.assertFalse(self.registry.poll())
+        notifier.send(b"address removed")
+        self.assertTrue(self.registry.poll())
+        self.assertFalse(self.registry.is_local("10.8.0.2"))
+
+    def test_no_default_route(self):
+        registry = InterfaceRegistry(list_addresses=lambda: {"127.0.0.1", "10.0.0.7"},
+                                     route=lambda: None, watch=False)
+        self.assertEqual(registry.primary, "10.0.0.7")
+        self.assertTrue(registry.is_local("10.0.0.7"))
+        registry = InterfaceRegistry(list_addresses=lambda: {"127.0.0.1"},
+                                     route=lambda: None, watch=False)
+        self.assertEqual(registry.primary, "127.0.0.1")
+        self.assertEqual(registry.addresses, frozenset())
+
+    def test_host_addresses(self):
+        addresses = local_addresses()
+        self.assertIsInstance(addresses, set)
+        for ip in addresses:
+            socket.inet_aton(ip)
+        with patch("src.logic.interfaces._shared", None):
+            self.assertIs(shared_registry(), shared_registry())
+
+
+if __name__ == "__main__":
+    unittest.main()
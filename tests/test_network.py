@@ -1,8 +1,24 @@
 import unittest
 import socket
+import threading
+import tempfile
+import errno
+import io
+import os
+import shutil
+import struct
 import time
+from contextlib import redirect_stdout
+from unittest.mock import patch
 
+from src.logic.codecs import encode_block, get_codec
 from src.logic.network import NetworkManager
+from src.logic.partial_file import PartialFile
+from src.logic.protocol import (
+    MAGIC, OP_CHUNK_OFFER, OP_ENTRY, OP_FOLDER, OP_FOLDER_END, OP_STRIPE, encode_frame,
+    recv_frame, send_frame
+)
+from src.logic.transfer_control import TransferControl
 
 
 class TestNetworkManager(unittest.TestCase):
@@ -52,5 +68,783 @@ class TestNetworkManager(unittest.TestCase):
         sock_udp.close()
 
 
+class TestSendBody(unittest.TestCase):
+    def setUp(self):
+        self.payload = os.urandom(3 * 1024 * 1024 + 123)
+        tmp = tempfile.NamedTemporaryFile(delete=False)
+        tmp.write(self.payload)
+        tmp.close()
+        self.path = tmp.name
+
+    def tearDown(self):
+        os.unlink(self.path)
+
+    def _pump(self, network_manager, offset=0):
+        """Send the temp file through a socketpair and return what arrived"""
+        tx, rx = socket.socketpair()
+        received = bytearray()
+
+        def drain():
+            while True:
+                chunk = rx.recv(65536)
+                if not chunk:
+                    break
+                received.extend(chunk)
+
+        reader = threading.Thread(target=drain)
+        reader.start()
+        with open(self.path, "rb") as f:
+            sent = network_manager._send_body(
+                tx, f, len(self.payload) - offset, offset)
+        tx.close()
+        reader.join()
+        rx.close()
+        return sent, bytes(received)
+
+    def test_zero_copy_matches_chunked(self):
+        """Both send paths deliver identical bytes and count them"""
+        for mode in (True, False):
+            nm = quiet_manager(zero_copy=mode)
+            sent, received = self._pump(nm)
+            self.assertEqual(received, self.payload)
+            self.assertEqual(sent, len(self.payload))
+            self.assertEqual(nm._upload_bytes, len(self.payload))
+
+    def test_offset(self):
+        nm = quiet_manager()
+        sent, received = self._pump(nm, offset=1000)
+        self.assertEqual(received, self.payload[1000:])
+        self.assertEqual(sent, len(self.payload) - 1000)
+
+    def test_sendfile_unsupported_falls_back(self):
+        """An EINVAL from sendfile() switches to the chunked loop"""
+        nm = quiet_manager(zero_copy=True)
+        with patch("os.sendfile", side_effect=OSError(errno.EINVAL, "nope")):
+            sent, received = self._pump(nm)
+        self.assertEqual(received, self.payload)
+        self.assertEqual(nm._upload_bytes, len(self.payload))
+
+
+def free_port(kind=socket.SOCK_STREAM):
+    with socket.socket(socket.AF_INET, kind) as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def quiet_manager(**kwargs):
+    """A NetworkManager without the bandwidth monitor, which would reset
+    the byte counters (and expire peers) under a test"""
+    with patch.object(NetworkManager, "_bandwidth_monitor", lambda self: None):
+        return NetworkManager(**kwargs)
+
+
+class TestLoopbackTransfer(unittest.TestCase):
+    """End-to-end transfers against a local server on a free port"""
+
+    def setUp(self):
+        self.download_dir = tempfile.mkdtemp()
+        self.network_manager = quiet_manager(port=free_port(), download_dir=self.download_dir)
+        self.network_manager.running = True
+        threading.Thread(target=self.network_manager._start_server,
+                         daemon=True).start()
+        time.sleep(0.2)
+
+    def tearDown(self):
+        self.network_manager.stop()
+        shutil.rmtree(self.download_dir)
+
+    def make_source(self, data):
+        tmp = tempfile.NamedTemporaryFile(delete=False, suffix=".bin")
+        tmp.write(data)
+        tmp.close()
+        self.addCleanup(os.unlink, tmp.name)
+        return tmp.name
+
+    def wait_for(self, name, size, timeout=5):
+        path = os.path.join(self.download_dir, name)
+        deadline = time.time() + timeout
+        while time.time() < deadline:
+            if os.path.exists(path) and os.path.getsize(path) == size:
+                time.sleep(0.05)
+                return path
+            time.sleep(0.02)
+        self.fail(f"{name} did not arrive")
+
+    def test_send_and_receive(self):
+        data = os.urandom(2 * 1024 * 1024 + 7)
+        source = self.make_source(data)
+        self.network_manager.send_file("127.0.0.1", source)
+        path = self.wait_for(os.path.basename(source), len(data))
+        with open(path, "rb") as f:
+            self.assertEqual(f.read(), data)
+
+    def test_striped_transfer(self):
+        """Ranges sent over several connections reassemble at their offsets"""
+        data = os.urandom(10 * 64 * 1024 + 99)
+        source = self.make_source(data)
+        self.network_manager.streams = 4
+        with patch("src.logic.network.STRIPE_SIZE", 64 * 1024):
+            self.network_manager.send_file("127.0.0.1", source)
+        path = self.wait_for(os.path.basename(source), len(data))
+        with open(path, "rb") as f:
+            self.assertEqual(f.read(), data)
+        self.assertEqual(self.network_manager._incoming, {})
+
+    def test_resume_sends_only_missing_ranges(self):
+        """A partial copy left by a dropped transfer is completed, not redone"""
+        data = os.urandom(1024 * 1024)
+        source = self.make_source(data)
+        meta = self.network_manager._transfer_meta(source, len(data))
+        part = PartialFile(os.path.join(self.download_dir, meta["name"]),
+                           len(data), meta["fp"])
+        part.write_at(0, data[:400000])
+        part.commit(0, 400000)
+        part.close()
+
+        self.network_manager.send_file("127.0.0.1", source)
+        path = self.wait_for(meta["name"], len(data))
+        with open(path, "rb") as f:
+            self.assertEqual(f.read(), data)
+        self.assertEqual(self.network_manager._upload_bytes, len(data) - 400000)
+        self.assertEqual(os.listdir(self.download_dir), [meta["name"]])
+
+    def test_dedup_sends_only_changed_chunks(self):
+        """Re-sending an edited file only moves the chunks that changed"""
+        data = os.urandom(4 * 1024 * 1024)
+        source = self.make_source(data)
+        name = os.path.basename(source)
+        self.network_manager.dedup = True
+        self.network_manager.send_file("127.0.0.1", source)
+        self.wait_for(name, len(data))
+
+        edited = data[:2000000] + b"a small edit" + data[2000000:]
+        with open(source, "wb") as f:
+            f.write(edited)
+        self.network_manager._upload_bytes = 0
+        self.network_manager.send_file("127.0.0.1", source)
+        path = self.wait_for(name, len(edited))
+        with open(path, "rb") as f:
+            self.assertEqual(f.read(), edited)
+        self.assertLess(self.network_manager._upload_bytes, 600 * 1024)
+
+    def test_bad_chunk_offer_refused(self):
+        """Chunk lengths of 0, over MAX_CHUNK, or not adding up to the size
+        drop the connection before anything is allocated or written"""
+        offer = {"id": "x", "name": "bad.bin", "fp": "x"}
+        for size, chunks in ((1 << 40, [["d", 1 << 40]]), (0, [["d", 0]]),
+                             (2048, [["d", 1024]])):
+            with socket.create_connection(("127.0.0.1", self.network_manager.port)) as s:
+                s.settimeout(2)
+                s.sendall(MAGIC)
+                send_frame(s, OP_CHUNK_OFFER, dict(offer, size=size, chunks=chunks))
+                self.assertEqual(recv_frame(s), (None, None))
+        self.assertEqual(os.listdir(self.download_dir), [".chunks"])
+
+    def test_failed_dedup_leaves_no_temp_file(self):
+        data = os.urandom(1024 * 1024)
+        source = self.make_source(data)
+        name = os.path.basename(source)
+        self.network_manager.dedup = True
+        # A resumable download of the same name must survive
+        with open(os.path.join(self.download_dir, name + ".part"), "wb") as f:
+            f.write(b"partial")
+        with patch("src.logic.network.chunk_digest", return_value="corrupt"):
+            try:
+                self.network_manager.send_file("127.0.0.1", source)
+            except Exception:
+                pass
+            time.sleep(0.3)
+        self.assertEqual(sorted(os.listdir(self.download_dir)), [".chunks", name + ".part"])
+        with open(os.path.join(self.download_dir, name + ".part"), "rb") as f:
+            self.assertEqual(f.read(), b"partial")
+
+    def test_delta_rebuilds_from_existing_copy(self):
+        data = os.urandom(1024 * 1024)
+        source = self.make_source(data)
+        name = os.path.basename(source)
+        with open(os.path.join(self.download_dir, name), "wb") as f:
+            f.write(data)
+        self.assertTrue(self.network_manager.has_local_copy(source))
+
+        # A resumable download of the same name is left alone
+        with open(os.path.join(self.download_dir, name + ".part"), "wb") as f:
+            f.write(b"partial")
+
+        edited = data[:500000] + b"changed" + data[500100:]
+        with open(source, "wb") as f:
+            f.write(edited)
+        self.network_manager.send_file_delta("127.0.0.1", source)
+        path = self.wait_for(name, len(edited))
+        with open(path, "rb") as f:
+            self.assertEqual(f.read(), edited)
+        self.assertLess(self.network_manager._upload_bytes, 16 * 1024)
+        with open(path + ".part", "rb") as f:
+            self.assertEqual(f.read(), b"partial")
+
+    def test_corrupt_delta_rebuild_falls_back_to_full_send(self):
+        data = os.urandom(1024 * 1024)
+        source = self.make_source(data)
+        name = os.path.basename(source)
+        with open(os.path.join(self.download_dir, name), "wb") as f:
+            f.write(data)
+        edited = data[:500000] + b"changed" + data[500100:]
+        with open(source, "wb") as f:
+            f.write(edited)
+        recv_body = NetworkManager._recv_body
+
+        def corrupting(nm, conn, f, count):
+            n = recv_body(nm, conn, f, count)
+            # Damage the literal's last byte on its way to disk
+            f.seek(-1, os.SEEK_CUR)
+            f.write(bytes([edited[f.tell()] ^ 0xff]))
+            return n
+
+        with patch.object(NetworkManager, "_recv_body", corrupting):
+            self.assertTrue(self.network_manager.send_file_delta("127.0.0.1", source))
+        path = self.wait_for(name, len(edited))
+        with open(path, "rb") as f:
+            self.assertEqual(f.read(), edited)
+        self.assertGreater(self.network_manager._upload_bytes, len(edited))
+        self.assertEqual(sorted(os.listdir(self.download_dir)), [name])
+
+    def test_delta_of_unrelated_file_keeps_receiver_listening(self):
+        """A new file sharing no block with the old copy streams its data
+        while the scan goes on, rather than after it"""
+        name = "report.bin"
+        with open(os.path.join(self.download_dir, name), "wb") as f:
+            f.write(os.urandom(1024 * 1024))
+        data = os.urandom(2 * 1024 * 1024)
+        source = os.path.join(tempfile.mkdtemp(), name)
+        self.addCleanup(shutil.rmtree, os.path.dirname(source))
+        with open(source, "wb") as f:
+            f.write(data)
+        with patch("src.logic.network.SESSION_IDLE_TIMEOUT", 0.3), \
+                patch("src.logic.delta.READ_SIZE", 64 * 1024), \
+                patch.object(self.network_manager, "send_file") as send_file:
+            self.assertTrue(self.network_manager.send_file_delta("127.0.0.1", source))
+        send_file.assert_not_called()  # no fallback to a full send
+        path = self.wait_for(name, len(data))
+        with open(path, "rb") as f:
+            self.assertEqual(f.read(), data)
+
+    def test_failed_delta_falls_back_to_full_send(self):
+        data = os.urandom(256 * 1024)
+        source = self.make_source(data)
+        name = os.path.basename(source)
+        with open(os.path.join(self.download_dir, name), "wb") as f:
+            f.write(os.urandom(1000))
+        with patch("src.logic.network.delta_ops", side_effect=OSError("broken pipe")):
+            self.assertTrue(self.network_manager.send_file_delta("127.0.0.1", source))
+        path = self.wait_for(name, len(data))
+        with open(path, "rb") as f:
+            self.assertEqual(f.read(), data)
+
+    def test_folder_streamed_and_extracted(self):
+        source = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, source)
+        tree = os.path.join(source, "photos")
+        os.makedirs(os.path.join(tree, "2024"))
+        files = {f"2024/img{i}.jpg": os.urandom(100 + i) for i in range(200)}
+        files["big.raw"] = os.urandom(1024 * 1024)
+        for rel, data in files.items():
+            with open(os.path.join(tree, rel), "wb") as f:
+                f.write(data)
+        self.network_manager.send_file("127.0.0.1", tree)
+        self.wait_for(os.path.join("photos", "big.raw"), len(files["big.raw"]))
+        for rel, data in files.items():
+            path = self.wait_for(os.path.join("photos", rel), len(data))
+            with open(path, "rb") as f:
+                self.assertEqual(f.read(), data)
+
+    def test_folder_name_cannot_escape_download_dir(self):
+        name = f"evil-{os.path.basename(self.download_dir)}.txt"
+        escaped = os.path.join(os.path.dirname(self.download_dir), name)
+        self.addCleanup(lambda: os.path.exists(escaped) and os.unlink(escaped))
+        for folder in ("..", ".", "", "a/.."):
+            with socket.create_connection(("127.0.0.1", self.network_manager.port)) as s:
+                s.sendall(MAGIC + encode_frame(OP_FOLDER, {"name": folder})
+                          + encode_frame(OP_ENTRY, {"path": name, "size": 4}) + b"evil"
+                          + encode_frame(OP_FOLDER_END, {"files": 1, "bytes": 4}))
+                s.settimeout(2)
+                try:
+                    self.assertEqual(s.recv(1), b"")  # refused and closed
+                except ConnectionResetError:
+                    pass
+        self.assertFalse(os.path.exists(escaped))
+        self.assertEqual(os.listdir(self.download_dir), [])
+
+    def test_stop_closes_idle_sessions(self):
+        """A pooled connection waiting for its next frame does not keep a
+        worker (and so the process) alive after stop()"""
+        with socket.create_connection(("127.0.0.1", self.network_manager.port)) as s:
+            s.sendall(MAGIC)
+            time.sleep(0.2)
+            self.network_manager.stop()
+            s.settimeout(2)
+            self.assertEqual(s.recv(1), b"")
+        self.network_manager.executor.shutdown(wait=True)
+        self.assertEqual(self.network_manager._sessions, set())
+
+    def test_stop_mid_transfer_is_a_clean_exit(self):
+        """stop() wakes a worker reading a stripe without closing the socket
+        under it, and the short read that follows is not reported"""
+        data = os.urandom(256 * 1024)
+        meta = self.network_manager._transfer_meta(self.make_source(data), len(data))
+        with socket.create_connection(("127.0.0.1", self.network_manager.port)) as s:
+            s.sendall(MAGIC)
+            send_frame(s, OP_STRIPE, dict(meta, offset=0, length=len(data)))
+            s.sendall(data[:100000])
+            time.sleep(0.2)
+            output = io.StringIO()
+            with redirect_stdout(output):
+                self.network_manager.stop()
+                self.network_manager.executor.shutdown(wait=True)
+        self.assertNotIn("[ERROR]", output.getvalue())
+        self.assertEqual(self.network_manager._sessions, set())
+
+    def test_many_files_over_one_connection(self):
+        files = {self.make_source(os.urandom(4096 + i)): 4096 + i for i in range(300)}
+        control = TransferControl()
+        with patch("socket.create_connection", wraps=socket.create_connection) as connect:
+            self.assertTrue(self.network_manager.send_files("127.0.0.1", list(files),
+                                                            control=control))
+            # The confirmed connection goes back to the pool for the next batch
+            big = self.make_source(os.urandom(300000))
+            self.assertTrue(self.network_manager.send_files("127.0.0.1", [big]))
+        self.assertEqual(connect.call_count, 1)
+        self.assertEqual(control.transferred, sum(files.values()))
+        files[big] = 300000
+        for source, size in files.items():
+            path = self.wait_for(os.path.basename(source), size)
+            with open(source, "rb") as a, open(path, "rb") as b:
+                self.assertEqual(a.read(), b.read())
+
+    def test_back_to_back_sends_reuse_connection(self):
+        for _ in range(3):
+            source = self.make_source(os.urandom(100000))
+            self.network_manager.send_file("127.0.0.1", source)
+            self.wait_for(os.path.basename(source), 100000)
+        self.assertEqual(self.network_manager.pool.created, 1)
+        self.assertEqual(self.network_manager.pool.reused, 2)
+
+    def test_control_message_over_pooled_connection(self):
+        received = []
+        self.network_manager.control_handler = lambda data, addr: received.append(data)
+        self.network_manager.send_control("127.0.0.1", "TRANSFER_RESPONSE:me:42:accept")
+        deadline = time.time() + 2
+        while not received and time.time() < deadline:
+            time.sleep(0.02)
+        self.assertEqual(received, [b"TRANSFER_RESPONSE:me:42:accept"])
+
+    def test_compressed_transfer(self):
+        """A negotiated codec shrinks compressible data on the wire"""
+        data = b"".join(b"2024-01-01,host%03d,%d,ok\n" % (i % 100, i) for i in range(100000))
+        source = self.make_source(data)
+        self.network_manager.streams = 2
+        with patch("src.logic.network.STRIPE_SIZE", 512 * 1024):
+            self.network_manager.send_file("127.0.0.1", source, codec="zlib")
+        path = self.wait_for(os.path.basename(source), len(data))
+        with open(path, "rb") as f:
+            self.assertEqual(f.read(), data)
+        self.assertLess(self.network_manager._upload_bytes, len(data) // 4)
+
+    def test_compressed_block_cannot_overrun_its_stripe(self):
+        """A block decoding to more than the stripe holds drops the
+        connection without writing past the stripe"""
+        data = os.urandom(100000)
+        meta = self.network_manager._transfer_meta(self.make_source(data), len(data))
+        with socket.create_connection(("127.0.0.1", self.network_manager.port)) as s:
+            s.sendall(MAGIC)
+            send_frame(s, OP_STRIPE, dict(meta, offset=90000, length=10000, codec="zlib"))
+            s.sendall(encode_block(get_codec("zlib"), 6, b"\0" * 20000))
+            s.settimeout(2)
+            self.assertEqual(s.recv(1), b"")
+        part = os.path.join(self.download_dir, meta["name"] + ".part")
+        self.assertEqual(os.path.getsize(part), len(data))
+
+    def test_incompressible_file_skips_codec(self):
+        data = os.urandom(300000)
+        source = self.make_source(data)
+        self.network_manager.send_file("127.0.0.1", source, codec="lzma")
+        path = self.wait_for(os.path.basename(source), len(data))
+        with open(path, "rb") as f:
+            self.assertEqual(f.read(), data)
+        self.assertEqual(self.network_manager._upload_bytes, len(data))
+
+    def test_corrupted_stripe_resent_alone(self):
+        """A stripe that fails its digest check is the only one sent again"""
+        data = os.urandom(5 * 64 * 1024)
+        source = self.make_source(data)
+        write_at = PartialFile.write_at
+        corrupted = []
+
+        def flaky_write(part, offset, chunk):
+            if offset == 2 * 64 * 1024 and not corrupted:
+                corrupted.append(offset)
+                chunk = b"\xff" + bytes(chunk[1:])
+            write_at(part, offset, chunk)
+
+        with patch("src.logic.network.STRIPE_SIZE", 64 * 1024), \
+                patch.object(PartialFile, "write_at", flaky_write):
+            self.network_manager.send_file("127.0.0.1", source)
+        path = self.wait_for(os.path.basename(source), len(data))
+        with open(path, "rb") as f:
+            self.assertEqual(f.read(), data)
+        self.assertEqual(corrupted, [2 * 64 * 1024])
+        self.assertEqual(self.network_manager._upload_bytes, len(data) + 64 * 1024)
+
+    def test_upload_cap_throttles_transfer(self):
+        data = os.urandom(1536 * 1024)
+        source = self.make_source(data)
+        self.network_manager.set_rate_limits(upload=1024 * 1024)
+        start = time.monotonic()
+        self.network_manager.send_file("127.0.0.1", source)
+        self.wait_for(os.path.basename(source), len(data))
+        self.assertGreater(time.monotonic() - start, 1.3)
+
+    def make_folder(self, count, size):
+        """A folder of `count` small files of `size` bytes each"""
+        source = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, source)
+        tree = os.path.join(source, "notes")
+        os.mkdir(tree)
+        for i in range(count):
+            with open(os.path.join(tree, f"note{i}.txt"), "wb") as f:
+                f.write(os.urandom(size))
+        return tree
+
+    def test_upload_cap_throttles_folder_of_small_files(self):
+        """Small files go out inside archive batches, which are charged to
+        the caps like any other upload"""
+        tree = self.make_folder(100, 8000)
+        self.network_manager.set_rate_limits(upload=400 * 1024)
+        start = time.monotonic()
+        self.assertTrue(self.network_manager.send_file("127.0.0.1", tree))
+        self.assertGreater(time.monotonic() - start, 1.5)
+        self.assertEqual(self.network_manager._upload_bytes, 800000)
+        self.wait_for(os.path.join("notes", "note99.txt"), 8000)
+
+    def start_throttled_send(self, source, control):
+        """Send `source` at 1 MB/s on a thread; returns [result] once done"""
+        self.network_manager.set_rate_limits(upload=1024 * 1024)
+        result = []
+        sender = threading.Thread(target=lambda: result.append(
+            self.network_manager.send_file("127.0.0.1", source, control=control)))
+        sender.start()
+        time.sleep(0.5)
+        return sender, result
+
+    def test_pause_stops_quickly_and_resume_continues(self):
+        data = os.urandom(2 * 1024 * 1024)
+        source = self.make_source(data)
+        control = TransferControl()
+        with patch("src.logic.network.STRIPE_SIZE", 64 * 1024):
+            sender, result = self.start_throttled_send(source, control)
+            start = time.monotonic()
+            control.pause()
+            sender.join(2)
+            self.assertLess(time.monotonic() - start, 0.1)
+            self.assertEqual(result, [False])
+            self.assertTrue(control.take_interrupted())
+
+            sent = self.network_manager._upload_bytes
+            self.network_manager.set_rate_limits(upload=0)
+            control.resume()
+            self.assertTrue(self.network_manager.send_file("127.0.0.1", source,
+                                                           control=control))
+        path = self.wait_for(os.path.basename(source), len(data))
+        with open(path, "rb") as f:
+            self.assertEqual(f.read(), data)
+        # Only what had not been committed when paused is sent again
+        resent = self.network_manager._upload_bytes - sent
+        self.assertLess(resent, len(data) - 256 * 1024)
+
+    def test_cancel_removes_partial_download(self):
+        data = os.urandom(2 * 1024 * 1024)
+        source = self.make_source(data)
+        control = TransferControl()
+        with patch("src.logic.network.STRIPE_SIZE", 64 * 1024):
+            sender, result = self.start_throttled_send(source, control)
+            self.assertTrue(os.listdir(self.download_dir))
+            start = time.monotonic()
+            control.cancel()
+            sender.join(2)
+            self.assertLess(time.monotonic() - start, 0.1)
+        self.assertEqual(result, [False])
+        deadline = time.time() + 2
+        while os.listdir(self.download_dir) and time.time() < deadline:
+            time.sleep(0.02)
+        self.assertEqual(os.listdir(self.download_dir), [])
+        self.assertEqual(self.network_manager._incoming, {})
+
+    def test_receiver_cancel_removes_partial_download(self):
+        """Cancelling on our side while a stripe is half read discards it"""
+        data = os.urandom(256 * 1024)
+        meta = self.network_manager._transfer_meta(self.make_source(data), len(data))
+        receiving = []
+
+        def track(meta, peer_ip):
+            receiving.append(TransferControl(park=True))
+            return receiving[-1]
+
+        self.network_manager.incoming_handler = track
+        with socket.create_connection(("127.0.0.1", self.network_manager.port)) as s:
+            s.sendall(MAGIC)
+            send_frame(s, OP_STRIPE, dict(meta, offset=0, length=len(data)))
+            s.sendall(data[:100000])
+            deadline = time.time() + 2
+            while not (receiving and receiving[0].transferred == 100000) \
+                    and time.time() < deadline:
+                time.sleep(0.02)
+            receiving[0].cancel()
+            deadline = time.time() + 2
+            while os.listdir(self.download_dir) and time.time() < deadline:
+                time.sleep(0.02)
+        self.assertEqual(os.listdir(self.download_dir), [])
+        self.assertEqual(self.network_manager._incoming, {})
+
+    def test_long_pause_held_until_resumed(self):
+        """A receiver paused past park_timeout drops the connection, but has
+        the sender hold the transfer rather than fail it; resuming has the
+        sender carry on from the receiver's manifest"""
+        data = os.urandom(2 * 1024 * 1024)
+        source = self.make_source(data)
+        receiving, finished = [], []
+
+        def track(meta, peer_ip):
+            receiving.append(TransferControl(park=True, park_timeout=0.2))
+            receiving[-1].on_finish = finished.append
+            return receiving[-1]
+
+        self.network_manager.incoming_handler = track
+        control = TransferControl()
+        resent = []
+
+        def send_again():  # as the scheduler does once the transfer is released
+            self.network_manager.set_rate_limits(upload=0)
+            resent.append(self.network_manager.send_file("127.0.0.1", source, control=control))
+
+        self.network_manager.release_handler = \
+            lambda: threading.Thread(target=send_again).start()
+        with patch("src.logic.network.STRIPE_SIZE", 64 * 1024):
+            sender, result = self.start_throttled_send(source, control)
+            receiving[0].pause()
+            sender.join(3)
+            self.assertEqual(result, [False])
+            self.assertTrue(control.held)
+            self.assertTrue(control.take_interrupted())  # requeued, not failed
+            self.assertEqual(self.network_manager._incoming, {})
+            self.assertEqual(finished, [])  # still paused at the receiver
+            receiving[0].resume()
+            path = self.wait_for(os.path.basename(source), len(data))
+        deadline = time.time() + 2
+        while not resent and time.time() < deadline:
+            time.sleep(0.02)
+        self.assertEqual(resent, [True])
+        self.assertFalse(control.held)
+        self.assertEqual(len(receiving), 1)  # the same transfer, resumed
+        self.assertEqual(finished, [True])
+        with open(path, "rb") as f:
+            self.assertEqual(f.read(), data)
+
+    def test_long_pause_then_cancel_discards_partial(self):
+        data = os.urandom(2 * 1024 * 1024)
+        source = self.make_source(data)
+        receiving, finished = [], []
+
+        def track(meta, peer_ip):
+            receiving.append(TransferControl(park=True, park_timeout=0.2))
+            receiving[-1].on_finish = finished.append
+            return receiving[-1]
+
+        self.network_manager.incoming_handler = track
+        control = TransferControl()
+        with patch("src.logic.network.STRIPE_SIZE", 64 * 1024):
+            sender, result = self.start_throttled_send(source, control)
+            receiving[0].pause()
+            sender.join(3)
+        self.assertTrue(control.held)
+        deadline = time.time() + 2
+        while receiving[0].on_cancel is None and time.time() < deadline:
+            time.sleep(0.02)  # the receiving session winding down
+        self.assertEqual(finished, [])
+        receiving[0].cancel()
+        self.assertEqual(finished, [False])
+        self.assertEqual(os.listdir(self.download_dir), [])
+        self.assertEqual(self.network_manager._incoming_controls, {})
+
+    def test_folder_receive_paused_then_cancelled(self):
+        """A folder being received parks on pause like a file does, and a
+        cancel deletes what was extracted of it"""
+        tree = self.make_folder(8, 256 * 1024)
+        receiving, finished = [], []
+
+        def track(meta, peer_ip):
+            receiving.append(TransferControl(park=True))
+            receiving[-1].on_finish = finished.append
+            return receiving[-1]
+
+        self.network_manager.incoming_handler = track
+        sender, result = self.start_throttled_send(tree, TransferControl())
+        receiving[0].pause()
+        time.sleep(0.2)
+        parked_at = receiving[0].transferred
+        time.sleep(0.3)
+        self.assertEqual(receiving[0].transferred, parked_at)
+        self.assertLess(parked_at, 8 * 256 * 1024)
+        receiving[0].cancel()
+        sender.join(3)
+        self.assertEqual(result, [False])
+        self.assertEqual(finished, [False])
+        self.assertEqual(os.listdir(self.download_dir), [])
+
+    def test_folder_long_pause_held_until_resumed(self):
+        tree = self.make_folder(8, 256 * 1024)
+        receiving, finished = [], []
+
+        def track(meta, peer_ip):
+            receiving.append(TransferControl(park=True, park_timeout=0.2))
+            receiving[-1].on_finish = finished.append
+            return receiving[-1]
+
+        self.network_manager.incoming_handler = track
+        control = TransferControl()
+        resent = []
+
+        def send_again():
+            self.network_manager.set_rate_limits(upload=0)
+            resent.append(self.network_manager.send_file("127.0.0.1", tree, control=control))
+
+        self.network_manager.release_handler = \
+            lambda: threading.Thread(target=send_again).start()
+        sender, result = self.start_throttled_send(tree, control)
+        receiving[0].pause()
+        sender.join(3)
+        self.assertEqual(result, [False])
+        self.assertTrue(control.held)
+        self.assertEqual(finished, [])
+        receiving[0].resume()
+        deadline = time.time() + 5
+        while not resent and time.time() < deadline:
+            time.sleep(0.02)
+        self.assertEqual(resent, [True])
+        self.assertEqual(len(receiving), 1)
+        self.assertEqual(finished, [True])
+        self.assertEqual(len(os.listdir(os.path.join(self.download_dir, "notes"))), 8)
+
+    def test_progress_reported_both_ways(self):
+        """The sending and receiving pumps report bytes as they move, and
+        the receiver announces the incoming file"""
+        data = os.urandom(1024 * 1024)
+        source = self.make_source(data)
+        incoming = []
+
+        def track(meta, peer_ip):
+            control = TransferControl(park=True)
+            incoming.append((meta["name"], peer_ip, control))
+            return control
+
+        self.network_manager.incoming_handler = track
+        sender = TransferControl()
+        reports = []
+        sender.on_progress = reports.append
+        self.network_manager.send_file("127.0.0.1", source, control=sender)
+        self.wait_for(os.path.basename(source), len(data))
+        self.assertEqual(reports[-1], len(data))
+        self.assertEqual(reports, sorted(reports))
+        self.assertEqual(len(incoming), 1)
+        name, peer_ip, receiver = incoming[0]
+        self.assertEqual((name, peer_ip), (os.path.basename(source), "127.0.0.1"))
+        self.assertEqual(receiver.transferred, len(data))
+
+    def test_folder_of_small_files_reports_progress(self):
+        """Progress moves with each batch, not only at the end"""
+        tree = self.make_folder(300, 8000)
+        control = TransferControl()
+        reports = []
+        control.on_progress = reports.append
+        self.assertTrue(self.network_manager.send_file("127.0.0.1", tree, control=control))
+        self.assertGreater(len(reports), 1)
+        self.assertLess(reports[0], 2400000)
+        self.assertEqual(reports, sorted(reports))
+        self.assertEqual(reports[-1], 2400000)
+
+    def test_every_kind_of_receive_is_tracked(self):
+        """Folders, batches, deltas and deduplicated files show up on the
+        receiving side too, report their bytes as they land, and finish"""
+        incoming = []
+
+        def track(meta, peer_ip):
+            control = TransferControl(park=True)
+            reports, finished = [], []
+            control.on_progress = reports.append
+            control.on_finish = finished.append
+            incoming.append((meta["name"], meta["size"], reports, finished))
+            return control
+
+        self.network_manager.incoming_handler = track
+        tree = self.make_folder(20, 8000)
+        data = os.urandom(300000)
+        source = self.make_source(data)
+        name = os.path.basename(source)
+        self.assertTrue(self.network_manager.send_file("127.0.0.1", tree))
+        self.assertTrue(self.network_manager.send_files("127.0.0.1", [source, tree]))
+        with open(source, "r+b") as f:
+            f.write(b"edited")
+        self.assertTrue(self.network_manager.send_file_delta("127.0.0.1", source))
+        os.unlink(os.path.join(self.download_dir, name))
+        self.network_manager.dedup = True
+        self.assertTrue(self.network_manager.send_file("127.0.0.1", source))
+        self.wait_for(name, len(data))  # the sender does not wait for it
+        self.assertEqual([(n, size) for n, size, _, _ in incoming],
+                         [("notes", 160000), ("2 files", 460000),
+                          (name, len(data)), (name, len(data))])
+        for _, size, reports, finished in incoming:
+            self.assertGreater(len(reports), 1)
+            self.assertEqual(reports[-1], size)
+            self.assertEqual(finished, [True])
+        self.assertEqual(self.network_manager._incoming_controls, {})
+
+    def test_resumed_send_reports_existing_bytes(self):
+        data = os.urandom(1024 * 1024)
+        source = self.make_source(data)
+        meta = self.network_manager._transfer_meta(source, len(data))
+        part = PartialFile(os.path.join(self.download_dir, meta["name"]),
+                           len(data), meta["fp"])
+        part.write_at(0, data[:400000])
+        part.commit(0, 400000)
+        part.close()
+        reports = []
+        control = TransferControl()
+        control.on_progress = reports.append
+        self.network_manager.send_file("127.0.0.1", source, control=control)
+        self.assertEqual(reports[0], 400000)
+        self.assertEqual(reports[-1], len(data))
+
+    def test_short_legacy_upload_discarded(self):
+        with socket.create_connection(("127.0.0.1", self.network_manager.port)) as s:
+            s.sendall(struct.pack("!II", 8, 1000) + b"cut.name" + b"x" * 10)
+        time.sleep(0.3)
+        self.assertFalse(os.path.exists(os.path.join(self.download_dir, "cut.name")))
+
+    def test_legacy_header_still_received(self):
+        """Peers speaking the original unframed header are still understood"""
+        data = b"legacy payload"
+        with socket.create_connection(("127.0.0.1", self.network_manager.port)) as s:
+            s.sendall(struct.pack("!II", 8, len(data)) + b"old.name" + data)
+        path = self.wait_for("old.name", len(data))
+        with open(path, "rb") as f:
+            self.assertEqual(f.read(), data)
+
+    def test_receive_reuses_pooled_buffers(self):
+        pool = self.network_manager.buffer_pool
+        for _ in range(3):
+            source = self.make_source(os.urandom(300000))
+            self.network_manager.send_file("127.0.0.1", source)
+            self.wait_for(os.path.basename(source), 300000)
+        self.assertEqual(pool.misses, 0)
+        self.assertEqual(pool.available(), pool.capacity)
+
+
 if __name__ == "__main__":
     unittest.main()
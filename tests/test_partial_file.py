@@ -0,0 +1,116 @@
+import unittest
+import os
+import shutil
+import tempfile
+import threading
+
+from src.logic.partial_file import PartialFile, add_range, missing_ranges
+
+
+class TestRanges(unittest.TestCase):
+    def test_add_range_merges(self):
+        ranges = []
+        ranges = add_range(ranges, 10, 20)
+        ranges = add_range(ranges, 30, 40)
+        self.assertEqual(ranges, [[10, 20], [30, 40]])
+        ranges = add_range(ranges, 0, 5)
+        self.assertEqual(ranges, [[0, 5], [10, 20], [30, 40]])
+        ranges = add_range(ranges, 20, 30)
+        self.assertEqual(ranges, [[0, 5], [10, 40]])
+
+    def test_missing_ranges(self):
+        self.assertEqual(missing_ranges([], 100), [[0, 100]])
+        self.assertEqual(missing_ranges([[0, 5], [10, 40]], 50),
+                         [[5, 10], [40, 50]])
+        self.assertEqual(missing_ranges([[0, 50]], 50), [])
+
+
+class TestPartialFile(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.dir, "out.bin")
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def test_preallocates(self):
+        part = PartialFile(self.path, 12345)
+        self.assertEqual(os.path.getsize(part.part_path), 12345)
+        part.close()
+
+    def test_out_of_order_concurrent_writes(self):
+        """Ranges written from several threads land at their offsets"""
+        data = os.urandom(64 * 1000)
+        part = PartialFile(self.path, len(data))
+        done = []
+
+        def write(start):
+            for offset in range(start, len(data), 4000):
+                part.write_at(offset, data[offset:offset + 1000])
+                done.append(part.commit(offset, 1000))
+
+        threads = [threading.Thread(target=write, args=(i * 1000,)) for i in range(4)]
+        for t in reversed(threads):
+            t.start()
+        for t in threads:
+            t.join()
+        part.close()
+        self.assertEqual(done.count(True), 1)
+        self.assertFalse(os.path.exists(part.part_path))
+        with open(self.path, "rb") as f:
+            self.assertEqual(f.read(), data)
+
+    def test_resume_from_manifest(self):
+        """An interrupted file reopens with its committed ranges intact"""
+        data = os.urandom(10000)
+        part = PartialFile(self.path, len(data), "fp1")
+        part.write_at(0, data[:3000])
+        part.commit(0, 3000)
+        part.write_at(7000, data[7000:])
+        part.commit(7000, 3000)
+        part.close()
+        self.assertTrue(os.path.exists(part.manifest_path))
+        self.assertFalse(os.path.exists(self.path))
+
+        part = PartialFile(self.path, len(data), "fp1")
+        self.assertEqual(part.missing(), [[3000, 7000]])
+        part.write_at(3000, data[3000:7000])
+        self.assertTrue(part.commit(3000, 4000))
+        part.close()
+        self.assertFalse(os.path.exists(part.manifest_path))
+        with open(self.path, "rb") as f:
+            self.assertEqual(f.read(), data)
+
+    def test_changed_source_restarts(self):
+        """A different fingerprint discards the old partial data"""
+        part = PartialFile(self.path, 100, "old")
+        part.write_at(0, b"x" * 50)
+        part.commit(0, 50)
+        part.close()
+        part = PartialFile(self.path, 100, "new")
+        self.assertEqual(part.missing(), [[0, 100]])
+        part.close()
+
+
+    def test_rejected_ranges_settle(self):
+        """wait_settled returns once every range is committed or rejected"""
+        part = PartialFile(self.path, 300)
+        part.commit(0, 100)
+        self.assertFalse(part.wait_settled([[0, 300]], timeout=0.05))
+        timer = threading.Timer(0.05, part.reject, args=(100, 100))
+        timer.start()
+        part.commit(200, 100)
+        self.assertTrue(part.wait_settled([[0, 300]], timeout=2))
+        timer.join()
+        self.assertEqual(part.missing(), [[100, 200]])
+        self.assertEqual(part.rejected, [])
+        part.close()
+
+    def test_read_at(self):
+        part = PartialFile(self.path, 100)
+        part.write_at(10, b"abc")
+        self.assertEqual(part.read_at(9, 5), b"\0abc\0")
+        part.close()
+
+if __name__ == "__main__":
+    unittest.main()
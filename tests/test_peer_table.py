@@ -0,0 +1,125 @@
+import unittest
+import socket
+import threading
+import time
+
+from src.logic.interfaces import InterfaceRegistry
+from src.logic.network import CAPABILITIES, DISCOVERY_MAGIC
+from src.logic.peer_table import PeerTable, TimerWheel
+from tests.test_network import free_port, quiet_manager
+
+
+class TestTimerWheel(unittest.TestCase):
+    def test_keys_fire_when_due(self):
+        wheel = TimerWheel(tick=1.0, slots=8, now=100.0)
+        wheel.schedule("a", 102.5)
+        wheel.schedule("b", 105.0)
+        wheel.schedule("c", 113.0)  # a turn of the wheel later, in b's slot
+        self.assertEqual(wheel.advance(102.0), [])
+        self.assertEqual(wheel.advance(103.0), ["a"])
+        self.assertEqual(wheel.advance(112.0), ["b"])
+        self.assertEqual(len(wheel), 1)
+        self.assertEqual(wheel.advance(200.0), ["c"])
+
+    def test_reschedule_and_cancel(self):
+        wheel = TimerWheel(tick=1.0, slots=8, now=0.0)
+        wheel.schedule("a", 2.0)
+        wheel.schedule("a", 6.0)
+        wheel.schedule("b", 3.0)
+        wheel.cancel("b")
+        self.assertEqual(wheel.advance(5.0), [])
+        self.assertEqual(wheel.advance(6.0), ["a"])
+        self.assertEqual(len(wheel), 0)
+
+
+class TestPeerTable(unittest.TestCase):
+    def setUp(self):
+        self.events = []
+        self.table = PeerTable(ttl=10)
+        self.table.on_change = lambda *change: self.events.append(change)
+        self.t0 = time.monotonic()
+
+    def test_changes_reported_only_on_deltas(self):
+        meta = {"port": 5001, "name": "alice", "caps": ["swarm"]}
+        for i in range(5):
+            self.table.seen("10.0.0.2", meta, self.t0 + i)
+        self.assertEqual(self.events, [(["10.0.0.2"], [], [])])
+        self.table.seen("10.0.0.2", dict(meta, name="alice2"), self.t0 + 6)
+        self.assertEqual(self.events[-1], ([], [], ["10.0.0.2"]))
+        self.assertEqual(self.table.get("10.0.0.2").name, "alice2")
+        self.assertEqual(len(self.events), 2)
+
+    def test_silent_peers_expire(self):
+        self.table.seen("10.0.0.2", now=self.t0)
+        self.table.seen("10.0.0.3", now=self.t0)
+        for i in range(1, 30, 3):  # 10.0.0.3 keeps beaconing
+            self.table.seen("10.0.0.3", now=self.t0 + i)
+            self.table.expire(self.t0 + i)
+        self.assertEqual(list(self.table), ["10.0.0.3"])
+        self.assertIn(([], ["10.0.0.2"], []), self.events)
+        self.assertEqual(self.table.expire(self.t0 + 45), ["10.0.0.3"])
+        self.assertEqual(len(self.table), 0)
+
+    def test_peers_added_by_hand_stay(self):
+        self.table.add("10.0.0.9")
+        self.table.seen("10.0.0.9", {"name": "nas"}, self.t0)
+        self.assertEqual(self.table.expire(self.t0 + 1000), [])
+        self.assertIn("10.0.0.9", self.table)
+        self.table.discard("10.0.0.9")
+        self.table.discard("10.0.0.9")
+        self.assertEqual(self.events, [(["10.0.0.9"], [], []), ([], [], ["10.0.0.9"]),
+                                       ([], ["10.0.0.9"], [])])
+
+    def test_advertised_metadata(self):
+        self.table.seen("10.0.0.2", {"port": 6001, "caps": ["browse"]}, self.t0)
+        self.table.seen("10.0.0.3", {}, self.t0)  # an older version
+        self.assertEqual(self.table.port_of("10.0.0.2", 5001), 6001)
+        self.assertEqual(self.table.port_of("10.0.0.3", 5001), 5001)
+        self.assertFalse(self.table.supports("10.0.0.2", "relay"))
+        self.assertTrue(self.table.supports("10.0.0.3", "relay"))
+
+
+class TestDiscovery(unittest.TestCase):
+    def setUp(self):
+        self.network_manager = quiet_manager(port=free_port())
+        self.addCleanup(self.network_manager.stop)
+        self.events = []
+        self.network_manager.peers.on_change = lambda *change: self.events.append(change)
+
+    def test_beacon_carries_metadata(self):
+        nm = self.network_manager
+        nm.name = "alice"
+        beacon = nm._beacon()
+        self.assertTrue(beacon.startswith(DISCOVERY_MAGIC + b" "))
+        nm.interfaces = InterfaceRegistry(list_addresses=lambda: {"10.0.0.1", "10.1.0.1"},
+                                          route=lambda: None, watch=False)
+        nm._on_discovery_datagram(beacon, ("10.0.0.2", 5002))
+        nm._on_discovery_datagram(beacon, ("10.0.0.2", 5002))
+        nm._on_discovery_datagram(DISCOVERY_MAGIC, ("10.0.0.3", 5002))
+        nm._on_discovery_datagram(DISCOVERY_MAGIC + b" {bad", ("10.0.0.4", 5002))
+        nm._on_discovery_datagram(b"HELLO", ("10.0.0.5", 5002))
+        nm._on_discovery_datagram(beacon, ("10.0.0.1", 5002))  # our own, on either NIC
+        nm._on_discovery_datagram(beacon, ("10.1.0.1", 5002))
+        self.assertEqual(sorted(nm.get_peers()), ["10.0.0.2", "10.0.0.3"])
+        self.assertEqual(nm.get_peer_info("10.0.0.2"),
+                         {"port": nm.port, "name": "alice", "caps": CAPABILITIES})
+        self.assertEqual(nm.get_peer_info("10.0.0.3"), {"port": None, "name": None, "caps": None})
+        self.assertEqual(len(self.events), 2)
+
+    def test_connections_use_the_advertised_port(self):
+        server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.addCleanup(server.close)
+        server.bind(("127.0.0.2", 0))
+        server.listen(1)
+        accepted = []
+        threading.Thread(target=lambda: accepted.append(server.accept()), daemon=True).start()
+        self.network_manager.peers.seen("127.0.0.2", {"port": server.getsockname()[1]})
+        sock = self.network_manager.pool.acquire("127.0.0.2")
+        self.addCleanup(sock.close)
+        time.sleep(0.1)
+        self.assertEqual(len(accepted), 1)
+        accepted[0][0].close()
+
+
+if __name__ == "__main__":
+    unittest.main()
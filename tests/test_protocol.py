@@ -0,0 +1,39 @@
+import unittest
+import socket
+
+from src.logic.protocol import (
+    MAGIC, FRAME, OP_STRIPE, ProtocolError, recv_exact, recv_frame, send_frame
+)
+
+
+class TestProtocol(unittest.TestCase):
+    def setUp(self):
+        self.a, self.b = socket.socketpair()
+
+    def tearDown(self):
+        self.a.close()
+        self.b.close()
+
+    def test_frame_round_trip(self):
+        meta = {"id": "abc", "name": "f.bin", "offset": 4096, "length": 10}
+        send_frame(self.a, OP_STRIPE, meta)
+        self.assertEqual(recv_frame(self.b), (OP_STRIPE, meta))
+
+    def test_clean_eof(self):
+        self.a.close()
+        self.assertEqual(recv_frame(self.b), (None, None))
+
+    def test_truncated_frame(self):
+        self.a.sendall(FRAME.pack(OP_STRIPE, 50) + b'{"id"')
+        self.a.close()
+        with self.assertRaises(ProtocolError):
+            recv_frame(self.b)
+
+    def test_recv_exact_reassembles(self):
+        self.a.sendall(MAGIC[:2])
+        self.a.sendall(MAGIC[2:])
+        self.assertEqual(recv_exact(self.b, 4), MAGIC)
+
+
+if __name__ == "__main__":
+    unittest.main()
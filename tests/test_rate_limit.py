@@ -0,0 +1,75 @@
+import unittest
+import threading
+import time
+
+from src.logic.rate_limit import RateLimiter, TokenBucket
+
+KB = 1024
+
+
+def pump(limiter, peer_ip, seconds, chunk, totals):
+    """Push `chunk`-byte pieces through the limiter for `seconds`"""
+    deadline = time.monotonic() + seconds
+    while time.monotonic() < deadline:
+        limiter.throttle(peer_ip, chunk)
+        totals[peer_ip] = totals.get(peer_ip, 0) + chunk
+
+
+class TestTokenBucket(unittest.TestCase):
+    def test_unlimited_never_waits(self):
+        self.assertEqual(TokenBucket(0).reserve(10**9), 0)
+
+    def test_debt_becomes_delay(self):
+        bucket = TokenBucket(1000 * KB)
+        bucket.tokens = 0
+        self.assertAlmostEqual(bucket.reserve(500 * KB), 0.5, delta=0.01)
+        self.assertAlmostEqual(bucket.reserve(500 * KB), 1.0, delta=0.01)
+
+    def test_raising_rate_forgives_debt(self):
+        bucket = TokenBucket(100 * KB)
+        bucket.reserve(1000 * KB)
+        bucket.set_rate(10000 * KB)
+        self.assertEqual(bucket.reserve(100 * KB), 0)
+
+
+class TestRateLimiter(unittest.TestCase):
+    def test_global_rate_within_five_percent_over_ten_seconds(self):
+        """Several concurrent streams together stay within ±5% of the cap"""
+        rate = 2000 * KB
+        limiter = RateLimiter(rate)
+        totals = {}
+        threads = [threading.Thread(target=pump, args=(limiter, peer, 10, chunk, totals))
+                   for peer, chunk in (("10.0.0.1", 64 * KB), ("10.0.0.2", 256 * KB),
+                                       ("10.0.0.3", 8 * KB))]
+        start = time.monotonic()
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        achieved = sum(totals.values()) / (time.monotonic() - start)
+        self.assertAlmostEqual(achieved / rate, 1.0, delta=0.05)
+
+    def test_per_peer_caps(self):
+        limiter = RateLimiter(peer_rate=400 * KB)
+        limiter.set_peer_rate("10.0.0.2", 800 * KB)
+        totals = {}
+        threads = [threading.Thread(target=pump, args=(limiter, peer, 2, 32 * KB, totals))
+                   for peer in ("10.0.0.1", "10.0.0.2")]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        self.assertAlmostEqual(totals["10.0.0.1"] / 2, 400 * KB, delta=40 * KB)
+        self.assertAlmostEqual(totals["10.0.0.2"] / 2, 800 * KB, delta=80 * KB)
+
+    def test_enabled(self):
+        limiter = RateLimiter()
+        self.assertFalse(limiter.enabled)
+        limiter.set_peer_rate("10.0.0.1", 100)
+        self.assertTrue(limiter.enabled)
+        limiter.set_peer_rate("10.0.0.1", None)
+        self.assertFalse(limiter.enabled)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,128 @@
+import unittest
+import os
+import shutil
+import tempfile
+import threading
+import time
+from unittest.mock import patch
+
+from src.logic.relay import build_tree, tree_peers
+from tests.test_network import free_port, quiet_manager
+
+KB = 1024
+
+
+class TestRelayTree(unittest.TestCase):
+    def test_complete_tree_breadth_first(self):
+        tree = build_tree("abcdef", fanout=2)
+        self.assertEqual(tree, [["a", [["c", []], ["d", []]]],
+                                ["b", [["e", []], ["f", []]]]])
+        self.assertEqual(tree_peers(tree), list("acdbef"))
+        self.assertEqual(build_tree("abc", fanout=5), [["a", []], ["b", []], ["c", []]])
+        self.assertEqual(build_tree("ab", fanout=1), [["a", [["b", []]]]])
+        self.assertEqual(build_tree([]), [])
+
+
+class TestRelayLoopback(unittest.TestCase):
+    """Simulated peers on 127.0.0.2-31, each with its own download dir"""
+
+    PEERS = [f"127.0.0.{i}" for i in range(2, 32)]
+    DEAD = "127.0.0.40"  # nothing listens there
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.dir)
+        self.data = os.urandom(512 * KB + 7)
+        self.source = os.path.join(self.dir, "update.bin")
+        with open(self.source, "wb") as f:
+            f.write(self.data)
+        self.port = free_port()
+        self.sender = self.manager()
+        self.peers = {}
+        for ip in self.PEERS:
+            self.peers[ip] = self.manager(host=ip, download_dir=os.path.join(self.dir, ip))
+            os.mkdir(self.peers[ip].download_dir)
+            # Relays only forward to peers they know of
+            for other in self.PEERS + [self.DEAD]:
+                self.peers[ip].add_peer(other)
+            self.peers[ip].running = True
+            threading.Thread(target=self.peers[ip]._start_server, daemon=True).start()
+        time.sleep(0.2)
+
+    def manager(self, **kwargs):
+        network_manager = quiet_manager(port=self.port, **kwargs)
+        self.addCleanup(network_manager.stop)
+        return network_manager
+
+    def received(self, ip):
+        path = os.path.join(self.peers[ip].download_dir, "update.bin")
+        if not os.path.exists(path):
+            return None
+        with open(path, "rb") as f:
+            return f.read()
+
+    def test_every_peer_gets_the_file(self):
+        peers = self.PEERS[:7]
+        results = self.sender.relay_file(peers, self.source, fanout=2)
+        self.assertEqual(results, dict.fromkeys(peers, True))
+        for ip in peers:
+            self.assertEqual(self.received(ip), self.data)
+        # We only sent it to our two children
+        self.assertEqual(self.sender._upload_bytes, 2 * len(self.data))
+        self.assertIsNone(self.received(self.PEERS[7]))
+
+    def test_time_grows_with_depth_not_peer_count(self):
+        # Every peer's uplink capped, so the timings measure the tree and
+        # not how fast this machine copies bytes between threads
+        uplink = 2048 * KB
+        for network_manager in [self.sender, *self.peers.values()]:
+            network_manager.set_rate_limits(upload=uplink)
+        times = {}
+        for count in (2, 6, 14, 30):  # complete binary trees, 1 to 4 levels
+            start = time.monotonic()
+            results = self.sender.relay_file(self.PEERS[:count], self.source, fanout=2)
+            times[count] = time.monotonic() - start
+            self.assertTrue(all(results.values()))
+        self.assertEqual(self.received(self.PEERS[29]), self.data)
+        one_by_one = 30 * len(self.data) / uplink
+        self.assertLess(times[30], one_by_one / 3)
+        self.assertLess(times[30], 2 * times[2])
+
+    def test_unreachable_peer_is_routed_around(self):
+        # The first child of ours is not running; its children get the
+        # file from us instead
+        dead = self.DEAD
+        peers = [dead] + self.PEERS[:6]
+        results = self.sender.relay_file(peers, self.source, fanout=2)
+        self.assertFalse(results.pop(dead))
+        self.assertEqual(results, dict.fromkeys(self.PEERS[:6], True))
+        for ip in self.PEERS[:6]:
+            self.assertEqual(self.received(ip), self.data)
+
+    def test_peers_the_tree_missed_are_sent_directly(self):
+        # A relaying peer that drops its branch: they are sent the file by us
+        peers = self.PEERS[:6]
+        relay = self.peers[peers[0]]
+        with patch.object(relay, "_recv_relayed", side_effect=ConnectionResetError("gone")):
+            results = self.sender.relay_file(peers, self.source, fanout=2)
+        self.assertEqual(results, dict.fromkeys(peers, True))
+        for ip in peers:
+            self.assertEqual(self.received(ip), self.data)
+
+    def test_unknown_peers_are_not_relayed_to(self):
+        """A tree naming an address the relay does not know is not forwarded
+        at all; the sender reaches that branch itself"""
+        peers = self.PEERS[:3]
+        relay = self.peers[peers[0]]
+        relay.remove_peer(peers[1])
+        results = self.sender.relay_file(peers, self.source, fanout=1)
+        self.assertEqual(relay._upload_bytes, 0)
+        self.assertEqual(results, dict.fromkeys(peers, True))
+        for ip in peers:
+            self.assertEqual(self.received(ip), self.data)
+        # Sent by us to all three: the relay passed nothing on
+        self.assertEqual(self.sender._upload_bytes, 3 * len(self.data))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,118 @@
+import unittest
+import os
+import shutil
+import tempfile
+import threading
+import time
+from unittest.mock import patch
+
+from src.logic.network import MAX_BROWSE_PAGE
+from src.logic.remote_catalog import RemoteCatalog
+from src.logic.shared_library import SharedLibrary
+from tests.test_network import free_port, quiet_manager
+
+
+class FakeNetwork:
+    """Answers browse() like a peer sharing `names`, counting the calls"""
+
+    def __init__(self, names):
+        self.names = names
+        self.calls = []
+
+    def browse(self, peer_ip, query="", offset=0, limit=MAX_BROWSE_PAGE, substring=False):
+        self.calls.append((query, offset))
+        words = query.lower().split()
+        matched = [[i, name, 10, None, []] for i, name in enumerate(self.names)
+                   if all(w in name.lower() for w in words)]
+        return {"total": len(matched), "offset": offset,
+                "entries": matched[offset:offset + limit]}
+
+
+class TestRemoteCatalog(unittest.TestCase):
+    def setUp(self):
+        names = [f"report {i}.pdf" for i in range(50)] + [f"photo {i}.jpg" for i in range(500)]
+        self.network = FakeNetwork(names)
+        self.catalog = RemoteCatalog(self.network, page_size=100, ttl=60)
+
+    def test_repeated_query_served_from_cache(self):
+        first = self.catalog.page("10.0.0.1", "Photo")
+        self.assertEqual(self.catalog.page("10.0.0.1", "photo "), first)
+        self.assertEqual(first[0], 500)
+        self.assertEqual(len(first[1]), 100)
+        self.assertEqual(self.network.calls, [("photo", 0)])
+        self.catalog.page("10.0.0.2", "photo")  # another peer is asked
+        self.assertEqual(len(self.network.calls), 2)
+
+    def test_answers_expire(self):
+        self.catalog.ttl = 0.05
+        self.catalog.page("10.0.0.1", "photo")
+        time.sleep(0.1)
+        self.catalog.page("10.0.0.1", "photo")
+        self.assertEqual(len(self.network.calls), 2)
+
+    def test_typing_narrows_a_complete_answer_locally(self):
+        total, entries = self.catalog.page("10.0.0.1", "rep")
+        self.assertEqual(total, 50)
+        for query in ("repo", "report", "report 4", "report 42"):
+            self.catalog.page("10.0.0.1", query)
+        self.assertEqual(self.network.calls, [("rep", 0)])
+        total, entries = self.catalog.page("10.0.0.1", "report 4")
+        self.assertEqual([e["name"] for e in entries],
+                         ["report 4.pdf"] + [f"report {i}.pdf" for i in range(40, 50)])
+        # "photo" has 500 matches, more than one page holds: ask again
+        self.catalog.page("10.0.0.1", "photo")
+        self.catalog.page("10.0.0.1", "photo 4")
+        self.assertEqual(len(self.network.calls), 3)
+
+    def test_pages_fetched_on_demand(self):
+        pages = self.catalog.pages("10.0.0.1", "photo")
+        self.assertEqual(len(next(pages)), 100)
+        self.assertEqual(len(self.network.calls), 1)
+        self.assertEqual(sum(len(p) for p in pages), 400)
+        self.assertEqual([offset for _, offset in self.network.calls], [0, 100, 200, 300, 400])
+
+
+class TestBrowseLoopback(unittest.TestCase):
+    """A peer's library browsed over the framed protocol"""
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.dir)
+        with patch.object(SharedLibrary, "_stat"):  # the paths are made up
+            self.library = SharedLibrary(os.path.join(self.dir, "shared_files.db"),
+                                         rescan_interval=0)
+            self.addCleanup(self.library.stop)
+            self.library.add([f"/srv/share/report {i}.pdf" for i in range(100000)])
+            self.assertTrue(self.library.wait_idle(30))
+        self.network_manager = quiet_manager(port=free_port())
+        self.addCleanup(self.network_manager.stop)
+        self.network_manager.browse_handler = self.library.browse
+        self.network_manager.running = True
+        threading.Thread(target=self.network_manager._start_server, daemon=True).start()
+        time.sleep(0.2)
+
+    def test_100k_library_paged(self):
+        meta = self.network_manager.browse("127.0.0.1", limit=10**6)
+        self.assertEqual(meta["total"], 100000)
+        self.assertEqual(len(meta["entries"]), MAX_BROWSE_PAGE)  # capped
+        self.assertEqual(meta["entries"][0][:2], [1, "report 0.pdf"])
+
+        catalog = RemoteCatalog(self.network_manager, page_size=500)
+        total, entries = catalog.page("127.0.0.1", "report 999", page=1)
+        self.assertEqual(total, 1 + 10 + 100)
+        self.assertEqual(entries, [])
+        total, entries = catalog.page("127.0.0.1", "report 999")
+        self.assertEqual(entries[0], {"id": 1000, "name": "report 999.pdf", "size": None,
+                                      "hash": None, "tags": []})
+
+    def test_substring_search(self):
+        meta = self.network_manager.browse("127.0.0.1", "ORT 9999.", substring=True)
+        self.assertEqual({e[1] for e in meta["entries"]},
+                         {f"report {n}9999.pdf" for n in ("", 1, 2, 3, 4, 5, 6, 7, 8, 9)})
+        # A prefix search does not match inside words
+        self.assertEqual(self.network_manager.browse("127.0.0.1", "ort")["total"], 0)
+        self.assertEqual(self.network_manager.browse("127.0.0.1", "share")["total"], 0)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,167 @@
+import unittest
+import threading
+import time
+
+from src.logic.file_manager import FileManager
+from src.logic.scheduler import PRIORITY_HIGH, PRIORITY_LOW, TransferScheduler
+from src.logic.transfer_control import TransferInterrupted
+
+
+class TestTransferScheduler(unittest.TestCase):
+    def setUp(self):
+        self.file_manager = FileManager()
+        self.gate = threading.Event()
+        self.started = []
+        self.lock = threading.Lock()
+
+    def tearDown(self):
+        self.gate.set()
+
+    def job(self, name, ok=True):
+        def run():
+            with self.lock:
+                self.started.append(name)
+            self.gate.wait(5)
+            return ok
+        return run
+
+    def submit(self, scheduler, name, peer="10.0.0.1", size=100, priority=1, ok=True):
+        transfer = self.file_manager.add_transfer(name, peer, size)
+        scheduler.submit(transfer, self.job(name, ok), priority)
+        return transfer
+
+    def settle(self):
+        time.sleep(0.1)
+
+    def test_global_limit(self):
+        scheduler = TransferScheduler(self.file_manager, max_running=2, max_per_peer=5)
+        transfers = [self.submit(scheduler, f"f{i}", peer=f"10.0.0.{i}") for i in range(5)]
+        self.settle()
+        self.assertEqual(scheduler.running, 2)
+        self.assertEqual([t.status for t in transfers],
+                         ["Running", "Running", "Queued", "Queued", "Queued"])
+        self.gate.set()
+        self.assertTrue(scheduler.wait_idle(2))
+        self.assertEqual({t.status for t in transfers}, {"Completed"})
+
+    def test_per_peer_limit_lets_other_peers_through(self):
+        scheduler = TransferScheduler(self.file_manager, max_running=3, max_per_peer=1)
+        self.submit(scheduler, "a1", peer="10.0.0.1")
+        self.submit(scheduler, "a2", peer="10.0.0.1")
+        self.submit(scheduler, "b1", peer="10.0.0.2")
+        self.settle()
+        self.assertEqual(sorted(self.started), ["a1", "b1"])
+
+    def test_priority_then_fifo(self):
+        scheduler = TransferScheduler(self.file_manager, max_running=1)
+        self.submit(scheduler, "blocker")
+        self.settle()
+        self.submit(scheduler, "low", priority=PRIORITY_LOW)
+        self.submit(scheduler, "normal1")
+        self.submit(scheduler, "high", priority=PRIORITY_HIGH)
+        self.submit(scheduler, "normal2")
+        self.assertEqual([t.filename for t in scheduler.queued()],
+                         ["high", "normal1", "normal2", "low"])
+        self.gate.set()
+        self.assertTrue(scheduler.wait_idle(2))
+        self.assertEqual(self.started, ["blocker", "high", "normal1", "normal2", "low"])
+
+    def test_shortest_first(self):
+        scheduler = TransferScheduler(self.file_manager, max_running=1, policy="shortest")
+        self.submit(scheduler, "blocker")
+        self.settle()
+        for name, size in (("big", 10**9), ("small", 10), ("medium", 10**5)):
+            self.submit(scheduler, name, size=size)
+        self.assertEqual([t.filename for t in scheduler.queued()], ["small", "medium", "big"])
+
+    def test_paused_waits_and_cancelled_dropped(self):
+        scheduler = TransferScheduler(self.file_manager, max_running=1)
+        self.submit(scheduler, "blocker")
+        self.settle()
+        paused = self.submit(scheduler, "paused")
+        self.file_manager.pause_transfer("paused", "10.0.0.1")
+        self.submit(scheduler, "cancelled")
+        self.file_manager.cancel_transfer("cancelled", "10.0.0.1")
+        self.submit(scheduler, "next")
+        self.gate.set()
+        self.assertTrue(scheduler.wait_idle(2))
+        self.assertEqual(self.started, ["blocker", "next"])
+        self.assertEqual(paused.status, "Paused")
+        self.file_manager.resume_transfer("paused", "10.0.0.1")
+        self.assertEqual(paused.status, "Queued")
+        scheduler.dispatch()
+        self.assertTrue(scheduler.wait_idle(2))
+        self.assertEqual(paused.status, "Completed")
+
+    def test_pause_while_running_frees_slot_and_requeues(self):
+        scheduler = TransferScheduler(self.file_manager, max_running=1)
+        attempts = []
+
+        def job():
+            attempts.append(transfer.control.paused)
+            try:
+                transfer.control.checkpoint(5)  # a pump waiting on the network
+            except TransferInterrupted:
+                return False
+            return True
+
+        transfer = self.file_manager.add_transfer("big", "10.0.0.1", 100)
+        scheduler.submit(transfer, job)
+        self.settle()
+        self.submit(scheduler, "next")
+        self.file_manager.pause_transfer("big", "10.0.0.1")
+        self.gate.set()
+        self.assertTrue(scheduler.wait_idle(2))
+        self.assertEqual(self.started, ["next"])
+        self.assertEqual(transfer.status, "Paused")
+        self.assertEqual(scheduler.queued(), [transfer])
+
+        self.file_manager.resume_transfer("big", "10.0.0.1")
+        self.assertEqual(transfer.status, "Queued")
+        transfer.control.checkpoint = lambda delay=0: None
+        scheduler.dispatch()
+        self.assertTrue(scheduler.wait_idle(2))
+        self.assertEqual(attempts, [False, False])
+        self.assertEqual(transfer.status, "Completed")
+
+    def test_held_by_receiver_waits_for_release(self):
+        scheduler = TransferScheduler(self.file_manager, max_running=1)
+        attempts = []
+
+        def job():
+            attempts.append(transfer.control.held)
+            try:
+                transfer.control.checkpoint(5)
+            except TransferInterrupted:
+                return False
+            return True
+
+        transfer = self.file_manager.add_transfer("big", "10.0.0.1", 100)
+        scheduler.submit(transfer, job)
+        self.settle()
+        transfer.control.hold()
+        self.assertTrue(scheduler.wait_idle(2))
+        self.assertEqual(transfer.status, "Paused")
+        self.assertEqual(scheduler.queued(), [transfer])
+
+        transfer.control.release()
+        transfer.control.checkpoint = lambda delay=0: None
+        scheduler.dispatch()
+        self.assertTrue(scheduler.wait_idle(2))
+        self.assertEqual(attempts, [False, False])
+        self.assertEqual(transfer.status, "Completed")
+
+    def test_failed_job(self):
+        scheduler = TransferScheduler(self.file_manager)
+        self.gate.set()
+        transfer = self.submit(scheduler, "bad", ok=False)
+        self.assertTrue(scheduler.wait_idle(2))
+        self.assertEqual(transfer.status, "Failed")
+
+    def test_unknown_policy(self):
+        with self.assertRaises(ValueError):
+            TransferScheduler(self.file_manager, policy="random")
+
+
+if __name__ == "__main__":
+    unittest.main()
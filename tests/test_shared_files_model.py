@@ -0,0 +1,66 @@
+import unittest
+import os
+import shutil
+import sys
+import tempfile
+import time
+from unittest.mock import patch
+
+from PyQt5.QtWidgets import QApplication
+
+from src.gui.gui_models import SharedFilesModel
+from src.logic.shared_library import SharedLibrary
+
+
+class TestSharedFilesModel(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.app = QApplication.instance() or QApplication(sys.argv)
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.dir)
+        self.library = SharedLibrary(os.path.join(self.dir, "shared_files.db"),
+                                     rescan_interval=0)
+        self.addCleanup(self.library.stop)
+        self.assertTrue(self.library.wait_idle(5))
+        self.model = SharedFilesModel(self.library)
+
+    def make_file(self, name, size):
+        path = os.path.join(self.dir, name)
+        with open(path, "wb") as f:
+            f.write(b"x" * size)
+        return path
+
+    def test_sizes_fill_in_and_only_those_rows_repaint(self):
+        paths = [self.make_file(f"f{i}.txt", 2048) for i in range(5)]
+        with patch.object(SharedLibrary, "_stat"):
+            ids = self.library.add(paths)
+        self.model.reload()
+        self.assertEqual(self.model.index(3).data(), "📄 f3.txt • …")
+        changed = []
+        self.model.dataChanged.connect(
+            lambda top, bottom, roles: changed.append((top.row(), bottom.row())))
+        self.library._stat([ids[1], ids[2], ids[4]])
+        self.assertTrue(self.library.wait_idle(5))
+        self.model.sizes_changed()
+        self.assertEqual(changed, [(1, 2), (4, 4)])
+        self.assertEqual(self.model.index(1).data(), "📄 f1.txt • 2.0 KB")
+
+    def test_filter_200k_rows(self):
+        paths = [f"/nowhere/file {i} {'odd' if i % 2 else 'even'}.bin" for i in range(200000)]
+        with patch.object(SharedLibrary, "_stat"):  # the paths are made up
+            self.library.add(paths)
+        self.model.set_filter("warm up")
+        for query in ("odd", "file 1999", ""):
+            start = time.perf_counter()
+            self.model.set_filter(query)
+            self.assertLess(time.perf_counter() - start, 0.1, query)
+        self.assertEqual(self.model.rowCount(), 200000)
+        self.model.set_filter("file 1999 odd")
+        self.assertEqual(self.model.rowCount(), 1 + 5 + 50)  # 1999, 1999x, 1999xx
+        self.assertEqual(self.model.index(0).data(), "📄 file 1999 odd.bin • …")
+
+
+if __name__ == "__main__":
+    unittest.main()
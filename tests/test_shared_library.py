@@ -0,0 +1,195 @@
+import unittest
+import json
+import os
+import random
+import shutil
+import sqlite3
+import tempfile
+import time
+from unittest.mock import patch
+
+from src.logic import shared_library
+from src.logic.catalog import Catalog, file_hash
+from src.logic.shared_library import SearchIndex, SharedLibrary, tokenize
+
+
+class TestSearchIndex(unittest.TestCase):
+    def setUp(self):
+        self.index = SearchIndex()
+        for item_id, name in enumerate(["Quarterly Report 2024.pdf", "holiday_photo.jpg",
+                                        "report-draft.docx", "Photos 2023.zip"]):
+            self.index.add(item_id, name)
+
+    def test_tokenize(self):
+        self.assertEqual(tokenize("Quarterly Report_2024.PDF"),
+                         ["quarterly", "report", "2024", "pdf"])
+
+    def test_prefix_and_all_tokens(self):
+        self.assertEqual(self.index.search("rep"), {0, 2})
+        self.assertEqual(self.index.search("rep 20"), {0})
+        self.assertEqual(self.index.search("PHOTO"), {1, 3})
+        self.assertEqual(self.index.search("photo zip"), {3})
+        self.assertEqual(self.index.search("nothing"), set())
+        self.assertIsNone(self.index.search("  "))
+
+    def test_remove(self):
+        self.index.remove(0, "Quarterly Report 2024.pdf")
+        self.assertEqual(self.index.search("rep"), {2})
+        self.assertEqual(self.index.search("quarterly"), set())
+
+
+class TestSharedLibrary(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.dir)
+        self.store = os.path.join(self.dir, "shared_files.db")
+
+    def make_file(self, name, size):
+        path = os.path.join(self.dir, name)
+        with open(path, "wb") as f:
+            f.write(b"x" * size)
+        return path
+
+    def library(self):
+        library = SharedLibrary(self.store, rescan_interval=0)
+        self.addCleanup(library.stop)
+        self.assertTrue(library.wait_idle(5))
+        return library
+
+    def test_sizes_looked_up_in_background(self):
+        a = self.make_file("a.txt", 10)
+        b = self.make_file("b.txt", 2000)
+        library = self.library()
+        ids = library.add([a, b])
+        self.assertTrue(library.wait_idle(5))
+        self.assertEqual([library.size(i) for i in ids], [10, 2000])
+        self.assertEqual(library.take_changed(), set(ids))
+
+    def test_refresh_reports_only_changed_files(self):
+        a = self.make_file("a.txt", 10)
+        b = self.make_file("b.txt", 20)
+        library = self.library()
+        ids = library.add([a, b])
+        library.wait_idle(5)
+        library.take_changed()
+        library.refresh()
+        library.wait_idle(5)
+        self.assertEqual(library.take_changed(), set())
+        with open(b, "ab") as f:
+            f.write(b"more")
+        os.utime(b, ns=(time.time_ns(), time.time_ns() + 10**9))
+        library.refresh()
+        library.wait_idle(5)
+        self.assertEqual(library.take_changed(), {ids[1]})
+        self.assertEqual(library.size(ids[1]), 24)
+
+    def test_missing_files_dropped_from_imported_list(self):
+        a = self.make_file("a.txt", 10)
+        b = self.make_file("b.txt", 20)
+        with open(os.path.join(self.dir, "shared_files.json"), "w") as f:
+            json.dump([a, b], f)
+        os.unlink(b)
+        library = self.library()
+        self.assertEqual(library.paths(), [a])
+        library.stop()
+        self.assertEqual(list(Catalog(self.store).paths().values()), [a])
+
+    def test_catalog_kept_between_runs(self):
+        a = self.make_file("a.txt", 10)
+        library = self.library()
+        [item_id] = library.add([a])
+        library.set_tags(item_id, ["work", "2024"])
+        self.assertTrue(library.wait_idle(5))
+        library.stop()
+        with patch.object(SharedLibrary, "_stat"):
+            library = SharedLibrary(self.store, rescan_interval=0)
+            self.addCleanup(library.stop)
+            self.assertTrue(library.wait_idle(5))
+        self.assertEqual(library.size(item_id), 10)  # known before any stat
+        self.assertEqual(library.tags(item_id), ["work", "2024"])
+        self.assertEqual(library.search("work"), [item_id])
+        self.assertEqual(library.entries([item_id]),
+                         {item_id: (a, 10, file_hash(a), ["work", "2024"])})
+
+    def test_only_changed_files_rehashed(self):
+        a = self.make_file("a.txt", 10)
+        b = self.make_file("b.txt", 20)
+        library = self.library()
+        ids = library.add([a, b])
+        self.assertTrue(library.wait_idle(5))
+        with patch.object(shared_library, "file_hash", side_effect=file_hash) as hashed:
+            library.refresh()
+            self.assertTrue(library.wait_idle(5))
+            self.assertEqual(hashed.call_count, 0)
+            with open(b, "ab") as f:
+                f.write(b"more")
+            os.utime(b, ns=(time.time_ns(), time.time_ns() + 10**9))
+            library.refresh()
+            self.assertTrue(library.wait_idle(5))
+        self.assertEqual([call.args[0] for call in hashed.call_args_list], [b])
+        self.assertEqual(library.entries([ids[1]])[ids[1]][2], file_hash(b))
+
+    def test_scan_agrees_with_index(self):
+        library = self.library()
+        with patch.object(SharedLibrary, "_stat"):
+            ids = library.add(["/x/Quarterly Report 2024.pdf", "/report/holiday_photo.jpg",
+                               "/x/report-draft.docx", "/x/Photos 2023.zip"])
+        library.set_tags(ids[1], ["Reports"])
+        for query in ("rep", "rep 20", "PHOTO", "photo zip", "hol rep", "por", ""):
+            self.assertEqual(library._scan(query), library.search(query), query)
+
+    def test_periodic_rescan(self):
+        a = self.make_file("a.txt", 10)
+        library = SharedLibrary(self.store, rescan_interval=0.05)
+        self.addCleanup(library.stop)
+        [item_id] = library.add([a])
+        self.assertTrue(library.wait_idle(5))
+        os.unlink(a)
+        deadline = time.monotonic() + 5
+        while len(library) and time.monotonic() < deadline:
+            time.sleep(0.02)
+        self.assertEqual(library.path(item_id), None)
+
+    def test_startup_with_500k_catalog(self):
+        Catalog(self.store).close()
+        with sqlite3.connect(self.store) as db:
+            db.executemany("INSERT INTO files (path, size, mtime_ns) VALUES (?, ?, ?)",
+                           ((f"/nowhere/dir {i % 100}/report {i}.pdf", i, i)
+                            for i in range(500000)))
+        db.close()
+        with patch.object(SharedLibrary, "_stat"):  # the paths are made up
+            start = time.perf_counter()
+            library = SharedLibrary(self.store, rescan_interval=0)
+            self.addCleanup(library.stop)
+            self.assertTrue(library.wait_loaded(5))
+            self.assertLess(time.perf_counter() - start, 1.0)
+            self.assertEqual(len(library), 500000)
+            # Found by a scan or the index, depending on how far it got
+            self.assertEqual(library.search("report 499999"), [500000])
+            self.assertTrue(library.wait_idle(30))
+        self.assertEqual(library.search("report 499999"), [500000])
+        self.assertEqual(library.size(500000), 499999)
+
+    def test_search_200k_files_stays_interactive(self):
+        words = ["report", "holiday", "photo", "invoice", "backup", "draft", "music"]
+        rng = random.Random(1)
+        paths = [f"/nowhere/{rng.choice(words)}_{rng.choice(words)} {i}.pdf"
+                 for i in range(200000)]
+        with open(os.path.join(self.dir, "shared_files.json"), "w") as f:
+            json.dump(paths, f)
+        with patch.object(SharedLibrary, "_stat"):  # the paths are made up
+            library = SharedLibrary(self.store, rescan_interval=0)
+            self.addCleanup(library.stop)
+            self.assertTrue(library.wait_idle(30))
+        self.assertEqual(len(library), len(paths))
+        library.search("warm up")
+        for query in ("rep", "photo 19", "holiday draft", "123", ""):
+            start = time.perf_counter()
+            found = library.search(query)
+            self.assertLess(time.perf_counter() - start, 0.05, query)
+            self.assertTrue(found, query)
+        self.assertEqual(len(library.search("")), len(paths))
+
+
+if __name__ == "__main__":
+    unittest.main()
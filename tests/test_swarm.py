@@ -0,0 +1,205 @@
+import unittest
+import os
+import shutil
+import socket
+import tempfile
+import threading
+import time
+from contextlib import contextmanager
+from unittest.mock import patch
+
+from src.logic import swarm
+from src.logic.catalog import file_hash
+from src.logic.partial_file import PartialFile
+from src.logic.protocol import MAGIC, OP_GET, recv_frame, send_frame
+from src.logic.swarm import PiecePicker, SwarmDownload
+from src.logic.transfer_control import TransferControl
+from tests.test_network import free_port, quiet_manager
+
+PIECE = 64 * 1024
+
+
+@contextmanager
+def without_pread():
+    """Run as on Windows, whose os module has no pread() or pwrite()"""
+    saved = os.pread, os.pwrite
+    del os.pread, os.pwrite
+    try:
+        yield
+    finally:
+        os.pread, os.pwrite = saved
+
+
+class TestPiecePicker(unittest.TestCase):
+    def test_rarest_first(self):
+        picker = PiecePicker(4, done={0})
+        picker.add_peer([0, 1, 2, 3])
+        picker.add_peer([1, 2])
+        picker.add_peer([1])
+        self.assertEqual(picker.pick([0, 1, 2, 3]), 3)  # held by one peer only
+        self.assertEqual(picker.pick([0, 1, 2, 3]), 2)
+        self.assertEqual(picker.pick([1, 2]), 1)
+        self.assertIsNone(picker.pick([0]))  # nothing we need
+
+    def test_endgame_duplicates_and_first_copy_wins(self):
+        picker = PiecePicker(2)
+        for _ in range(3):
+            picker.add_peer([0, 1])
+        first, second = picker.pick([0, 1]), picker.pick([0, 1])
+        self.assertEqual({first, second}, {0, 1})
+        self.assertIn(picker.pick([0, 1]), (0, 1))  # everything is in flight
+        self.assertTrue(picker.finished(first))
+        self.assertEqual(picker.pick([0, 1]), second)
+        self.assertTrue(picker.finished(second))
+        self.assertFalse(picker.finished(second))
+        self.assertTrue(picker.complete)
+
+    def test_unique_holder(self):
+        picker = PiecePicker(3)
+        picker.add_peer([0, 1, 2])
+        picker.add_peer([0, 1])
+        self.assertTrue(picker.unique([0, 1, 2]))
+        self.assertFalse(picker.unique([0, 1]))
+
+
+class TestSwarmLoopback(unittest.TestCase):
+    """Seeders on 127.0.0.2-4 sharing one file with a downloader"""
+
+    SEEDERS = ("127.0.0.2", "127.0.0.3", "127.0.0.4")
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.dir)
+        self.data = os.urandom(160 * PIECE + 123)
+        self.source = os.path.join(self.dir, "image.iso")
+        with open(self.source, "wb") as f:
+            f.write(self.data)
+        self.digest = file_hash(self.source)
+        self.port = free_port()
+        self.seeders = {ip: self.manager(host=ip) for ip in self.SEEDERS}
+        for seeder in self.seeders.values():
+            seeder.content_handler = {self.digest: self.source}.get
+            self.serve(seeder)
+        self.download_dir = os.path.join(self.dir, "downloads")
+        os.mkdir(self.download_dir)
+        self.downloader = self.manager(download_dir=self.download_dir)
+        time.sleep(0.2)
+
+    def manager(self, **kwargs):
+        network_manager = quiet_manager(port=self.port, **kwargs)
+        self.addCleanup(network_manager.stop)
+        return network_manager
+
+    def serve(self, network_manager):
+        network_manager.running = True
+        threading.Thread(target=network_manager._start_server, daemon=True).start()
+
+    def download(self, peers=SEEDERS, control=None):
+        job = SwarmDownload(self.downloader, self.digest, "image.iso", len(self.data),
+                            peers, control, piece_size=PIECE)
+        return job, job.run()
+
+    def received(self):
+        with open(os.path.join(self.download_dir, "image.iso"), "rb") as f:
+            return f.read()
+
+    def test_pieces_come_from_every_seeder(self):
+        job, ok = self.download()
+        self.assertTrue(ok)
+        self.assertEqual(self.received(), self.data)
+        self.assertEqual(set(job.samples), set(self.SEEDERS))
+        served = sum(s._upload_bytes for s in self.seeders.values())
+        self.assertGreaterEqual(served, len(self.data))
+        self.assertEqual(self.downloader.seeds, {
+            self.digest: os.path.join(self.download_dir, "image.iso")})
+
+    def test_slow_seeder_dropped(self):
+        # Paced so the download lasts long enough to judge the slow one
+        for seeder in self.seeders.values():
+            seeder.set_rate_limits(upload=4 * 1024 * 1024)
+        self.seeders["127.0.0.4"].set_rate_limits(upload=256 * 1024)
+        start = time.monotonic()
+        job, ok = self.download()
+        self.assertTrue(ok)
+        self.assertEqual(self.received(), self.data)
+        self.assertEqual(job.dropped, ["127.0.0.4"])
+        # Far sooner than the slow seeder alone would take over its share
+        self.assertLess(time.monotonic() - start, len(self.data) / 3 / (256 * 1024))
+
+    def test_downloader_passes_pieces_on(self):
+        # A peer halfway through its own swarm download of the file
+        relay = self.manager(host="127.0.0.5", download_dir=os.path.join(self.dir, "relay"))
+        os.mkdir(relay.download_dir)
+        part = PartialFile(relay._download_path("image.iso"), len(self.data), self.digest)
+        self.addCleanup(part.close)
+        half = 20 * PIECE
+        part.write_at(0, self.data[:half])
+        part.commit(0, half)
+        relay.swarm_started(self.digest, part)
+        self.serve(relay)
+        time.sleep(0.2)
+        with patch.object(swarm, "STALL_TIMEOUT", 0.5):
+            job, ok = self.download(peers=["127.0.0.5"])
+        self.assertFalse(ok)  # it only has half
+        self.assertEqual(job.picker.done, set(range(20)))
+        job, ok = self.download(peers=["127.0.0.5", "127.0.0.2"])  # resumed
+        self.assertTrue(ok)
+        self.assertEqual(self.received(), self.data)
+
+    def test_seeding_without_pread(self):
+        relay = self.manager(host="127.0.0.5", download_dir=os.path.join(self.dir, "relay"))
+        os.mkdir(relay.download_dir)
+        part = PartialFile(relay._download_path("image.iso"), len(self.data), self.digest)
+        self.addCleanup(part.close)
+        part.write_at(0, self.data[:20 * PIECE])
+        part.commit(0, 20 * PIECE)
+        relay.swarm_started(self.digest, part)
+        self.serve(relay)
+        time.sleep(0.2)
+        with without_pread():
+            job, ok = self.download(peers=["127.0.0.5", "127.0.0.2"])
+        self.assertTrue(ok)
+        self.assertEqual(self.received(), self.data)
+        self.assertEqual(set(job.samples), {"127.0.0.5", "127.0.0.2"})
+
+    def test_content_not_matching_hash_discarded(self):
+        with open(self.source, "r+b") as f:
+            f.write(b"tampered")
+        job, ok = self.download()
+        self.assertFalse(ok)
+        self.assertFalse(os.path.exists(os.path.join(self.download_dir, "image.iso")))
+        self.assertEqual(self.downloader.seeds, {})
+
+    def test_oversized_get_refused(self):
+        """A GET for more than a piece, or past the end of the file, drops
+        the connection instead of reading it all into memory"""
+        seeder = self.seeders["127.0.0.2"]
+        for offset, length in ((0, 1 << 40), (len(self.data) - 10, 100), (-1, 10)):
+            with socket.create_connection(("127.0.0.2", self.port)) as s:
+                s.settimeout(2)
+                s.sendall(MAGIC)
+                send_frame(s, OP_GET, {"hash": self.digest, "offset": offset,
+                                       "length": length})
+                self.assertEqual(recv_frame(s), (None, None))
+        self.assertEqual(seeder._upload_bytes, 0)
+
+    def test_pause_keeps_pieces_for_resume(self):
+        for seeder in self.seeders.values():
+            seeder.set_rate_limits(upload=400 * 1024)
+        control = TransferControl()
+        threading.Timer(0.5, control.pause).start()
+        job, ok = self.download(control=control)
+        self.assertFalse(ok)
+        self.assertTrue(control.take_interrupted())
+        done = len(job.picker.done)
+        self.assertGreater(done, 0)
+        for seeder in self.seeders.values():
+            seeder.set_rate_limits(upload=0)
+        control.resume()
+        job, ok = self.download(control=control)
+        self.assertTrue(ok)
+        self.assertEqual(self.received(), self.data)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,90 @@
+import unittest
+import socket
+import threading
+import time
+
+from src.logic.transfer_control import TransferControl, TransferInterrupted
+
+
+def later(seconds, action):
+    timer = threading.Timer(seconds, action)
+    timer.start()
+    return timer
+
+
+class TestTransferControl(unittest.TestCase):
+    def test_checkpoint_passes_when_running(self):
+        TransferControl().checkpoint()
+        TransferControl(park=True).checkpoint()
+
+    def test_pause_interrupts_sender_wait(self):
+        control = TransferControl()
+        later(0.1, control.pause)
+        start = time.monotonic()
+        with self.assertRaises(TransferInterrupted):
+            control.checkpoint(5)
+        self.assertLess(time.monotonic() - start, 0.2)
+        self.assertTrue(control.take_interrupted())
+        self.assertFalse(control.take_interrupted())
+
+    def test_receiver_parks_until_resumed(self):
+        control = TransferControl(park=True)
+        control.pause()
+        later(0.2, control.resume)
+        start = time.monotonic()
+        control.checkpoint()
+        self.assertGreaterEqual(time.monotonic() - start, 0.15)
+        self.assertFalse(control.take_interrupted())
+
+    def test_park_is_bounded(self):
+        control = TransferControl(park=True, park_timeout=0.2)
+        control.pause()
+        start = time.monotonic()
+        with self.assertRaises(TransferInterrupted):
+            control.checkpoint()
+        self.assertGreaterEqual(time.monotonic() - start, 0.15)
+        self.assertTrue(control.take_interrupted())
+
+    def test_poll_does_not_wait(self):
+        control = TransferControl(park=True, park_timeout=10)
+        self.assertFalse(control.poll())
+        control.pause()
+        self.assertTrue(control.poll(5))
+        with self.assertRaises(TransferInterrupted):
+            control.poll(10)
+        sender = TransferControl()
+        sender.pause()
+        with self.assertRaises(TransferInterrupted):
+            sender.poll()
+
+    def test_cancel_unparks_receiver(self):
+        control = TransferControl(park=True)
+        control.pause()
+        later(0.1, control.cancel)
+        with self.assertRaises(TransferInterrupted):
+            control.checkpoint()
+
+    def test_cancel_wakes_blocked_socket(self):
+        """A pump stuck in recv() returns within 100 ms of cancel()"""
+        a, b = socket.socketpair()
+        self.addCleanup(a.close)
+        self.addCleanup(b.close)
+        control = TransferControl(park=True)
+        control.bind(a)
+        later(0.1, control.cancel)
+        start = time.monotonic()
+        self.assertEqual(a.recv(1), b"")
+        self.assertLess(time.monotonic() - start, 0.2)
+
+    def test_binding_after_cancel_shuts_socket(self):
+        a, b = socket.socketpair()
+        self.addCleanup(a.close)
+        self.addCleanup(b.close)
+        control = TransferControl()
+        control.cancel()
+        control.bind(a)
+        self.assertEqual(a.recv(1), b"")
+
+
+if __name__ == "__main__":
+    unittest.main()
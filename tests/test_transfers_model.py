@@ -0,0 +1,82 @@
+import unittest
+import sys
+import time
+
+from PyQt5.QtCore import QCoreApplication, QElapsedTimer
+from PyQt5.QtWidgets import QApplication
+
+from src.gui.gui_models import FRAME_RATE, Coalescer, TransfersModel
+from src.logic.file_manager import FileTransfer
+
+
+class TestTransfersModel(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.app = QApplication.instance() or QApplication(sys.argv)
+
+    def setUp(self):
+        self.transfers = [FileTransfer(f"file{i}.bin", "10.0.0.1", 1000) for i in range(1000)]
+        self.model = TransfersModel(lambda: list(self.transfers))
+        self.model.refresh()
+        self.changed = []
+        self.model.dataChanged.connect(
+            lambda top, bottom, roles: self.changed.append((top.row(), bottom.row())))
+
+    def test_rows_follow_source(self):
+        self.assertEqual(self.model.rowCount(), 1000)
+        self.assertEqual(self.model.index(5, 0).data(), "📤 file5.bin")
+        self.assertEqual(self.model.index(5, 2).data(), "Queued")
+
+    def test_only_changed_rows_repainted(self):
+        self.model.refresh()
+        self.assertEqual(self.changed, [])
+        for i in (10, 11, 500):
+            self.transfers[i].update_progress(40)
+        self.model.refresh()
+        self.assertEqual(self.changed, [(10, 11), (500, 500)])
+        self.assertEqual(self.model.index(500, TransfersModel.PROGRESS_COLUMN).data(), 40)
+
+    def test_finished_removed_and_new_appended(self):
+        removed = []
+        self.model.rowsRemoved.connect(lambda parent, first, last: removed.append((first, last)))
+        del self.transfers[100:200]
+        del self.transfers[3]
+        newcomer = FileTransfer("new.bin", "10.0.0.2", 10)
+        self.transfers.append(newcomer)
+        self.model.refresh()
+        self.assertEqual(removed, [(100, 199), (3, 3)])
+        self.assertEqual(self.model.rowCount(), 900)
+        self.assertIs(self.model.transfer(899), newcomer)
+        self.assertIs(self.model.transfer(3), self.transfers[3])
+
+    def test_refresh_with_1000_moving_transfers_fits_a_frame(self):
+        timer = QElapsedTimer()
+        timer.start()
+        for step in range(1, 11):
+            for t in self.transfers:
+                t.progress = step * 10
+            self.model.refresh()
+        self.assertLess(timer.elapsed() / 10, 1000 / FRAME_RATE)
+        self.assertEqual(len(self.changed), 10)  # one contiguous run each
+
+
+class TestCoalescer(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.app = QApplication.instance() or QApplication(sys.argv)
+
+    def test_signal_storm_capped_at_frame_rate(self):
+        calls = []
+        coalescer = Coalescer(lambda: calls.append(1))
+        deadline = time.monotonic() + 0.5
+        while time.monotonic() < deadline:
+            for _ in range(100):
+                coalescer.poke()
+            QCoreApplication.processEvents()
+        QCoreApplication.processEvents()
+        self.assertGreater(len(calls), 0)
+        self.assertLessEqual(len(calls), 0.5 * FRAME_RATE + 1)
+
+
+if __name__ == "__main__":
+    unittest.main()